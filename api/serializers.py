@@ -299,6 +299,18 @@ class VmDiskSnapSerializer(serializers.Serializer):
         return vm
 
 
+class VdiskSnapSerializer(serializers.Serializer):
+    '''
+    云硬盘快照序列化器
+    '''
+    id = serializers.IntegerField()
+    vdisk = serializers.CharField(source='vdisk_id')
+    snap = serializers.CharField()
+    size = serializers.IntegerField()
+    create_time = serializers.DateTimeField()
+    remarks = serializers.CharField()
+
+
 class PCIDeviceSerializer(serializers.Serializer):
     '''
     PCI设备序列化器
@@ -384,6 +396,27 @@ class VmDetailSerializer(serializers.ModelSerializer):
         return PCIDeviceSerializer(instance=devs, many=True, required=False).data
 
 
+class VmJobSerializer(serializers.Serializer):
+    '''
+    虚拟机异步任务序列化器
+    '''
+    id = serializers.IntegerField()
+    action = serializers.CharField(source='get_action_display')
+    vm_uuid = serializers.CharField()
+    status = serializers.IntegerField()
+    status_display = serializers.CharField(source='get_status_display')
+    step = serializers.CharField()
+    progress = serializers.SerializerMethodField()
+    attempts = serializers.IntegerField()
+    create_time = serializers.DateTimeField()
+    start_time = serializers.DateTimeField()
+    end_time = serializers.DateTimeField()
+    message = serializers.CharField()
+
+    def get_progress(self, obj):
+        return obj.get_checkpoint().get('progress')
+
+
 class VmChangePasswordSerializer(serializers.Serializer):
     """
     虚拟主机修改密码
@@ -1,3 +1,34 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from .views import parse_byte_range
+
+
+class ParseByteRangeTests(SimpleTestCase):
+    def test_start_end(self):
+        self.assertEqual(parse_byte_range('bytes=0-1023', 4096), (0, 1024))
+        self.assertEqual(parse_byte_range('bytes=100-100', 4096), (100, 101))
+
+    def test_open_end(self):
+        self.assertEqual(parse_byte_range('bytes=1024-', 4096), (1024, 4096))
+
+    def test_suffix(self):
+        self.assertEqual(parse_byte_range('bytes=-100', 4096), (3996, 4096))
+        self.assertEqual(parse_byte_range('bytes=-8192', 4096), (0, 4096))
+
+    def test_end_beyond_size(self):
+        self.assertEqual(parse_byte_range('bytes=4000-9999', 4096), (4000, 4096))
+
+    def test_unsatisfiable(self):
+        self.assertIsNone(parse_byte_range('bytes=4096-', 4096))
+        self.assertIsNone(parse_byte_range('bytes=-0', 4096))
+
+    def test_ignored(self):
+        self.assertIs(parse_byte_range('items=0-10', 4096), False)
+        self.assertIs(parse_byte_range('bytes=0-10,20-30', 4096), False)
+        self.assertIs(parse_byte_range('bytes=10', 4096), False)
+        self.assertIs(parse_byte_range('bytes=a-b', 4096), False)
+
+    def test_invalid_ignored(self):
+        self.assertIs(parse_byte_range('bytes=5-3', 4096), False)
+        self.assertIs(parse_byte_range('bytes=200-100', 4096), False)
+        self.assertIs(parse_byte_range('bytes=200--1', 4096), False)
@@ -7,6 +7,7 @@ app_name = "api"
 
 router = DefaultRouter()
 router.register(r'vms', views.VmsViewSet, basename='vms')
+router.register(r'vmjob', views.VmJobViewSet, basename='vmjob')
 router.register(r'center', views.CenterViewSet, basename='center')
 router.register(r'group', views.GroupViewSet, basename='group')
 router.register(r'host', views.HostViewSet, basename='host')
@@ -1,3 +1,7 @@
+import time
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, BasePermission
@@ -11,13 +15,15 @@ from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from drf_yasg.utils import swagger_auto_schema, no_body
 from drf_yasg import openapi
 
-from vms.manager import VmManager, VmAPI, VmError, FlavorManager
+from vms.manager import VmManager, VmAPI, VmError, FlavorManager, VmJobManager
+from vms.models import VmJob
 from novnc.manager import NovncTokenManager, NovncError
 from compute.models import Center, Group, Host
 from compute.managers import HostManager, CenterManager, GroupManager, ComputeError
 from network.managers import VlanManager
 from network.managers import MacIPManager
 from image.managers import ImageManager
+from image.models import Image
 from vdisk.models import Vdisk
 from vdisk.manager import VdiskManager, VdiskError
 from device.manager import PCIDeviceManager, DeviceError
@@ -68,6 +74,144 @@ def str_to_int_or_default(val, default):
         return default
 
 
+def iter_stream(stream, chunk_size: int = 4 * 1024**2):
+    """
+    分块读取数据流
+
+    :param stream: 有read()方法的数据流，如请求体
+    :param chunk_size: 每块大小
+    :return:
+        generator   # bytes
+    """
+    while True:
+        data = stream.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+def parse_byte_range(range_header: str, size: int):
+    """
+    解析请求头Range，只支持单个范围
+
+    :param range_header: 如 "bytes=0-1023"
+    :param size: 数据总大小
+    :return:
+        (start, end)    # 范围[start, end)
+        None            # 范围有效但无法满足
+        False           # 不是单个有效的bytes范围，忽略Range
+    """
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return False
+
+    start, sep, end = ranges.strip().partition('-')
+    if not sep:
+        return False
+    try:
+        if start:
+            start = int(start)
+            if end:
+                end = int(end) + 1
+                if end <= start:    # last-byte-pos < first-byte-pos，语法无效
+                    return False
+            else:
+                end = size
+        else:   # 最后N个字节
+            start = size - int(end)
+            end = size
+    except ValueError:
+        return False
+
+    start = max(start, 0)
+    end = min(end, size)
+    if start >= end:
+        return None
+
+    return start, end
+
+
+class RbdExportStream:
+    """
+    rbd image数据流，响应结束时关闭读取对象
+    """
+    def __init__(self, reader, start: int, end: int):
+        self._reader = reader
+        self._iter = reader.iter_range(start, end)
+
+    def __iter__(self):
+        return self._iter
+
+    def close(self):
+        self._iter.close()      # 先等待未完成的异步读
+        self._reader.close()
+
+
+def rbd_export_response(request, reader, filename: str):
+    """
+    流式导出rbd image数据的响应，支持Range请求断点续传
+
+    :param reader: RbdImageStreamReader()
+    :param filename: 下载的文件名
+    :return:
+        StreamingHttpResponse()
+    """
+    size = reader.size
+    start, end = 0, size
+    byte_range = parse_byte_range(request.META.get('HTTP_RANGE', ''), size) if 'HTTP_RANGE' in request.META else False
+    if byte_range is None:
+        reader.close()
+        response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range:
+        start, end = byte_range
+
+    response = StreamingHttpResponse(RbdExportStream(reader=reader, start=start, end=end),
+                                     content_type='application/octet-stream')
+    if byte_range:
+        response.status_code = status.HTTP_206_PARTIAL_CONTENT
+        response['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    response['Content-Length'] = end - start
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+ASYNC_PARAMETER = openapi.Parameter(
+    name='async',
+    in_=openapi.IN_QUERY,
+    type=openapi.TYPE_BOOLEAN,
+    required=False,
+    description='true:提交异步任务，立即返回任务信息（http code 202），通过vmjob接口查询任务进度'
+)
+
+
+def is_async_request(request):
+    return request.query_params.get('async', '').lower() == 'true'
+
+
+def add_vm_job_response(action: int, user, vm_uuid: str = '', **params):
+    """
+    添加虚拟机异步任务，返回任务信息
+
+        http code 202:
+        {
+            "code": 202,
+            "code_text": "任务已提交",
+            "job": {}
+        }
+    """
+    try:
+        job = VmJobManager().add_job(action=action, user=user, vm_uuid=vm_uuid, **params)
+    except VmError as e:
+        return Response(data=e.data(), status=e.code)
+
+    return Response(data={'code': 202, 'code_text': '任务已提交', 'job': serializers.VmJobSerializer(job).data},
+                    status=status.HTTP_202_ACCEPTED)
+
+
 class IsSuperUser(BasePermission):
     """
     Allows access only to super users.
@@ -467,10 +611,12 @@ class VmsViewSet(viewsets.GenericViewSet):
                 type=openapi.TYPE_STRING,
                 required=False,
                 description='指定分配IP类型，可选值public（公网）、 private（私网）'
-            )
+            ),
+            ASYNC_PARAMETER
         ],
         responses={
-            201: ''
+            201: '',
+            202: '已提交异步任务'
         }
     )
     def create(self, request, *args, **kwargs):
@@ -510,6 +656,10 @@ class VmsViewSet(viewsets.GenericViewSet):
                 validated_data['vcpu'] = flavor.vcpus
                 validated_data['mem'] = flavor.ram
 
+        if is_async_request(request):
+            return add_vm_job_response(action=VmJob.ACTION_CREATE, user=request.user, ip_public=ip_public,
+                                       **validated_data)
+
         api = VmAPI()
         try:
             vm = api.create_vm(user=request.user, **validated_data, ip_public=ip_public)
@@ -561,10 +711,12 @@ class VmsViewSet(viewsets.GenericViewSet):
                 type=openapi.TYPE_BOOLEAN,
                 required=False,
                 description='true:强制删除'
-            )
+            ),
+            ASYNC_PARAMETER
         ],
         responses={
-            204: 'SUCCESS NO CONTENT'
+            204: 'SUCCESS NO CONTENT',
+            202: '已提交异步任务'
         }
     )
     def destroy(self, request, *args, **kwargs):
@@ -585,6 +737,9 @@ class VmsViewSet(viewsets.GenericViewSet):
         force = request.query_params.get('force', '').lower()
         force = True if force == 'true' else False
 
+        if is_async_request(request):
+            return add_vm_job_response(action=VmJob.ACTION_DELETE, user=request.user, vm_uuid=vm_uuid, force=force)
+
         api = VmAPI()
         try:
              api.delete_vm(user=request.user, vm_uuid=vm_uuid, force=force)
@@ -599,7 +754,8 @@ class VmsViewSet(viewsets.GenericViewSet):
             200: '''
                 {
                     "code": 200,
-                    "code_text": "修改虚拟机成功"
+                    "code_text": "修改虚拟机成功",
+                    "live": true
                 }
             '''
         }
@@ -608,12 +764,14 @@ class VmsViewSet(viewsets.GenericViewSet):
         '''
         修改虚拟机vcpu和内存大小
 
-            指定flavor或者直接指定vcpu和mem, 优先使用flavor
+            指定flavor或者直接指定vcpu和mem, 优先使用flavor；
+            运行中的虚拟机在xml模板配置的最大vcpu和内存内热调整，不能热调整时重启虚拟机后生效
 
             http code 200 修改成功：
             {
                 "code": 200,
-                "code_text": "修改虚拟机成功"
+                "code_text": "修改虚拟机成功",
+                "live": true        # false: 虚拟机运行中不能热调整，重启虚拟机后生效
             }
             http code 400 修改失败：
             {
@@ -660,14 +818,14 @@ class VmsViewSet(viewsets.GenericViewSet):
 
         api = VmAPI()
         try:
-            ok = api.edit_vm_vcpu_mem(user=request.user, vm_uuid=vm_uuid, mem=mem, vcpu=vcpu)
+            live = api.edit_vm_vcpu_mem(user=request.user, vm_uuid=vm_uuid, mem=mem, vcpu=vcpu)
         except VmError as e:
             return Response(data={'code': 400, 'code_text': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-        if not ok:
-            return Response(data={'code': 400, 'code_text': '修改虚拟机失败'}, status=status.HTTP_400_BAD_REQUEST)
+        if not live:
+            return Response(data={'code': 200, 'code_text': '修改虚拟机成功，重启虚拟机后生效', 'live': False})
 
-        return Response(data={'code': 200, 'code_text': '修改虚拟机成功'})
+        return Response(data={'code': 200, 'code_text': '修改虚拟机成功', 'live': True})
 
     @swagger_auto_schema(
         operation_summary='操作虚拟机',
@@ -1044,6 +1202,7 @@ class VmsViewSet(viewsets.GenericViewSet):
     @swagger_auto_schema(
         operation_summary='更换虚拟机系统',
         request_body=no_body,
+        manual_parameters=[ASYNC_PARAMETER],
         responses={
             201: '''
                 {
@@ -1069,6 +1228,10 @@ class VmsViewSet(viewsets.GenericViewSet):
         if image_id <= 0:
             return Response(data={'code': 400, 'code_text': '无效的id参数'}, status=status.HTTP_400_BAD_REQUEST)
 
+        if is_async_request(request):
+            return add_vm_job_response(action=VmJob.ACTION_CHANGE_SYS_DISK, user=request.user, vm_uuid=vm_uuid,
+                                       image_id=image_id)
+
         api = VmAPI()
         try:
             vm = api.change_sys_disk(vm_uuid=vm_uuid, image_id=image_id, user=request.user)
@@ -1081,6 +1244,21 @@ class VmsViewSet(viewsets.GenericViewSet):
     @swagger_auto_schema(
         operation_summary='迁移虚拟机到指定宿主机',
         request_body=no_body,
+        manual_parameters=[
+            ASYNC_PARAMETER,
+            openapi.Parameter(
+                name='live', in_=openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN, required=False,
+                description='true:热迁移运行中的虚拟机；默认冷迁移，需要先关闭虚拟机；热迁移耗时较长，建议同时使用async=true'
+            ),
+            openapi.Parameter(
+                name='bandwidth', in_=openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=False,
+                description='热迁移带宽限制，单位MiB/s，0不限制'
+            ),
+            openapi.Parameter(
+                name='max_downtime', in_=openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=False,
+                description='热迁移最长停机时间，单位毫秒'
+            ),
+        ],
         responses={
             201: '''
                     {
@@ -1106,9 +1284,24 @@ class VmsViewSet(viewsets.GenericViewSet):
         if host_id <= 0:
             return Response(data={'code': 400, 'code_text': '无效的host id参数'}, status=status.HTTP_400_BAD_REQUEST)
 
+        live = request.query_params.get('live', '').lower() == 'true'
+        bandwidth = str_to_int_or_default(request.query_params.get('bandwidth', ''), default=None)
+        max_downtime = str_to_int_or_default(request.query_params.get('max_downtime', ''), default=None)
+        if (bandwidth is not None and bandwidth < 0) or (max_downtime is not None and max_downtime < 0):
+            return Response(data={'code': 400, 'code_text': '无效的bandwidth或max_downtime参数'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if is_async_request(request):
+            return add_vm_job_response(action=VmJob.ACTION_MIGRATE, user=request.user, vm_uuid=vm_uuid,
+                                       host_id=host_id, live=live, bandwidth=bandwidth, max_downtime=max_downtime)
+
         api = VmAPI()
         try:
-            vm = api.migrate_vm(vm_uuid=vm_uuid, host_id=host_id, user=request.user)
+            if live:
+                vm = api.live_migrate_vm(vm_uuid=vm_uuid, host_id=host_id, user=request.user, bandwidth=bandwidth,
+                                         max_downtime=max_downtime)
+            else:
+                vm = api.migrate_vm(vm_uuid=vm_uuid, host_id=host_id, user=request.user)
         except VmError as e:
             return Response(data={'code': 400, 'code_text': f'迁移虚拟机失败，{str(e)}'},
                             status=status.HTTP_400_BAD_REQUEST)
@@ -1155,6 +1348,42 @@ class VmsViewSet(viewsets.GenericViewSet):
 
         return Response(data={'code': 200, 'code_text': '修改虚拟机登录密码成功'})
 
+    @swagger_auto_schema(
+        operation_summary='导出下载虚拟机系统盘',
+        manual_parameters=[
+            openapi.Parameter(
+                name='snap_id', in_=openapi.IN_QUERY,
+                type=openapi.TYPE_INTEGER,
+                required=False,
+                description='导出系统盘快照的id，默认导出系统盘当前数据（虚拟机需要关机）'
+            ),
+        ],
+        responses={
+            200: 'raw格式的系统盘数据',
+            206: '请求头Range指定范围的数据',
+        }
+    )
+    @action(methods=['get'], url_path='export', detail=True, url_name='vm-export')
+    def vm_export(self, request, *args, **kwargs):
+        '''
+        导出下载虚拟机系统盘，raw格式，支持请求头Range断点续传
+
+            http code 400:
+            {
+                "code": 400,
+                "code_text": "xxx"
+            }
+        '''
+        vm_uuid = kwargs.get(self.lookup_field, '')
+        snap_id = str_to_int_or_default(request.query_params.get('snap_id', 0), 0)
+        try:
+            reader, filename = VmAPI().get_sys_disk_reader(vm_uuid=vm_uuid, user=request.user, snap_id=snap_id)
+        except VmError as e:
+            return Response(data={'code': 400, 'code_text': f'导出系统盘失败，{str(e)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return rbd_export_response(request=request, reader=reader, filename=filename)
+
     def get_serializer_class(self):
         """
         Return the class to use for the serializer.
@@ -1174,6 +1403,115 @@ class VmsViewSet(viewsets.GenericViewSet):
         return Serializer
 
 
+class VmJobViewSet(viewsets.GenericViewSet):
+    '''
+    虚拟机异步任务类视图
+    '''
+    permission_classes = [IsAuthenticated, ]
+    pagination_class = LimitOffsetPagination
+    lookup_field = 'id'
+    lookup_value_regex = '[0-9]+'
+    queryset = VmJob.objects.none()
+
+    @swagger_auto_schema(
+        operation_summary='获取虚拟机异步任务列表',
+        manual_parameters=[
+            openapi.Parameter(
+                name='vm_uuid', in_=openapi.IN_QUERY, type=openapi.TYPE_STRING, required=False,
+                description='只获取指定虚拟机的任务'
+            ),
+            openapi.Parameter(
+                name='status', in_=openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=False,
+                description='任务状态，0：等待；1：执行中；2：完成；3：失败'
+            ),
+        ],
+        responses={
+            200: ''
+        }
+    )
+    def list(self, request, *args, **kwargs):
+        '''
+        获取当前用户的虚拟机异步任务列表
+
+            http code 200:
+            {
+              "count": 1,
+              "next": null,
+              "previous": null,
+              "results": [
+                {
+                  "id": 1,
+                  "action": "创建虚拟机",
+                  "vm_uuid": "4c0cdba7fe97405bac174baa03f3d036",
+                  "status": 2,
+                  "status_display": "完成",
+                  "step": "created",
+                  "attempts": 1,
+                  "create_time": "2020-03-06T14:46:27.149648+08:00",
+                  "start_time": "2020-03-06T14:46:28.149648+08:00",
+                  "end_time": "2020-03-06T14:46:37.149648+08:00",
+                  "message": ""
+                }
+              ]
+            }
+        '''
+        queryset = VmJobManager.get_job_queryset().filter(user=request.user)
+        vm_uuid = request.query_params.get('vm_uuid', '')
+        if vm_uuid:
+            queryset = queryset.filter(vm_uuid=vm_uuid.replace('-', ''))
+        job_status = str_to_int_or_default(request.query_params.get('status', ''), default=None)
+        if job_status is not None:
+            queryset = queryset.filter(status=job_status)
+
+        page = self.paginate_queryset(queryset)
+        serializer = serializers.VmJobSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @swagger_auto_schema(
+        operation_summary='查询虚拟机异步任务',
+        manual_parameters=[
+            openapi.Parameter(
+                name='wait', in_=openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=False,
+                description='任务未结束时，最多等待的秒数，期间任务状态或检查点变化时立即返回；'
+                            '最大值由settings.VM_JOB_WAIT_MAX限制'
+            ),
+        ],
+        responses={
+            200: ''
+        }
+    )
+    def retrieve(self, request, *args, **kwargs):
+        '''
+        查询虚拟机异步任务的状态和进度（检查点）
+
+            http code 200:
+            {
+              "code": 200,
+              "code_text": "获取任务信息成功",
+              "job": {}
+            }
+        '''
+        job_id = str_to_int_or_default(kwargs.get(self.lookup_field, 0), default=0)
+        manager = VmJobManager()
+        try:
+            job = manager.get_user_job(job_id=job_id, user=request.user)
+        except VmError as e:
+            return Response(data=e.data(), status=e.code)
+
+        wait = str_to_int_or_default(request.query_params.get('wait', 0), default=0)
+        wait = min(max(wait, 0), getattr(settings, 'VM_JOB_WAIT_MAX', 15))
+        deadline = time.time() + wait
+        state = (job.status, job.step)
+        while not job.is_finished and time.time() < deadline:
+            time.sleep(1)
+            job.refresh_from_db()
+            if (job.status, job.step) != state:
+                break
+
+        return Response(data={'code': 200, 'code_text': '获取任务信息成功',
+                              'job': serializers.VmJobSerializer(job).data})
+
+
 class CenterViewSet(viewsets.GenericViewSet):
     '''
     分中心类视图
@@ -1631,6 +1969,100 @@ class ImageViewSet(viewsets.GenericViewSet):
         serializer = self.get_serializer(queryset, many=True)
         return Response({'results': serializer.data})
 
+    @swagger_auto_schema(
+        operation_summary='上传系统镜像',
+        request_body=no_body,
+        manual_parameters=[
+            openapi.Parameter(name='name', in_=openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True,
+                              description='镜像名称'),
+            openapi.Parameter(name='version', in_=openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True,
+                              description='系统版本信息'),
+            openapi.Parameter(name='ceph_pool_id', in_=openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=True,
+                              description='镜像存储的ceph pool id'),
+            openapi.Parameter(name='type_id', in_=openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=True,
+                              description='镜像类型id'),
+            openapi.Parameter(name='xml_tpl_id', in_=openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=True,
+                              description='xml模板id'),
+            openapi.Parameter(name='sys_type', in_=openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=False,
+                              description='系统类型，默认6(其他)'),
+            openapi.Parameter(name='tag', in_=openapi.IN_QUERY, type=openapi.TYPE_INTEGER, required=False,
+                              description='镜像标签，默认2(用户镜像)'),
+            openapi.Parameter(name='desc', in_=openapi.IN_QUERY, type=openapi.TYPE_STRING, required=False,
+                              description='描述'),
+        ]
+    )
+    @action(methods=['put'], detail=False, url_path='upload', url_name='image-upload',
+            permission_classes=[IsAuthenticated, IsSuperUser])
+    def upload(self, request, *args, **kwargs):
+        '''
+        上传系统镜像，需要超级用户权限
+
+            请求体为raw格式的镜像文件数据（不支持qcow2，请先使用"qemu-img convert -O raw"转换），
+            数据直接写入新的rbd image，然后创建镜像快照
+
+            curl -X PUT -H "Authorization: ..." -T centos8.raw "http://host/api/v3/image/upload/?name=centos8&version=64bit&ceph_pool_id=1&type_id=1&xml_tpl_id=1"
+
+            http code 201:
+            {
+                "code": 201,
+                "code_text": "上传系统镜像成功",
+                "image": {}     # 镜像信息
+            }
+            http code 400:
+            {
+                "code": 400,
+                "code_text": "xxx"
+            }
+        '''
+        params = request.query_params
+        stream = request.stream     # 不能访问request.data，避免请求体被读取缓存
+        if stream is None:
+            return Response(data={'code': 400, 'code_text': '请求体没有镜像数据'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            image = ImageManager().create_image_from_stream(
+                chunks=iter_stream(stream),
+                name=params.get('name', ''), version=params.get('version', ''),
+                ceph_pool_id=str_to_int_or_default(params.get('ceph_pool_id', 0), 0),
+                type_id=str_to_int_or_default(params.get('type_id', 0), 0),
+                xml_tpl_id=str_to_int_or_default(params.get('xml_tpl_id', 0), 0),
+                sys_type=str_to_int_or_default(params.get('sys_type', Image.SYS_TYPE_OTHER), 0),
+                tag=str_to_int_or_default(params.get('tag', Image.TAG_USER), 0),
+                desc=params.get('desc', ''), user=request.user)
+        except exceptions.ImageError as e:
+            return Response(data={'code': 400, 'code_text': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(data={'code': 201, 'code_text': '上传系统镜像成功',
+                              'image': serializers.ImageSerializer(image).data}, status=status.HTTP_201_CREATED)
+
+    @swagger_auto_schema(
+        operation_summary='导出下载系统镜像',
+        responses={
+            200: 'raw格式的系统镜像数据',
+            206: '请求头Range指定范围的数据',
+        }
+    )
+    @action(methods=['get'], detail=True, url_path='export', url_name='image-export',
+            permission_classes=[IsAuthenticated, IsSuperUser])
+    def export(self, request, *args, **kwargs):
+        '''
+        导出下载系统镜像当前生效的快照，raw格式，支持请求头Range断点续传，需要超级用户权限
+
+            http code 400:
+            {
+                "code": 400,
+                "code_text": "xxx"
+            }
+        '''
+        image_id = str_to_int_or_default(kwargs.get(self.lookup_field, 0), 0)
+        try:
+            reader, filename = ImageManager().get_image_reader(image_id=image_id)
+        except exceptions.ImageError as e:
+            return Response(data={'code': 400, 'code_text': f'导出系统镜像失败，{str(e)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return rbd_export_response(request=request, reader=reader, filename=filename)
+
     def get_serializer_class(self):
         """
         Return the class to use for the serializer.
@@ -2347,6 +2779,258 @@ class VDiskViewSet(viewsets.GenericViewSet):
 
         return Response(data={'code': 200, 'code_text': '修改硬盘备注信息成功'})
 
+    @swagger_auto_schema(
+        operation_summary='导出下载硬盘',
+        responses={
+            200: 'raw格式的硬盘数据',
+            206: '请求头Range指定范围的数据',
+        }
+    )
+    @action(methods=['get'], url_path='export', detail=True, url_name='disk-export')
+    def disk_export(self, request, *args, **kwargs):
+        '''
+        导出下载未挂载的硬盘，raw格式，支持请求头Range断点续传
+
+            http code 400:
+            {
+                "code": 400,
+                "code_text": "xxx"
+            }
+        '''
+        disk_uuid = kwargs.get(self.lookup_field, '')
+        try:
+            reader, filename = VdiskManager().get_vdisk_reader(uuid=disk_uuid, user=request.user)
+        except VdiskError as e:
+            return Response(data={'code': 400, 'code_text': f'导出硬盘失败，{str(e)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return rbd_export_response(request=request, reader=reader, filename=filename)
+
+    @swagger_auto_schema(
+        operation_summary='创建硬盘快照',
+        request_body=no_body,
+        manual_parameters=[
+            openapi.Parameter(
+                name='remark',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                required=False,
+                description='快照备注信息'
+            )
+        ],
+        responses={
+            201: '''
+            {
+              "code": 201,
+              "code_text": "创建硬盘快照成功",
+              "snap": {
+                "id": 1,
+                "vdisk": "0bd3c7c4d0ee4b9ba29e29e9dd2cb7b9",
+                "snap": "0bd3c7c4d0ee4b9ba29e29e9dd2cb7b9-20201020_073930",
+                "size": 100,
+                "create_time": "2020-10-20T15:39:30.149648+08:00",
+                "remarks": "xxx"
+              }
+            }
+            ''',
+            400: '''
+            {
+                "code": 400,
+                "code_text": "xxx"
+            }
+            '''
+        }
+    )
+    @action(methods=['post'], url_path='snap', detail=True, url_name='disk-snap')
+    def disk_snap(self, request, *args, **kwargs):
+        '''
+        创建硬盘快照，挂载中的硬盘快照为crash一致性
+        '''
+        remark = request.query_params.get('remark', '')
+        disk_uuid = kwargs.get(self.lookup_field, '')
+        try:
+            snap = VdiskManager().create_vdisk_snap(uuid=disk_uuid, user=request.user, remarks=remark)
+        except VdiskError as e:
+            return Response(data={'code': 400, 'code_text': f'创建硬盘快照失败，{str(e)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(data={'code': 201, 'code_text': '创建硬盘快照成功',
+                              'snap': serializers.VdiskSnapSerializer(snap).data}, status=status.HTTP_201_CREATED)
+
+    @swagger_auto_schema(
+        operation_summary='获取硬盘快照列表',
+        responses={
+            200: '''
+            {
+              "code": 200,
+              "code_text": "获取硬盘快照列表成功",
+              "snaps": [
+                {
+                  "id": 1,
+                  "vdisk": "0bd3c7c4d0ee4b9ba29e29e9dd2cb7b9",
+                  "snap": "0bd3c7c4d0ee4b9ba29e29e9dd2cb7b9-20201020_073930",
+                  "size": 100,
+                  "create_time": "2020-10-20T15:39:30.149648+08:00",
+                  "remarks": "xxx"
+                }
+              ]
+            }
+            '''
+        }
+    )
+    @action(methods=['get'], url_path='snaps', detail=True, url_name='disk-snaps')
+    def disk_snaps(self, request, *args, **kwargs):
+        '''
+        获取硬盘的所有快照
+        '''
+        disk_uuid = kwargs.get(self.lookup_field, '')
+        try:
+            snaps = VdiskManager().get_vdisk_snaps(uuid=disk_uuid, user=request.user)
+            data = serializers.VdiskSnapSerializer(snaps, many=True).data
+        except VdiskError as e:
+            return Response(data={'code': 400, 'code_text': f'获取硬盘快照列表失败，{str(e)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(data={'code': 200, 'code_text': '获取硬盘快照列表成功', 'snaps': data})
+
+    @swagger_auto_schema(
+        operation_summary='删除一个硬盘快照',
+        manual_parameters=[
+            openapi.Parameter(
+                name='id',
+                in_=openapi.IN_PATH,
+                type=openapi.TYPE_STRING,
+                required=True,
+                description='快照id'
+            )
+        ],
+        responses={
+            204: '''SUCCESS NO CONTENT''',
+            400: '''
+                {
+                    "code": 400,
+                    "code_text": "xxx"
+                }
+            '''
+        }
+    )
+    @action(methods=['delete'], url_path=r'snap/(?P<id>[0-9]+)', detail=False, url_name='delete-disk-snap')
+    def delete_disk_snap(self, request, *args, **kwargs):
+        '''
+        删除一个硬盘快照，有从快照创建的硬盘未flatten时不能删除
+        '''
+        snap_id = str_to_int_or_default(kwargs.get('id', '0'), default=0)
+        if snap_id <= 0:
+            return Response(data={'code': 400, 'code_text': '无效的id参数'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            VdiskManager().delete_vdisk_snap(snap_id=snap_id, user=request.user)
+        except VdiskError as e:
+            return Response(data={'code': 400, 'code_text': f'删除硬盘快照失败，{str(e)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @swagger_auto_schema(
+        operation_summary='硬盘回滚到指定快照',
+        request_body=no_body,
+        responses={
+            201: '''
+            {
+                "code": 201,
+                "code_text": "回滚硬盘成功"
+            }
+            ''',
+            400: '''
+            {
+                "code": 400,
+                "code_text": "xxx"
+            }
+            '''
+        }
+    )
+    @action(methods=['post'], url_path=r'rollback/(?P<snap_id>[0-9]+)', detail=True, url_name='disk-rollback-snap')
+    def disk_rollback_snap(self, request, *args, **kwargs):
+        '''
+        未挂载的硬盘回滚到指定快照
+        '''
+        disk_uuid = kwargs.get(self.lookup_field, '')
+        snap_id = str_to_int_or_default(kwargs.get('snap_id', '0'), default=0)
+        if snap_id <= 0:
+            return Response(data={'code': 400, 'code_text': '无效的id参数'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            VdiskManager().rollback_vdisk_to_snap(uuid=disk_uuid, snap_id=snap_id, user=request.user)
+        except VdiskError as e:
+            return Response(data={'code': 400, 'code_text': f'回滚硬盘失败，{str(e)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(data={'code': 201, 'code_text': '回滚硬盘成功'}, status=status.HTTP_201_CREATED)
+
+    @swagger_auto_schema(
+        operation_summary='从硬盘快照创建硬盘',
+        request_body=no_body,
+        manual_parameters=[
+            openapi.Parameter(
+                name='id',
+                in_=openapi.IN_PATH,
+                type=openapi.TYPE_STRING,
+                required=True,
+                description='快照id'
+            ),
+            openapi.Parameter(
+                name='size',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_INTEGER,
+                required=False,
+                description='新硬盘容量大小（GB），默认和快照时硬盘容量相同'
+            ),
+            openapi.Parameter(
+                name='remarks',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_STRING,
+                required=False,
+                description='新硬盘备注信息'
+            )
+        ],
+        responses={
+            201: '''
+            {
+                "code": 201,
+                "code_text": "从快照创建硬盘成功",
+                "vdisk": {}     # 同获取云硬盘详细信息
+            }
+            ''',
+            400: '''
+            {
+                "code": 400,
+                "code_text": "xxx"
+            }
+            '''
+        }
+    )
+    @action(methods=['post'], url_path=r'snap/(?P<id>[0-9]+)/clone', detail=False, url_name='disk-snap-clone')
+    def disk_snap_clone(self, request, *args, **kwargs):
+        '''
+        从硬盘快照创建一个新硬盘，新硬盘是快照的写时复制克隆，创建很快，容量从源硬盘的云硬盘CEPH存储池申请
+        '''
+        snap_id = str_to_int_or_default(kwargs.get('id', '0'), default=0)
+        if snap_id <= 0:
+            return Response(data={'code': 400, 'code_text': '无效的id参数'}, status=status.HTTP_400_BAD_REQUEST)
+
+        size = str_to_int_or_default(request.query_params.get('size', '0'), default=-1)
+        if size < 0:
+            return Response(data={'code': 400, 'code_text': '无效的size参数'}, status=status.HTTP_400_BAD_REQUEST)
+
+        remarks = request.query_params.get('remarks', '')
+        try:
+            vdisk = VdiskManager().create_vdisk_from_snap(snap_id=snap_id, user=request.user, size=size, remarks=remarks)
+        except VdiskError as e:
+            return Response(data={'code': 400, 'code_text': f'从快照创建硬盘失败，{str(e)}'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(data={'code': 201, 'code_text': '从快照创建硬盘成功',
+                              'vdisk': serializers.VdiskDetailSerializer(vdisk).data}, status=status.HTTP_201_CREATED)
+
     def get_serializer_class(self):
         """
         Return the class to use for the serializer.
@@ -0,0 +1,40 @@
+from django.contrib import admin, messages
+
+from .models import BackupChain, BackupRecord
+
+
+@admin.register(BackupChain)
+class BackupChainAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'disk_type', 'disk', 'ceph_pool', 'vm_uuid', 'enable', 'create_time', 'remarks')
+    search_fields = ['disk', 'vm_uuid', 'remarks']
+    list_filter = ['disk_type', 'enable']
+
+    def delete_queryset(self, request, queryset):
+        '''
+        后台管理批量删除重写， 通过每个对象的delete()方法删除，同时会删除备份文件和rbd快照
+        '''
+        for obj in queryset:
+            obj.delete()
+
+
+@admin.register(BackupRecord)
+class BackupRecordAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'chain', 'parent', 'snap', 'size', 'data_size', 'status', 'create_time', 'start_time',
+                    'end_time', 'message')
+    search_fields = ['chain__disk', 'snap']
+    list_filter = ['status']
+    list_select_related = ('chain',)
+
+    raw_id_fields = ('chain', 'parent')
+
+    def delete_queryset(self, request, queryset):
+        '''
+        后台管理批量删除重写，从最新的备份开始逐个删除，有依赖的增量备份的不能删除
+        '''
+        for obj in queryset.order_by('-id'):
+            try:
+                obj.delete()
+            except Exception as e:
+                self.message_user(request, f'备份<{obj}>删除失败，{str(e)}', level=messages.ERROR)
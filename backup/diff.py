@@ -0,0 +1,125 @@
+'''
+rbd export-diff v1格式的增量备份文件读写，与"rbd export-diff"、"rbd import-diff"命令的文件格式兼容
+
+文件格式：
+    header      b'rbd diff v1\n'
+    'f'         le32 len + from snap name, 可选
+    't'         le32 len + to snap name, 可选
+    's'         le64 image size
+    'w'         le64 offset + le64 length + data
+    'z'         le64 offset + le64 length, 区域数据为0
+    'e'         结束
+'''
+import struct
+
+
+DIFF_HEADER = b'rbd diff v1\n'
+
+_LE32 = struct.Struct('<I')
+_LE64 = struct.Struct('<Q')
+_EXTENT = struct.Struct('<QQ')
+
+
+class DiffFormatError(Exception):
+    pass
+
+
+def write_diff(fileobj, changes, size: int, from_snap: str = None, to_snap: str = None):
+    '''
+    写入一个diff文件
+
+    :param fileobj: 二进制写打开的文件对象
+    :param changes: 有变化的区域，iterable of (offset, length, data)，data为None表示区域数据为0
+    :param size: image大小
+    :param from_snap: 增量的起始快照名称，全量时为None
+    :param to_snap: 增量的结束快照名称
+    :return:
+        int     # 写入的数据区域字节数
+    :raises: RadosError
+    '''
+    fileobj.write(DIFF_HEADER)
+    for tag, name in ((b'f', from_snap), (b't', to_snap)):
+        if name:
+            name = name.encode('utf-8')
+            fileobj.write(tag + _LE32.pack(len(name)) + name)
+    fileobj.write(b's' + _LE64.pack(size))
+
+    zero_block = b''
+    data_bytes = 0
+    for offset, length, data in changes:
+        if data is not None:
+            if len(zero_block) < length:
+                zero_block = bytes(length)
+            if data != zero_block[:length]:
+                fileobj.write(b'w' + _EXTENT.pack(offset, length))
+                fileobj.write(data)
+                data_bytes += length
+                continue
+            if from_snap is None:   # 全量备份，全0的区域恢复时不需要写入
+                continue
+
+        fileobj.write(b'z' + _EXTENT.pack(offset, length))
+
+    fileobj.write(b'e')
+    return data_bytes
+
+
+def _read_exact(fileobj, n: int):
+    data = fileobj.read(n)
+    if len(data) != n:
+        raise DiffFormatError('diff文件不完整')
+    return data
+
+
+def iter_diff(fileobj, block_size: int = 4 * 1024 ** 2):
+    '''
+    读取一个diff文件，大的数据区域按块拆分，内存占用与文件大小无关
+
+    :param fileobj: 二进制读打开的文件对象
+    :return:
+        generator   # ('s', size, None), ('w', offset, data), ('z', offset, length)
+    :raises: DiffFormatError
+    '''
+    if _read_exact(fileobj, len(DIFF_HEADER)) != DIFF_HEADER:
+        raise DiffFormatError('不是rbd diff v1格式的文件')
+
+    while True:
+        tag = _read_exact(fileobj, 1)
+        if tag in (b'f', b't'):
+            n, = _LE32.unpack(_read_exact(fileobj, _LE32.size))
+            _read_exact(fileobj, n)
+        elif tag == b's':
+            size, = _LE64.unpack(_read_exact(fileobj, _LE64.size))
+            yield 's', size, None
+        elif tag == b'w':
+            offset, length = _EXTENT.unpack(_read_exact(fileobj, _EXTENT.size))
+            end = offset + length
+            while offset < end:
+                n = min(block_size, end - offset)
+                yield 'w', offset, _read_exact(fileobj, n)
+                offset += n
+        elif tag == b'z':
+            offset, length = _EXTENT.unpack(_read_exact(fileobj, _EXTENT.size))
+            yield 'z', offset, length
+        elif tag == b'e':
+            return
+        else:
+            raise DiffFormatError(f'无效的diff记录类型{tag!r}')
+
+
+def apply_diff(fileobj, writer, image_size: int):
+    '''
+    diff文件的数据写入rbd image
+
+    :param fileobj: 二进制读打开的diff文件对象
+    :param writer: RbdImageStreamWriter()，image大小应不小于image_size
+    :param image_size: image大小，超出此大小的区域忽略
+    :raises: RadosError, DiffFormatError
+    '''
+    for tag, offset, value in iter_diff(fileobj):
+        if tag == 'w':
+            writer.write_at(offset, value)
+        elif tag == 'z' and offset < image_size:
+            writer.discard(offset, min(value, image_size - offset))
+
+    writer.flush()   # 之后的diff文件可能覆盖相同的区域
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backup.managers import BackupManager, BackupError
+
+
+class Command(BaseCommand):
+    help = '增量备份虚拟机系统盘和云硬盘，硬盘第一次备份为全量备份，之后只导出相对于上一次备份有变化的数据'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--vm', action='append', default=[], dest='vm_uuids',
+            help='添加指定虚拟机系统盘的备份任务，可多次指定')
+        parser.add_argument(
+            '--vdisk', action='append', default=[], dest='vdisk_uuids',
+            help='添加指定云硬盘的备份任务，可多次指定')
+        parser.add_argument(
+            '--all', action='store_true', default=False,
+            help='为所有开启定时备份的备份链（备份过的硬盘）添加备份任务')
+        parser.add_argument(
+            '--workers', type=int, default=4, help='同时执行的备份数，默认4')
+        parser.add_argument(
+            '--pool-limit', type=int, default=0,
+            help='每个ceph pool同时执行的备份数，默认0使用配置BACKUP_POOL_CONCURRENCY')
+        parser.add_argument(
+            '--max-count', type=int, default=0, help='本次最多执行的备份任务数，默认0不限制')
+        parser.add_argument(
+            '--reset-running', type=int, default=0,
+            help='执行中超过指定小时数的任务设置为失败（执行进程异常退出的任务），默认0不处理')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers不能小于1')
+
+        manager = BackupManager()
+        if options['reset_running'] > 0:
+            count = manager.reset_running_records(hours=options['reset_running'])
+            self.stdout.write(f'{count}个执行中的任务设置为失败')
+
+        try:
+            for vm_uuid in options['vm_uuids']:
+                manager.add_vm_backup(vm_uuid=vm_uuid)
+            for uuid in options['vdisk_uuids']:
+                manager.add_vdisk_backup(uuid=uuid)
+            if options['all']:
+                count = manager.add_enabled_chain_backups()
+                self.stdout.write(f'添加了{count}个定时备份任务')
+        except BackupError as e:
+            raise CommandError(str(e))
+
+        ok_count, failed_count = manager.run_backups(
+            workers=options['workers'], pool_limit=options['pool_limit'], max_count=options['max_count'])
+        self.stdout.write(f'备份完成{ok_count}个，失败{failed_count}个')
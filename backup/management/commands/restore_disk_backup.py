@@ -0,0 +1,44 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from backup.managers import BackupManager, BackupError
+
+
+class Command(BaseCommand):
+    help = '从硬盘备份恢复到一个新的云硬盘，或恢复虚拟机的系统盘'
+
+    def add_arguments(self, parser):
+        parser.add_argument('record_id', type=int, help='备份记录id')
+        parser.add_argument(
+            '--to-vm', default='', help='恢复到指定虚拟机的系统盘，虚拟机需要关机，原系统盘的快照会被删除')
+        parser.add_argument(
+            '--to-vdisk', action='store_true', default=False, help='恢复到一个新的云硬盘')
+        parser.add_argument(
+            '--quota-id', type=int, default=None, help='新云硬盘所在的云硬盘存储池id，默认备份的云硬盘所在的存储池')
+        parser.add_argument(
+            '--username', default='', help='新云硬盘的所有者用户名')
+
+    def handle(self, *args, **options):
+        record_id = options['record_id']
+        manager = BackupManager()
+        if options['to_vm']:
+            try:
+                manager.restore_to_sys_disk(record_id=record_id, vm_uuid=options['to_vm'])
+            except BackupError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f'虚拟机<{options["to_vm"]}>的系统盘已恢复到备份<{record_id}>')
+            return
+
+        if not options['to_vdisk']:
+            raise CommandError('需要指定--to-vm或--to-vdisk')
+
+        user = get_user_model().objects.filter(username=options['username']).first()
+        if not user:
+            raise CommandError('需要用--username指定有效的新云硬盘所有者')
+
+        try:
+            vdisk = manager.restore_to_vdisk(record_id=record_id, user=user, quota=options['quota_id'],
+                                             remarks=f'从备份{record_id}恢复')
+        except BackupError as e:
+            raise CommandError(str(e))
+        self.stdout.write(f'备份<{record_id}>已恢复到新的云硬盘<{vdisk.uuid}>')
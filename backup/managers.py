@@ -0,0 +1,470 @@
+import os
+import math
+import collections
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from ceph.managers import get_rbd_manager, RadosError, RbdImageStreamWriter
+from utils.errors import BackupError
+from utils.ev_libvirt.virt import VirtError
+from vdisk.manager import VdiskManager, VdiskError
+from vdisk.models import Vdisk
+from vms.manager import VmManager, DiskFlattenManager
+from vms.models import Vm, rename_sys_disk_delete, rename_image
+from .diff import write_diff, apply_diff, DiffFormatError
+from .models import BackupChain, BackupRecord
+
+
+class BackupManager:
+    '''
+    硬盘增量备份管理器
+    '''
+    BackupError = BackupError
+
+    @staticmethod
+    def get_chain_queryset():
+        return BackupChain.objects.all()
+
+    @staticmethod
+    def get_record_queryset():
+        return BackupRecord.objects.all()
+
+    def get_or_create_vm_chain(self, vm):
+        '''
+        获取虚拟机系统盘的备份链，没有时创建
+
+        :param vm: Vm()
+        :return:
+            BackupChain()
+        :raises: BackupError
+        '''
+        try:
+            chain, created = BackupChain.objects.get_or_create(
+                disk_type=BackupChain.TYPE_SYS_DISK, disk=vm.disk,
+                defaults={'ceph_pool': vm.image.ceph_pool, 'vm_uuid': vm.hex_uuid})
+        except Exception as e:
+            raise BackupError(msg=f'获取硬盘备份链失败，{str(e)}')
+
+        return chain
+
+    def get_or_create_vdisk_chain(self, vdisk):
+        '''
+        获取云硬盘的备份链，没有时创建
+
+        :param vdisk: Vdisk()
+        :return:
+            BackupChain()
+        :raises: BackupError
+        '''
+        try:
+            chain, created = BackupChain.objects.get_or_create(
+                disk_type=BackupChain.TYPE_VDISK, disk=vdisk.uuid, defaults={'ceph_pool': vdisk.quota.cephpool})
+        except Exception as e:
+            raise BackupError(msg=f'获取硬盘备份链失败，{str(e)}')
+
+        return chain
+
+    def add_backup(self, chain):
+        '''
+        添加一个备份任务，备份链已有未完成的备份时不重复添加
+
+        :param chain: BackupChain()
+        :return:
+            (BackupRecord(), created:bool)
+        :raises: BackupError
+        '''
+        try:
+            record = chain.records.filter(
+                status__in=[BackupRecord.STATUS_WAIT, BackupRecord.STATUS_RUNNING]).first()
+            if record:
+                return record, False
+
+            record = BackupRecord(chain=chain)
+            record.save()
+        except Exception as e:
+            raise BackupError(msg=f'添加备份任务失败，{str(e)}')
+
+        return record, True
+
+    def add_vm_backup(self, vm_uuid: str):
+        '''
+        添加虚拟机系统盘备份任务
+
+        :return:
+            (BackupRecord(), created:bool)
+        :raises: BackupError
+        '''
+        vm = Vm.objects.select_related('image__ceph_pool').filter(uuid=vm_uuid).first()
+        if not vm:
+            raise BackupError(msg=f'虚拟机<{vm_uuid}>不存在')
+
+        return self.add_backup(chain=self.get_or_create_vm_chain(vm))
+
+    def add_vdisk_backup(self, uuid: str):
+        '''
+        添加云硬盘备份任务
+
+        :return:
+            (BackupRecord(), created:bool)
+        :raises: BackupError
+        '''
+        vdisk = Vdisk.objects.select_related('quota__cephpool').filter(uuid=uuid, deleted=False).first()
+        if not vdisk:
+            raise BackupError(msg=f'云硬盘<{uuid}>不存在')
+
+        return self.add_backup(chain=self.get_or_create_vdisk_chain(vdisk))
+
+    def add_enabled_chain_backups(self):
+        '''
+        为所有开启定时备份的备份链添加备份任务
+
+        :return:
+            int     # 新添加的任务数
+        :raises: BackupError
+        '''
+        count = 0
+        for chain in self.get_chain_queryset().filter(enable=True).iterator():
+            record, created = self.add_backup(chain=chain)
+            if created:
+                count += 1
+
+        return count
+
+    def reset_running_records(self, hours: int):
+        '''
+        执行中超过指定小时数的备份任务（执行任务的进程异常退出）设置为失败，rbd快照和备份文件残留由之后的备份处理
+
+        :param hours: 小时数
+        :return:
+            int     # 重置的任务数
+        '''
+        before = timezone.now() - timedelta(hours=hours)
+        return self.get_record_queryset().filter(status=BackupRecord.STATUS_RUNNING, start_time__lt=before).update(
+            status=BackupRecord.STATUS_FAILED, message='执行任务的进程异常退出', end_time=timezone.now())
+
+    def run_backups(self, workers: int = 4, pool_limit: int = 0, max_count: int = 0):
+        '''
+        并发执行等待中的备份任务，同一个ceph pool同时执行的备份数不超过pool_limit
+
+        :param workers: 同时执行的备份数
+        :param pool_limit: 每个ceph pool同时执行的备份数，默认settings.BACKUP_POOL_CONCURRENCY
+        :param max_count: 本次最多执行的任务数，默认0不限制
+        :return:
+            (ok:int, failed:int)
+        '''
+        pool_limit = pool_limit or getattr(settings, 'BACKUP_POOL_CONCURRENCY', 1)
+        qs = self.get_record_queryset().filter(status=BackupRecord.STATUS_WAIT).select_related(
+            'chain__ceph_pool__ceph').order_by('id')
+        if max_count > 0:
+            qs = qs[:max_count]
+        records = list(qs)
+
+        ok = failed = 0
+        running = {}    # {future: pool key}
+        pool_running = collections.Counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while records or running:
+                for record in list(records):
+                    if len(running) >= workers:
+                        break
+
+                    pool = record.chain.ceph_pool
+                    key = (pool.ceph_id, pool.pool_name) if pool else None  # 多个CephPool记录可能是同一个pool
+                    if pool_running[key] >= pool_limit:
+                        continue
+
+                    records.remove(record)
+                    pool_running[key] += 1
+                    running[executor.submit(self._run_backup_in_thread, record)] = key
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pool_running[running.pop(future)] -= 1
+                    if future.result():
+                        ok += 1
+                    else:
+                        failed += 1
+
+        return ok, failed
+
+    def _run_backup_in_thread(self, record):
+        try:
+            return self.run_backup(record)
+        finally:
+            connection.close()  # 线程结束，关闭线程的数据库连接
+
+    def run_backup(self, record):
+        '''
+        执行一个备份任务，创建硬盘快照，导出相对于上一个备份快照有变化的数据到备份文件；
+        上一个备份的rbd快照不再需要，备份成功后删除
+
+        :param record: BackupRecord()
+        :return:
+            True    # success
+            False   # failed
+        '''
+        now = timezone.now()
+        claimed = BackupRecord.objects.filter(id=record.id, status=BackupRecord.STATUS_WAIT).update(
+            status=BackupRecord.STATUS_RUNNING, start_time=now)
+        if not claimed:     # 已被其他进程执行
+            return False
+
+        record.status = BackupRecord.STATUS_RUNNING
+        record.start_time = now
+        chain = record.chain
+        last = chain.get_last_ok_record()
+        try:
+            pool = chain.ceph_pool
+            if pool is None:
+                raise BackupError(msg='can not get ceph pool')
+
+            rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+            parent = self._get_backup_parent(last=last, rbd=rbd)
+            snap = f'backup-{now.strftime("%Y%m%d_%H%M%S")}'
+            rbd.create_snap(image_name=chain.disk, snap_name=snap)
+            record.snap = snap
+            try:
+                self._export_diff(record=record, rbd=rbd, parent=parent)
+            except Exception:
+                try:
+                    rbd.remove_snap(image_name=chain.disk, snap=snap)
+                except RadosError:
+                    pass
+                raise
+
+            record.parent = parent
+            record.status = BackupRecord.STATUS_OK
+            record.message = '增量备份完成' if parent else '全量备份完成'
+        except (BackupError, RadosError, DiffFormatError, OSError) as e:
+            record.status = BackupRecord.STATUS_FAILED
+            record.message = str(e)
+
+        record.end_time = timezone.now()
+        try:
+            record.save(update_fields=['parent', 'snap', 'filename', 'size', 'data_size', 'status',
+                                       'message', 'end_time'])
+        except Exception:
+            pass
+
+        if last and record.status == BackupRecord.STATUS_OK:
+            last._remove_rbd_snap()
+
+        return record.status == BackupRecord.STATUS_OK
+
+    @staticmethod
+    def _get_backup_parent(last, rbd):
+        '''
+        增量备份的基础备份，没有成功的备份、基础备份的rbd快照已不存在、或增量备份数达到上限时做全量备份
+
+        :param last: 最后一个成功的备份BackupRecord()
+        :return:
+            BackupRecord()  # 增量备份
+            None            # 全量备份
+        :raises: RadosError
+        '''
+        if not last or not last.snap:
+            return None
+
+        max_depth = getattr(settings, 'BACKUP_MAX_INCREMENTALS', 0)
+        if max_depth > 0:
+            depth = 0
+            record = last
+            while record.parent_id:
+                depth += 1
+                if depth >= max_depth:
+                    return None
+                record = record.parent
+
+        snaps = [s['name'] for s in rbd.list_image_snaps(name=last.chain.disk)]
+        if last.snap not in snaps:
+            return None
+
+        return last
+
+    @staticmethod
+    def _export_diff(record, rbd, parent=None):
+        '''
+        导出备份快照相对于基础备份快照有变化的数据，写入备份文件，完成后设置record的文件和大小信息
+
+        :raises: RadosError, OSError
+        '''
+        chain = record.chain
+        os.makedirs(chain.backup_dir, exist_ok=True)
+        filename = f'{record.id}_{record.snap}.diff'
+        path = os.path.join(chain.backup_dir, filename)
+        tmp_path = path + '.tmp'
+        from_snap = parent.snap if parent else None
+        reader = rbd.open_image_reader(image_name=chain.disk, snap=record.snap)
+        try:
+            with open(tmp_path, 'wb') as f:
+                data_size = write_diff(f, reader.iter_changes(from_snap=from_snap), size=reader.size,
+                                       from_snap=from_snap, to_snap=record.snap)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        finally:
+            reader.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        record.filename = filename
+        record.size = reader.size
+        record.data_size = data_size
+
+    def get_ok_record(self, record_id: int):
+        '''
+        :return:
+            BackupRecord()
+        :raises: BackupError
+        '''
+        record = self.get_record_queryset().select_related('chain').filter(id=record_id).first()
+        if not record:
+            raise BackupError(msg=f'备份记录<{record_id}>不存在')
+
+        if record.status != BackupRecord.STATUS_OK:
+            raise BackupError(msg=f'备份记录<{record_id}>不是成功的备份')
+
+        return record
+
+    @staticmethod
+    def _apply_records(record, rbd, image_name: str):
+        '''
+        依次把全量备份和之后的增量备份写入rbd image，image大小应不小于备份的硬盘大小
+
+        :raises: BackupError
+        '''
+        image = rbd.get_rbd_image(image_name=image_name)
+        writer = RbdImageStreamWriter(image=image)
+        try:
+            for r in record.get_restore_records():
+                with open(r.file_path, 'rb') as f:
+                    apply_diff(f, writer, image_size=record.size)
+        except (RadosError, DiffFormatError, OSError) as e:
+            writer.wait_all()
+            raise BackupError(msg=f'恢复备份数据失败，{str(e)}')
+        finally:
+            rbd.close_rbd_image(image)
+
+    def restore_to_vdisk(self, record_id: int, user, quota=None, remarks: str = ''):
+        '''
+        从备份恢复到一个新的云硬盘
+
+        :param record_id: 备份记录id
+        :param user: 新云硬盘的所有者
+        :param quota: 新云硬盘所在的云硬盘CEPH存储池Quota()或id，默认备份的云硬盘所在的存储池
+        :param remarks: 备注信息
+        :return:
+            Vdisk()
+        :raises: BackupError
+        '''
+        record = self.get_ok_record(record_id=record_id)
+        if quota is None:
+            vdisk = Vdisk.objects.select_related('quota').filter(uuid=record.chain.disk).first()
+            if not vdisk:
+                raise BackupError(msg='需要指定新云硬盘的存储池')
+            quota = vdisk.quota
+
+        size = math.ceil(record.size / 1024 ** 3)
+        try:
+            vdisk = VdiskManager().create_vdisk(size=size, user=user, quota=quota, remarks=remarks)
+        except VdiskError as e:
+            raise BackupError(msg=f'创建云硬盘失败，{str(e)}')
+
+        try:
+            ceph_pool = vdisk.quota.cephpool
+            rbd = get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+            self._apply_records(record=record, rbd=rbd, image_name=vdisk.uuid)
+        except (BackupError, RadosError) as e:
+            try:
+                vdisk.delete()
+            except Exception:
+                pass
+            raise BackupError(msg=str(e))
+
+        return vdisk
+
+    def restore_to_sys_disk(self, record_id: int, vm_uuid: str):
+        '''
+        从备份恢复虚拟机系统盘，虚拟机需要关机；数据先恢复到新的rbd image，完成后替换系统盘，
+        原系统盘修改为已删除归档的名称，系统盘快照和系统盘备份链的rbd快照会被删除，备份链下一次做全量备份
+
+        :param record_id: 备份记录id
+        :param vm_uuid: 虚拟机uuid
+        :return:
+            Vm()
+        :raises: BackupError
+        '''
+        record = self.get_ok_record(record_id=record_id)
+        vm = Vm.objects.select_related('host', 'image__ceph_pool__ceph').filter(uuid=vm_uuid).first()
+        if not vm:
+            raise BackupError(msg=f'虚拟机<{vm_uuid}>不存在')
+        if vm.locked_by:
+            raise BackupError(msg=f'虚拟机正在执行{vm.locked_by}，暂不能恢复')
+
+        try:
+            run = VmManager.get_vm_domain(host_ipv4=vm.host.ipv4, vm_uuid=vm_uuid).is_running()
+        except VirtError as e:
+            raise BackupError(msg=f'获取虚拟机运行状态失败,{str(e)}')
+        if run:
+            raise BackupError(msg='虚拟机正在运行，请先关闭虚拟机')
+
+        disk_name = vm.disk
+        pool = vm.image.ceph_pool
+        data_pool = pool.data_pool if pool.has_data_pool else None
+        tmp_name = f'{disk_name}_restore'
+        rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+        try:
+            if not rbd.create_image(name=tmp_name, size=record.size, data_pool=data_pool,
+                                    features=pool.rbd_features_mask):
+                raise BackupError(msg=f'rbd image<{tmp_name}>已存在')
+            self._apply_records(record=record, rbd=rbd, image_name=tmp_name)
+        except (BackupError, RadosError) as e:
+            self._remove_image_quietly(rbd=rbd, image_name=tmp_name)
+            raise BackupError(msg=str(e))
+
+        try:
+            VmManager.detach_clone_parent_snap(vm)
+            vm.sys_snaps.delete()
+        except Exception as e:
+            self._remove_image_quietly(rbd=rbd, image_name=tmp_name)
+            raise BackupError(msg=f'删除虚拟机系统盘快照失败，{str(e)}')
+
+        ok, deleted_disk = rename_sys_disk_delete(ceph=pool.ceph, pool_name=pool.pool_name, disk_name=disk_name)
+        if not ok:
+            self._remove_image_quietly(rbd=rbd, image_name=tmp_name)
+            raise BackupError(msg='虚拟机系统盘重命名失败')
+
+        try:
+            rbd.rename_image(image_name=tmp_name, new_name=disk_name)
+        except RadosError as e:
+            rename_image(ceph=pool.ceph, pool_name=pool.pool_name, image_name=deleted_disk, new_name=disk_name)  # 原系统盘改回原名
+            raise BackupError(msg=f'替换虚拟机系统盘失败，{str(e)}')
+
+        DiskFlattenManager().clear_disk_tasks(disk=disk_name)
+        self._reset_chain_snaps(disk=disk_name, archived_disk=deleted_disk)
+        return vm
+
+    @staticmethod
+    def _reset_chain_snaps(disk: str, archived_disk: str):
+        '''
+        系统盘被替换后，备份链的rbd快照留在了归档的原系统盘上：删除快照，使归档的系统盘可以被回收；
+        备份链对应替换后的新系统盘，下一次做全量备份
+
+        :param disk: 系统盘rbd image名称
+        :param archived_disk: 归档的原系统盘rbd image名称
+        '''
+        try:
+            BackupChain.release_disk(disk_type=BackupChain.TYPE_SYS_DISK, disk=disk, image_name=archived_disk)
+        except RadosError:
+            pass
+
+    @staticmethod
+    def _remove_image_quietly(rbd, image_name: str):
+        try:
+            rbd.remove_image(image_name=image_name)
+        except RadosError:
+            pass
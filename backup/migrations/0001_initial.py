@@ -0,0 +1,57 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('ceph', '0003_auto_20200211_0931'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupChain',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('disk_type', models.SmallIntegerField(choices=[(1, '虚拟机系统盘'), (2, '云硬盘')], verbose_name='硬盘类型')),
+                ('disk', models.CharField(max_length=100, verbose_name='硬盘rbd image')),
+                ('vm_uuid', models.CharField(blank=True, default='', max_length=36, verbose_name='虚拟机UUID')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('enable', models.BooleanField(default=True, help_text='backup_disks --all时是否备份此硬盘', verbose_name='定时备份')),
+                ('remarks', models.TextField(blank=True, default='', verbose_name='备注')),
+                ('ceph_pool', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='ceph.CephPool', verbose_name='CEPH POOL')),
+            ],
+            options={
+                'verbose_name': '硬盘备份链',
+                'verbose_name_plural': '硬盘备份链',
+                'ordering': ['-id'],
+                'unique_together': {('disk_type', 'disk')},
+            },
+        ),
+        migrations.CreateModel(
+            name='BackupRecord',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('snap', models.CharField(blank=True, default='', max_length=100, verbose_name='rbd快照')),
+                ('filename', models.CharField(blank=True, default='', max_length=255, verbose_name='备份文件')),
+                ('size', models.BigIntegerField(default=0, help_text='单位Bytes', verbose_name='硬盘大小')),
+                ('data_size', models.BigIntegerField(default=0, help_text='单位Bytes', verbose_name='备份的数据大小')),
+                ('status', models.SmallIntegerField(choices=[(0, '等待'), (1, '执行中'), (2, '完成'), (3, '失败')], default=0, verbose_name='状态')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('start_time', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('end_time', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('message', models.TextField(blank=True, default='', verbose_name='执行信息')),
+                ('chain', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='records', to='backup.BackupChain', verbose_name='备份链')),
+                ('parent', models.ForeignKey(blank=True, help_text='增量备份的基础备份，为空是全量备份', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='backup.BackupRecord', verbose_name='上一个备份')),
+            ],
+            options={
+                'verbose_name': '硬盘备份记录',
+                'verbose_name_plural': '硬盘备份记录',
+                'ordering': ['-id'],
+            },
+        ),
+    ]
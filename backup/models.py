@@ -0,0 +1,181 @@
+import os
+import shutil
+
+from django.db import models
+from django.conf import settings
+
+from ceph.models import CephPool
+from ceph.managers import get_rbd_manager, RadosError
+
+
+class BackupChain(models.Model):
+    '''
+    一个硬盘（虚拟机系统盘或云硬盘）的备份记录链，第一个备份为全量备份，之后的备份为相对上一个备份快照的增量备份
+    '''
+    TYPE_SYS_DISK = 1
+    TYPE_VDISK = 2
+    CHOICES_TYPE = (
+        (TYPE_SYS_DISK, '虚拟机系统盘'),
+        (TYPE_VDISK, '云硬盘'),
+    )
+
+    id = models.AutoField(verbose_name='ID', primary_key=True)
+    disk_type = models.SmallIntegerField(verbose_name='硬盘类型', choices=CHOICES_TYPE)
+    disk = models.CharField(verbose_name='硬盘rbd image', max_length=100)
+    ceph_pool = models.ForeignKey(to=CephPool, on_delete=models.SET_NULL, null=True, verbose_name='CEPH POOL')
+    vm_uuid = models.CharField(verbose_name='虚拟机UUID', max_length=36, blank=True, default='')
+    create_time = models.DateTimeField(verbose_name='创建时间', auto_now_add=True)
+    enable = models.BooleanField(verbose_name='定时备份', default=True, help_text='backup_disks --all时是否备份此硬盘')
+    remarks = models.TextField(verbose_name='备注', default='', blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = '硬盘备份链'
+        verbose_name_plural = '硬盘备份链'
+        unique_together = ('disk_type', 'disk')
+
+    def __str__(self):
+        return f'{self.get_disk_type_display()}<{self.disk}>'
+
+    @property
+    def backup_dir(self):
+        '''备份文件所在目录'''
+        return os.path.join(settings.BACKUP_ROOT, self.disk)
+
+    def delete(self, using=None, keep_parents=False):
+        '''
+        删除备份链的所有备份记录、备份文件和rbd快照
+        '''
+        last = self.get_last_ok_record()
+        super().delete(using=using, keep_parents=keep_parents)
+        if last:
+            last._remove_rbd_snap()
+        shutil.rmtree(self.backup_dir, ignore_errors=True)
+
+    @classmethod
+    def release_disk(cls, disk_type: int, disk: str, image_name: str = None, close: bool = False):
+        '''
+        硬盘删除、重置或替换前调用：删除备份链留在硬盘上的rbd快照，有快照的rbd image移入回收站后不能被清除；
+        清除备份记录的快照名，下一次备份做全量备份
+
+        :param disk_type: 硬盘类型
+        :param disk: 硬盘rbd image名称
+        :param image_name: 快照所在的rbd image名称，默认disk（硬盘已重命名时为新名称）
+        :param close: True：硬盘已删除，关闭备份链的定时备份，备份记录保留，可以恢复到新的云硬盘
+        :raises: RadosError
+        '''
+        chain = cls.objects.select_related('ceph_pool__ceph').filter(disk_type=disk_type, disk=disk).first()
+        if not chain:
+            return
+
+        records = chain.records.exclude(snap='')
+        snaps = list(records.values_list('snap', flat=True))
+        pool = chain.ceph_pool
+        if snaps and pool:
+            rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+            _, failed = rbd.remove_snaps(image_name=image_name or disk, snaps=snaps)
+            if failed:
+                raise RadosError(f'删除备份快照失败：{";".join(f"{snap}({err})" for snap, err in failed)}')
+
+        records.update(snap='')
+        if close and chain.enable:
+            chain.enable = False
+            chain.save(update_fields=['enable'])
+
+    def get_last_ok_record(self):
+        '''
+        最后一个成功的备份记录
+
+        :return:
+            BackupRecord()
+            None
+        '''
+        return self.records.filter(status=BackupRecord.STATUS_OK).order_by('-id').first()
+
+
+class BackupRecord(models.Model):
+    '''
+    一次备份，备份文件为rbd export-diff v1格式，parent为空的是全量备份；
+    最后一个成功的备份的rbd快照保留在ceph中，作为下一次增量备份的起点
+    '''
+    STATUS_WAIT = 0
+    STATUS_RUNNING = 1
+    STATUS_OK = 2
+    STATUS_FAILED = 3
+    CHOICES_STATUS = (
+        (STATUS_WAIT, '等待'),
+        (STATUS_RUNNING, '执行中'),
+        (STATUS_OK, '完成'),
+        (STATUS_FAILED, '失败'),
+    )
+
+    id = models.AutoField(verbose_name='ID', primary_key=True)
+    chain = models.ForeignKey(to=BackupChain, on_delete=models.CASCADE, related_name='records', verbose_name='备份链')
+    parent = models.ForeignKey(to='self', on_delete=models.CASCADE, null=True, blank=True, related_name='children',
+                               verbose_name='上一个备份', help_text='增量备份的基础备份，为空是全量备份')
+    snap = models.CharField(verbose_name='rbd快照', max_length=100, blank=True, default='')
+    filename = models.CharField(verbose_name='备份文件', max_length=255, blank=True, default='')
+    size = models.BigIntegerField(verbose_name='硬盘大小', default=0, help_text='单位Bytes')
+    data_size = models.BigIntegerField(verbose_name='备份的数据大小', default=0, help_text='单位Bytes')
+    status = models.SmallIntegerField(verbose_name='状态', choices=CHOICES_STATUS, default=STATUS_WAIT)
+    create_time = models.DateTimeField(verbose_name='创建时间', auto_now_add=True)
+    start_time = models.DateTimeField(verbose_name='开始时间', null=True, blank=True)
+    end_time = models.DateTimeField(verbose_name='结束时间', null=True, blank=True)
+    message = models.TextField(verbose_name='执行信息', default='', blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = '硬盘备份记录'
+        verbose_name_plural = '硬盘备份记录'
+
+    def __str__(self):
+        return f'{self.chain.disk}@{self.snap}({self.get_status_display()})'
+
+    @property
+    def is_full(self):
+        return self.parent_id is None
+
+    @property
+    def file_path(self):
+        return os.path.join(self.chain.backup_dir, self.filename)
+
+    def get_restore_records(self):
+        '''
+        恢复到此备份需要依次应用的备份记录，从全量备份开始
+
+        :return:
+            [BackupRecord(), ]
+        '''
+        records = [self]
+        record = self
+        while record.parent_id:
+            record = record.parent
+            records.append(record)
+        records.reverse()
+        return records
+
+    def delete(self, using=None, keep_parents=False):
+        if self.children.exists():
+            raise Exception('有依赖此备份的增量备份，不能删除')
+
+        super().delete(using=using, keep_parents=keep_parents)
+        self._remove_rbd_snap()
+        if self.filename:
+            try:
+                os.remove(self.file_path)
+            except FileNotFoundError:
+                pass
+
+    def _remove_rbd_snap(self):
+        '''
+        删除备份的rbd快照，快照已不存在或删除失败时忽略
+        '''
+        pool = self.chain.ceph_pool
+        if not self.snap or not pool:
+            return
+
+        try:
+            rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+            rbd.remove_snap(image_name=self.chain.disk, snap=self.snap)
+        except (RadosError, Exception):
+            pass
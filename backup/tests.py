@@ -0,0 +1,138 @@
+import io
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+
+from ceph.models import CephCluster, CephPool
+from compute.models import Center, Group
+from vdisk.models import Quota, Vdisk
+from .diff import DIFF_HEADER, DiffFormatError, iter_diff, write_diff
+from .models import BackupChain, BackupRecord
+
+
+class DiffFileTests(SimpleTestCase):
+    def write(self, changes, size=1024, from_snap=None, to_snap='s2'):
+        f = io.BytesIO()
+        n = write_diff(f, changes, size=size, from_snap=from_snap, to_snap=to_snap)
+        return f.getvalue(), n
+
+    def test_full_round_trip(self):
+        changes = [(0, 4, b'abcd'), (8, 4, bytes(4)), (16, 2, None)]
+        data, n = self.write(changes, size=1024)
+        self.assertTrue(data.startswith(DIFF_HEADER))
+        self.assertEqual(n, 4)
+        # 全量备份全0的区域不写入，没有数据的区域记录为0
+        self.assertEqual(list(iter_diff(io.BytesIO(data))), [
+            ('s', 1024, None), ('w', 0, b'abcd'), ('z', 16, 2)])
+
+    def test_incremental_round_trip(self):
+        changes = [(0, 4, b'abcd'), (8, 4, bytes(4)), (16, 2, None)]
+        data, n = self.write(changes, size=2048, from_snap='s1')
+        self.assertIn(b'f' + len(b's1').to_bytes(4, 'little') + b's1', data)
+        self.assertEqual(n, 4)
+        self.assertEqual(list(iter_diff(io.BytesIO(data))), [
+            ('s', 2048, None), ('w', 0, b'abcd'), ('z', 8, 4), ('z', 16, 2)])
+
+    def test_split_blocks(self):
+        data, _ = self.write([(100, 10, b'0123456789')])
+        self.assertEqual(list(iter_diff(io.BytesIO(data), block_size=4)), [
+            ('s', 1024, None), ('w', 100, b'0123'), ('w', 104, b'4567'), ('w', 108, b'89')])
+
+    def test_invalid_header(self):
+        with self.assertRaises(DiffFormatError):
+            list(iter_diff(io.BytesIO(b'rbd diff v2\n')))
+
+    def test_truncated(self):
+        data, _ = self.write([(0, 4, b'abcd')])
+        with self.assertRaises(DiffFormatError):
+            list(iter_diff(io.BytesIO(data[:-3])))
+
+    def test_invalid_record(self):
+        with self.assertRaises(DiffFormatError):
+            list(iter_diff(io.BytesIO(DIFF_HEADER + b'x')))
+
+
+class FakeRbd:
+    def __init__(self):
+        self.snaps = {}     # {image_name: set(snap)}
+        self.trashed = {}   # {image_name: 移入回收站时的快照}
+        self.fail_snaps = set()
+
+    def list_image_snaps(self, name):
+        return [{'name': snap} for snap in sorted(self.snaps.get(name, ()))]
+
+    def remove_snaps(self, image_name, snaps):
+        failed = [(snap, 'error') for snap in snaps if snap in self.fail_snaps]
+        removed = [snap for snap in snaps if snap not in self.fail_snaps]
+        self.snaps.get(image_name, set()).difference_update(removed)
+        return removed, failed
+
+    def remove_snap(self, image_name, snap):
+        self.snaps.get(image_name, set()).discard(snap)
+
+    def trash_move(self, image_name, delay=0):
+        self.trashed[image_name] = set(self.snaps.pop(image_name, ()))
+
+
+class ReleaseDiskTests(TestCase):
+    def setUp(self):
+        center = Center.objects.create(name='c', location='l')
+        CephCluster.objects.bulk_create([CephCluster(name='ceph', center=center)])
+        self.pool = CephPool.objects.create(pool_name='pool', ceph=CephCluster.objects.get(name='ceph'))
+        self.quota = Quota.objects.create(name='q', group=Group.objects.create(center=center, name='g'),
+                                          cephpool=self.pool, total=100, size_used=10)
+        self.rbd = FakeRbd()
+        for target in ('backup.models.get_rbd_manager', 'vdisk.models.get_rbd_manager'):
+            p = mock.patch(target, return_value=self.rbd)
+            p.start()
+            self.addCleanup(p.stop)
+
+    def create_chain(self, disk_type, disk):
+        chain = BackupChain.objects.create(disk_type=disk_type, disk=disk, ceph_pool=self.pool)
+        full = BackupRecord.objects.create(chain=chain, snap='', status=BackupRecord.STATUS_OK)
+        BackupRecord.objects.create(chain=chain, parent=full, snap='backup-2', status=BackupRecord.STATUS_OK)
+        self.rbd.snaps[disk] = {'backup-2', 'user-snap'}
+        return chain
+
+    def test_release_sys_disk(self):
+        chain = self.create_chain(BackupChain.TYPE_SYS_DISK, 'disk1')
+        BackupChain.release_disk(disk_type=BackupChain.TYPE_SYS_DISK, disk='disk1')
+        self.assertEqual(self.rbd.snaps['disk1'], {'user-snap'})
+        self.assertFalse(chain.records.exclude(snap='').exists())
+        chain.refresh_from_db()
+        self.assertTrue(chain.enable)   # 重置系统盘后继续备份
+
+    def test_release_renamed_disk(self):
+        self.create_chain(BackupChain.TYPE_SYS_DISK, 'disk1')
+        self.rbd.snaps['x_disk1'] = self.rbd.snaps.pop('disk1')
+        BackupChain.release_disk(disk_type=BackupChain.TYPE_SYS_DISK, disk='disk1', image_name='x_disk1')
+        self.assertEqual(self.rbd.snaps['x_disk1'], {'user-snap'})
+
+    def test_release_close(self):
+        chain = self.create_chain(BackupChain.TYPE_SYS_DISK, 'disk1')
+        BackupChain.release_disk(disk_type=BackupChain.TYPE_SYS_DISK, disk='disk1', close=True)
+        chain.refresh_from_db()
+        self.assertFalse(chain.enable)
+        self.assertEqual(chain.records.count(), 2)  # 备份记录保留
+
+    def test_release_failed(self):
+        chain = self.create_chain(BackupChain.TYPE_SYS_DISK, 'disk1')
+        self.rbd.fail_snaps.add('backup-2')
+        with self.assertRaises(Exception):
+            BackupChain.release_disk(disk_type=BackupChain.TYPE_SYS_DISK, disk='disk1')
+        self.assertTrue(chain.records.filter(snap='backup-2').exists())
+
+    def test_no_chain(self):
+        BackupChain.release_disk(disk_type=BackupChain.TYPE_VDISK, disk='none')
+
+    def test_vdisk_delete(self):
+        user = get_user_model().objects.create(username='test')
+        Vdisk.objects.bulk_create([Vdisk(uuid='vdisk1', size=10, user=user, quota=self.quota)])
+        chain = self.create_chain(BackupChain.TYPE_VDISK, 'vdisk1')
+        Vdisk.objects.get(uuid='vdisk1').delete()
+
+        self.assertEqual(self.rbd.trashed, {'vdisk1': set()})  # 没有快照，回收站中的image可以被清除
+        chain.refresh_from_db()
+        self.assertFalse(chain.enable)
+        self.assertFalse(chain.records.exclude(snap='').exists())
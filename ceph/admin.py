@@ -1,4 +1,5 @@
 from django.contrib import admin
+from django.db.models import Sum
 
 from .models import CephPool, CephCluster
 
@@ -16,7 +17,17 @@ class CephClusterAdmin(admin.ModelAdmin):
 @admin.register(CephPool)
 class CephPoolAdmin(admin.ModelAdmin):
     list_display_links = ('id', 'pool_name')
-    list_display = ('id', 'pool_name', 'has_data_pool', 'data_pool', 'ceph', 'remarks')
+    list_display = ('id', 'pool_name', 'has_data_pool', 'data_pool', 'ceph', 'enable', 'image_replica', 'rbd_features',
+                    'trim_reclaimed', 'remarks')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(reclaimed=Sum('disk_trim_logs__reclaimed'))
+
+    def trim_reclaimed(self, obj):
+        return f'{(obj.reclaimed or 0) / 1024 ** 3:.2f}GB'
+
+    trim_reclaimed.short_description = 'fstrim回收的空间'
+    trim_reclaimed.admin_order_field = 'reclaimed'
     # list_filter = ['ceph']
     # search_fields = ['pool_name']
 
@@ -0,0 +1,110 @@
+import time
+from datetime import datetime
+
+import rbd
+from django.core.management.base import BaseCommand, CommandError
+
+from ceph.models import CephPool
+from ceph.managers import get_rbd_manager, RadosError
+
+
+class Command(BaseCommand):
+    help = '清除ceph pool回收站中保留期已过的rbd image；也可以列举回收站内容，或从回收站恢复rbd image'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pool-id', type=int, action='append', default=[], dest='pool_ids',
+            help='只处理指定的ceph pool，可多次指定，默认所有pool')
+        parser.add_argument(
+            '--max-count', type=int, default=0, help='本次最多清除的rbd image数，默认0不限制')
+        parser.add_argument(
+            '--interval', type=float, default=5, help='两次清除之间的间隔秒数，默认5')
+        parser.add_argument(
+            '--list', action='store_true', default=False, help='只列举回收站中的rbd image，不清除')
+        parser.add_argument(
+            '--restore', default='', help='从回收站恢复指定名称的rbd image，需要用--pool-id指定一个pool')
+        parser.add_argument(
+            '--restore-as', default='', help='恢复后的rbd image名称，默认使用原名称')
+
+    def handle(self, *args, **options):
+        pools = CephPool.objects.select_related('ceph').all()
+        if options['pool_ids']:
+            pools = pools.filter(id__in=options['pool_ids'])
+
+        if options['restore']:
+            if len(options['pool_ids']) != 1:
+                raise CommandError('恢复rbd image需要用--pool-id指定一个pool')
+            pool = pools.first()
+            if not pool:
+                raise CommandError('指定的pool不存在')
+            self.restore(pool=pool, name=options['restore'], new_name=options['restore_as'])
+            return
+
+        max_count = options['max_count']
+        interval = options['interval']
+        purged = 0
+        done = set()
+        for pool in pools:
+            key = (pool.ceph_id, pool.pool_name)   # 多个CephPool记录可能是同一个pool
+            if key in done:
+                continue
+            done.add(key)
+
+            try:
+                rbd_mgr = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+                items = rbd_mgr.trash_list()
+            except RadosError as e:
+                self.stderr.write(f'pool<{pool.pool_name}>, {str(e)}')
+                continue
+
+            if options['list']:
+                self.list_items(pool=pool, items=items)
+                continue
+
+            for item in self.expired_items(items):
+                if max_count and purged >= max_count:
+                    break
+                if purged and interval > 0:
+                    time.sleep(interval)        # 限速，避免大量删除影响ceph集群
+
+                try:
+                    rbd_mgr.trash_remove(image_id=item['id'])
+                except RadosError as e:
+                    self.stderr.write(f'pool<{pool.pool_name}>, image<{item["name"]}>, {str(e)}')
+                    continue
+
+                purged += 1
+                self.stdout.write(f'pool<{pool.pool_name}>, 清除了image<{item["name"]}>')
+
+        if not options['list']:
+            self.stdout.write(f'共清除{purged}个rbd image')
+
+    @staticmethod
+    def expired_items(items):
+        '''
+        保留期已过的用户删除的rbd image，按删除时间排序
+        '''
+        now = datetime.utcnow()
+        source_user = getattr(rbd, 'RBD_TRASH_IMAGE_SOURCE_USER', 0)
+        items = [i for i in items if i.get('source', source_user) == source_user and i['deferment_end_time'] <= now]
+        items.sort(key=lambda i: i['deletion_time'])
+        return items
+
+    def list_items(self, pool, items):
+        for item in items:
+            self.stdout.write(f'pool<{pool.pool_name}> id={item["id"]} name={item["name"]} '
+                              f'deletion_time={item["deletion_time"]} deferment_end_time={item["deferment_end_time"]}(UTC)')
+
+    def restore(self, pool, name: str, new_name: str = ''):
+        try:
+            rbd_mgr = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+            items = [i for i in rbd_mgr.trash_list() if i['name'] == name]
+            if not items:
+                raise CommandError(f'pool<{pool.pool_name}>回收站中没有image<{name}>')
+
+            item = max(items, key=lambda i: i['deletion_time'])    # 同名的恢复最后删除的
+            rbd_mgr.trash_restore(image_id=item['id'], name=new_name or name)
+        except RadosError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f'pool<{pool.pool_name}>, 恢复了image<{new_name or name}>')
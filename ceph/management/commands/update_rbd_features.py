@@ -0,0 +1,74 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ceph.models import CephPool
+from ceph.managers import get_rbd_manager, RadosError
+
+
+class Command(BaseCommand):
+    help = '按ceph pool配置的rbd image特性，为已有的image开启缺少的特性（exclusive-lock、object-map、fast-diff等），' \
+           '并重建object map；开启特性需要获取image的独占锁，运行中虚拟机的系统盘可能失败，可在虚拟机关机后重新执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pool-id', type=int, action='append', default=[], dest='pool_ids',
+            help='只处理指定的ceph pool，可多次指定，默认所有配置了rbd image特性的pool')
+        parser.add_argument(
+            '--prefix', default='', help='只处理名称以此前缀开头的image')
+        parser.add_argument(
+            '--no-rebuild', action='store_true', default=False, help='不重建object map')
+        parser.add_argument(
+            '--max-count', type=int, default=0, help='本次最多处理的image数，默认0不限制')
+        parser.add_argument(
+            '--interval', type=float, default=1, help='两次重建object map之间的间隔秒数，默认1')
+
+    def handle(self, *args, **options):
+        pools = CephPool.objects.select_related('ceph').exclude(rbd_features='')
+        if options['pool_ids']:
+            pools = pools.filter(id__in=options['pool_ids'])
+
+        self.max_count = options['max_count']
+        self.interval = options['interval']
+        self.rebuild = not options['no_rebuild']
+        self.updated = 0
+        done = set()
+        for pool in pools:
+            features = pool.rbd_features_mask
+            key = (pool.ceph_id, pool.pool_name)  # 多个CephPool记录可能是同一个pool
+            if not features or key in done:
+                continue
+            done.add(key)
+
+            try:
+                rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+                self.update_pool(rbd=rbd, features=features, prefix=options['prefix'])
+            except RadosError as e:
+                self.stderr.write(f'pool<{pool.pool_name}>, {str(e)}')
+                continue
+
+        self.stdout.write(f'共更新{self.updated}个image')
+
+    def update_pool(self, rbd, features: int, prefix: str):
+        """
+        :raises: RadosError     # 列举pool中image错误
+        """
+        pool_name = rbd.pool_name
+        for name in rbd.iter_images(prefix=prefix):
+            if self.max_count and self.updated >= self.max_count:
+                return
+
+            try:
+                enabled, rebuilt = rbd.enable_image_features(image_name=name, features=features, rebuild=self.rebuild)
+            except RadosError as e:
+                self.stderr.write(f'pool<{pool_name}>, image<{name}>, {str(e)}')
+                continue
+
+            if not enabled and not rebuilt:
+                continue
+
+            self.updated += 1
+            self.stdout.write(f'pool<{pool_name}>, image<{name}>, 开启特性掩码{enabled}，'
+                              f'{"已重建object map" if rebuilt else "未重建object map"}')
+            if rebuilt and self.interval > 0:
+                time.sleep(self.interval)   # 限速，避免重建object map影响ceph集群
@@ -1,6 +1,12 @@
 import os
+import json
+import time
+import heapq
+import collections
+import threading
 
 import rados, rbd  #yum install python36-rbd.x86_64 python-rados.x86_64
+from django.conf import settings
 
 from .models import CephCluster
 
@@ -118,6 +124,27 @@ class RbdManager:
 
         return True
 
+    def protect_snap(self, image_name: str, snap: str):
+        '''
+        设置快照protect，克隆image需要父快照是protected；已protected时忽略
+
+        :param image_name: rbd image名称
+        :param snap: 快照名称
+        :return:
+            True    # success
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=image_name) as image:
+                    if not image.is_protected_snap(snap):
+                        image.protect_snap(snap)
+        except Exception as e:
+            raise RadosError(f'protect_snap error:{str(e)}')
+
+        return True
+
     def rename_image(self, image_name:str, new_name:str):
         '''
         重命名一个rbd image
@@ -163,7 +190,7 @@ class RbdManager:
 
         return True
 
-    def clone_image(self, snap_image_name:str, snap_name:str, new_image_name:str, data_pool=None):
+    def clone_image(self, snap_image_name:str, snap_name:str, new_image_name:str, data_pool=None, features=None):
         '''
         从快照克隆一个rbd image
 
@@ -171,6 +198,7 @@ class RbdManager:
         :param snap_name: 快照名称
         :param new_image_name: 新克隆的image名称
         :param data_pool: 如果指定，数据存储的到此pool
+        :param features: image特性掩码，默认None使用ceph集群默认特性
         :return:
             True    # success
             raise RadosError # failed
@@ -185,7 +213,7 @@ class RbdManager:
             with cluster.open_ioctx(self.pool_name) as p_ioctx:
                 c_ioctx = p_ioctx   # 克隆的image元数据保存在同一个pool，通过data_pool参数可指定数据块存储到data_pool
                 rbd.RBD().clone(p_ioctx=p_ioctx, p_name=snap_image_name, p_snapname=snap_name, c_ioctx=c_ioctx,
-                                c_name=new_image_name, data_pool=data_pool)
+                                c_name=new_image_name, features=features, data_pool=data_pool)
         except rbd.ImageExists as e:
             raise ImageExistsError(f'clone_image error,image exists,{str(e)}')
         except Exception as e:
@@ -210,13 +238,101 @@ class RbdManager:
         except Exception as e:
             raise RadosError(f'rename_image error:{str(e)}')
 
-    def create_image(self, name:str, size:int, data_pool=None):
+    def iter_images(self, prefix:str=''):
+        '''
+        逐个获取pool中的image名称，不一次性构建整个列表
+
+        :param prefix: 只获取名称以此前缀开头的image，如'x_'
+        :return:
+            generator   # image name
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                r = rbd.RBD()
+                if hasattr(r, 'list2'):
+                    names = (i['name'] for i in r.list2(ioctx))
+                else:
+                    names = r.list(ioctx)
+
+                for name in names:
+                    if name.startswith(prefix):
+                        yield name
+        except Exception as e:
+            raise RadosError(f'iter_images error:{str(e)}')
+
+    def list_images_page(self, prefix:str='', page_token:str='', page_size:int=1000):
+        '''
+        分页获取pool中的image名称，按名称排序，每页只保留page_size个名称在内存中
+
+        :param prefix: 只获取名称以此前缀开头的image
+        :param page_token: 上一页返回的next_token，第一页为空
+        :param page_size: 每页数量
+        :return:
+            (names:list, next_token:str)    # next_token为None时没有下一页
+        :raises: RadosError
+        '''
+        names = heapq.nsmallest(page_size, (n for n in self.iter_images(prefix=prefix) if n > page_token))
+        next_token = names[-1] if len(names) >= page_size else None
+        return names, next_token
+
+    def iter_image_snaps(self, name:str):
+        '''
+        逐个获取rbd image的快照
+
+        :param name: rbd image
+        :return:
+            generator   # {'id': int, 'size': int, 'name': str}
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=name, read_only=True) as image:
+                    for snap in image.list_snaps():
+                        yield snap
+        except Exception as e:
+            raise RadosError(f'iter_image_snaps error:{str(e)}')
+
+    def get_image_meta(self, image_name:str):
+        '''
+        获取rbd image元数据对象，首次访问属性时才读取
+
+        :param image_name: rbd image名称
+        :return:
+            RbdImageMeta()
+        '''
+        return RbdImageMeta(rbd_manager=self, image_name=image_name)
+
+    def image_exists(self, image_name:str):
+        '''
+        rbd image是否存在
+
+        :param image_name: rbd image名称
+        :return:
+            True    # 存在
+            False   # 不存在
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=image_name, read_only=True):
+                    return True
+        except rbd.ImageNotFound:
+            return False
+        except Exception as e:
+            raise RadosError(f'image_exists error:{str(e)}')
+
+    def create_image(self, name:str, size:int, data_pool=None, features=None):
         '''
         Create an rbd image.
 
         :param name: what the image is called
         :param size: how big the image is in bytes
         :param data_pool: 如果指定，数据存储的到此pool
+        :param features: image特性掩码，默认None使用ceph集群默认特性
         :return:
             True    # success
             None    # image already exists
@@ -226,7 +342,8 @@ class RbdManager:
         cluster = self.get_cluster()
         try:
             with cluster.open_ioctx(self.pool_name) as ioctx:
-                rbd.RBD().create(ioctx=ioctx, name=name, size=size, old_format=False, data_pool=data_pool)
+                rbd.RBD().create(ioctx=ioctx, name=name, size=size, old_format=False, features=features,
+                                 data_pool=data_pool)
         except rbd.ImageExists as e:
             return None
         except (TypeError, rbd.InvalidArgument, Exception) as e:
@@ -234,6 +351,66 @@ class RbdManager:
 
         return True
 
+    def import_image_from_stream(self, image_name:str, chunks, data_pool=None,
+                                 block_size:int=4*1024**2, max_in_flight:int=8, features=None):
+        '''
+        创建一个rbd image，并把数据流写入，数据不在本地缓存；写入失败会删除创建的image
+
+        :param image_name: 新的rbd image名称
+        :param chunks: 可迭代的数据块，如上传请求体的分块
+        :param data_pool: 如果指定，数据存储的到此pool
+        :param block_size: 每次异步写的块大小
+        :param max_in_flight: 同时进行中的异步写请求数
+        :param features: image特性掩码，默认None使用ceph集群默认特性
+        :return:
+            int     # 数据大小
+        :raises: RadosError, ImageExistsError
+        '''
+        cluster = self.get_cluster()
+        created = False
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                rbd.RBD().create(ioctx=ioctx, name=image_name, size=0, old_format=False, features=features,
+                                 data_pool=data_pool)
+                created = True
+                with rbd.Image(ioctx=ioctx, name=image_name) as image:
+                    writer = RbdImageStreamWriter(image=image, block_size=block_size, max_in_flight=max_in_flight)
+                    try:
+                        for chunk in chunks:
+                            writer.write(chunk)
+                        size = writer.close()
+                    finally:
+                        writer.wait_all()       # image关闭前等待所有异步写结束
+        except rbd.ImageExists as e:
+            raise ImageExistsError(f'import_image_from_stream error,image exists,{str(e)}')
+        except Exception as e:
+            if created:
+                try:
+                    self.remove_image(image_name=image_name)
+                except RadosError:
+                    pass
+            if isinstance(e, RadosError):
+                raise e
+            raise RadosError(f'import_image_from_stream error:{str(e)}')
+
+        if size <= 0:
+            self.remove_image(image_name=image_name)
+            raise RadosError('import_image_from_stream error:no data')
+
+        return size
+
+    def open_image_reader(self, image_name:str, snap:str=None):
+        '''
+        打开rbd image流式读取对象，使用完需要调用close()
+
+        :param image_name: rbd image名称
+        :param snap: 读取此快照的数据，默认None读取image当前数据
+        :return:
+            RbdImageStreamReader()
+        :raises: RadosError
+        '''
+        return RbdImageStreamReader(rbd_manager=self, image_name=image_name, snap=snap)
+
     def list_image_snaps(self, name:str):
         '''
         获取rbd image的所有快照
@@ -272,6 +449,48 @@ class RbdManager:
             raise RadosError(f'remove_snap error:{str(e)}')
         return True
 
+    def remove_snaps(self, image_name:str, snaps:list):
+        '''
+        批量删除一个rbd image的多个快照，只打开一次image
+
+        :param image_name: rbd image名称
+        :param snaps: 快照名称list
+        :return:
+            (removed:list, failed:list)    # removed = [snap, ]; failed = [(snap, err_msg), ]
+        :raises: RadosError     # 连接ceph或打开image失败
+        '''
+        removed = []
+        failed = []
+        if not snaps:
+            return removed, failed
+
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=image_name) as image:
+                    exists_snaps = {s['name'] for s in image.list_snaps()}
+                    for snap in snaps:
+                        if snap not in exists_snaps:    # 快照不存在
+                            removed.append(snap)
+                            continue
+                        try:
+                            if image.is_protected_snap(snap):  # protected snap check
+                                image.unprotect_snap(snap)
+                            image.remove_snap(snap)
+                        except rbd.ObjectNotFound:
+                            pass
+                        except Exception as e:
+                            failed.append((snap, str(e)))
+                            continue
+
+                        removed.append(snap)
+        except rbd.ImageNotFound as e:
+            return list(snaps), []      # image不存在，快照也不存在了
+        except Exception as e:
+            raise RadosError(f'remove_snaps error:{str(e)}')
+
+        return removed, failed
+
     def image_rollback_to_snap(self, image_name:str, snap:str):
         '''
         rbd image回滚到历史快照
@@ -291,6 +510,260 @@ class RbdManager:
             raise RadosError(f'rollback_to_snap error:{str(e)}')
         return True
 
+    def resize_image(self, image_name:str, size:int):
+        '''
+        调整rbd image大小
+
+        :param image_name: rbd image名称
+        :param size: 新的大小，单位字节
+        :return:
+            True    # success
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=image_name) as image:
+                    image.resize(size)
+        except Exception as e:
+            raise RadosError(f'resize_image error:{str(e)}')
+        return True
+
+    def get_image_parent(self, image_name:str):
+        '''
+        获取克隆rbd image的父镜像快照信息
+
+        :param image_name: rbd image名称
+        :return:
+            (pool_name, image_name, snap_name)  # success
+            None    # 不是克隆的image，没有父镜像
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=image_name, read_only=True) as image:
+                    try:
+                        return image.parent_info()
+                    except rbd.ImageNotFound:
+                        return None
+        except Exception as e:
+            raise RadosError(f'get_image_parent error:{str(e)}')
+
+    def flatten_image(self, image_name:str):
+        '''
+        克隆的rbd image解除与父镜像快照的依赖（flatten），父镜像的数据会复制到image，耗时与image大小有关
+
+        :param image_name: rbd image名称
+        :return:
+            True    # success
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=image_name) as image:
+                    try:
+                        image.parent_info()
+                    except rbd.ImageNotFound:
+                        return True     # 不是克隆的image，不需要flatten
+
+                    image.flatten()
+        except Exception as e:
+            raise RadosError(f'flatten_image error:{str(e)}')
+        return True
+
+    def list_snap_children(self, image_name:str, snap:str):
+        '''
+        获取rbd image快照的所有克隆子image
+
+        :param image_name: rbd image名称
+        :param snap: 快照名称
+        :return:
+            [(pool_name, image_name), ]    # success
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=image_name, snapshot=snap, read_only=True) as image:
+                    return list(image.list_children())
+        except Exception as e:
+            raise RadosError(f'list_snap_children error:{str(e)}')
+
+    def get_image_used_size(self, image_name:str):
+        '''
+        image已分配的数据大小，同"rbd du"的USED，不包括克隆父镜像的数据；开启fast-diff特性时只需读取object map
+
+        :param image_name: rbd image名称
+        :return:
+            int     # Bytes
+        :raises: RadosError
+        '''
+        used = 0
+
+        def on_extent(offset, length, exists):
+            nonlocal used
+            if exists:
+                used += length
+
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=image_name, read_only=True) as image:
+                    image.diff_iterate(0, image.size(), None, on_extent, include_parent=False, whole_object=True)
+        except Exception as e:
+            raise RadosError(f'get_image_used_size error:{str(e)}')
+
+        return used
+
+    # 已有image可以动态开启的特性，layering、deep-flatten等只能在创建时指定
+    DYNAMIC_FEATURES = (rbd.RBD_FEATURE_EXCLUSIVE_LOCK | rbd.RBD_FEATURE_OBJECT_MAP | rbd.RBD_FEATURE_FAST_DIFF |
+                        rbd.RBD_FEATURE_JOURNALING)
+
+    def enable_image_features(self, image_name:str, features:int, rebuild:bool=True):
+        '''
+        为已有image开启缺少的特性；开启object-map后，或object map无效时，重建object map（耗时与image大小成正比）
+
+        :param image_name: rbd image名称
+        :param features: 期望的特性掩码，只能在创建时指定的特性忽略
+        :param rebuild: 是否重建object map
+        :return:
+            (enabled:int, rebuilt:bool)     # 新开启的特性掩码，是否重建了object map
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=image_name) as image:
+                    enabled = features & self.DYNAMIC_FEATURES & ~image.features()
+                    if enabled:
+                        image.update_features(enabled, True)
+
+                    rebuilt = False
+                    if rebuild and image.features() & rbd.RBD_FEATURE_OBJECT_MAP:
+                        invalid = image.flags() & (rbd.RBD_FLAG_OBJECT_MAP_INVALID | rbd.RBD_FLAG_FAST_DIFF_INVALID)
+                        if invalid or enabled & rbd.RBD_FEATURE_OBJECT_MAP:
+                            image.rebuild_object_map()
+                            rebuilt = True
+        except Exception as e:
+            raise RadosError(f'enable_image_features error:{str(e)}')
+
+        return enabled, rebuilt
+
+    def get_pools_stats(self):
+        '''
+        ceph集群所有pool的容量和客户端IO统计，同"ceph df"和"ceph osd pool stats"
+
+        :return:
+            {pool_name: {'used': int, 'max_avail': int, 'iops': int}}    # 容量单位Bytes，iops为当前每秒读写操作数
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        stats = {}
+        try:
+            df = self._mon_command(cluster, {'prefix': 'df', 'format': 'json'})
+            for pool in df.get('pools', []):
+                st = pool.get('stats', {})
+                stats[pool['name']] = {'used': st.get('bytes_used', 0), 'max_avail': st.get('max_avail', 0), 'iops': 0}
+
+            for pool in self._mon_command(cluster, {'prefix': 'osd pool stats', 'format': 'json'}):
+                io = pool.get('client_io_rate', {})
+                if pool.get('pool_name') in stats:
+                    stats[pool['pool_name']]['iops'] = io.get('read_op_per_sec', 0) + io.get('write_op_per_sec', 0)
+        except RadosError:
+            raise
+        except Exception as e:
+            raise RadosError(f'get_pools_stats error:{str(e)}')
+
+        return stats
+
+    @staticmethod
+    def _mon_command(cluster, cmd:dict):
+        ret, out, err = cluster.mon_command(json.dumps(cmd), b'', timeout=10)
+        if ret != 0:
+            raise RadosError(f'mon command "{cmd["prefix"]}" error:{err}')
+        return json.loads(out)
+
+    def trash_move(self, image_name:str, delay:int=0):
+        '''
+        rbd image移入回收站，延迟期内不能被删除，可以恢复
+
+        :param image_name: rbd image名称
+        :param delay: 在回收站内的保留时间（秒），延迟期内不能被清除
+        :return:
+            True    # success
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                rbd.RBD().trash_move(ioctx, image_name, delay)
+        except rbd.ImageNotFound as e:
+            return True
+        except Exception as e:
+            raise RadosError(f'trash_move error:{str(e)}')
+
+        return True
+
+    def trash_list(self):
+        '''
+        获取pool回收站中的所有rbd image
+
+        :return:
+            [{'id': str, 'name': str, 'source': str, 'deletion_time': datetime, 'deferment_end_time': datetime}, ]
+            # 时间为UTC时间
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                return list(rbd.RBD().trash_list(ioctx))
+        except Exception as e:
+            raise RadosError(f'trash_list error:{str(e)}')
+
+    def trash_restore(self, image_id:str, name:str):
+        '''
+        从回收站恢复rbd image
+
+        :param image_id: 回收站中image的id
+        :param name: 恢复后的image名称
+        :return:
+            True    # success
+        :raises: RadosError, ImageExistsError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                rbd.RBD().trash_restore(ioctx, image_id, name)
+        except rbd.ImageExists as e:
+            raise ImageExistsError(f'trash_restore error,image exists,{str(e)}')
+        except Exception as e:
+            raise RadosError(f'trash_restore error:{str(e)}')
+
+        return True
+
+    def trash_remove(self, image_id:str, force:bool=False):
+        '''
+        从回收站彻底删除rbd image
+
+        :param image_id: 回收站中image的id
+        :param force: True(延迟期未到也删除)
+        :return:
+            True    # success
+        :raises: RadosError
+        '''
+        cluster = self.get_cluster()
+        try:
+            with cluster.open_ioctx(self.pool_name) as ioctx:
+                rbd.RBD().trash_remove(ioctx, image_id, force)
+        except rbd.ImageNotFound as e:
+            return True
+        except Exception as e:
+            raise RadosError(f'trash_remove error:{str(e)}')
+
+        return True
+
     def get_rbd_image(self, image_name:str):
         '''
         获取rbd image对象, 使用close_rbd_image()关闭
@@ -316,6 +789,476 @@ class RbdManager:
             pass
 
 
+class RbdImageStreamWriter:
+    '''
+    流式写入rbd image，数据按块对齐后异步写入(aio_write)，同时最多max_in_flight个写请求，
+    全0的块不写入，image保持稀疏；写入超出image大小时自动扩容，close()时调整为实际数据大小
+    '''
+    QCOW2_MAGIC = b'QFI\xfb'
+
+    def __init__(self, image, block_size:int=4*1024**2, max_in_flight:int=8):
+        '''
+        :param image: 可写打开的rbd.Image()
+        :param block_size: 每次写入的块大小，应为rbd对象大小(默认4MB)的整数倍
+        :param max_in_flight: 同时进行中的异步写请求数
+        '''
+        self._image = image
+        self._block_size = block_size
+        self._zero_block = bytes(block_size)
+        self._buf = bytearray(block_size)
+        self._buf_len = 0
+        self._offset = 0    # 已提交的数据大小
+        self._image_size = image.size()
+        self._max_in_flight = max_in_flight
+        self._slots = threading.Semaphore(max_in_flight)
+        self._errors = []
+
+    @property
+    def size(self):
+        '''已写入的数据大小'''
+        return self._offset + self._buf_len
+
+    def write(self, data):
+        '''
+        写入数据
+
+        :param data: bytes like
+        :raises: RadosError
+        '''
+        mv = memoryview(data)
+        while mv:
+            if self._buf_len == 0 and len(mv) >= self._block_size:     # 整块直接提交，不经过缓冲区
+                self._submit(bytes(mv[:self._block_size]))
+                mv = mv[self._block_size:]
+                continue
+
+            n = min(len(mv), self._block_size - self._buf_len)
+            self._buf[self._buf_len:self._buf_len + n] = mv[:n]
+            self._buf_len += n
+            mv = mv[n:]
+            if self._buf_len == self._block_size:
+                self._buf_len = 0
+                self._submit(self._buf)
+
+    def close(self):
+        '''
+        写入缓冲区剩余数据，等待所有异步写完成，调整image大小为实际数据大小
+
+        :return:
+            int     # 数据大小
+        :raises: RadosError
+        '''
+        if self._buf_len > 0:
+            n = self._buf_len
+            self._buf_len = 0
+            self._submit(self._buf[:n])
+
+        self.wait_all()
+        self._check_errors()
+        if self._image_size != self._offset:
+            self._image.resize(self._offset)
+            self._image_size = self._offset
+        self._image.flush()
+        return self._offset
+
+    def _submit(self, block):
+        offset = self._offset
+        length = len(block)
+        self._offset += length
+        if offset == 0 and bytes(block[:4]) == self.QCOW2_MAGIC:
+            raise RadosError('不支持qcow2格式的镜像，请先使用"qemu-img convert -O raw"转换为raw格式')
+
+        zero_block = self._zero_block if length == self._block_size else self._zero_block[:length]
+        if block == zero_block:
+            return      # 全0块跳过，rbd image未写入的区域读取为0
+
+        self._check_errors()
+        end = offset + length
+        if end > self._image_size:
+            new_size = max(end, self._image_size * 2)   # 成倍扩容，减少resize次数
+            self._image.resize(new_size)
+            self._image_size = new_size
+
+        if isinstance(block, bytearray):    # 缓冲区会被重用，异步写需要独立的数据
+            block = bytes(block)
+
+        self._slots.acquire()
+        try:
+            self._image.aio_write(block, offset, self._on_complete)
+        except Exception as e:
+            self._slots.release()
+            raise RadosError(f'aio_write error:{str(e)}')
+
+    def _on_complete(self, completion):
+        ret = completion.get_return_value()
+        if ret < 0:
+            self._errors.append(ret)
+        self._slots.release()
+
+    def write_at(self, offset:int, data):
+        '''
+        异步写入数据到image指定位置，不影响顺序写入的位置，image需要已有足够的大小；
+        与未完成的写请求区域重叠时，需要先调用wait_all()
+
+        :param offset: 写入位置
+        :param data: bytes
+        :raises: RadosError
+        '''
+        self._check_errors()
+        self._slots.acquire()
+        try:
+            self._image.aio_write(data, offset, self._on_complete)
+        except Exception as e:
+            self._slots.release()
+            raise RadosError(f'aio_write error:{str(e)}')
+
+    def discard(self, offset:int, length:int):
+        '''
+        释放image指定区域，区域读取为0；与未完成的写请求区域重叠时，需要先调用wait_all()
+
+        :raises: RadosError
+        '''
+        self._check_errors()
+        try:
+            self._image.discard(offset, length)
+        except Exception as e:
+            raise RadosError(f'discard error:{str(e)}')
+
+    def flush(self):
+        '''
+        等待所有异步写完成并检查写入结果
+
+        :raises: RadosError
+        '''
+        self.wait_all()
+        self._check_errors()
+        try:
+            self._image.flush()
+        except Exception as e:
+            raise RadosError(f'flush error:{str(e)}')
+
+    def wait_all(self):
+        '''等待所有异步写完成'''
+        for _ in range(self._max_in_flight):
+            self._slots.acquire()
+        for _ in range(self._max_in_flight):
+            self._slots.release()
+
+    def _check_errors(self):
+        if self._errors:
+            raise RadosError(f'aio_write error, return value {self._errors[0]}')
+
+
+class RbdImageStreamReader:
+    '''
+    流式读取rbd image，按块对齐异步预读(aio_read)，通过diff_iterate跳过未分配的区域（空洞直接返回0数据），
+    内存占用只与块大小和预读数量有关，与image大小无关；使用完需要调用close()
+    '''
+    def __init__(self, rbd_manager, image_name:str, snap:str=None, block_size:int=4*1024**2,
+                 read_ahead:int=4, window_size:int=256*1024**2):
+        '''
+        :param rbd_manager: RbdManager()，读取完成前保持引用，避免与ceph的连接被关闭
+        :param image_name: rbd image名称
+        :param snap: 读取此快照的数据，默认None读取image当前数据
+        :param block_size: 每次读取的块大小，应为rbd对象大小(默认4MB)的整数倍
+        :param read_ahead: 预读的块数
+        :param window_size: 每次查询已分配区域的范围大小
+
+        :raises: RadosError
+        '''
+        self._rbd_manager = rbd_manager
+        self._block_size = block_size
+        self._read_ahead = read_ahead
+        self._window_size = window_size
+        self._zero_block = bytes(block_size)
+        self._ioctx = None
+        self._image = None
+        try:
+            self._ioctx = rbd_manager.get_cluster().open_ioctx(rbd_manager.pool_name)
+            self._image = rbd.Image(ioctx=self._ioctx, name=image_name, snapshot=snap, read_only=True)
+            self.size = self._image.size()
+        except Exception as e:
+            self.close()
+            raise RadosError(f'open image reader error:{str(e)}')
+
+    def close(self):
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+        if self._ioctx is not None:
+            self._ioctx.close()
+            self._ioctx = None
+
+    def _iter_diff_extents(self, from_snap, start:int, end:int):
+        '''
+        逐个获取[start, end)范围内相对于快照from_snap有变化的区域，每次只查询一个窗口范围；
+        from_snap为None时返回所有已分配数据的区域
+
+        :return:
+            generator   # (offset, length, exists)，exists=False表示区域数据已被释放（读取为0）
+        '''
+        pos = start
+        while pos < end:
+            win_end = min(end, pos + self._window_size)
+            extents = []
+            self._image.diff_iterate(pos, win_end - pos, from_snap,
+                                     lambda offset, length, exists: extents.append((offset, length, exists)),
+                                     include_parent=True, whole_object=True)
+            for offset, length, exists in sorted(extents):
+                offset, ext_end = max(offset, pos), min(offset + length, win_end)     # whole_object时区域按对象对齐
+                if ext_end <= offset:
+                    continue
+                yield offset, ext_end - offset, exists
+                pos = ext_end
+            pos = win_end
+
+    def _iter_extents(self, start:int, end:int):
+        '''
+        逐个获取[start, end)范围内已分配数据的区域和空洞，每次只查询一个窗口范围
+
+        :return:
+            generator   # (offset, length, has_data)
+        '''
+        pos = start
+        while pos < end:
+            win_end = min(end, pos + self._window_size)
+            extents = []
+            self._image.diff_iterate(pos, win_end - pos, None,
+                                     lambda offset, length, exists: extents.append((offset, length)) if exists else None,
+                                     include_parent=True, whole_object=True)
+            for offset, length in sorted(extents):
+                offset, ext_end = max(offset, pos), min(offset + length, win_end)     # whole_object时区域按对象对齐
+                if ext_end <= offset:
+                    continue
+                if offset > pos:
+                    yield pos, offset - pos, False
+                yield offset, ext_end - offset, True
+                pos = ext_end
+
+            if pos < win_end:
+                yield pos, win_end - pos, False
+            pos = win_end
+
+    def _iter_blocks(self, start:int, end:int, extents=None):
+        '''
+        [start, end)范围按块对齐拆分
+
+        :param extents: 要拆分的区域，默认[start, end)范围内的所有区域
+        :return:
+            generator   # (offset, length, has_data)
+        '''
+        if extents is None:
+            extents = self._iter_extents(start, end)
+
+        for offset, length, has_data in extents:
+            ext_end = offset + length
+            while offset < ext_end:
+                block_end = min(ext_end, (offset // self._block_size + 1) * self._block_size)
+                yield offset, block_end - offset, has_data
+                offset = block_end
+
+    def _aio_read(self, offset:int, length:int):
+        event = threading.Event()
+        result = {}
+
+        def on_complete(completion, data):
+            result['ret'] = completion.get_return_value()
+            result['data'] = data
+            event.set()
+
+        self._image.aio_read(offset, length, on_complete)
+        return event, result
+
+    def iter_range(self, start:int = 0, end:int = None):
+        '''
+        读取[start, end)范围的数据
+
+        :return:
+            generator   # bytes
+        :raises: RadosError
+        '''
+        end = self.size if end is None else min(end, self.size)
+        pending = collections.deque()
+        try:
+            for offset, length, has_data in self._iter_blocks(start, end):
+                if has_data:
+                    pending.append(self._aio_read(offset, length))
+                else:
+                    pending.append(length)
+
+                while len(pending) > self._read_ahead:
+                    yield self._pop_block(pending)
+
+            while pending:
+                yield self._pop_block(pending)
+        except RadosError:
+            raise
+        except Exception as e:
+            raise RadosError(f'read image error:{str(e)}')
+        finally:
+            for item in pending:        # 等待未完成的异步读，之后才能关闭image
+                if not isinstance(item, int):
+                    item[0].wait()
+
+    def iter_changes(self, from_snap:str=None):
+        '''
+        读取相对于快照from_snap有变化的数据，用于增量备份；from_snap为None时读取所有已分配的数据
+
+        :param from_snap: 同一image的较早的快照
+        :return:
+            generator   # (offset, length, data)，data为None表示区域数据已被释放（读取为0）
+        :raises: RadosError
+        '''
+        pending = collections.deque()
+        try:
+            extents = self._iter_diff_extents(from_snap, 0, self.size)
+            for offset, length, exists in self._iter_blocks(0, self.size, extents=extents):
+                pending.append((offset, length, self._aio_read(offset, length) if exists else None))
+                while len(pending) > self._read_ahead:
+                    yield self._pop_change(pending)
+
+            while pending:
+                yield self._pop_change(pending)
+        except RadosError:
+            raise
+        except Exception as e:
+            raise RadosError(f'read image changes error:{str(e)}')
+        finally:
+            for item in pending:        # 等待未完成的异步读，之后才能关闭image
+                if item[2] is not None:
+                    item[2][0].wait()
+
+    def _pop_change(self, pending):
+        offset, length, item = pending.popleft()
+        if item is None:
+            return offset, length, None
+
+        event, result = item
+        event.wait()
+        if result['ret'] < 0:
+            raise RadosError(f'aio_read error, return value {result["ret"]}')
+        return offset, length, result['data']
+
+    def _pop_block(self, pending):
+        item = pending.popleft()
+        if isinstance(item, int):   # 空洞
+            return self._zero_block if item == self._block_size else self._zero_block[:item]
+
+        event, result = item
+        event.wait()
+        if result['ret'] < 0:
+            raise RadosError(f'aio_read error, return value {result["ret"]}')
+        return result['data']
+
+
+def sync_image_changes(src_rbd, image_name:str, snap:str, dst_rbd, dst_image_name:str=None, from_snap:str=None):
+    '''
+    复制rbd image快照相对于较早快照from_snap有变化的数据到另一个rbd image（可以在另一个ceph集群），用于跨集群增量同步；
+    目标image需要已存在，小于快照大小时扩容；from_snap为None时复制所有已分配的数据，目标image应为新创建的空image
+
+    :param src_rbd: 源image所在pool的RbdManager()
+    :param image_name: 源image名称
+    :param snap: 源image的快照
+    :param dst_rbd: 目标image所在pool的RbdManager()
+    :param dst_image_name: 目标image名称，默认同源image名称
+    :param from_snap: 上一次同步的源image快照，目标image已有此快照时的数据
+    :return:
+        int     # 复制的数据大小
+    :raises: RadosError
+    '''
+    reader = src_rbd.open_image_reader(image_name=image_name, snap=snap)
+    image = None
+    writer = None
+    try:
+        image = dst_rbd.get_rbd_image(image_name=dst_image_name or image_name)
+        if image.size() < reader.size:
+            image.resize(reader.size)
+
+        copied = 0
+        zero_block = b''
+        writer = RbdImageStreamWriter(image=image)
+        for offset, length, data in reader.iter_changes(from_snap=from_snap):
+            if data is not None:
+                if len(zero_block) < length:
+                    zero_block = bytes(length)
+                if data != zero_block[:length]:
+                    writer.write_at(offset, data)
+                    copied += length
+                    continue
+            if from_snap is not None:    # 全量复制时目标image是空的，不需要释放
+                writer.discard(offset, length)
+
+        writer.flush()
+        return copied
+    except RadosError:
+        raise
+    except Exception as e:
+        raise RadosError(f'sync image error:{str(e)}')
+    finally:
+        if writer is not None:
+            writer.wait_all()
+        reader.close()
+        if image is not None:
+            dst_rbd.close_rbd_image(image)
+
+
+class RbdImageMeta:
+    '''
+    rbd image元数据，首次访问任一属性时打开一次image读取全部元数据
+    '''
+    def __init__(self, rbd_manager, image_name:str):
+        self._rbd_manager = rbd_manager
+        self.name = image_name
+        self._meta = None
+
+    def _load(self):
+        '''
+        :raises: RadosError
+        '''
+        if self._meta is not None:
+            return self._meta
+
+        cluster = self._rbd_manager.get_cluster()
+        try:
+            with cluster.open_ioctx(self._rbd_manager.pool_name) as ioctx:
+                with rbd.Image(ioctx=ioctx, name=self.name, read_only=True) as image:
+                    try:
+                        parent = image.parent_info()
+                    except rbd.ImageNotFound:
+                        parent = None
+
+                    self._meta = {
+                        'size': image.size(),
+                        'parent': parent,
+                        'snap_count': sum(1 for _ in image.list_snaps()),
+                        'create_time': image.create_timestamp()
+                    }
+        except Exception as e:
+            raise RadosError(f'get image meta error:{str(e)}')
+
+        return self._meta
+
+    @property
+    def size(self):
+        '''image大小，单位Bytes'''
+        return self._load()['size']
+
+    @property
+    def parent(self):
+        '''克隆的父镜像快照(pool_name, image_name, snap_name)，不是克隆的image为None'''
+        return self._load()['parent']
+
+    @property
+    def snap_count(self):
+        '''快照数量'''
+        return self._load()['snap_count']
+
+    @property
+    def create_time(self):
+        '''创建时间，UTC时间'''
+        return self._load()['create_time']
+
+
 class CephClusterManager:
     '''
     CEPH集群管理器
@@ -340,5 +1283,96 @@ class CephClusterManager:
             raise RadosError(f'查询CEPH集群时错误,{str(e)}')
 
 
+class CephPoolPlacement:
+    '''
+    按ceph pool的剩余容量和IO负载选择存储位置，新增的pool剩余容量多，会优先被选中
+
+    pool的统计信息（ceph df、ceph osd pool stats）按ceph集群缓存settings.CEPH_POOL_STATS_CACHE_SECONDS秒，
+    获取失败时只按配额剩余容量选择
+    '''
+    _stats_cache = {}   # {ceph_id: (expire_time, {pool_name: stats})}
+    _stats_lock = threading.Lock()
+
+    def get_pools_stats(self, ceph:CephCluster):
+        '''
+        ceph集群所有pool的统计信息，有缓存
 
+        :return:
+            {pool_name: {'used': int, 'max_avail': int, 'iops': int}}
+            {}      # 获取失败
+        '''
+        now = time.time()
+        with self._stats_lock:
+            cached = self._stats_cache.get(ceph.id)
+            if cached and cached[0] > now:
+                return cached[1]
+
+        try:
+            rbd_manager = get_rbd_manager(ceph=ceph, pool_name='')
+            stats = rbd_manager.get_pools_stats()
+            timeout = getattr(settings, 'CEPH_POOL_STATS_CACHE_SECONDS', 300)
+        except Exception:
+            stats = {}
+            timeout = 60    # 集群不可访问时，避免每次选择都等待连接超时
+
+        with self._stats_lock:
+            self._stats_cache[ceph.id] = (now + timeout, stats)
+        return stats
+
+    def get_pool_stats(self, ceph_pool):
+        '''
+        :param ceph_pool: CephPool()
+        :return:
+            {'used': int, 'max_avail': int, 'iops': int}
+            None    # 获取失败
+        '''
+        pool_name = ceph_pool.data_pool if ceph_pool.has_data_pool else ceph_pool.pool_name  # 数据所在的pool
+        return self.get_pools_stats(ceph_pool.ceph).get(pool_name)
+
+    def score(self, ceph_pool, free:int=None, total:int=None):
+        '''
+        pool的放置得分，剩余容量比例 * IO余量比例；剩余容量比例取配额和pool实际剩余比例的较小者
+
+        :param ceph_pool: CephPool()
+        :param free: 配额剩余容量，单位GB
+        :param total: 配额总容量，单位GB
+        :return:
+            (full:bool, score:float)    # full为pool已使用比例达到settings.CEPH_POOL_FULL_RATIO
+        '''
+        ratios = []
+        if total:
+            ratios.append(max(free, 0) / total)
+
+        full = False
+        iops_ratio = 1.0
+        stats = self.get_pool_stats(ceph_pool)
+        if stats:
+            capacity = stats['used'] + stats['max_avail']
+            if capacity > 0:
+                ratios.append(stats['max_avail'] / capacity)
+                full = stats['used'] / capacity >= getattr(settings, 'CEPH_POOL_FULL_RATIO', 0.85)
+            iops_limit = getattr(settings, 'CEPH_POOL_IOPS_LIMIT', 0)
+            if iops_limit:
+                iops_ratio = max(1 - stats['iops'] / iops_limit, 0.05)
+
+        free_ratio = min(ratios) if ratios else 1.0
+        return full, free_ratio * iops_ratio
+
+    def choose(self, candidates):
+        '''
+        选择得分最高的候选，已满的pool排在未满的之后
+
+        :param candidates: [(obj, CephPool(), free:int or None, total:int or None), ]
+        :return:
+            obj
+            None    # candidates为空
+        '''
+        best = None
+        best_key = None
+        for obj, ceph_pool, free, total in candidates:
+            full, score = self.score(ceph_pool, free=free, total=total)
+            key = (not full, score)
+            if best_key is None or key > best_key:
+                best, best_key = obj, key
 
+        return best
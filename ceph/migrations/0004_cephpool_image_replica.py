@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ceph', '0003_auto_20200211_0931'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cephpool',
+            name='image_replica',
+            field=models.BooleanField(default=False, help_text='选中时，其他分中心的全局镜像复制到此pool', verbose_name='接收全局镜像'),
+        ),
+    ]
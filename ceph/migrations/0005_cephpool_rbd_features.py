@@ -0,0 +1,19 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:20
+
+import ceph.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ceph', '0004_cephpool_image_replica'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cephpool',
+            name='rbd_features',
+            field=models.CharField(blank=True, default='', help_text='创建和克隆image时开启的特性，逗号分隔，如layering,exclusive-lock,object-map,fast-diff,deep-flatten；为空使用ceph集群默认配置', max_length=255, validators=[ceph.models.parse_rbd_features], verbose_name='rbd image特性'),
+        ),
+    ]
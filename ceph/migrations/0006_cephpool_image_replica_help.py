@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-19 01:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ceph', '0005_cephpool_rbd_features'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cephpool',
+            name='image_replica',
+            field=models.BooleanField(default=False, help_text='选中时，全局镜像复制到此pool，包括同一分中心的pool', verbose_name='接收全局镜像'),
+        ),
+    ]
@@ -2,10 +2,53 @@ import os
 
 from django.db import models
 from django.conf import settings
+from django.core.exceptions import ValidationError
 
 from compute.models import Center
 
-# Create your models here.
+
+# rbd image特性名称，值同librbd的RBD_FEATURE_*；striping、data-pool由创建参数决定，不在此配置
+RBD_FEATURES = {
+    'layering': 1,
+    'exclusive-lock': 4,
+    'object-map': 8,
+    'fast-diff': 16,
+    'deep-flatten': 32,
+    'journaling': 64,
+}
+# 特性依赖的其他特性
+RBD_FEATURE_REQUIRES = {
+    'object-map': 'exclusive-lock',
+    'fast-diff': 'object-map',
+    'journaling': 'exclusive-lock',
+}
+
+
+def parse_rbd_features(value: str):
+    '''
+    解析逗号分隔的rbd image特性名称
+
+    :return:
+        int     # 特性掩码
+        None    # 未配置，使用ceph集群默认特性
+    :raises: ValidationError
+    '''
+    names = {n.strip() for n in value.split(',') if n.strip()}
+    if not names:
+        return None
+
+    invalid = names - set(RBD_FEATURES)
+    if invalid:
+        raise ValidationError(f'无效的rbd特性：{",".join(sorted(invalid))}')
+    if 'layering' not in names:
+        raise ValidationError('必须包含layering特性，系统盘和云硬盘快照需要克隆')
+    for name in names:
+        required = RBD_FEATURE_REQUIRES.get(name)
+        if required and required not in names:
+            raise ValidationError(f'{name}特性需要同时开启{required}特性')
+
+    return sum(RBD_FEATURES[n] for n in names)
+
 
 class CephCluster(models.Model):
     '''
@@ -99,6 +142,12 @@ class CephPool(models.Model):
     data_pool = models.CharField(verbose_name='数据存储POOL名称', max_length=100, blank=True, default='')
     ceph = models.ForeignKey(to=CephCluster, on_delete=models.CASCADE)
     enable = models.BooleanField(default=True, verbose_name='是否启用')
+    image_replica = models.BooleanField(default=False, verbose_name='接收全局镜像',
+                                        help_text='选中时，全局镜像复制到此pool，包括同一分中心的pool')
+    rbd_features = models.CharField(
+        verbose_name='rbd image特性', max_length=255, blank=True, default='', validators=[parse_rbd_features],
+        help_text='创建和克隆image时开启的特性，逗号分隔，如layering,exclusive-lock,object-map,fast-diff,deep-flatten；'
+                  '为空使用ceph集群默认配置')
     remarks = models.CharField(max_length=255, default='', blank=True, verbose_name='备注')
 
     class Meta:
@@ -109,4 +158,14 @@ class CephPool(models.Model):
     def __str__(self):
         return f'ceph<{self.ceph.name}>@pool<{self.pool_name}>'
 
+    @property
+    def rbd_features_mask(self):
+        '''
+        创建image时指定的特性掩码，None使用ceph集群默认特性
+        '''
+        try:
+            return parse_rbd_features(self.rbd_features)
+        except ValidationError:
+            return None
+
 
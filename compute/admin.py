@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
 from .models import Center, Group, Host
 
@@ -32,10 +32,38 @@ class GroupAdmin(admin.ModelAdmin):
 class HostAdmin(admin.ModelAdmin):
     list_display_links = ('ipv4',)
     list_display = ('id', 'ipv4', 'group', 'real_cpu', 'vcpu_total', 'vcpu_allocated', 'vcpu_allocated_now',
-                    'mem_total', 'mem_allocated', 'mem_allocated_now', 'vm_created', 'vm_created_now', 'enable', 'desc')
-    list_filter = ['group']
+                    'mem_total', 'mem_allocated', 'mem_allocated_now', 'vm_created', 'vm_created_now', 'enable', 'maintenance', 'op_queue',
+                    'desc')
+    list_filter = ['group', 'maintenance']
     search_fields = ['ipv4']
     filter_horizontal = ['vlans']
+    actions = ['evacuate_hosts', 'exit_maintenance']
+
+    def evacuate_hosts(self, request, queryset):
+        '''
+        选中的宿主机进入维护模式，添加疏散任务，由任务执行进程并行迁移所有虚拟机
+        '''
+        from vms.manager import HostEvacuateManager, VmError
+
+        manager = HostEvacuateManager()
+        for host in queryset:
+            try:
+                task = manager.add_task(host_id=host.id, user=request.user)
+            except VmError as e:
+                self.message_user(request, f'宿主机{host}疏散失败，{str(e)}', level=messages.ERROR)
+                continue
+
+            p = task.get_progress()
+            self.message_user(request, f'宿主机{host}已进入维护模式，添加了疏散任务<{task.id}>，'
+                                       f'{p["total"]}个虚拟机中{p["failed"]}个无法迁移')
+
+    evacuate_hosts.short_description = '进入维护模式并疏散虚拟机'
+
+    def exit_maintenance(self, request, queryset):
+        count = queryset.update(maintenance=False)
+        self.message_user(request, f'{count}个宿主机退出维护模式')
+
+    exit_maintenance.short_description = '退出维护模式'
 
     def vcpu_allocated_now(self, obj):
         s = obj.stats_vcpu_mem_vms_now()
@@ -55,4 +83,12 @@ class HostAdmin(admin.ModelAdmin):
 
     vm_created_now.short_description = '实时统计虚拟机数'
 
+    def op_queue(self, obj):
+        from utils.ev_libvirt.virt import HostOpSemaphore
+
+        running, waiting = HostOpSemaphore(host_ip=obj.ipv4).queue_depth()
+        return f'{running}/{waiting}'
+
+    op_queue.short_description = 'libvirt操作(执行/排队)'
+
 
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compute', '0004_host_real_cpu'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='maintenance',
+            field=models.BooleanField(default=False, help_text='维护模式的宿主机不再调度创建或迁入虚拟机，可以疏散迁出所有虚拟机', verbose_name='维护模式'),
+        ),
+    ]
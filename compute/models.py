@@ -87,6 +87,8 @@ class Host(models.Model):
     vm_limit = models.IntegerField(default=10, verbose_name='本机可创建虚拟机数量上限')
     vm_created = models.IntegerField(default=0, verbose_name='本机已创建虚拟机数量')
     enable = models.BooleanField(default=True, verbose_name='宿主机状态')
+    maintenance = models.BooleanField(default=False, verbose_name='维护模式',
+                                      help_text='维护模式的宿主机不再调度创建或迁入虚拟机，可以疏散迁出所有虚拟机')
     desc = models.CharField(max_length=200, default='', blank=True, verbose_name='描述')
 
     ipmi_host = models.CharField(max_length=100, default='', blank=True)
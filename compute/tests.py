@@ -1,3 +1,97 @@
-from django.test import TestCase
+import os
+import subprocess
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from utils.ev_libvirt.virt import HostOpSemaphore, VirtError
+
+
+class HostOpSemaphoreTests(SimpleTestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.queue_dir = os.path.join(self._tmp.name, 'host_ops')
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def semaphore(self, limit=1, timeout=5):
+        return HostOpSemaphore(host_ip='10.0.0.1', limit=limit, timeout=timeout, queue_dir=self.queue_dir)
+
+    def wait_depth(self, sem, depth):
+        deadline = time.time() + 5
+        while sem.queue_depth() != depth:
+            self.assertLess(time.time(), deadline, f'queue depth {sem.queue_depth()} != {depth}')
+            time.sleep(0.01)
+
+    def test_fifo_order(self):
+        sem = self.semaphore(limit=1)
+        ticket = sem.acquire('define')
+        order = []
+
+        def run(name):
+            with self.semaphore(limit=1).slot(name):
+                order.append(name)
+
+        threads = []
+        for i, name in enumerate(['a', 'b', 'c']):
+            t = threading.Thread(target=run, args=(name,))
+            t.start()
+            threads.append(t)
+            self.wait_depth(sem, (1, i + 1))
+
+        sem.release(ticket)
+        for t in threads:
+            t.join(timeout=10)
+        self.assertEqual(order, ['a', 'b', 'c'])
+        self.assertEqual(sem.queue_depth(), (0, 0))
+
+    def test_limit_and_timeout(self):
+        sem = self.semaphore(limit=2, timeout=0.2)
+        tickets = [sem.acquire('start'), sem.acquire('start')]
+        self.assertEqual(sem.queue_depth(), (2, 0))
+        with self.assertRaises(VirtError):
+            sem.acquire('start')
+        self.assertEqual(sem.queue_depth(), (2, 0))     # 超时的排队记录已移除
+
+        sem.release(tickets[0])
+        sem.release(sem.acquire('start'))
+        sem.release(tickets[1])
+        self.assertEqual(sem.queue_depth(), (0, 0))
+
+    def test_dead_pid_removed(self):
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        sem = self.semaphore(limit=1, timeout=0.2)
+        with sem._locked_queue() as queue:
+            queue.append(['dead', proc.pid, 'start', time.time()])
+        self.assertEqual(sem.queue_depth(), (0, 0))
+        with sem.slot('start'):
+            self.assertEqual(sem.queue_depth(), (1, 0))
+
+    def test_queue_file_mode(self):
+        old_umask = os.umask(0o077)
+        try:
+            sem = self.semaphore()
+            with sem.slot('start'):
+                pass
+        finally:
+            os.umask(old_umask)
+        self.assertEqual(os.stat(sem.path).st_mode & 0o777, 0o666)
+
+    def test_no_limit(self):
+        with self.semaphore(limit=0).slot('start'):
+            pass
+        self.assertFalse(os.path.exists(self.queue_dir))
+
+    def test_queue_file_error(self):
+        # 排队文件不能读写时不限制
+        path = os.path.join(self._tmp.name, 'file')
+        open(path, 'w').close()
+        sem = HostOpSemaphore(host_ip='10.0.0.1', limit=1, queue_dir=path)
+        with sem.slot('start'):
+            with sem.slot('start'):
+                pass
+        self.assertEqual(sem.queue_depth(), (0, 0))
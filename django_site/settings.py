@@ -56,7 +56,8 @@ INSTALLED_APPS = [
     'docs',
     'reports',
     'pcservers',
-    'vpn'
+    'vpn',
+    'backup.apps.BackupConfig',
 ]
 
 MIDDLEWARE = [
@@ -228,6 +229,42 @@ SIMPLE_JWT = {
 VNCSERVER_BASE_PORT = 5900
 # NOVNC_SERVER_PORT = 84  # novnc代理服务websockify的端口； 默认为80（需要通过nginx代理）
 
+# ceph rbd回收站，删除的虚拟机系统盘和云硬盘先移入回收站，保留期内可以恢复，过期后由purge_rbd_trash命令清除
+RBD_TRASH_DELAY = 7 * 24 * 3600     # 保留时间（秒）
+
+# 硬盘增量备份，备份文件（rbd export-diff格式）保存在本地或挂载的存储目录
+BACKUP_ROOT = '/var/evcloud/backup'
+BACKUP_POOL_CONCURRENCY = 2     # 每个ceph pool同时执行的备份数
+BACKUP_MAX_INCREMENTALS = 6     # 连续增量备份数上限，达到后做一次全量备份
+
+# 系统盘快照回滚方式，True：从快照克隆新系统盘替换原系统盘（耗时与硬盘大小无关），后台flatten；False：rbd rollback
+VM_SNAP_ROLLBACK_CLONE = True
+
+# 云硬盘和系统盘存储池选择，按配额和ceph pool的剩余容量、IO负载选择
+CEPH_POOL_STATS_CACHE_SECONDS = 300     # ceph pool统计信息（ceph df、ceph osd pool stats）缓存时间（秒）
+CEPH_POOL_FULL_RATIO = 0.85     # pool已使用比例达到此值时，只在没有其他可选pool时使用
+CEPH_POOL_IOPS_LIMIT = 0        # 单个pool的IOPS能力，用于计算IO余量；0不考虑IO负载
+
+# 虚拟机异步任务，由manage.py run_vm_jobs执行
+VM_JOB_HEARTBEAT_TIMEOUT = 120  # 执行进程心跳超时（秒），超时的任务根据检查点完成或回滚
+VM_JOB_MAX_ATTEMPTS = 3     # 任务最大执行次数
+VM_JOB_WAIT_MAX = 15        # 查询任务时最多等待任务变化的秒数，应小于uwsgi http-timeout
+
+# 虚拟机热迁移（libvirt migrateToURI3），系统盘和云硬盘为共享的ceph rbd，只迁移内存
+VM_LIVE_MIGRATE_BANDWIDTH = 0       # 迁移带宽限制，单位MiB/s，0不限制
+VM_LIVE_MIGRATE_COMPRESSED = False  # 是否压缩迁移的内存数据
+VM_LIVE_MIGRATE_AUTO_CONVERGE = True    # 内存变化快于迁移时，自动降低虚拟机vcpu速度使迁移收敛
+VM_LIVE_MIGRATE_MAX_DOWNTIME = 500  # 迁移最后阶段最长停机时间，单位毫秒，0使用libvirt默认值
+VM_LIVE_MIGRATE_TIMEOUT = 0         # 迁移超时秒数，超时中止迁移，0不限制
+
+# 宿主机libvirt重操作（启动、定义、迁移虚拟机，挂载设备）并发限制，本服务器上所有进程共享，按申请顺序排队
+VIRT_HOST_OP_LIMIT = 0          # 每个宿主机同时执行的操作数，0不限制；启用时排队目录需要web服务和管理命令的用户都可写
+VIRT_HOST_OP_TIMEOUT = 300      # 排队等待超时秒数
+VIRT_HOST_OP_QUEUE_DIR = '/var/evcloud/host_ops'    # 每个宿主机的排队文件所在目录
+
+# 虚拟机状态、是否存在、xml的读取，进程内相同的并发读取合并为一次libvirt调用
+VIRT_READ_CACHE_TTL = 0     # 读取结果缓存秒数，覆盖短时间内的重复查询；0只合并并发的读取
+
 # 日志配置
 LOGGING_FILES_DIR = os.path.join('/var/log', os.path.basename(BASE_DIR))
 if not os.path.exists(LOGGING_FILES_DIR):
@@ -1,12 +1,21 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 
+from ceph.managers import get_rbd_manager, RadosError
+from utils.errors import ImageError
+from .forms import ImageUploadForm
+from .managers import ImageManager, ImageReplicaManager
 from .models import VmXmlTemplate, Image, ImageType
+from .uploadhandler import RbdImageUploadHandler
 
 
 @admin.register(VmXmlTemplate)
 class VmXmlTemplateAdmin(admin.ModelAdmin):
     list_display_links = ('id', 'name',)
-    list_display = ('id', 'name', 'desc')
+    list_display = ('id', 'name', 'max_vcpu', 'max_mem', 'desc')
     search_fields = ('name', 'desc')
 
 
@@ -20,9 +29,102 @@ class ImageTypeAdmin(admin.ModelAdmin):
 @admin.register(Image)
 class ImageAdmin(admin.ModelAdmin):
     list_display_links = ('id', 'name',)
-    list_display = ('id', 'name', 'version', 'tag', 'sys_type', 'type', 'base_image', 'snap', 'enable', 'xml_tpl', 'desc')
+    list_display = ('id', 'name', 'version', 'tag', 'sys_type', 'type', 'ceph_pool', 'base_image', 'snap', 'enable',
+                    'is_global', 'source', 'xml_tpl', 'desc')
     search_fields = ('name',)
-    list_filter = ('type', 'enable', 'tag', 'sys_type')
-    readonly_fields = ('snap',)
+    list_filter = ('type', 'enable', 'tag', 'sys_type', 'is_global')
+    readonly_fields = ('snap', 'source')
+    actions = ['replicate_images']
 
+    def replicate_images(self, request, queryset):
+        '''
+        选中的全局镜像复制到其他接收全局镜像的ceph pool，镜像较大时建议使用命令"manage.py replicate_images"
+        '''
+        manager = ImageReplicaManager()
+        for image in queryset.select_related('ceph_pool__ceph').filter(is_global=True, source=None):
+            try:
+                results = manager.replicate_image(image=image)
+            except ImageError as e:
+                self.message_user(request, str(e), level=messages.ERROR)
+                continue
 
+            for pool, replica, copied, err in results:
+                if err:
+                    self.message_user(request, f'镜像"{image.fullname}"复制到{pool}失败，{err}', level=messages.ERROR)
+                else:
+                    self.message_user(request, f'镜像"{image.fullname}"复制到{pool}完成，复制数据{copied}字节')
+
+    replicate_images.short_description = '复制全局镜像到其他pool'
+
+    def get_urls(self):
+        urls = [
+            path('upload/', self.admin_site.admin_view(self.upload_view), name='image_image_upload'),
+        ]
+        return urls + super().get_urls()
+
+    @csrf_exempt
+    def upload_view(self, request):
+        '''
+        上传系统镜像，先填写镜像信息（GET参数），再上传镜像文件，文件数据直接写入rbd image
+
+        csrf检查会解析请求体，需要在设置上传处理器之后再做csrf检查
+        '''
+        form = ImageUploadForm(request.GET or None)
+        if request.method == 'POST' and form.is_valid():
+            return self.upload_file(request=request, form=form)
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title='上传系统镜像',
+            form=form,
+            upload_file=form.is_bound and form.is_valid()
+        )
+        return TemplateResponse(request, 'admin/image/image/upload.html', context)
+
+    def upload_file(self, request, form):
+        data = form.cleaned_data
+        ceph_pool = data['ceph_pool']
+        manager = ImageManager()
+        try:
+            manager.check_create_image_params(
+                name=data['name'], version=data['version'], ceph_pool_id=ceph_pool.id, type_id=data['type'].id,
+                xml_tpl_id=data['xml_tpl'].id, sys_type=data['sys_type'], tag=data['tag'])
+            rbd = get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+        except (ImageError, RadosError) as e:
+            self.message_user(request, str(e), level=messages.ERROR)
+            return redirect(request.get_full_path())
+
+        handler = RbdImageUploadHandler(request=request, rbd_manager=rbd, image_name=manager.new_base_image_name(),
+                                        data_pool=ceph_pool.data_pool if ceph_pool.has_data_pool else None,
+                                        features=ceph_pool.rbd_features_mask)
+        request.upload_handlers = [handler]
+        try:
+            response = csrf_protect(self._create_uploaded_image)(request, form=form, handler=handler)
+        except Exception as e:
+            handler.abort()
+            raise e
+
+        if response.status_code >= 400:     # csrf检查未通过
+            handler.abort()
+        return response
+
+    def _create_uploaded_image(self, request, form, handler):
+        data = form.cleaned_data
+        uploaded = request.FILES.get('file')
+        if not uploaded or uploaded.size <= 0:
+            handler.abort()
+            self.message_user(request, f'上传镜像文件失败，{handler.error or "文件无数据"}', level=messages.ERROR)
+            return redirect(request.get_full_path())
+
+        try:
+            image = ImageManager().create_image_with_rbd(
+                base_image=uploaded.rbd_image, name=data['name'], version=data['version'],
+                ceph_pool=data['ceph_pool'], image_type=data['type'], xml_tpl=data['xml_tpl'],
+                sys_type=data['sys_type'], tag=data['tag'], desc=data['desc'], user=request.user)
+        except ImageError as e:
+            self.message_user(request, str(e), level=messages.ERROR)
+            return redirect(request.get_full_path())
+
+        self.message_user(request, f'上传系统镜像"{image.fullname}"成功，大小{uploaded.size}字节')
+        return redirect(reverse('admin:image_image_change', args=(image.id,)))
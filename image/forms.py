@@ -0,0 +1,19 @@
+from django import forms
+
+from ceph.models import CephPool
+from .models import Image, ImageType, VmXmlTemplate
+
+
+class ImageUploadForm(forms.Form):
+    '''
+    上传系统镜像表单，镜像文件单独上传，直接写入rbd image
+    '''
+    name = forms.CharField(label='镜像名称', max_length=100)
+    version = forms.CharField(label='系统版本信息', max_length=100)
+    type = forms.ModelChoiceField(label='类型', queryset=ImageType.objects.all())
+    ceph_pool = forms.ModelChoiceField(label='CEPH存储后端', queryset=CephPool.objects.filter(enable=True))
+    xml_tpl = forms.ModelChoiceField(label='xml模板', queryset=VmXmlTemplate.objects.all())
+    sys_type = forms.TypedChoiceField(label='系统类型', choices=Image.CHOICES_SYS_TYPE, coerce=int,
+                                      initial=Image.SYS_TYPE_LINUX)
+    tag = forms.TypedChoiceField(label='镜像标签', choices=Image.CHOICES_TAG, coerce=int, initial=Image.TAG_BASE)
+    desc = forms.CharField(label='描述', required=False, widget=forms.Textarea(attrs={'rows': 3}))
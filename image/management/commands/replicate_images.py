@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from image.managers import ImageReplicaManager, ImageError
+
+
+class Command(BaseCommand):
+    help = '全局镜像的当前快照增量复制到其他接收全局镜像的ceph pool，并创建或更新复制镜像元数据'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--image-id', type=int, action='append', default=[], dest='image_ids',
+            help='只复制指定的全局镜像；可多次指定，默认所有全局镜像')
+
+    def handle(self, *args, **options):
+        manager = ImageReplicaManager()
+        images = manager.get_global_image_queryset()
+        if options['image_ids']:
+            images = images.filter(id__in=options['image_ids'])
+
+        failed = 0
+        for image in images:
+            try:
+                results = manager.replicate_image(image=image)
+            except ImageError as e:
+                self.stderr.write(str(e))
+                failed += 1
+                continue
+
+            for pool, replica, copied, err in results:
+                if err:
+                    self.stderr.write(f'镜像<{image.fullname}>复制到{pool}失败，{err}')
+                    failed += 1
+                else:
+                    self.stdout.write(f'镜像<{image.fullname}>复制到{pool}完成，快照{replica.snap}，复制数据{copied}字节')
+
+        if failed:
+            raise CommandError(f'{failed}个复制失败')
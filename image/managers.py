@@ -1,6 +1,10 @@
+from uuid import uuid4
+
 from django.db.models import Q
 
-from .models import Image, ImageType
+from .models import Image, ImageType, VmXmlTemplate
+from ceph.models import CephPool
+from ceph.managers import get_rbd_manager, RadosError, sync_image_changes, CephPoolPlacement
 from compute.managers import CenterManager, ComputeError
 from utils.errors import ImageError
 
@@ -30,6 +34,31 @@ class ImageManager:
         except Exception as e:
             raise ImageError(msg=f'查询镜像时错误,{str(e)}')
 
+    def get_image_reader(self, image_id: int):
+        """
+        获取镜像当前生效快照数据的流式读取对象，用于导出下载
+
+        :param image_id: 镜像id
+        :return:
+            (RbdImageStreamReader(), filename)     # success
+        :raise ImageError
+        """
+        image = self.get_image_by_id(image_id, related_fields=('ceph_pool__ceph',))
+        if not image:
+            raise ImageError(msg='镜像不存在')
+
+        if not image.snap:
+            raise ImageError(msg='镜像没有生效的快照')
+
+        ceph_pool = image.ceph_pool
+        try:
+            rbd = get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+            reader = rbd.open_image_reader(image_name=image.base_image, snap=image.snap)
+        except RadosError as e:
+            raise ImageError(msg=f'打开镜像失败，{str(e)}')
+
+        return reader, f'{image.base_image}@{image.snap}.raw'
+
     def get_image_type_queryset(self):
         '''
         可用镜像类型查询集
@@ -141,3 +170,257 @@ class ImageManager:
 
         return queryset.select_related(*related_fields).all()
 
+    def check_create_image_params(self, name: str, version: str, ceph_pool_id: int, type_id: int, xml_tpl_id: int,
+                                  sys_type: int = Image.SYS_TYPE_OTHER, tag: int = Image.TAG_USER):
+        """
+        检查创建镜像的参数
+
+        :return:
+            (CephPool(), ImageType(), VmXmlTemplate())
+        :raises: ImageError
+        """
+        if not name or not version:
+            raise ImageError(msg='镜像名称和系统版本不能为空')
+
+        if sys_type not in dict(Image.CHOICES_SYS_TYPE) or tag not in dict(Image.CHOICES_TAG):
+            raise ImageError(msg='系统类型或镜像标签参数无效')
+
+        if Image.objects.filter(name=name, version=version, ceph_pool_id=ceph_pool_id).exists():
+            raise ImageError(msg=f'镜像"{name} {version}"已存在')
+
+        ceph_pool = CephPool.objects.select_related('ceph').filter(id=ceph_pool_id).first()
+        if not ceph_pool or not ceph_pool.ceph:
+            raise ImageError(msg='ceph pool不存在')
+
+        image_type = ImageType.objects.filter(id=type_id).first()
+        if not image_type:
+            raise ImageError(msg='镜像类型不存在')
+
+        xml_tpl = VmXmlTemplate.objects.filter(id=xml_tpl_id).first()
+        if not xml_tpl:
+            raise ImageError(msg='xml模板不存在')
+
+        return ceph_pool, image_type, xml_tpl
+
+    @staticmethod
+    def new_base_image_name():
+        """
+        上传镜像的rbd image名称
+        """
+        return f'image_{uuid4().hex}'
+
+    def create_image_with_rbd(self, base_image: str, name: str, version: str, ceph_pool, image_type, xml_tpl,
+                              sys_type: int = Image.SYS_TYPE_OTHER, tag: int = Image.TAG_USER, desc: str = '',
+                              user=None):
+        """
+        为已写入数据的rbd image创建镜像快照和镜像元数据，失败时删除rbd image
+
+        :param base_image: 已写入镜像数据的rbd image名称
+        :return:
+            Image()
+        :raises: ImageError
+        """
+        image = Image(name=name, version=version, type=image_type, ceph_pool=ceph_pool, tag=tag, sys_type=sys_type,
+                      base_image=base_image, xml_tpl=xml_tpl, user=user, desc=desc,
+                      create_newsnap=True)   # 保存时创建镜像快照
+        try:
+            image.save()
+        except Exception as e:
+            try:
+                rbd = get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+                rbd.remove_image(image_name=base_image)
+            except RadosError:
+                pass
+            raise ImageError(msg=f'创建镜像快照或镜像元数据失败，{str(e)}')
+
+        return image
+
+    def create_image_from_stream(self, chunks, name: str, version: str, ceph_pool_id: int, type_id: int,
+                                 xml_tpl_id: int, sys_type: int = Image.SYS_TYPE_OTHER, tag: int = Image.TAG_USER,
+                                 desc: str = '', user=None):
+        """
+        上传数据流创建系统镜像，数据直接写入新的rbd image，然后创建镜像快照和镜像元数据
+
+        :param chunks: 可迭代的镜像数据块，raw格式
+        :param name: 镜像名称
+        :param version: 系统版本信息
+        :param ceph_pool_id: 镜像存储的ceph pool id
+        :param type_id: 镜像类型id
+        :param xml_tpl_id: xml模板id
+        :param sys_type: 系统类型
+        :param tag: 镜像标签
+        :param desc: 描述
+        :param user: 创建者
+        :return:
+            Image()
+        :raises: ImageError
+        """
+        ceph_pool, image_type, xml_tpl = self.check_create_image_params(
+            name=name, version=version, ceph_pool_id=ceph_pool_id, type_id=type_id, xml_tpl_id=xml_tpl_id,
+            sys_type=sys_type, tag=tag)
+
+        base_image = self.new_base_image_name()
+        data_pool = ceph_pool.data_pool if ceph_pool.has_data_pool else None
+        try:
+            rbd = get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+            rbd.import_image_from_stream(image_name=base_image, chunks=chunks, data_pool=data_pool,
+                                         features=ceph_pool.rbd_features_mask)
+        except RadosError as e:
+            raise ImageError(msg=f'上传镜像数据失败，{str(e)}')
+
+        return self.create_image_with_rbd(
+            base_image=base_image, name=name, version=version, ceph_pool=ceph_pool, image_type=image_type,
+            xml_tpl=xml_tpl, sys_type=sys_type, tag=tag, desc=desc, user=user)
+
+    @staticmethod
+    def choose_image_copy(image):
+        """
+        选择创建虚拟机系统盘的镜像；全局镜像在同一分中心的多个ceph pool有复制镜像时，
+        按pool的剩余容量和负载选择，系统盘克隆在所选镜像的pool中
+
+        :param image: 镜像Image()
+        :return:
+            Image()
+        """
+        root_id = image.source_id or image.id
+        copies = list(Image.objects.select_related('ceph_pool__ceph', 'xml_tpl').filter(
+            Q(id=root_id) | Q(source_id=root_id), enable=True, ceph_pool__enable=True,
+            ceph_pool__ceph__center_id=image.ceph_pool.ceph.center_id).exclude(snap=''))
+        if len(copies) <= 1:
+            return image
+
+        return CephPoolPlacement().choose([(c, c.ceph_pool, None, None) for c in copies])
+
+
+class ImageReplicaManager:
+    '''
+    全局镜像复制管理器
+
+    全局镜像的当前快照复制到其他接收全局镜像的ceph pool，目标pool中的rbd image和快照与源镜像同名；
+    目标pool已有复制镜像时，只复制相对于复制镜像当前快照变化的数据，源镜像保留复制镜像的当前快照作为增量复制的基础
+    '''
+    ImageError = ImageError
+
+    @staticmethod
+    def get_global_image_queryset():
+        '''
+        全局镜像查询集
+        :return: QuerySet()
+        '''
+        return Image.objects.select_related('ceph_pool__ceph').filter(is_global=True, source=None).all()
+
+    @staticmethod
+    def get_replica_pools(image):
+        '''
+        镜像要复制到的ceph pool，源镜像pool以外启用并接收全局镜像的pool；
+        同一分中心的多个pool都有镜像时，创建虚拟机时按pool剩余容量和负载选择
+
+        :param image: 全局镜像Image()
+        :return: QuerySet()
+        '''
+        return CephPool.objects.select_related('ceph').filter(enable=True, image_replica=True).exclude(
+            id=image.ceph_pool_id)
+
+    def replicate_image(self, image):
+        '''
+        复制全局镜像的当前快照到其他pool，一个pool复制失败不影响其他pool
+
+        :param image: 全局镜像Image()
+        :return:
+            [(CephPool(), Image() or None, copied:int, err:str)]
+        :raises: ImageError
+        '''
+        if not image.is_global or image.source_id:
+            raise ImageError(msg=f'镜像"{image.fullname}"不是全局镜像')
+        if not image.snap:
+            raise ImageError(msg=f'镜像"{image.fullname}"没有快照')
+
+        src_pool = image.ceph_pool
+        try:
+            src_rbd = get_rbd_manager(ceph=src_pool.ceph, pool_name=src_pool.pool_name)
+        except RadosError as e:
+            raise ImageError(msg=str(e))
+
+        results = []
+        old_snaps = set()
+        for pool in self.get_replica_pools(image):
+            replica = image.replicas.filter(ceph_pool=pool).first()
+            if replica:
+                old_snaps.add(replica.snap)
+            try:
+                replica, copied = self._replicate_to_pool(image=image, src_rbd=src_rbd, pool=pool, replica=replica)
+            except (ImageError, RadosError) as e:
+                results.append((pool, replica, 0, str(e)))
+                continue
+            results.append((pool, replica, copied, ''))
+
+        # 不再是任何复制镜像增量基础的旧快照
+        for snap in old_snaps:
+            if snap == image.snap or image.is_snap_replicated(snap):
+                continue
+            try:
+                if not src_rbd.list_snap_children(image_name=image.base_image, snap=snap):
+                    src_rbd.remove_snap(image_name=image.base_image, snap=snap)
+            except RadosError:
+                pass
+
+        return results
+
+    def _replicate_to_pool(self, image, src_rbd, pool, replica=None):
+        '''
+        复制全局镜像的当前快照到一个ceph pool，创建或更新复制镜像元数据
+
+        :param image: 全局镜像Image()
+        :param src_rbd: 全局镜像所在pool的RbdManager()
+        :param pool: 目标CephPool()
+        :param replica: 目标pool中已有的复制镜像Image()
+        :return:
+            (Image(), copied:int)
+        :raises: ImageError, RadosError
+        '''
+        base_image = image.base_image
+        dst_rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+        from_snap = None
+        copied = 0
+        if replica is None:
+            if Image.objects.filter(name=image.name, version=image.version, ceph_pool=pool).exists():
+                raise ImageError(msg=f'pool<{pool.pool_name}>已存在镜像"{image.fullname}"，不是复制的镜像')
+
+            data_pool = pool.data_pool if pool.has_data_pool else None
+            if not dst_rbd.create_image(name=base_image, size=0, data_pool=data_pool, features=pool.rbd_features_mask):
+                raise ImageError(msg=f'pool<{pool.pool_name}>已存在rbd image<{base_image}>')
+            replica = Image(source=image, ceph_pool=pool, base_image=base_image, enable=image.enable)
+        elif replica.snap != image.snap:
+            src_snaps = {s['name'] for s in src_rbd.list_image_snaps(base_image)}
+            if replica.snap not in src_snaps:
+                raise ImageError(msg=f'源镜像快照<{replica.snap}>已不存在，无法增量复制，请删除复制镜像后重新复制')
+            from_snap = replica.snap
+
+        if replica.snap != image.snap:
+            try:
+                copied = sync_image_changes(src_rbd=src_rbd, image_name=base_image, snap=image.snap,
+                                            dst_rbd=dst_rbd, from_snap=from_snap)
+                dst_rbd.create_snap(image_name=base_image, snap_name=image.snap, protected=True)
+            except RadosError as e:
+                if replica.id is None:
+                    try:
+                        dst_rbd.remove_image(image_name=base_image)
+                    except RadosError:
+                        pass
+                raise e
+
+        for field in ('name', 'version', 'type_id', 'tag', 'sys_type', 'xml_tpl_id', 'desc'):
+            setattr(replica, field, getattr(image, field))
+        replica.snap = image.snap
+        try:
+            replica.save()
+        except Exception as e:
+            raise ImageError(msg=f'保存复制镜像元数据失败，{str(e)}')
+
+        if from_snap:
+            try:
+                dst_rbd.remove_snap(image_name=base_image, snap=from_snap)   # 还有克隆的系统盘时无法删除
+            except RadosError:
+                pass
+
+        return replica, copied
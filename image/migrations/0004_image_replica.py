@@ -0,0 +1,29 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ceph', '0004_cephpool_image_replica'),
+        ('image', '0003_auto_20191122_1541'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='is_global',
+            field=models.BooleanField(default=False, help_text='选中时，镜像快照可以复制到其他分中心接收全局镜像的ceph pool', verbose_name='全局镜像'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='source',
+            field=models.ForeignKey(blank=True, help_text='从其他分中心全局镜像复制的镜像', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='replicas', to='image.Image', verbose_name='复制源镜像'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='image',
+            unique_together={('name', 'version', 'ceph_pool')},
+        ),
+    ]
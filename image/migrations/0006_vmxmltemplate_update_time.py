@@ -0,0 +1,23 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image', '0004_image_replica'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmxmltemplate',
+            name='update_time',
+            field=models.DateTimeField(auto_now=True, verbose_name='修改时间'),
+        ),
+        migrations.AlterField(
+            model_name='vmxmltemplate',
+            name='xml',
+            field=models.TextField(help_text='变量格式如{uuid}，可用的变量：name、uuid、mem、vcpu、ceph_uuid、ceph_pool、diskname、ceph_username、ceph_hosts_xml、mac、bridge', verbose_name='XML模板'),
+        ),
+    ]
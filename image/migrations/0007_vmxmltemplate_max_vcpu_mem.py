@@ -0,0 +1,28 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image', '0006_vmxmltemplate_update_time'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vmxmltemplate',
+            name='max_mem',
+            field=models.IntegerField(default=0, help_text='单位MB，模板变量max_mem的值，运行中的虚拟机可通过balloon热调整内存到此大小；小于mem时等于mem', verbose_name='最大内存'),
+        ),
+        migrations.AddField(
+            model_name='vmxmltemplate',
+            name='max_vcpu',
+            field=models.IntegerField(default=0, help_text='模板变量max_vcpu的值，运行中的虚拟机可热调整vcpu到此数量；小于vcpu时等于vcpu', verbose_name='最大vcpu'),
+        ),
+        migrations.AlterField(
+            model_name='vmxmltemplate',
+            name='xml',
+            field=models.TextField(help_text='变量格式如{uuid}，可用的变量：name、uuid、mem、vcpu、max_mem、max_vcpu、ceph_uuid、ceph_pool、diskname、ceph_username、ceph_hosts_xml、mac、bridge；支持热调整配置的模板如<vcpu current="{vcpu}">{max_vcpu}</vcpu>、<memory unit="MiB">{max_mem}</memory><currentMemory unit="MiB">{mem}</currentMemory>', verbose_name='XML模板'),
+        ),
+    ]
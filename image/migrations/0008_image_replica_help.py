@@ -0,0 +1,24 @@
+# Generated by Django 2.2.16 on 2026-10-19 01:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('image', '0007_vmxmltemplate_max_vcpu_mem'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='is_global',
+            field=models.BooleanField(default=False, help_text='选中时，镜像快照可以复制到其他接收全局镜像的ceph pool', verbose_name='全局镜像'),
+        ),
+        migrations.AlterField(
+            model_name='image',
+            name='source',
+            field=models.ForeignKey(blank=True, help_text='从全局镜像复制的镜像', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='replicas', to='image.Image', verbose_name='复制源镜像'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 
@@ -14,8 +15,16 @@ class VmXmlTemplate(models.Model):
     '''
     id = models.AutoField(primary_key=True)
     name = models.CharField(verbose_name='模板名称', max_length=100, unique=True)
-    xml = models.TextField(verbose_name='XML模板')
+    xml = models.TextField(verbose_name='XML模板', help_text='变量格式如{uuid}，可用的变量：name、uuid、mem、vcpu、'
+                           'max_mem、max_vcpu、ceph_uuid、ceph_pool、diskname、ceph_username、ceph_hosts_xml、mac、bridge；'
+                           '支持热调整配置的模板如<vcpu current="{vcpu}">{max_vcpu}</vcpu>、'
+                           '<memory unit="MiB">{max_mem}</memory><currentMemory unit="MiB">{mem}</currentMemory>')
+    max_vcpu = models.IntegerField(verbose_name='最大vcpu', default=0,
+                                   help_text='模板变量max_vcpu的值，运行中的虚拟机可热调整vcpu到此数量；小于vcpu时等于vcpu')
+    max_mem = models.IntegerField(verbose_name='最大内存', default=0,
+                                  help_text='单位MB，模板变量max_mem的值，运行中的虚拟机可通过balloon热调整内存到此大小；小于mem时等于mem')
     desc = models.TextField(verbose_name='描述', default='', blank=True)
+    update_time = models.DateTimeField(verbose_name='修改时间', auto_now=True)
 
     def __str__(self):
         return self.name
@@ -24,6 +33,17 @@ class VmXmlTemplate(models.Model):
         verbose_name = '虚拟机XML模板'
         verbose_name_plural = '08_虚拟机XML模板'
 
+    def clean(self):
+        '''
+        保存前检查模板变量和填充后的xml是否有效
+        '''
+        from vms.xml import compile_xml_template, XMLError
+
+        try:
+            compile_xml_template(self.xml, has_auth=False)
+        except XMLError as e:
+            raise ValidationError({'xml': str(e)})
+
 
 class ImageType(models.Model):
     '''
@@ -84,6 +104,10 @@ class Image(models.Model):
     create_time = models.DateTimeField(auto_now_add=True)
     update_time = models.DateTimeField(auto_now=True)
     desc = models.TextField(verbose_name='描述', default='', blank=True)
+    is_global = models.BooleanField(verbose_name='全局镜像', default=False,
+                                    help_text='选中时，镜像快照可以复制到其他接收全局镜像的ceph pool')
+    source = models.ForeignKey(to='self', on_delete=models.SET_NULL, null=True, blank=True, related_name='replicas',
+                               verbose_name='复制源镜像', help_text='从全局镜像复制的镜像')
 
     def __str__(self):
         return self.name
@@ -92,7 +116,7 @@ class Image(models.Model):
         ordering = ['-id']
         verbose_name = '操作系统镜像'
         verbose_name_plural = '10_操作系统镜像'
-        unique_together = ('name', 'version')
+        unique_together = ('name', 'version', 'ceph_pool')
 
     @property
     def fullname(self):
@@ -132,10 +156,13 @@ class Image(models.Model):
         self.create_newsnap = False
         try:
             rbd = get_rbd_manager(ceph=config, pool_name=pool_name)
-            try:
-                rbd.remove_snap(image_name=self.base_image, snap=self.snap)     # 删除旧快照
-            except RadosError as e:
-                pass
+            if not self.is_snap_replicated(self.snap):
+                try:
+                    rbd.remove_snap(image_name=self.base_image, snap=self.snap)     # 删除旧快照
+                except RadosError as e:
+                    # 旧快照还有克隆的系统盘时无法删除，
+                    # 通过命令"manage.py flatten_sys_disk --image-id"flatten这些系统盘后删除旧快照
+                    pass
             rbd.create_snap(image_name=self.base_image, snap_name=snap_name, protected=True)
         except RadosError as e:
             raise Exception(f'create_snap error, {str(e)}')
@@ -143,6 +170,15 @@ class Image(models.Model):
         self.snap = snap_name
         return True
 
+    def is_snap_replicated(self, snap: str):
+        '''
+        快照是否是复制镜像的当前快照，是下一次增量复制的基础，不能删除
+        '''
+        if not self.id or not snap:
+            return False
+
+        return self.replicas.filter(snap=snap).exists()
+
     def delete(self, using=None, keep_parents=False):
         self._remove_image()
         super().delete(using=using, keep_parents=keep_parents)
@@ -0,0 +1,104 @@
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+from django.core.files.uploadedfile import UploadedFile
+
+from ceph.managers import RbdImageStreamWriter, RadosError
+
+
+class RbdUploadedFile(UploadedFile):
+    '''
+    数据已写入rbd image的上传文件
+    '''
+    def __init__(self, rbd_image: str, name, size, content_type=None, charset=None):
+        super().__init__(file=None, name=name, content_type=content_type, size=size, charset=charset)
+        self.rbd_image = rbd_image
+
+
+class RbdImageUploadHandler(FileUploadHandler):
+    '''
+    上传的文件直接写入新的rbd image，不缓存到内存或本地磁盘；只接收一个文件
+    '''
+    chunk_size = 4 * 1024 ** 2
+
+    def __init__(self, request, rbd_manager, image_name: str, data_pool=None, features=None):
+        '''
+        :param rbd_manager: RbdManager()
+        :param image_name: 新的rbd image名称
+        :param data_pool: 如果指定，数据存储的到此pool
+        :param features: image特性掩码，默认None使用ceph集群默认特性
+        '''
+        super().__init__(request=request)
+        self.rbd_manager = rbd_manager
+        self.image_name = image_name
+        self.data_pool = data_pool
+        self.features = features
+        self.error = ''
+        self._image = None
+        self._writer = None
+        self._created = False
+        self._completed = False
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        if self._created:
+            self.error = '只能上传一个镜像文件'
+            raise StopUpload(connection_reset=True)
+
+        try:
+            if not self.rbd_manager.create_image(name=self.image_name, size=0, data_pool=self.data_pool,
+                                                 features=self.features):
+                raise RadosError(f'rbd image "{self.image_name}" already exists')
+            self._created = True
+            self._image = self.rbd_manager.get_rbd_image(image_name=self.image_name)
+        except RadosError as e:
+            self.error = str(e)
+            self.abort()
+            raise StopUpload(connection_reset=True)
+
+        self._writer = RbdImageStreamWriter(image=self._image)
+
+    def receive_data_chunk(self, raw_data, start):
+        try:
+            self._writer.write(raw_data)
+        except RadosError as e:
+            self.error = str(e)
+            self.abort()
+            raise StopUpload(connection_reset=True)
+
+        return None     # 数据不再传递给其他上传处理器
+
+    def file_complete(self, file_size):
+        try:
+            size = self._writer.close()
+        except RadosError as e:
+            self.error = str(e)
+            self.abort()
+            return None
+
+        self._close_image()
+        self._completed = True
+        return RbdUploadedFile(rbd_image=self.image_name, name=self.file_name, size=size,
+                               content_type=self.content_type, charset=self.charset)
+
+    def upload_complete(self):
+        if not self._completed:
+            self.abort()
+
+    def abort(self):
+        '''
+        上传未完成，删除已创建的rbd image
+        '''
+        if self._writer is not None:
+            self._writer.wait_all()
+            self._writer = None
+        self._close_image()
+        if self._created:
+            try:
+                self.rbd_manager.remove_image(image_name=self.image_name)
+            except RadosError:
+                pass
+            self._created = False
+
+    def _close_image(self):
+        if self._image is not None:
+            self.rbd_manager.close_rbd_image(self._image)
+            self._image = None
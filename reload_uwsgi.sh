@@ -1 +1,2 @@
-uwsgi --reload uwsgi-master.pid
\ No newline at end of file
+uwsgi --reload uwsgi-master.pid
+uwsgi --reload uwsgi-upload-master.pid
\ No newline at end of file
@@ -1 +1,2 @@
-uwsgi --ini evcloud_uwsgi.ini
\ No newline at end of file
+uwsgi --ini evcloud_uwsgi.ini
+uwsgi --ini evcloud_upload_uwsgi.ini
\ No newline at end of file
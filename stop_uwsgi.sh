@@ -1 +1,2 @@
-uwsgi --stop uwsgi-master.pid
\ No newline at end of file
+uwsgi --stop uwsgi-master.pid
+uwsgi --stop uwsgi-upload-master.pid
\ No newline at end of file
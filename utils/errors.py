@@ -128,3 +128,10 @@ class ComputeError(Error):
     计算资源相关错误定义
     """
     pass
+
+
+class BackupError(Error):
+    """
+    硬盘备份相关错误定义
+    """
+    pass
@@ -1,6 +1,16 @@
+import fcntl
+import functools
+import itertools
+import json
+import logging
+import os
 import subprocess
+import threading
+import time
+from contextlib import contextmanager, ExitStack
 
 import libvirt
+from django.conf import settings
 
 
 VIR_DOMAIN_NOSTATE = 0  # no state
@@ -193,10 +203,337 @@ def wrap_error(err: libvirt.libvirtError, msg=''):
     return VirtError(code=err_code, msg=msg, err=err)
 
 
+class HostOpSemaphore:
+    '''
+    宿主机libvirt重操作信号量，限制本服务器上所有进程、线程对一个宿主机同时执行的操作数，
+    避免批量启动、创建虚拟机时大量请求同时到达一个libvirtd
+
+    每个宿主机一个排队文件，通过文件锁互斥修改；按申请顺序排队，队列中前limit个可以执行，
+    进程已退出的排队记录自动清除；排队目录和文件所有用户可读写，web服务和管理命令可以以不同用户运行
+    '''
+    _ticket_counter = itertools.count()
+    FILE_MODE = 0o666
+    DIR_MODE = 0o1777       # 同/tmp，所有用户可以创建文件，只能删除自己的文件
+
+    def __init__(self, host_ip: str, limit: int = None, timeout: float = None, queue_dir: str = None):
+        """
+        :param host_ip: 宿主机IP
+        :param limit: 同时执行的操作数，默认settings.VIRT_HOST_OP_LIMIT，0不限制
+        :param timeout: 排队等待超时秒数，默认settings.VIRT_HOST_OP_TIMEOUT
+        :param queue_dir: 排队文件所在目录，默认settings.VIRT_HOST_OP_QUEUE_DIR
+        """
+        self.host_ip = host_ip or 'localhost'
+        self.limit = getattr(settings, 'VIRT_HOST_OP_LIMIT', 0) if limit is None else limit
+        self.timeout = getattr(settings, 'VIRT_HOST_OP_TIMEOUT', 300) if timeout is None else timeout
+        queue_dir = queue_dir or getattr(settings, 'VIRT_HOST_OP_QUEUE_DIR', '/var/evcloud/host_ops')
+        self.queue_dir = queue_dir
+        self.path = os.path.join(queue_dir, f'{self.host_ip}.json')
+
+    @staticmethod
+    def _pid_alive(pid: int):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @contextmanager
+    def _locked_queue(self):
+        '''
+        加文件锁读取排队记录，退出时写回
+
+        :return:
+            [[ticket:str, pid:int, op:str, time:float], ]
+        '''
+        self._make_queue_file()
+        with open(self.path, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                queue = json.loads(f.read() or '[]')
+            except ValueError:
+                queue = []
+            queue = [q for q in queue if self._pid_alive(q[1])]
+            try:
+                yield queue
+            finally:
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(queue))
+
+    def _make_queue_file(self):
+        '''
+        创建排队目录和文件，设置为所有用户可读写（不受umask影响）
+
+        :raises: OSError
+        '''
+        if not os.path.isdir(self.queue_dir):
+            os.makedirs(self.queue_dir, exist_ok=True)
+            try:
+                os.chmod(self.queue_dir, self.DIR_MODE)
+            except OSError:
+                pass    # 其他进程创建的
+
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_EXCL, self.FILE_MODE)
+        except FileExistsError:
+            return
+        try:
+            os.fchmod(fd, self.FILE_MODE)
+        finally:
+            os.close(fd)
+
+    def acquire(self, op: str = ''):
+        '''
+        排队直到可以执行
+
+        :param op: 操作名称，如start、define
+        :return:
+            ticket: str     # 用于release()
+
+        :raises: VirtError  # 排队超时; OSError  # 排队文件读写错误
+        '''
+        pid = os.getpid()
+        ticket = f'{pid}-{threading.get_ident()}-{next(self._ticket_counter)}'
+        deadline = time.time() + self.timeout
+        interval = 0.05
+        while True:
+            with self._locked_queue() as queue:
+                tickets = [q[0] for q in queue]
+                if ticket not in tickets:
+                    queue.append([ticket, pid, op, time.time()])
+                    tickets.append(ticket)
+                index = tickets.index(ticket)
+                if index < self.limit:
+                    return ticket
+
+                if time.time() > deadline:
+                    del queue[index]
+                    raise VirtError(msg=f'宿主机{self.host_ip}上执行中的操作过多，排队{self.timeout}秒超时，'
+                                        f'排在第{index - self.limit + 1}位')
+
+            time.sleep(interval)
+            interval = min(interval * 2, 1)
+
+    def release(self, ticket: str):
+        with self._locked_queue() as queue:
+            queue[:] = [q for q in queue if q[0] != ticket]
+
+    @contextmanager
+    def slot(self, op: str = ''):
+        '''
+        with HostOpSemaphore(host_ip).slot('start'):
+            ...
+
+        排队文件读写错误（如目录没有权限）时不限制，记录错误日志，不影响操作执行
+        '''
+        if self.limit <= 0:
+            yield
+            return
+
+        try:
+            ticket = self.acquire(op=op)
+        except OSError as e:
+            logging.getLogger('debug').error(f'宿主机操作排队文件{self.path}读写错误，不限制同时执行的操作数，{str(e)}')
+            ticket = None
+        try:
+            yield
+        finally:
+            if ticket is not None:
+                try:
+                    self.release(ticket)
+                except OSError:
+                    pass    # 进程退出后排队记录会被自动清除
+
+    def queue_depth(self):
+        '''
+        宿主机上执行中和排队中的操作数
+
+        :return:
+            (running:int, waiting:int)
+        '''
+        if self.limit <= 0 or not os.path.exists(self.path):
+            return 0, 0
+
+        try:
+            with self._locked_queue() as queue:
+                n = len(queue)
+        except OSError:
+            return 0, 0
+        return min(n, self.limit), max(n - self.limit, 0)
+
+
+def host_op_slot(host_ip: str, op: str = ''):
+    '''
+    在宿主机上执行重操作前排队，限制宿主机上同时执行的操作数
+
+    :raises: VirtError  # 排队超时
+    '''
+    return HostOpSemaphore(host_ip=host_ip).slot(op=op)
+
+
+class _FlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.forgotten = False
+
+
+class SingleFlight:
+    '''
+    合并本进程内相同的并发调用：同一key同时只执行一次，其他调用等待并共享结果或异常；
+    ttl>0时成功的结果缓存ttl秒，覆盖短时间内的重复查询
+    '''
+    STATS_LOG_EVERY = 1000     # 每多少次调用记录一次统计日志
+
+    def __init__(self, name: str = ''):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}    # {key: _FlightCall()}
+        self._cache = {}    # {key: (expire_time, result)}
+        self._stats = {'calls': 0, 'executed': 0, 'shared': 0, 'cached': 0}
+
+    def do(self, key: tuple, func, ttl: float = 0):
+        '''
+        :param key: 调用的标识，如('status', host_ipv4, vm_uuid)
+        :param func: 无参数的调用函数
+        :param ttl: 结果缓存秒数，0只合并并发的调用
+        :return:
+            func()的返回值
+
+        :raises: func()抛出的异常
+        '''
+        with self._lock:
+            self._stats['calls'] += 1
+            if self._stats['calls'] % self.STATS_LOG_EVERY == 0:
+                logging.getLogger('debug').debug(f'libvirt read singleflight {self.name}: {self._get_stats()}')
+            if ttl > 0:
+                cached = self._cache.get(key)
+                if cached is not None and cached[0] > time.monotonic():
+                    self._stats['cached'] += 1
+                    return cached[1]
+
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _FlightCall()
+                self._stats['executed'] += 1
+            else:
+                self._stats['shared'] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+                if ttl > 0 and call.error is None and not call.forgotten:
+                    self._store(key=key, result=call.result, ttl=ttl)
+            call.event.set()
+
+        return call.result
+
+    def _store(self, key, result, ttl: float):
+        now = time.monotonic()
+        if len(self._cache) >= 1024:
+            self._cache = {k: v for k, v in self._cache.items() if v[0] > now}
+        self._cache[key] = (now + ttl, result)
+
+    def forget(self, match):
+        '''
+        清除缓存的结果，执行中的调用结果不再缓存，之后的调用重新执行
+
+        :param match: 函数match(key) -> bool，返回True的key被清除
+        '''
+        with self._lock:
+            for key in [k for k in self._cache if match(k)]:
+                del self._cache[key]
+            for key in [k for k in self._calls if match(k)]:
+                self._calls.pop(key).forgotten = True
+
+    def _get_stats(self):
+        stats = dict(self._stats)
+        calls = stats['calls']
+        stats['coalesced_ratio'] = round((calls - stats['executed']) / calls, 4) if calls else 0
+        return stats
+
+    def get_stats(self):
+        '''
+        调用统计
+
+        :return:
+            {
+                'calls': int,       # 调用次数
+                'executed': int,    # 实际执行次数
+                'shared': int,      # 共享执行中调用结果的次数
+                'cached': int,      # 使用缓存结果的次数
+                'coalesced_ratio': float    # 被合并的调用比例，(calls - executed) / calls
+            }
+        '''
+        with self._lock:
+            return self._get_stats()
+
+
+def _coalesce_read(op: str):
+    '''
+    VirtAPI(host_ipv4, vm_uuid)读取方法的装饰器，本进程内相同的并发调用合并为一次，
+    结果缓存settings.VIRT_READ_CACHE_TTL秒
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, host_ipv4: str, vm_uuid: str):
+            ttl = getattr(settings, 'VIRT_READ_CACHE_TTL', 0)
+            return VirtAPI.read_flight.do(key=(op, host_ipv4, vm_uuid), func=lambda: func(self, host_ipv4, vm_uuid),
+                                          ttl=ttl)
+        return wrapper
+    return decorator
+
+
+def forget_domain_reads(host_ipv4: str = None, vm_uuid: str = None):
+    '''
+    清除本进程中虚拟机（vm_uuid为None时宿主机上所有虚拟机）合并缓存的读取结果
+    '''
+    if vm_uuid is not None:
+        VirtAPI.read_flight.forget(lambda key: key[2] == vm_uuid)
+    else:
+        VirtAPI.read_flight.forget(lambda key: key[1] == host_ipv4)
+
+
+def _forget_reads(func):
+    '''
+    修改虚拟机的方法执行后，清除此虚拟机合并缓存的读取结果；VirtAPI(host_ipv4, vm_uuid)方法或VmDomain的方法
+    '''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            if isinstance(self, VmDomain):
+                forget_domain_reads(vm_uuid=self._vmid)
+            else:
+                vm_uuid = kwargs['vm_uuid'] if 'vm_uuid' in kwargs else args[1]
+                forget_domain_reads(vm_uuid=vm_uuid)
+    return wrapper
+
+
 class VirtAPI(object):
     '''
     libvirt api包装
     '''
+    read_flight = SingleFlight(name='VirtAPI')     # 虚拟机状态、是否存在、xml读取的合并
+
     def __init__(self):
         self.VirtError = VirtError
 
@@ -252,12 +589,14 @@ class VirtAPI(object):
 
         :raise VirtError()
         '''
-        conn = self._get_connection(host_ipv4)
-        try:
-            dom = conn.defineXML(xml_desc)
-            return dom
-        except libvirt.libvirtError as e:
-            raise wrap_error(err=e)
+        with host_op_slot(host_ipv4, 'define'):
+            conn = self._get_connection(host_ipv4)
+            try:
+                dom = conn.defineXML(xml_desc)
+                forget_domain_reads(vm_uuid=dom.UUIDString())
+                return dom
+            except libvirt.libvirtError as e:
+                raise wrap_error(err=e)
 
     def get_domain(self, host_ipv4:str, vm_uuid:str):
         '''
@@ -277,6 +616,7 @@ class VirtAPI(object):
         except libvirt.libvirtError as e:
             raise wrap_error(err=e)
 
+    @_coalesce_read('exists')
     def domain_exists(self, host_ipv4:str, vm_uuid:str):
         '''
         检测虚拟机是否已存在
@@ -298,6 +638,7 @@ class VirtAPI(object):
         except libvirt.libvirtError as e:
             raise wrap_error(err=e)
 
+    @_forget_reads
     def undefine(self, host_ipv4:str, vm_uuid:str):
         '''
         删除一个虚拟机
@@ -322,6 +663,7 @@ class VirtAPI(object):
         except libvirt.libvirtError as e:
             raise wrap_error(err=e, msg=f'删除虚拟机失败,{str(e)}')
 
+    @_coalesce_read('status')
     def domain_status(self, host_ipv4:str, vm_uuid:str):
         '''
         获取虚拟机的当前状态
@@ -424,6 +766,7 @@ class VirtAPI(object):
             return True
         return False
 
+    @_forget_reads
     def start(self, host_ipv4:str, vm_uuid:str):
         '''
         开机启动一个虚拟机
@@ -436,18 +779,20 @@ class VirtAPI(object):
 
         :raise VirtError()
         '''
-        domain = self.get_domain(host_ipv4, vm_uuid)
-        if self._domain_is_running(domain):
-            return True
-
-        try:
-            res = domain.create()
-            if res == 0:
+        with host_op_slot(host_ipv4, 'start'):
+            domain = self.get_domain(host_ipv4, vm_uuid)
+            if self._domain_is_running(domain):
                 return True
-            return False
-        except libvirt.libvirtError as e:
-            raise wrap_error(err=e, msg=f'启动虚拟机失败,{str(e)}')
 
+            try:
+                res = domain.create()
+                if res == 0:
+                    return True
+                return False
+            except libvirt.libvirtError as e:
+                raise wrap_error(err=e, msg=f'启动虚拟机失败,{str(e)}')
+
+    @_forget_reads
     def reboot(self, host_ipv4:str, vm_uuid:str):
         '''
         重启虚拟机
@@ -460,18 +805,20 @@ class VirtAPI(object):
 
         :raise VirtError()
         '''
-        domain = self.get_domain(host_ipv4, vm_uuid)
-        if not self._domain_is_running(domain):
-            return False
+        with host_op_slot(host_ipv4, 'reboot'):
+            domain = self.get_domain(host_ipv4, vm_uuid)
+            if not self._domain_is_running(domain):
+                return False
 
-        try:
-            res = domain.reboot()
-            if res == 0:
-                return True
-            return False
-        except libvirt.libvirtError as e:
-            raise wrap_error(err=e, msg=f'重启虚拟机失败, {str(e)}')
+            try:
+                res = domain.reboot()
+                if res == 0:
+                    return True
+                return False
+            except libvirt.libvirtError as e:
+                raise wrap_error(err=e, msg=f'重启虚拟机失败, {str(e)}')
 
+    @_forget_reads
     def shutdown(self, host_ipv4:str, vm_uuid:str):
         '''
         关机
@@ -496,6 +843,7 @@ class VirtAPI(object):
         except libvirt.libvirtError as e:
             raise wrap_error(err=e, msg=f'关闭虚拟机失败, {str(e)}')
 
+    @_forget_reads
     def poweroff(self, host_ipv4:str, vm_uuid:str):
         '''
         关闭电源
@@ -520,6 +868,7 @@ class VirtAPI(object):
         except libvirt.libvirtError as e:
             raise wrap_error(err=e, msg=f'关闭虚拟机电源失败, {str(e)}')
 
+    @_coalesce_read('xml')
     def get_domain_xml_desc(self, host_ipv4:str, vm_uuid:str):
         '''
         动态从宿主机获取虚拟机的xml内容
@@ -677,32 +1026,168 @@ class VmDomain:
         """
         return self.virt.get_domain_xml_desc(host_ipv4=self._hip, vm_uuid=self._vmid)
 
-    def attach_device(self, xml: str):
+    def inactive_xml_desc(self):
         """
-        附加设备到虚拟机
+        获取虚拟机持久化定义的xml内容，不包括运行时的信息
 
-        :param xml: 设备xml
+        :return:
+            xml: str    # success
+
+        :raise VirtError()
+        """
+        domain = self.virt.get_domain(self._hip, self._vmid)
+        try:
+            return domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE)
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
+
+    def fstrim(self, minimum: int = 0):
+        """
+        通过guest agent在虚拟机内对所有已挂载的文件系统执行fstrim，释放已删除数据占用的硬盘空间；
+        需要虚拟机运行中、安装了qemu-guest-agent，并且硬盘开启了discard
+
+        :param minimum: 小于此大小（Bytes）的连续空闲区域不释放
         :return:
             True    # success
-            False   # failed
 
         :raises: VirtError
         """
         domain = self.virt.get_domain(self._hip, self._vmid)
         try:
-            ret = domain.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CONFIG)  # 指定将设备分配给持久化域
+            domain.fSTrim(None, minimum, 0)
         except libvirt.libvirtError as e:
-            msg = str(e)
-            err_code = e.get_error_code()
-            if err_code == VirErrorNumber.VIR_ERR_OPERATION_INVALID and 'exist' in msg:
-                return True
-            raise wrap_error(err=e, msg=msg)
+            raise wrap_error(err=e)
+        return True
 
-        if ret == 0:
-            return True
+    def job_stats(self):
+        """
+        虚拟机当前后台任务（如迁移）的统计信息
 
-        return False
+        :return:
+            dict    # libvirt jobStats，没有执行中的任务时type为VIR_DOMAIN_JOB_NONE
+
+        :raises: VirtError
+        """
+        domain = self.virt.get_domain(self._hip, self._vmid)
+        try:
+            return domain.jobStats()
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
+
+    @_forget_reads
+    def live_migrate(self, dst_host_ip: str, bandwidth: int = 0, compressed: bool = False,
+                     auto_converge: bool = True, max_downtime: int = 0, timeout: int = 0,
+                     progress=None, interval: float = 2):
+        """
+        热迁移运行中的虚拟机到目标宿主机（migrateToURI3），硬盘为共享的ceph rbd，只迁移内存；
+        迁移成功后虚拟机在目标宿主机持久化定义，源宿主机上的定义删除
+
+        :param dst_host_ip: 目标宿主机IP
+        :param bandwidth: 迁移带宽限制，单位MiB/s，0不限制
+        :param compressed: 是否压缩迁移的内存数据
+        :param auto_converge: 内存变化速度大于迁移速度时，是否自动降低虚拟机vcpu速度使迁移收敛
+        :param max_downtime: 迁移最后阶段虚拟机允许暂停的最长时间，单位毫秒，0使用libvirt默认值
+        :param timeout: 迁移超时时间（秒），超时中止迁移，0不限制
+        :param progress: 进度回调函数，progress(stats: dict)，参数为jobStats
+        :param interval: 获取进度的间隔秒数
+        :return:
+            dict    # 最后一次获取的jobStats
+
+        :raises: VirtError
+        """
+        with ExitStack() as op_slot:
+            # 只在迁移开始前占用宿主机操作数，迁移开始后释放，长时间的内存复制不阻塞其他操作排队
+            op_slot.enter_context(host_op_slot(self._hip, 'migrate'))
+            domain = self.virt.get_domain(self._hip, self._vmid)
+            flags = (libvirt.VIR_MIGRATE_LIVE | libvirt.VIR_MIGRATE_PEER2PEER | libvirt.VIR_MIGRATE_PERSIST_DEST |
+                     libvirt.VIR_MIGRATE_UNDEFINE_SOURCE)
+            if compressed:
+                flags |= libvirt.VIR_MIGRATE_COMPRESSED
+            if auto_converge:
+                flags |= libvirt.VIR_MIGRATE_AUTO_CONVERGE
+            params = {}
+            if bandwidth > 0:
+                params[libvirt.VIR_MIGRATE_PARAM_BANDWIDTH] = bandwidth
+
+            errors = []
+
+            def migrate():
+                try:
+                    domain.migrateToURI3(f'qemu+ssh://{dst_host_ip}/system', params, flags)
+                except libvirt.libvirtError as e:
+                    errors.append(e)
+
+            thread = threading.Thread(target=migrate, daemon=True)
+            thread.start()
+            stats = {}
+            downtime_set = False
+            aborted = False
+            start = time.time()
+            while True:
+                thread.join(timeout=interval)
+                if not thread.is_alive():
+                    break
+
+                try:
+                    job_stats = domain.jobStats()
+                except libvirt.libvirtError:
+                    continue
+                if job_stats.get('type', libvirt.VIR_DOMAIN_JOB_NONE) == libvirt.VIR_DOMAIN_JOB_NONE:
+                    continue
+
+                op_slot.close()
+                stats = job_stats
+                if max_downtime > 0 and not downtime_set:
+                    try:
+                        domain.migrateSetMaxDowntime(max_downtime, 0)    # 迁移开始后设置才对所有qemu版本有效
+                        downtime_set = True
+                    except libvirt.libvirtError:
+                        pass
+                if progress:
+                    progress(stats)
+                if timeout > 0 and not aborted and time.time() - start > timeout:
+                    try:
+                        domain.abortJob()
+                        aborted = True
+                    except libvirt.libvirtError:
+                        pass
+
+            if errors:
+                reason = f'超过{timeout}秒，已中止' if aborted else str(errors[0])
+                raise wrap_error(err=errors[0], msg=f'热迁移虚拟机失败，{reason}')
+
+            return stats
+
+    @_forget_reads
+    def attach_device(self, xml: str, ignore_exists: bool = True):
+        """
+        附加设备到虚拟机
+
+        :param xml: 设备xml
+        :param ignore_exists: True(默认)设备（如硬盘的target dev）已存在时视为成功；False时抛出错误
+        :return:
+            True    # success
+            False   # failed
 
+        :raises: VirtError
+        """
+        with host_op_slot(self._hip, 'attach'):
+            domain = self.virt.get_domain(self._hip, self._vmid)
+            try:
+                ret = domain.attachDeviceFlags(xml, libvirt.VIR_DOMAIN_AFFECT_CONFIG)  # 指定将设备分配给持久化域
+            except libvirt.libvirtError as e:
+                msg = str(e)
+                err_code = e.get_error_code()
+                if ignore_exists and err_code == VirErrorNumber.VIR_ERR_OPERATION_INVALID and 'exist' in msg:
+                    return True
+                raise wrap_error(err=e, msg=msg)
+
+            if ret == 0:
+                return True
+
+            return False
+
+    @_forget_reads
     def detach_device(self, xml: str):
         """
         从虚拟机拆卸设备
@@ -727,6 +1212,50 @@ class VmDomain:
             return True
         return False
 
+    @staticmethod
+    def _affect_flags(live: bool):
+        if live:
+            return libvirt.VIR_DOMAIN_AFFECT_LIVE | libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        return libvirt.VIR_DOMAIN_AFFECT_CONFIG
+
+    @_forget_reads
+    def set_vcpus(self, vcpu: int, live: bool = True):
+        """
+        修改虚拟机vcpu数，不能超过xml中vcpu的最大值
+
+        :param vcpu: vcpu数
+        :param live: True同时修改运行中的虚拟机（热插拔）和持久化定义；False只修改持久化定义，下次启动生效
+        :return:
+            True    # success
+
+        :raises: VirtError
+        """
+        domain = self.virt.get_domain(self._hip, self._vmid)
+        try:
+            domain.setVcpusFlags(vcpu, self._affect_flags(live))
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
+        return True
+
+    @_forget_reads
+    def set_memory(self, mem: int, live: bool = True):
+        """
+        修改虚拟机当前内存大小（balloon），不能超过xml中memory的最大值
+
+        :param mem: 内存大小，单位MiB
+        :param live: True同时修改运行中的虚拟机和持久化定义；False只修改持久化定义，下次启动生效
+        :return:
+            True    # success
+
+        :raises: VirtError
+        """
+        domain = self.virt.get_domain(self._hip, self._vmid)
+        try:
+            domain.setMemoryFlags(mem * 1024, self._affect_flags(live))  # 单位KiB
+        except libvirt.libvirtError as e:
+            raise wrap_error(err=e)
+        return True
+
     def set_user_password(self, username: str, password: str):
         """
         修改虚拟主机登录用户密码
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Vdisk, Quota
+from .models import Vdisk, Quota, VdiskSnap
 
 
 @admin.register(Quota)
@@ -43,3 +43,18 @@ class VdiskAdmin(admin.ModelAdmin):
 
     get_deleted.short_description = '删除状态'
 
+
+@admin.register(VdiskSnap)
+class VdiskSnapAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'vdisk', 'snap', 'size', 'create_time', 'remarks')
+    search_fields = ['disk', 'snap', 'remarks']
+
+    raw_id_fields = ('vdisk',)
+
+    def delete_queryset(self, request, queryset):
+        '''
+        后台管理批量删除重写， 通过每个对象的delete()方法删除，同时会删除ceph rbd快照
+        '''
+        for obj in queryset:
+            obj.delete()
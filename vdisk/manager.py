@@ -2,8 +2,10 @@ from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
 
+from ceph.managers import get_rbd_manager, RadosError, CephPoolPlacement
 from compute.managers import CenterManager, ComputeError
-from .models import Vdisk
+from vms.models import DiskFlattenTask
+from .models import Vdisk, VdiskSnap
 from .models import Quota
 from utils.errors import VdiskError
 
@@ -81,6 +83,24 @@ class VdiskManager:
         '''
         return self.get_quota_queryset().filter(group=group).all()
 
+    def choose_quota_by_group(self, group, size:int):
+        '''
+        从宿主机组的硬盘存储池配额中选择创建硬盘的配额，按配额和ceph pool的剩余容量、IO负载选择
+
+        :param group: 宿主机组对象或id
+        :param size: 要创建的硬盘大小，单位GB
+        :return:
+            Quota()
+            None    # 宿主机组没有配额
+        '''
+        quotas = list(self.get_quota_queryset_by_group(group=group).select_related('cephpool__ceph'))
+        candidates = [(q, q.cephpool, q.total - q.size_used, q.total) for q in quotas
+                      if q.cephpool and q.cephpool.enable and q.check_disk_size_limit(size=size) and q.meet_needs(size=size)]
+        if not candidates:
+            return quotas[0] if quotas else None    # 由调用者检查并返回具体的错误
+
+        return CephPoolPlacement().choose(candidates)
+
     def get_quota_queryset_by_group_ids(self, group_ids:list):
         '''
         获取宿主机组下的硬盘存储池配额查询集
@@ -153,12 +173,45 @@ class VdiskManager:
         except Exception as e:
             raise VdiskError(msg=str(e))
 
+    def get_vdisk_reader(self, uuid: str, user):
+        '''
+        获取硬盘数据的流式读取对象，用于导出下载；硬盘需要未挂载
+
+        :param uuid: 硬盘uuid
+        :param user: 用户
+        :return:
+            (RbdImageStreamReader(), filename)     # success
+
+        :raise:  VdiskError
+        '''
+        vdisk = self.get_vdisk_by_uuid(uuid=uuid, related_fields=('quota__cephpool__ceph',))
+        if not vdisk:
+            raise VdiskError(msg='硬盘不存在')
+
+        if not vdisk.user_has_perms(user=user):
+            raise VdiskError(msg='当前用户没有权限访问此硬盘')
+
+        if vdisk.vm_id:
+            raise VdiskError(msg='硬盘已挂载，请先卸载硬盘')
+
+        ceph_pool = vdisk.quota.cephpool
+        if not ceph_pool or not ceph_pool.ceph:
+            raise VdiskError(msg='硬盘存储池没有ceph pool信息')
+
+        try:
+            rbd = get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+            reader = rbd.open_image_reader(image_name=vdisk.uuid)
+        except RadosError as e:
+            raise VdiskError(msg=f'打开硬盘失败，{str(e)}')
+
+        return reader, f'{vdisk.uuid}.raw'
+
     def create_vdisk(self, size:int, user, group=None, quota=None, remarks=''):
         '''
         创建一个虚拟云硬盘
 
         备注：group和quota参数至少需要一个，优先使用quota参数；
-                当只有group参数时，通过group获取quota
+                当只有group参数时，按存储池剩余容量和负载从group的quota中选择
 
         :param group: 宿主机组对象或id
         :param quota: 硬盘所属的云硬盘CEPH存储池对象或id
@@ -179,8 +232,7 @@ class VdiskManager:
             if not isinstance(quota, Quota):
                 raise VdiskError(msg='无效的quota或quota id')
         elif group:
-            qs = self.get_quota_queryset_by_group(group=group)
-            quota = qs.first()
+            quota = self.choose_quota_by_group(group=group, size=size)
             if not isinstance(quota, Quota):
                 raise VdiskError(msg='无效的group或group id')
         else:
@@ -383,3 +435,185 @@ class VdiskManager:
             raise VdiskError(msg=str(e))
 
         return disk
+
+    def get_vdisk_snap_queryset(self):
+        '''
+        获取所有云硬盘快照的查询集
+        :return: QuerySet()
+        '''
+        return VdiskSnap.objects.all()
+
+    def get_user_vdisk_snap(self, snap_id: int, user):
+        '''
+        获取用户有权限访问的云硬盘快照
+
+        :param snap_id: 快照id
+        :param user: 用户
+        :return:
+            VdiskSnap()     # success
+
+        :raise:  VdiskError
+        '''
+        try:
+            snap = self.get_vdisk_snap_queryset().select_related(
+                'vdisk__user', 'vdisk__quota__cephpool__ceph').filter(id=snap_id).first()
+        except Exception as e:
+            raise VdiskError(msg=str(e))
+
+        if not snap:
+            raise VdiskError(msg='硬盘快照不存在')
+
+        if not snap.vdisk.user_has_perms(user=user):
+            raise VdiskError(msg='当前用户没有权限访问此硬盘快照')
+
+        return snap
+
+    def _get_user_vdisk(self, uuid: str, user):
+        '''
+        获取用户有权限访问的硬盘
+
+        :raise:  VdiskError
+        '''
+        vdisk = self.get_vdisk_by_uuid(uuid=uuid, related_fields=('user', 'quota__cephpool__ceph'))
+        if not vdisk:
+            raise VdiskError(msg='硬盘不存在')
+
+        if not vdisk.user_has_perms(user=user):
+            raise VdiskError(msg='当前用户没有权限访问此硬盘')
+
+        return vdisk
+
+    def get_vdisk_snaps(self, uuid: str, user):
+        '''
+        获取硬盘的所有快照
+
+        :param uuid: 硬盘uuid
+        :param user: 用户
+        :return:
+            QuerySet()     # success
+
+        :raise:  VdiskError
+        '''
+        vdisk = self._get_user_vdisk(uuid=uuid, user=user)
+        return vdisk.snaps.all()
+
+    def create_vdisk_snap(self, uuid: str, user, remarks: str = ''):
+        '''
+        创建硬盘快照，快照为crash一致性，挂载中的硬盘建议先在虚拟机内同步数据
+
+        :param uuid: 硬盘uuid
+        :param user: 用户
+        :param remarks: 备注信息
+        :return:
+            VdiskSnap()     # success
+
+        :raise:  VdiskError
+        '''
+        vdisk = self._get_user_vdisk(uuid=uuid, user=user)
+        if vdisk.vm_id and vdisk.vm.locked_by:
+            raise VdiskError(msg=f'硬盘挂载的虚拟机正在执行{vdisk.vm.locked_by}，暂不能创建快照')
+        snap = VdiskSnap(vdisk=vdisk, remarks=remarks)
+        try:
+            snap.save()
+        except Exception as e:
+            raise VdiskError(msg=f'创建硬盘快照失败，{str(e)}')
+
+        return snap
+
+    def delete_vdisk_snap(self, snap_id: int, user):
+        '''
+        删除硬盘快照，有从快照克隆的硬盘时不能删除
+
+        :param snap_id: 快照id
+        :param user: 用户
+        :return:
+            True    # success
+
+        :raise:  VdiskError
+        '''
+        snap = self.get_user_vdisk_snap(snap_id=snap_id, user=user)
+        try:
+            if snap.has_children():
+                raise VdiskError(msg='有从此快照克隆的硬盘，不能删除')
+            snap.delete()
+        except VdiskError as e:
+            raise e
+        except Exception as e:
+            raise VdiskError(msg=f'删除硬盘快照失败，{str(e)}')
+
+        return True
+
+    def rollback_vdisk_to_snap(self, uuid: str, snap_id: int, user):
+        '''
+        硬盘回滚到快照，硬盘需要未挂载
+
+        :param uuid: 硬盘uuid
+        :param snap_id: 快照id
+        :param user: 用户
+        :return:
+            True    # success
+
+        :raise:  VdiskError
+        '''
+        snap = self.get_user_vdisk_snap(snap_id=snap_id, user=user)
+        if snap.vdisk_id != uuid:
+            raise VdiskError(msg='快照不属于此硬盘')
+
+        with transaction.atomic():
+            vdisk = Vdisk.objects.select_for_update().filter(uuid=uuid).first()  # 锁定硬盘，回滚期间不能挂载
+            if not vdisk:
+                raise VdiskError(msg='硬盘不存在')
+
+            if vdisk.vm_id:
+                raise VdiskError(msg='硬盘已挂载，请先卸载硬盘')
+
+            snap.vdisk = vdisk
+            try:
+                snap.rollback()
+            except Exception as e:
+                raise VdiskError(msg=f'硬盘回滚到快照失败，{str(e)}')
+
+        return True
+
+    def create_vdisk_from_snap(self, snap_id: int, user, size: int = 0, remarks: str = ''):
+        '''
+        从硬盘快照创建一个新的硬盘，新硬盘是快照的rbd克隆（写时复制），创建后添加flatten任务，
+        由后台flatten_sys_disk命令解除与快照的依赖；容量从源硬盘的云硬盘CEPH存储池申请
+
+        :param snap_id: 快照id
+        :param user: 用户
+        :param size: 新硬盘容量大小GB，默认0和快照时硬盘容量相同，不能小于快照时容量
+        :param remarks: 备注信息
+        :return:
+            Vdisk()     # success
+
+        :raises: VdiskError
+        '''
+        snap = self.get_user_vdisk_snap(snap_id=snap_id, user=user)
+        if not size:
+            size = snap.size
+        if size < snap.size:
+            raise VdiskError(msg=f'硬盘容量不能小于快照时的容量{snap.size}GB')
+
+        quota = snap.vdisk.quota
+        if not quota.check_disk_size_limit(size=size):
+            raise VdiskError(msg='超出了可创建硬盘最大容量')
+
+        if not quota.claim(size=size):
+            raise VdiskError(msg='没有足够的存储容量创建硬盘')
+
+        vd = Vdisk(size=size, quota=quota, user=user, remarks=remarks)
+        vd.clone_from = snap
+        try:
+            vd.save()  # save内会从快照克隆ceph rbd image
+        except Exception as e:
+            quota.free(size=size)  # 释放申请的存储资源
+            raise VdiskError(msg=str(e))
+
+        try:
+            DiskFlattenTask(disk=vd.uuid, ceph_pool=quota.cephpool, parent=f'{quota.cephpool.pool_name}/{snap.disk}@{snap.snap}',
+                            reason=DiskFlattenTask.REASON_VDISK_CLONE).save()
+        except Exception:
+            pass
+
+        return vd
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vdisk', '0003_auto_20191112_1130'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VdiskSnap',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('disk', models.CharField(max_length=100, verbose_name='云硬盘rbd image')),
+                ('snap', models.CharField(max_length=100, verbose_name='CEPH快照')),
+                ('size', models.IntegerField(default=0, help_text='单位GB', verbose_name='快照时容量大小GB')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建日期')),
+                ('remarks', models.TextField(blank=True, default='', verbose_name='备注')),
+                ('vdisk', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snaps', to='vdisk.Vdisk', verbose_name='云硬盘')),
+            ],
+            options={
+                'verbose_name': '云硬盘快照',
+                'verbose_name_plural': '云硬盘快照',
+                'ordering': ['-id'],
+            },
+        ),
+    ]
@@ -2,9 +2,12 @@
 from uuid import uuid4
 
 from django.db import models
+from django.conf import settings
+from django.utils import timezone
 from django.db.models import F, Sum
 from django.contrib.auth import get_user_model
 
+from backup.models import BackupChain
 from ceph.models import CephPool
 from ceph.managers import get_rbd_manager, RadosError
 from compute.models import Group
@@ -140,6 +143,8 @@ class Vdisk(models.Model):
     enable = models.BooleanField(default=True, verbose_name='是否可用')
     deleted = models.BooleanField(default=False, verbose_name='已删除')
     remarks = models.TextField(blank=True, default='', verbose_name='备注')
+
+    clone_from = None   # 创建硬盘时，如果指定了快照VdiskSnap()，从此快照克隆rbd image
     
     class Meta:
         ordering = ['-create_time']
@@ -210,21 +215,61 @@ class Vdisk(models.Model):
         size = self.get_bytes_size()
         try:
             rbd = get_rbd_manager(ceph=config, pool_name=pool_name)
-            rbd.create_image(name=self.uuid, size=size, data_pool=data_pool)
+            snap = self.clone_from
+            if snap:
+                rbd.clone_image(snap_image_name=snap.disk, snap_name=snap.snap, new_image_name=self.uuid,
+                                data_pool=data_pool, features=ceph_pool.rbd_features_mask)
+                if self.size > snap.size:
+                    rbd.resize_image(image_name=self.uuid, size=size)
+            else:
+                rbd.create_image(name=self.uuid, size=size, data_pool=data_pool, features=ceph_pool.rbd_features_mask)
         except (RadosError, Exception) as e:
             raise e
 
         return True
 
     def delete(self, using=None, keep_parents=False):
+        try:
+            BackupChain.release_disk(disk_type=BackupChain.TYPE_VDISK, disk=self.uuid, close=True)
+        except RadosError as e:
+            raise Exception(f'remove vdisk backup snaps failed,{str(e)}')
+        self._remove_snaps()
         if not self._remove_ceph_disk():
             raise Exception('remove ceph rbd image failed')
         self.quota.free(size=self.size)  # 释放硬盘存储池资源
         super().delete(using=using, keep_parents=keep_parents)
 
+    def _remove_snaps(self):
+        '''
+        删除硬盘的所有rbd快照，快照有克隆的硬盘时不能删除
+
+        :raises: Exception
+        '''
+        snaps = list(self.snaps.all())
+        try:
+            ceph_pool = self.quota.cephpool
+            rbd = get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+            try:
+                names = [s['name'] for s in rbd.list_image_snaps(name=self.uuid)]   # 包括备份等创建的快照
+            except RadosError:
+                names = [s.snap for s in snaps]
+
+            if not names:
+                removed, failed = [], []
+            else:
+                removed, failed = rbd.remove_snaps(image_name=self.uuid, snaps=names)
+        except (RadosError, Exception) as e:
+            raise Exception(f'remove vdisk snaps failed,{str(e)}')
+
+        removed = set(removed)
+        VdiskSnap.objects.filter(id__in=[s.id for s in snaps if s.snap in removed]).delete()
+        if failed:
+            errors = ';'.join(f'{name}:{err}' for name, err in failed)
+            raise Exception(f'remove vdisk snaps failed,{errors}')
+
     def _remove_ceph_disk(self):
         '''
-        删除硬盘对应的ceph rbd image
+        删除硬盘对应的ceph rbd image，rbd image移入回收站，由后台purge_rbd_trash命令清除
 
         :return:
             True    # success
@@ -243,7 +288,7 @@ class Vdisk(models.Model):
 
         try:
             rbd = get_rbd_manager(ceph=config, pool_name=pool_name)
-            rbd.remove_image(image_name=self.uuid)
+            rbd.trash_move(image_name=self.uuid, delay=getattr(settings, 'RBD_TRASH_DELAY', 0))
         except (RadosError, Exception) as e:
             return False
 
@@ -270,7 +315,7 @@ class Vdisk(models.Model):
         if has_auth:
             return '''
             <disk type='network' device='disk'>
-                  <driver name='qemu'/>
+                  <driver name='qemu' discard='unmap'/>
                   <auth username='{auth_user}'>
                     <secret type='ceph' uuid='{auth_uuid}'/>
                   </auth>
@@ -282,7 +327,7 @@ class Vdisk(models.Model):
             '''
         return '''
             <disk type='network' device='disk'>
-                  <driver name='qemu'/>
+                  <driver name='qemu' discard='unmap'/>
                   <source protocol='rbd' name='{pool}/{name}'>
                     {hosts_xml}
                   </source>
@@ -336,4 +381,123 @@ class Vdisk(models.Model):
         except Exception as e:
             return False
 
-        return True
\ No newline at end of file
+        return True
+
+
+class VdiskSnap(models.Model):
+    '''
+    云硬盘快照，rbd快照创建后设置为protected，可以从快照克隆新的云硬盘
+    '''
+    id = models.AutoField(verbose_name='ID', primary_key=True)
+    vdisk = models.ForeignKey(to=Vdisk, on_delete=models.CASCADE, related_name='snaps', verbose_name='云硬盘')
+    disk = models.CharField(max_length=100, verbose_name='云硬盘rbd image')  # 同云硬盘uuid
+    snap = models.CharField(max_length=100, verbose_name='CEPH快照')  # 默认名称为 disk-snap创建日期
+    size = models.IntegerField(verbose_name='快照时容量大小GB', default=0, help_text='单位GB')
+    create_time = models.DateTimeField(auto_now_add=True, verbose_name='创建日期')
+    remarks = models.TextField(default='', blank=True, verbose_name='备注')
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = '云硬盘快照'
+        verbose_name_plural = '云硬盘快照'
+
+    def __str__(self):
+        return self.snap
+
+    def get_rbd_manager(self):
+        '''
+        :return:
+            RbdManager()
+
+        :raises: Exception
+        '''
+        ceph_pool = self.vdisk.quota.cephpool
+        if not ceph_pool:
+            raise Exception('can not get ceph pool')
+
+        config = ceph_pool.ceph
+        if not config:
+            raise Exception('can not get ceph')
+
+        return get_rbd_manager(ceph=config, pool_name=ceph_pool.pool_name)
+
+    def _create_snap(self):
+        '''
+        创建云硬盘快照
+        :return:
+            True    # success
+
+        :raises: Exception
+        '''
+        now_timestamp = timezone.now().strftime("%Y%m%d_%H%M%S")
+        try:
+            disk = self.vdisk.uuid
+            snap_name = f'{disk}-{now_timestamp}'
+            rbd = self.get_rbd_manager()
+            rbd.create_snap(image_name=disk, snap_name=snap_name, protected=True)
+        except (RadosError, Exception) as e:
+            raise Exception(str(e))
+
+        self.disk = disk
+        self.snap = snap_name
+        self.size = self.vdisk.size
+        return True
+
+    def _remove_snap(self):
+        '''
+        删除云硬盘快照，快照有克隆的云硬盘时删除失败
+        :return:
+            True    # success
+
+        :raises: Exception
+        '''
+        try:
+            rbd = self.get_rbd_manager()
+            rbd.remove_snap(image_name=self.disk, snap=self.snap)
+        except (RadosError, Exception) as e:
+            raise Exception(str(e))
+
+        return True
+
+    def rollback(self):
+        '''
+        云硬盘回滚到此快照，快照后扩容过的硬盘回滚后恢复当前容量大小
+        :return:
+            True    # success
+
+        :raises: Exception
+        '''
+        try:
+            rbd = self.get_rbd_manager()
+            rbd.image_rollback_to_snap(image_name=self.disk, snap=self.snap)
+            if self.vdisk.size > self.size:
+                rbd.resize_image(image_name=self.disk, size=self.vdisk.get_bytes_size())
+        except (RadosError, Exception) as e:
+            raise Exception(str(e))
+
+        return True
+
+    def has_children(self):
+        '''
+        快照是否有克隆的rbd image
+        :return:
+            True    # 有
+            False   # 没有
+
+        :raises: Exception
+        '''
+        try:
+            rbd = self.get_rbd_manager()
+            return bool(rbd.list_snap_children(image_name=self.disk, snap=self.snap))
+        except (RadosError, Exception) as e:
+            raise Exception(str(e))
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if not self.snap:
+            self._create_snap()
+        super().save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
+
+    def delete(self, using=None, keep_parents=False):
+        if self.snap:
+            self._remove_snap()
+        super().delete(using=using, keep_parents=keep_parents)
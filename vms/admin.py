@@ -1,15 +1,36 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
-from .models import Vm, VmArchive, VmLog, VmDiskSnap, MigrateLog, Flavor
+from .models import (Vm, VmArchive, VmLog, VmDiskSnap, MigrateLog, Flavor, DiskFlattenTask, CenterMigrateTask,
+                     DiskTrimLog, VmJob, HostEvacuation, HostEvacuationVm)
+from .manager import VmManager, HostEvacuateManager, VmError
 
 
 @admin.register(Vm)
 class VmAdmin(admin.ModelAdmin):
     list_display_links = ('hex_uuid',)
-    list_display = ('hex_uuid', 'mac_ip', 'image', 'vcpu', 'mem', 'host', 'user', 'create_time', 'remarks')
+    list_display = ('hex_uuid', 'mac_ip', 'image', 'vcpu', 'mem', 'host', 'user', 'create_time', 'locked_by',
+                    'remarks')
     search_fields = ['name', 'mac_ip__ipv4']
     list_filter = ['host', 'user']
     raw_id_fields = ('mac_ip', 'host', 'user', 'image')
+    readonly_fields = ('xml_version',)
+    actions = ['refresh_xml']
+
+    def refresh_xml(self, request, queryset):
+        '''
+        在宿主机上直接修改了虚拟机定义后，从宿主机获取xml更新缓存
+        '''
+        manager = VmManager()
+        count = 0
+        for vm in queryset.select_related('host'):
+            try:
+                manager.refresh_vm_xml(vm)
+                count += 1
+            except VmError as e:
+                self.message_user(request, f'虚拟机{vm.hex_uuid}刷新xml失败，{str(e)}', level=messages.ERROR)
+        self.message_user(request, f'刷新了{count}个虚拟机的xml')
+
+    refresh_xml.short_description = '从宿主机刷新xml缓存'
 
 
 @admin.register(VmArchive)
@@ -45,10 +66,12 @@ class VmDiskSnapAdmin(admin.ModelAdmin):
 
     def delete_queryset(self, request, queryset):
         '''
-        后台管理批量删除重写， 通过每个对象的delete()方法删除，同时会删除ceph rbd image snap
+        后台管理批量删除重写，按系统盘批量删除ceph rbd image snap，删除失败的快照保留记录
         '''
-        for obj in queryset:
-            obj.delete()
+        deleted, failed = queryset.bulk_delete()
+        if failed:
+            msg = ';'.join([f'{s.snap}({err})' for s, err in failed])
+            self.message_user(request, f'删除失败的快照：{msg}', level=messages.ERROR)
 
 
 @admin.register(MigrateLog)
@@ -63,3 +86,92 @@ class MigrateLogAdmin(admin.ModelAdmin):
 class FlavorAdmin(admin.ModelAdmin):
     list_display_links = ('id',)
     list_display = ('id', 'vcpus', 'ram', 'public', 'enable')
+
+
+@admin.register(DiskFlattenTask)
+class DiskFlattenTaskAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'disk', 'vm_uuid', 'ceph_pool', 'parent', 'reason', 'status', 'create_time', 'start_time',
+                    'end_time', 'message')
+    search_fields = ('disk', 'vm_uuid', 'parent')
+    list_filter = ('status', 'reason')
+
+
+@admin.register(CenterMigrateTask)
+class CenterMigrateTaskAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'vm_uuid', 'dst_group', 'dst_host', 'dst_image', 'status', 'stage', 'copied', 'downtime',
+                    'create_time', 'start_time', 'end_time', 'message')
+    search_fields = ('vm_uuid',)
+    list_filter = ('status', 'stage')
+    raw_id_fields = ('dst_host', 'dst_image', 'dst_quota', 'dst_vlan')
+
+
+@admin.register(DiskTrimLog)
+class DiskTrimLogAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'vm_uuid', 'disk', 'ceph_pool', 'used_before', 'used_after', 'reclaimed', 'result',
+                    'create_time', 'message')
+    search_fields = ('vm_uuid', 'disk')
+    list_filter = ('result', 'ceph_pool')
+
+
+@admin.register(VmJob)
+class VmJobAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'action', 'vm_uuid', 'user', 'status', 'step', 'attempts', 'worker', 'heartbeat',
+                    'create_time', 'start_time', 'end_time', 'message')
+    search_fields = ('vm_uuid',)
+    list_filter = ('action', 'status')
+    raw_id_fields = ('user',)
+
+
+class HostEvacuationVmInline(admin.TabularInline):
+    model = HostEvacuationVm
+    fields = ('vm_uuid', 'dst_host', 'live', 'status', 'progress', 'job', 'start_time', 'end_time', 'message')
+    readonly_fields = fields
+    can_delete = False
+    extra = 0
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(HostEvacuation)
+class HostEvacuationAdmin(admin.ModelAdmin):
+    list_display_links = ('id',)
+    list_display = ('id', 'host', 'user', 'source_limit', 'target_limit', 'status', 'progress', 'create_time',
+                    'start_time', 'end_time', 'message')
+    list_filter = ('status',)
+    readonly_fields = ('host', 'user', 'status', 'create_time', 'start_time', 'end_time', 'message')
+    inlines = [HostEvacuationVmInline]
+    actions = ['pause_tasks', 'resume_tasks']
+
+    def has_add_permission(self, request):
+        return False    # 通过宿主机的"进入维护模式并疏散虚拟机"操作添加
+
+    def progress(self, obj):
+        p = obj.get_progress()
+        return f'{p["ok"]}/{p["total"]}，迁移中{p["running"]}，失败{p["failed"]}'
+
+    progress.short_description = '进度'
+
+    def pause_tasks(self, request, queryset):
+        manager = HostEvacuateManager()
+        count = sum(manager.pause_task(task_id=task.id) for task in queryset)
+        self.message_user(request, f'暂停了{count}个疏散任务，迁移中的虚拟机会继续完成')
+
+    pause_tasks.short_description = '暂停'
+
+    def resume_tasks(self, request, queryset):
+        manager = HostEvacuateManager()
+        for task in queryset:
+            try:
+                ok = manager.resume_task(task_id=task.id)
+            except VmError as e:
+                self.message_user(request, f'疏散任务<{task.id}>继续失败，{str(e)}', level=messages.ERROR)
+                continue
+            if ok:
+                self.message_user(request, f'疏散任务<{task.id}>已继续，失败的虚拟机重新迁移')
+
+    resume_tasks.short_description = '继续（重新迁移失败的虚拟机）'
@@ -0,0 +1,140 @@
+import time
+import tracemalloc
+from xml.dom import minidom
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vms.models import Vm
+from vms.xml import XMLEditor
+
+
+DOMAIN_XML = '''<domain type="kvm" xmlns:qemu="http://libvirt.org/schemas/domain/qemu/1.0">
+  <name>bench</name>
+  <uuid>c7a5fdbd-cdaf-9455-926a-d65c16db1809</uuid>
+  <memory unit="KiB">4194304</memory>
+  <currentMemory unit="KiB">4194304</currentMemory>
+  <vcpu placement="static">4</vcpu>
+  <os><type arch="x86_64" machine="pc">hvm</type><boot dev="hd"/></os>
+  <features><acpi/><apic/></features>
+  <devices>
+    <emulator>/usr/libexec/qemu-kvm</emulator>
+    <disk type="network" device="disk">
+      <driver name="qemu" type="raw" cache="writeback"/>
+      <auth username="admin"><secret type="ceph" uuid="6d8fc28d-6b5f-4e3a-8c39-0d1f5a4b0c11"/></auth>
+      <source protocol="rbd" name="vm/sys-disk"><host name="10.0.0.1" port="6789"/></source>
+      <target dev="vda" bus="virtio"/>
+    </disk>
+{disks}{hostdevs}{interfaces}  </devices>
+  <qemu:commandline><qemu:arg value="-no-hpet"/></qemu:commandline>
+</domain>'''
+
+
+def build_domain_xml(disks: int, hostdevs: int, interfaces: int):
+    disk_xml = ''.join(
+        f'''    <disk type="network" device="disk">
+      <driver name="qemu" type="raw" cache="writeback"/>
+      <auth username="admin"><secret type="ceph" uuid="6d8fc28d-6b5f-4e3a-8c39-0d1f5a4b0c11"/></auth>
+      <source protocol="rbd" name="vdisk/disk-{i}"><host name="10.0.0.1" port="6789"/></source>
+      <target dev="vd{chr(ord('b') + i % 24)}" bus="virtio"/>
+    </disk>
+''' for i in range(disks))
+    hostdev_xml = ''.join(
+        f'''    <hostdev mode="subsystem" type="pci" managed="yes">
+      <source><address domain="0x0000" bus="0x{i + 1:02x}" slot="0x00" function="0x0"/></source>
+    </hostdev>
+''' for i in range(hostdevs))
+    interface_xml = ''.join(
+        f'''    <interface type="bridge">
+      <mac address="52:54:00:00:{i // 256:02x}:{i % 256:02x}"/><source bridge="br0"/><model type="virtio"/>
+    </interface>
+''' for i in range(interfaces))
+    return DOMAIN_XML.replace('{disks}', disk_xml).replace('{hostdevs}', hostdev_xml).replace(
+        '{interfaces}', interface_xml)
+
+
+def minidom_edit(xml_desc: str, vcpu: int, mem: int):
+    '''原minidom实现：修改vcpu、内存、去除系统盘auth、获取硬盘列表，每个操作都重新解析和序列化'''
+    root = minidom.parseString(xml_desc).documentElement
+    root.getElementsByTagName('vcpu')[0].firstChild.data = vcpu
+    xml_desc = root.toxml()
+
+    root = minidom.parseString(xml_desc).documentElement
+    for tag in ('memory', 'currentMemory'):
+        node = root.getElementsByTagName(tag)[0]
+        node.attributes['unit'].value = 'MiB'
+        node.firstChild.data = mem
+    xml_desc = root.toxml()
+
+    root = minidom.parseString(xml_desc).documentElement
+    disk = root.getElementsByTagName('devices')[0].getElementsByTagName('disk')[0]
+    disk.removeChild(disk.getElementsByTagName('auth')[0])
+    xml_desc = root.toxml()
+
+    root = minidom.parseString(xml_desc).documentElement
+    devs = []
+    for d in root.getElementsByTagName('devices')[0].childNodes:
+        if d.nodeName == 'disk':
+            for child in d.childNodes:
+                if child.nodeName == 'target':
+                    devs.append(child.getAttribute('dev'))
+    return xml_desc, devs
+
+
+def etree_edit(xml_desc: str, vcpu: int, mem: int):
+    '''XMLEditor实现：一次解析，多次修改，一次序列化'''
+    xml = XMLEditor(xml_desc)
+    xml.set_vcpu(vcpu)
+    xml.set_memory(mem)
+    xml.remove_sys_disk_auth()
+    devs = [d['dev'] for d in xml.list_disks()]
+    return xml.to_xml(), devs
+
+
+class Command(BaseCommand):
+    help = '虚拟机xml编辑性能测试，对比原minidom实现（每个修改重新解析和序列化）和ElementTree的XMLEditor（一次解析）' \
+           '修改vcpu、内存、去除系统盘auth和获取硬盘列表的耗时和内存峰值'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rounds', type=int, default=200, help='每种实现执行的次数，默认200')
+        parser.add_argument(
+            '--disks', type=int, default=20, help='生成的测试xml中云硬盘数，默认20')
+        parser.add_argument(
+            '--hostdevs', type=int, default=4, help='生成的测试xml中PCI设备数，默认4')
+        parser.add_argument(
+            '--interfaces', type=int, default=8, help='生成的测试xml中网卡数，默认8')
+        parser.add_argument(
+            '--vm', dest='vm_uuid', default='', help='使用此虚拟机元数据中的xml测试，不生成测试xml')
+
+    def handle(self, *args, **options):
+        if options['vm_uuid']:
+            vm = Vm.objects.filter(uuid=options['vm_uuid']).first()
+            if vm is None:
+                raise CommandError('虚拟机不存在')
+            xml_desc = vm.xml
+        else:
+            xml_desc = build_domain_xml(disks=options['disks'], hostdevs=options['hostdevs'],
+                                        interfaces=options['interfaces'])
+
+        rounds = max(options['rounds'], 1)
+        old_xml, old_devs = minidom_edit(xml_desc, 2, 2048)
+        new_xml, new_devs = etree_edit(xml_desc, 2, 2048)
+        if old_devs != new_devs:
+            raise CommandError(f'两种实现获取的硬盘列表不一致，{old_devs} != {new_devs}')
+        self.stdout.write(f'xml大小{len(xml_desc)}字符，执行{rounds}次')
+
+        results = {}
+        for name, func in (('minidom', minidom_edit), ('XMLEditor', etree_edit)):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                func(xml_desc, 2, 2048)
+            elapsed = (time.perf_counter() - start) / rounds * 1000
+
+            tracemalloc.start()
+            func(xml_desc, 2, 2048)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[name] = elapsed
+            self.stdout.write(f'{name:>10}: {elapsed:.3f}ms/次，内存峰值{peak / 1024:.1f}KiB')
+
+        self.stdout.write(f'XMLEditor耗时为minidom的{results["XMLEditor"] / results["minidom"]:.1%}')
@@ -0,0 +1,71 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from vms.manager import HostEvacuateManager, VmError
+
+
+class Command(BaseCommand):
+    help = '疏散宿主机，宿主机进入维护模式，计算所有虚拟机的目标宿主机后由任务执行进程（run_vm_jobs）并行迁移；' \
+           '可暂停、继续和查看疏散任务的进度'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host-id', type=int, default=0, help='添加疏散任务的宿主机id')
+        parser.add_argument(
+            '--username', default='', help='创建疏散任务的超级用户名')
+        parser.add_argument(
+            '--source-limit', type=int, default=2, help='同时从宿主机迁出的虚拟机数，默认2')
+        parser.add_argument(
+            '--target-limit', type=int, default=1, help='同时迁入一个目标宿主机的虚拟机数，默认1')
+        parser.add_argument(
+            '--pause', type=int, default=0, help='暂停指定id的疏散任务')
+        parser.add_argument(
+            '--resume', type=int, default=0, help='继续指定id的暂停或有失败的疏散任务，失败的虚拟机重新迁移')
+        parser.add_argument(
+            '--show', type=int, default=0, help='显示指定id的疏散任务每个虚拟机的迁移状态')
+
+    def handle(self, *args, **options):
+        manager = HostEvacuateManager()
+        task_id = 0
+        if options['host_id']:
+            user = get_user_model().objects.filter(username=options['username']).first()
+            if user is None:
+                raise CommandError('请通过--username指定一个存在的超级用户')
+            try:
+                task = manager.add_task(host_id=options['host_id'], user=user, source_limit=options['source_limit'],
+                                        target_limit=options['target_limit'])
+            except VmError as e:
+                raise CommandError(str(e))
+            task_id = task.id
+            self.stdout.write(f'宿主机{task.host}已进入维护模式，添加了疏散任务<{task.id}>')
+        elif options['pause']:
+            task_id = options['pause']
+            if not manager.pause_task(task_id=task_id):
+                raise CommandError('疏散任务不存在或不是等待、执行中状态')
+            self.stdout.write(f'已暂停疏散任务<{task_id}>，迁移中的虚拟机会继续完成')
+        elif options['resume']:
+            task_id = options['resume']
+            try:
+                ok = manager.resume_task(task_id=task_id)
+            except VmError as e:
+                raise CommandError(str(e))
+            if not ok:
+                raise CommandError('疏散任务不存在或不是暂停、有失败状态')
+            self.stdout.write(f'已继续疏散任务<{task_id}>')
+
+        task_id = task_id or options['show']
+        if task_id:
+            self.show_task(manager, task_id)
+
+    def show_task(self, manager, task_id: int):
+        task = manager.get_task_queryset().filter(id=task_id).first()
+        if task is None:
+            raise CommandError('疏散任务不存在')
+
+        p = task.get_progress()
+        self.stdout.write(f'疏散任务<{task.id}> 宿主机{task.host} {task.get_status_display()}: 共{p["total"]}个虚拟机，'
+                          f'等待{p["wait"]}，迁移中{p["running"]}，完成{p["ok"]}，失败{p["failed"]}')
+        for item in task.items.select_related('dst_host'):
+            mode = '热迁移' if item.live else '冷迁移'
+            self.stdout.write(f'  {item.vm_uuid} -> {item.dst_host or "-"} {mode} {item.get_status_display()} '
+                              f'{item.progress}% {item.message}')
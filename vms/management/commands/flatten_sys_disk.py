@@ -0,0 +1,102 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from image.models import Image
+from vms.manager import DiskFlattenManager, VmError
+
+
+def parse_time_window(value: str):
+    """
+    解析时间窗口字符串，格式：HH:MM-HH:MM
+
+    :return:
+        (datetime.time, datetime.time)
+    :raises: CommandError
+    """
+    try:
+        start, end = value.split('-')
+        start = datetime.strptime(start.strip(), '%H:%M').time()
+        end = datetime.strptime(end.strip(), '%H:%M').time()
+    except ValueError:
+        raise CommandError(f'无效的时间窗口"{value}"，格式：HH:MM-HH:MM')
+
+    return start, end
+
+
+class Command(BaseCommand):
+    help = '后台flatten虚拟机系统盘，解除系统盘与系统镜像快照的克隆依赖'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=0,
+            help='为创建时间超过指定天数的虚拟机系统盘添加flatten任务，默认0不添加')
+        parser.add_argument(
+            '--image-id', type=int, action='append', default=[], dest='image_ids',
+            help='为指定系统镜像所有快照的克隆系统盘添加flatten任务，完成后删除没有克隆依赖的旧快照；可多次指定')
+        parser.add_argument(
+            '--max-count', type=int, default=0, help='本次最多执行的flatten任务数，默认0不限制')
+        parser.add_argument(
+            '--interval', type=float, default=10, help='两个flatten任务之间的间隔秒数，默认10；只控制任务频率，不限制单个flatten的I/O')
+        parser.add_argument(
+            '--window', action='append', default=[], dest='windows',
+            help='允许执行flatten的时间窗口，格式：HH:MM-HH:MM，如01:00-06:00；可多次指定，默认不限制；'
+                 '每个任务开始前检查，窗口结束时执行中的flatten会执行完')
+        parser.add_argument(
+            '--reset-running', type=int, default=0,
+            help='执行中超过指定小时数的任务重置为等待状态（执行进程异常退出的任务），默认0不重置')
+        parser.add_argument(
+            '--report', action='store_true', default=False,
+            help='只输出各系统镜像快照的克隆系统盘数量，不执行flatten')
+
+    def handle(self, *args, **options):
+        manager = DiskFlattenManager()
+        image_ids = options['image_ids']
+        images = Image.objects.select_related('ceph_pool__ceph').all()
+        if image_ids:
+            images = images.filter(id__in=image_ids)
+
+        if options['report']:
+            self.report(manager=manager, images=images)
+            return
+
+        windows = [parse_time_window(w) for w in options['windows']]
+
+        if options['reset_running'] > 0:
+            count = manager.reset_running_tasks(hours=options['reset_running'])
+            self.stdout.write(f'重置了{count}个执行中的任务')
+
+        try:
+            if options['days'] > 0:
+                count = manager.add_aged_vm_tasks(days=options['days'])
+                self.stdout.write(f'添加了{count}个系统盘创建时间超期的flatten任务')
+
+            for image in images if image_ids else []:
+                count = manager.add_image_children_tasks(image=image)
+                self.stdout.write(f'镜像<{image.fullname}>添加了{count}个flatten任务')
+        except VmError as e:
+            raise CommandError(str(e))
+
+        ok_count, failed_count = manager.run_tasks(
+            max_count=options['max_count'], interval=options['interval'], windows=windows)
+        self.stdout.write(f'flatten完成{ok_count}个，失败{failed_count}个')
+
+        for image in images if image_ids else []:
+            try:
+                removed = manager.remove_unused_image_snaps(image=image)
+            except VmError as e:
+                self.stderr.write(f'镜像<{image.fullname}>, {str(e)}')
+                continue
+            if removed:
+                self.stdout.write(f'镜像<{image.fullname}>删除了旧快照：{", ".join(removed)}')
+
+    def report(self, manager, images):
+        for item in manager.snap_children_report(images=images):
+            image = item['image']
+            if item['error']:
+                self.stderr.write(f'镜像<{image.fullname}>, {item["error"]}')
+                continue
+
+            current = '(当前生效)' if item['current'] else ''
+            self.stdout.write(f'镜像<{image.fullname}> {image.base_image}@{item["snap"]}{current}: '
+                              f'{item["children"]}个克隆系统盘')
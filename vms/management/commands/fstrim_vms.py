@@ -0,0 +1,78 @@
+from django.core.management.base import BaseCommand
+
+from vms.manager import DiskTrimManager, VmError
+from vms.models import Vm
+
+
+def size_display(size: int):
+    return f'{size / 1024 ** 3:.2f}GB'
+
+
+class Command(BaseCommand):
+    help = '在运行中的虚拟机内通过guest agent执行fstrim，回收虚拟机内已删除数据占用的ceph空间，按宿主机分批限速执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host-id', type=int, action='append', default=[], dest='host_ids',
+            help='只处理指定宿主机上的虚拟机，可多次指定，默认所有宿主机')
+        parser.add_argument(
+            '--vm', action='append', default=[], dest='vm_uuids', help='只处理指定的虚拟机，可多次指定')
+        parser.add_argument(
+            '--batch', type=int, default=2, help='每个宿主机每批执行fstrim的虚拟机数，默认2')
+        parser.add_argument(
+            '--interval', type=float, default=10, help='同一个宿主机两批之间的间隔秒数，默认10')
+        parser.add_argument(
+            '--workers', type=int, default=4, help='同时执行的宿主机数，默认4')
+        parser.add_argument(
+            '--enable-discard', action='store_true', default=False,
+            help='虚拟机xml模板和虚拟机持久化定义的硬盘开启discard=unmap（运行中的虚拟机关机再开机后生效），不执行fstrim')
+        parser.add_argument(
+            '--report', type=int, default=None, metavar='DAYS',
+            help='只输出各ceph pool最近DAYS天（0不限制）回收的空间，不执行fstrim')
+
+    def handle(self, *args, **options):
+        manager = DiskTrimManager()
+        if options['report'] is not None:
+            self.report(manager=manager, days=options['report'])
+            return
+
+        vms = Vm.objects.select_related('host', 'image__ceph_pool__ceph').all()
+        if options['host_ids']:
+            vms = vms.filter(host_id__in=options['host_ids'])
+        if options['vm_uuids']:
+            vms = vms.filter(uuid__in=options['vm_uuids'])
+
+        if options['enable_discard']:
+            self.enable_discard(manager=manager, vms=vms)
+            return
+
+        logs = manager.run_trims(vms=vms, batch=options['batch'], interval=options['interval'],
+                                 workers=options['workers'])
+        reclaimed = 0
+        for log in logs:
+            if log.result:
+                reclaimed += log.reclaimed
+                self.stdout.write(f'虚拟机<{log.vm_uuid}> 硬盘<{log.disk}> 回收{size_display(log.reclaimed)}，'
+                                  f'已用{size_display(log.used_after)}')
+            else:
+                self.stderr.write(f'虚拟机<{log.vm_uuid}> 硬盘<{log.disk}> {log.message}')
+
+        self.stdout.write(f'共处理{len(logs)}个硬盘，回收{size_display(reclaimed)}')
+
+    def enable_discard(self, manager, vms):
+        count = manager.enable_templates_discard()
+        self.stdout.write(f'{count}个xml模板开启了discard')
+
+        count = 0
+        for vm in vms:
+            try:
+                if manager.enable_vm_discard(vm=vm):
+                    count += 1
+            except VmError as e:
+                self.stderr.write(f'虚拟机<{vm.hex_uuid}> {str(e)}')
+
+        self.stdout.write(f'{count}个虚拟机开启了discard')
+
+    def report(self, manager, days: int):
+        for item in manager.pool_reclaimed_report(days=days):
+            self.stdout.write(f'{item["ceph_pool"]}: {item["count"]}次，回收{size_display(item["reclaimed"])}')
@@ -0,0 +1,191 @@
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ceph.managers import get_rbd_manager, RadosError
+from ceph.models import CephPool
+from image.models import Image
+from vdisk.models import Vdisk
+from vms.manager import DiskFlattenManager
+from vms.models import Vm, VmArchive, VmDiskSnap
+
+
+def parse_archived_time(name: str):
+    """
+    从已删除归档的系统盘名称（x_{time}_{disk_name}）解析删除时间
+
+    :return:
+        datetime    # UTC时间
+        None        # 不是归档的系统盘名称
+    """
+    if not name.startswith('x_'):
+        return None
+
+    try:
+        return datetime.strptime(name[2:16], '%Y%m%d%H%M%S').replace(tzinfo=dt_timezone.utc)
+    except ValueError:
+        return None
+
+
+def get_known_image_names():
+    """
+    数据库中有记录的所有rbd image名称，只查询名称字段，不创建模型对象
+
+    :return:
+        set
+    """
+    known = set()
+    known.update(Vm.objects.values_list('disk', flat=True).iterator())
+    known.update(VmArchive.objects.values_list('disk', flat=True).iterator())
+    known.update(VmDiskSnap.objects.values_list('disk', flat=True).iterator())     # 克隆回滚后归档的系统盘
+    known.update(Vdisk.objects.values_list('uuid', flat=True).iterator())
+    known.update(Image.objects.values_list('base_image', flat=True).iterator())
+    return known
+
+
+class Command(BaseCommand):
+    help = '查找并清理ceph pool中没有数据库记录的rbd image（孤儿image），包括修改系统镜像等遗留的x_开头的系统盘'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pool-id', type=int, action='append', default=[], dest='pool_ids',
+            help='只处理指定的ceph pool，可多次指定，默认所有pool')
+        parser.add_argument(
+            '--prefix', default='', help='只处理名称以此前缀开头的image，如x_')
+        parser.add_argument(
+            '--days', type=int, default=30, help='只处理创建（x_开头的按删除）时间超过指定天数的孤儿image，默认30，最小1')
+        parser.add_argument(
+            '--remove', action='store_true', default=False,
+            help='孤儿image移入rbd回收站，由purge_rbd_trash命令清除；默认只输出报告')
+        parser.add_argument(
+            '--max-count', type=int, default=0, help='本次最多清理的孤儿image数，默认0不限制')
+        parser.add_argument(
+            '--interval', type=float, default=1, help='两次清理之间的间隔秒数，默认1')
+        parser.add_argument(
+            '--archive-days', type=int, default=0,
+            help='删除归档时间超过指定天数的虚拟机归档记录及其系统盘（移入回收站），需要同时指定--remove，默认0不删除')
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days < 1:
+            raise CommandError('--days不能小于1')
+
+        self.remove = options['remove']
+        self.max_count = options['max_count']
+        self.interval = options['interval']
+        self.removed = 0
+        if options['archive_days'] > 0:
+            self.gc_archives(days=options['archive_days'])
+        if self.remove:
+            count = DiskFlattenManager.remove_released_parent_snaps()
+            self.stdout.write(f'删除了{count}个已释放的克隆回滚父快照')
+
+        pools = CephPool.objects.select_related('ceph').all()
+        if options['pool_ids']:
+            pools = pools.filter(id__in=options['pool_ids'])
+
+        known = get_known_image_names()
+        deadline = timezone.now() - timedelta(days=days)
+        done = set()
+        for pool in pools:
+            key = (pool.ceph_id, pool.pool_name)  # 多个CephPool记录可能是同一个pool
+            if key in done:
+                continue
+            done.add(key)
+
+            try:
+                rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+                self.gc_pool(rbd=rbd, prefix=options['prefix'], known=known, deadline=deadline)
+            except RadosError as e:
+                self.stderr.write(f'pool<{pool.pool_name}>, {str(e)}')
+                continue
+
+        if self.remove:
+            self.stdout.write(f'共清理{self.removed}个孤儿image')
+
+    def gc_pool(self, rbd, prefix: str, known: set, deadline):
+        """
+        逐个检查pool中的image，不在known中的为孤儿image
+
+        :raises: RadosError     # 列举pool中image错误
+        """
+        pool_name = rbd.pool_name
+        orphan_count = 0
+        for name in rbd.iter_images(prefix=prefix):
+            if name in known:
+                continue
+
+            orphan_count += 1
+            try:
+                expired, info = self.is_expired(meta=rbd.get_image_meta(image_name=name), deadline=deadline)
+            except RadosError as e:
+                self.stderr.write(f'pool<{pool_name}>, image<{name}>, {str(e)}')
+                continue
+
+            if not expired:
+                continue
+
+            if not self.remove:
+                self.stdout.write(f'  {name} {info}')
+                continue
+
+            if self.max_count and self.removed >= self.max_count:
+                continue
+            if self.removed and self.interval > 0:
+                time.sleep(self.interval)
+
+            try:
+                rbd.trash_move(image_name=name, delay=getattr(settings, 'RBD_TRASH_DELAY', 0))
+            except RadosError as e:
+                self.stderr.write(f'pool<{pool_name}>, image<{name}>, {str(e)}')
+                continue
+
+            self.removed += 1
+            self.stdout.write(f'  {name} {info}, 已移入回收站')
+
+        self.stdout.write(f'pool<{pool_name}>: {orphan_count}个孤儿image')
+
+    @staticmethod
+    def is_expired(meta, deadline):
+        """
+        孤儿image是否超过保留期，有快照的image（可能有克隆依赖）不清理
+
+        :param meta: RbdImageMeta()
+        :return:
+            (expired:bool, info:str)
+        :raises: RadosError
+        """
+        t = parse_archived_time(meta.name)
+        if t is None:
+            t = meta.create_time.replace(tzinfo=dt_timezone.utc)
+
+        if t > deadline:
+            return False, ''
+
+        if meta.snap_count > 0:
+            return False, ''
+
+        return True, f'size={meta.size} time={timezone.localtime(t).strftime("%Y-%m-%d %H:%M:%S")}'
+
+    def gc_archives(self, days: int):
+        """
+        删除超期的虚拟机归档记录，归档记录的delete()会删除系统盘快照，系统盘移入回收站
+        """
+        qs = VmArchive.objects.filter(archive_time__lt=timezone.now() - timedelta(days=days))
+        if not self.remove:
+            self.stdout.write(f'{qs.count()}个虚拟机归档记录超过{days}天')
+            return
+
+        count = 0
+        for archive in qs.iterator():
+            try:
+                archive.delete()
+            except Exception as e:
+                self.stderr.write(f'虚拟机归档记录<{archive.uuid}>, {str(e)}')
+                continue
+            count += 1
+
+        self.stdout.write(f'删除了{count}个超过{days}天的虚拟机归档记录')
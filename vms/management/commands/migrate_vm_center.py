@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from vms.manager import CenterMigrateManager, VmError
+
+
+class Command(BaseCommand):
+    help = '虚拟机跨分中心迁移，运行中复制和增量同步硬盘到目标ceph集群，关机后最后同步一次，在目标宿主机组重新创建虚拟机'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--vm', dest='vm_uuid', default='', help='添加迁移任务的虚拟机uuid')
+        parser.add_argument(
+            '--group-id', type=int, default=0, help='目标宿主机组id')
+        parser.add_argument(
+            '--host-id', type=int, default=0, help='目标宿主机id，默认在目标宿主机组中自动选择')
+        parser.add_argument(
+            '--image-id', type=int, default=0, help='目标分中心的系统镜像id，默认与虚拟机镜像同名的镜像')
+        parser.add_argument(
+            '--quota-id', type=int, default=0, help='挂载的云硬盘迁移到的存储池id，默认目标宿主机组的第一个存储池')
+        parser.add_argument(
+            '--vlan-id', type=int, default=0, help='目标子网id，默认原IP的子网属于目标分中心时保留原IP，否则自动分配')
+        parser.add_argument(
+            '--sync-rounds', type=int, default=2, help='关机前最多增量同步次数，默认2')
+        parser.add_argument(
+            '--shutdown-timeout', type=int, default=300, help='等待虚拟机关机的最长秒数，默认300')
+        parser.add_argument(
+            '--max-count', type=int, default=0, help='本次最多执行的迁移任务数，默认0不限制')
+        parser.add_argument(
+            '--reset-running', type=int, default=0,
+            help='执行中超过指定小时数的任务（执行进程异常退出）标记为失败，默认0不处理')
+        parser.add_argument(
+            '--add-only', action='store_true', default=False, help='只添加迁移任务，不执行')
+
+    def handle(self, *args, **options):
+        manager = CenterMigrateManager()
+        if options['reset_running'] > 0:
+            count = manager.reset_running_tasks(hours=options['reset_running'])
+            self.stdout.write(f'{count}个执行中的任务标记为失败')
+
+        if options['vm_uuid']:
+            try:
+                task = manager.add_task(
+                    vm_uuid=options['vm_uuid'], group_id=options['group_id'], host_id=options['host_id'],
+                    image_id=options['image_id'], quota_id=options['quota_id'], vlan_id=options['vlan_id'],
+                    sync_rounds=options['sync_rounds'])
+            except VmError as e:
+                raise CommandError(str(e))
+            self.stdout.write(f'添加了跨分中心迁移任务<{task.id}>')
+
+        if options['add_only']:
+            return
+
+        ok_count, failed_count = manager.run_tasks(
+            max_count=options['max_count'], shutdown_timeout=options['shutdown_timeout'])
+        self.stdout.write(f'迁移完成{ok_count}个，失败{failed_count}个')
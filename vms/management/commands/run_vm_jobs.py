@@ -0,0 +1,73 @@
+import os
+import signal
+import socket
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from vms.manager import VmJobManager, HostEvacuateManager
+
+
+class Command(BaseCommand):
+    help = '虚拟机异步任务执行进程，执行创建、删除、迁移虚拟机和更换、重置系统盘任务；可在多台服务器上运行多个进程，' \
+           '与web服务分开扩展；执行进程异常退出后，其他执行进程根据检查点完成或回滚任务；同时分派宿主机疏散任务的虚拟机迁移'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=4, help='同时执行的任务数，默认4')
+        parser.add_argument(
+            '--interval', type=float, default=2, help='检查新任务和更新心跳的间隔秒数，默认2')
+        parser.add_argument(
+            '--once', action='store_true', default=False, help='执行完当前等待的任务后退出')
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        interval = max(options['interval'], 0.5)
+        worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        manager = VmJobManager()
+        evacuate_manager = HostEvacuateManager()
+
+        self._stopping = False
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self.stdout.write(f'执行进程{worker_id}启动，同时执行{workers}个任务')
+
+        running = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                manager.heartbeat(worker=worker_id)
+                for job in manager.recover_jobs():
+                    self.stdout.write(f'异常退出的任务{job.id}: {job.get_status_display()}，{job.message}')
+                if not self._stopping:
+                    for task in evacuate_manager.dispatch_tasks():
+                        self.stdout.write(f'宿主机{task.host}疏散任务{task.id}结束: {task.message}')
+
+                while not self._stopping and len(running) < workers:
+                    job = manager.claim_job(worker=worker_id)
+                    if job is None:
+                        break
+                    self.stdout.write(f'开始执行任务{job.id}: {job.get_action_display()}<{job.vm_uuid}>')
+                    running.add(executor.submit(self.run_job, manager, job))
+
+                if not running and (self._stopping or options['once']):
+                    break
+
+                done, _ = wait(running, timeout=interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = future.result()
+                    self.stdout.write(f'任务{job.id}结束: {job.get_status_display()} {job.message}')
+                running -= done
+
+        self.stdout.write(f'执行进程{worker_id}退出')
+
+    @staticmethod
+    def run_job(manager, job):
+        try:
+            return manager.run_job(job)
+        finally:
+            connection.close()  # 线程结束，关闭线程的数据库连接
+
+    def _stop(self, signum, frame):
+        self.stdout.write('收到退出信号，不再领取新任务，等待执行中的任务结束')
+        self._stopping = True
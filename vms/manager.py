@@ -1,17 +1,28 @@
+import json
+import time
 import uuid
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
-from django.db.models import Q
+from django.conf import settings
+from django.db import transaction, connection
+from django.db.models import Q, Sum, Count, F
+from django.utils import timezone
 
-from ceph.managers import RadosError, get_rbd_manager, ImageExistsError
-from ceph.models import CephCluster
+from backup.models import BackupChain
+from ceph.managers import RadosError, get_rbd_manager, ImageExistsError, sync_image_changes
+from ceph.models import CephCluster, CephPool
 from compute.managers import CenterManager, GroupManager, HostManager, ComputeError
 from image.managers import ImageManager, ImageError
+from image.models import Image, VmXmlTemplate
 from network.managers import VlanManager, MacIPManager, NetworkError
 from vdisk.manager import VdiskManager, VdiskError
+from vdisk.models import Vdisk, VdiskSnap
 from device.manager import DeviceError, PCIDeviceManager
 from utils.ev_libvirt.virt import VirtAPI, VirtError, VmDomain, VirDomainNotExist
-from .models import (Vm, VmArchive, VmLog, VmDiskSnap, rename_sys_disk_delete, rename_image, MigrateLog, Flavor)
-from .xml import XMLEditor
+from .models import (Vm, VmArchive, VmLog, VmDiskSnap, rename_sys_disk_delete, rename_image, MigrateLog, Flavor,
+                     DiskFlattenTask, CenterMigrateTask, DiskTrimLog, VmJob, HostEvacuation, HostEvacuationVm)
+from .xml import XMLEditor, XMLError, render_xml_template
 from utils.errors import VmError, VmNotExistError, VmRunningError
 from .scheduler import HostMacIPScheduler, ScheduleError
 
@@ -71,12 +82,11 @@ class VmManager(VirtAPI):
         if not xml.set_xml(xml_desc):
             raise VmError(msg='xml文本无效')
 
-        root = xml.get_root()
         try:
-            root.getElementsByTagName('vcpu')[0].firstChild.data = vcpu
-        except Exception as e:
+            xml.set_vcpu(vcpu)
+        except XMLError as e:
             raise VmError(msg='修改xml文本vcpu节点错误')
-        return root.toxml()
+        return xml.to_xml()
 
     def _xml_edit_mem(self, xml_desc:str, mem:int):
         '''
@@ -93,18 +103,10 @@ class VmManager(VirtAPI):
         if not xml.set_xml(xml_desc):
             raise VmError(msg='xml文本无效')
         try:
-            root = xml.get_root()
-            node = root.getElementsByTagName('memory')[0]
-            node.attributes['unit'].value = 'MiB'
-            node.firstChild.data = mem
-
-            node = root.getElementsByTagName('currentMemory')[0]
-            node.attributes['unit'].value = 'MiB'
-            node.firstChild.data = mem
-
-            return root.toxml()
-        except Exception as e:
+            xml.set_memory(mem)
+        except XMLError as e:
             raise VmError(msg='修改xml文本memory节点错误')
+        return xml.to_xml()
 
     def get_vms_queryset_by_center(self, center_or_id):
         '''
@@ -226,65 +228,109 @@ class VmManager(VirtAPI):
         except self.VirtError as e:
             raise VmError(msg=str(e))
 
-    def _xml_remove_sys_disk_auth(self, xml_desc:str):
+    def get_vm_xml_cached(self, vm: Vm):
         '''
-        去除vm xml中系统盘节点ceph认证的auth
+        获取缓存的虚拟机xml，只需要设备布局等信息时使用；xml未与宿主机同步时从宿主机获取并缓存
 
-        :param xml_desc: 定义虚拟机的xml内容
+        :param vm: 虚拟机对象
         :return:
             xml: str    # success
 
-        :raise:  VmError
+        :raise VmError()
         '''
-        xml = XMLEditor()
-        if not xml.set_xml(xml_desc):
-            raise VmError(msg='虚拟机xml文本无效')
+        if vm.xml_trusted:
+            return vm.xml
+
+        return self.refresh_vm_xml(vm)
+
+    def refresh_vm_xml(self, vm: Vm):
+        '''
+        从宿主机获取虚拟机xml，更新缓存
+
+        :param vm: 虚拟机对象
+        :return:
+            xml: str    # success
+
+        :raise VmError()
+        '''
+        xml_desc = self.get_vm_xml_desc(host_ipv4=vm.host.ipv4, vm_uuid=vm.get_uuid())
+        self.save_vm_xml(vm=vm, xml_desc=xml_desc)
+        return xml_desc
+
+    @staticmethod
+    def save_vm_xml(vm: Vm, xml_desc: str):
+        '''
+        EVCloud定义虚拟机后更新缓存的xml和版本号；锁定虚拟机行，版本号在数据库中的最新版本上加1
+
+        :param vm: 虚拟机对象
+        :param xml_desc: 定义虚拟机的xml
+        '''
+        vm.set_xml(xml_desc)
+        try:
+            with transaction.atomic():
+                version = Vm.objects.select_for_update().values_list('xml_version', flat=True).get(uuid=vm.uuid)
+                vm.xml_version = max(version, 0) + 1
+                Vm.objects.filter(uuid=vm.uuid).update(xml=xml_desc, xml_version=vm.xml_version)
+        except Exception:
+            pass
+
+    def update_vm_xml_device(self, vm: Vm, device_xml: str, attach: bool):
+        '''
+        EVCloud挂载或卸载设备后，在缓存的xml中同步添加或移除设备，不从宿主机获取xml；
+        缓存不可信或同步失败时从宿主机获取，获取失败时标记缓存不可信
 
-        root = xml.get_root()
-        devices = root.getElementsByTagName('devices')
-        if not devices:
-            raise VmError(msg='虚拟机xml文本无效, 未找到devices节点')
+        并发挂载、卸载时，锁定虚拟机行后重新读取缓存的xml再修改，避免覆盖其他请求的修改
 
-        disks = devices[0].getElementsByTagName('disk')
-        if not disks:
-            raise VmError(msg='虚拟机xml文本无效, 未找到devices>disk节点')
-        disk = disks[0]
-        auth = disk.getElementsByTagName('auth')
-        if not auth:
-            return xml_desc
+        :param vm: 虚拟机对象
+        :param device_xml: 设备xml
+        :param attach: True(挂载)，False(卸载)
+        '''
+        try:
+            with transaction.atomic():
+                vm.xml, vm.xml_version = Vm.objects.select_for_update().values_list(
+                    'xml', 'xml_version').get(uuid=vm.uuid)
+                xml = XMLEditor()
+                if vm.xml_trusted and xml.set_xml(vm.xml):
+                    if attach:
+                        xml.attach_device(device_xml)
+                    else:
+                        xml.detach_device(device_xml)
+                    vm.set_xml(xml.to_xml())
+                    Vm.objects.filter(uuid=vm.uuid).update(xml=vm.xml, xml_version=vm.xml_version)
+                    return
+        except Exception:     # xml无效或数据库错误，从宿主机获取
+            pass
 
-        disk.removeChild(auth[0])
-        return root.toxml()
+        try:
+            self.refresh_vm_xml(vm)
+        except VmError:
+            vm.xml_version = 0
+            Vm.objects.filter(uuid=vm.uuid).update(xml_version=0)
 
-    def get_vm_vdisk_dev_list(self, vm:Vm):
+    def get_vm_vdisk_dev_list(self, vm:Vm, live: bool = False):
         '''
         获取虚拟机所有硬盘的dev
 
         :param vm: 虚拟机对象
+        :param live: True从宿主机获取xml并更新缓存；默认False使用缓存的xml
         :return:
             (disk:list, dev:list)    # disk = [disk_uuid, disk_uuid, ]; dev = ['vda', 'vdb', ]
 
         :raises: VmError
         '''
-        xml_desc = self.get_vm_xml_desc(vm_uuid=vm.get_uuid(), host_ipv4=vm.host.ipv4)
+        xml_desc = self.refresh_vm_xml(vm=vm) if live else self.get_vm_xml_cached(vm=vm)
 
-        dev_list = []
-        disk_list = []
         xml = XMLEditor()
         if not xml.set_xml(xml_desc):
             raise VmError(msg='虚拟机xml文本无效')
 
-        root = xml.get_root()
-        devices = root.getElementsByTagName('devices')[0].childNodes
-        for d in devices:
-            if d.nodeName == 'disk':
-                for disk_child in d.childNodes:
-                    if disk_child.nodeName == 'source':
-                        pool_disk = disk_child.getAttribute('name')
-                        disk = pool_disk.split('/')[-1]
-                        disk_list.append(disk)
-                    if disk_child.nodeName == 'target':
-                        dev_list.append(disk_child.getAttribute('dev'))
+        try:
+            disks = xml.list_disks()
+        except XMLError as e:
+            raise VmError(msg=f'虚拟机{str(e)}')
+
+        disk_list = [d['source'].split('/')[-1] for d in disks if d['source']]
+        dev_list = [d['dev'] for d in disks if d['dev']]
         return disk_list, dev_list
 
     def new_vdisk_dev(self, dev_list:list):
@@ -304,12 +350,42 @@ class VmManager(VirtAPI):
 
         return None
 
-    def mount_disk(self, vm:Vm, disk_xml:str):
+    def claim_vdisk_dev(self, vm: Vm, vdisk_uuid: str, exclude_devs=()):
+        '''
+        为挂载的硬盘分配虚拟机中的设备名，并在硬盘元数据层面和虚拟机建立挂载关系；
+        锁定虚拟机记录，根据元数据中已挂载硬盘的dev分配，同一个虚拟机同时挂载多个硬盘时不会分配到相同的dev
+
+        :param vm: 虚拟机对象
+        :param vdisk_uuid: 虚拟硬盘uuid
+        :param exclude_devs: 不能分配的dev，如宿主机上虚拟机xml中已使用的
+        :return:
+            (dev:str, mounted:bool)     # mounted=True: 硬盘已挂载到此虚拟机，不需要再挂载
+
+        :raises: VmError
+        '''
+        with transaction.atomic():
+            Vm.objects.select_for_update().filter(uuid=vm.uuid).first()   # 虚拟机行锁
+            mounted = dict(Vdisk.objects.filter(vm=vm).values_list('uuid', 'dev'))
+            if vdisk_uuid in mounted:
+                return mounted[vdisk_uuid], True
+
+            dev = self.new_vdisk_dev(list(mounted.values()) + list(exclude_devs))
+            if not dev:
+                raise VmError(msg='不能挂载更多的硬盘了')
+            try:
+                VdiskManager().mount_to_vm(vdisk_uuid=vdisk_uuid, vm=vm, dev=dev)
+            except VdiskError as e:
+                raise VmError(msg=str(e))
+
+        return dev, False
+
+    def mount_disk(self, vm:Vm, disk_xml:str, ignore_exists: bool = True):
         '''
         向虚拟机挂载虚拟硬盘
 
         :param vm: 虚拟机对象
         :param disk_xml: 硬盘xml
+        :param ignore_exists: True(默认)虚拟机中已有此设备名的硬盘时视为成功；False时抛出错误
         :return:
             True    # success
             False   # failed
@@ -318,12 +394,14 @@ class VmManager(VirtAPI):
         host = vm.host
         domain = self.get_vm_domain(host_ipv4=host.ipv4, vm_uuid=vm.get_uuid())
         try:
-            if domain.attach_device(xml=disk_xml):
-                return True
-            return False
+            if not domain.attach_device(xml=disk_xml, ignore_exists=ignore_exists):
+                return False
         except self.VirtError as e:
             raise VmError(msg=f'挂载硬盘错误，{str(e)}')
 
+        self.update_vm_xml_device(vm=vm, device_xml=disk_xml, attach=True)
+        return True
+
     def umount_disk(self, vm:Vm, disk_xml:str):
         '''
         从虚拟机卸载虚拟硬盘
@@ -338,12 +416,14 @@ class VmManager(VirtAPI):
         host = vm.host
         domain = self.get_vm_domain(host_ipv4=host.ipv4, vm_uuid=vm.get_uuid())
         try:
-            if domain.detach_device(xml=disk_xml):
-                return True
-            return False
+            if not domain.detach_device(xml=disk_xml):
+                return False
         except self.VirtError as e:
             raise VmError(msg=f'卸载硬盘错误，{str(e)}')
 
+        self.update_vm_xml_device(vm=vm, device_xml=disk_xml, attach=False)
+        return True
+
     def create_sys_disk_snap(self, vm:Vm, remarks:str):
         '''
         创建虚拟机系统盘快照
@@ -417,13 +497,14 @@ class VmManager(VirtAPI):
 
         return snap
 
-    def disk_rollback_to_snap(self, vm:Vm, snap_id:int):
+    def disk_rollback_to_snap(self, vm:Vm, snap_id:int, clone:bool=None):
         '''
         回滚虚拟机系统盘到指定快照
 
         :param vm: 虚拟机对象
         :param snap_id: 快照id
-        :param user: 用户
+        :param clone: True：从快照克隆新系统盘替换原系统盘，耗时与硬盘大小无关；False：rbd rollback，耗时与硬盘大小成正比；
+                      默认None，由settings.VM_SNAP_ROLLBACK_CLONE决定
         :return:
             True    # success
 
@@ -433,9 +514,18 @@ class VmManager(VirtAPI):
         if not snap:
             raise VmError(msg='快照不存在')
 
-        if snap.disk != vm.disk:
+        try:
+            snap_disk = snap.sys_disk
+        except Exception as e:
+            raise VmError(msg=str(e))
+        if snap_disk != vm.disk and snap.vm_id != vm.id:
             raise VmError(msg='快照不属于此主机')
 
+        if clone is None:
+            clone = getattr(settings, 'VM_SNAP_ROLLBACK_CLONE', False)
+        if not clone and snap_disk != vm.disk:
+            raise VmError(msg='快照属于克隆回滚前的系统盘，只能克隆回滚')
+
         ceph_pool = snap.ceph_pool
         if not ceph_pool:
             raise VmError(msg='can not get ceph pool')
@@ -446,12 +536,111 @@ class VmManager(VirtAPI):
 
         try:
             rbd = get_rbd_manager(ceph=config, pool_name=pool_name)
-            rbd.image_rollback_to_snap(image_name=vm.disk, snap=snap.snap)
+            if not clone:
+                rbd.image_rollback_to_snap(image_name=vm.disk, snap=snap.snap)
+                return True
         except (RadosError, Exception) as e:
             raise VmError(msg=str(e))
 
+        return self._disk_clone_swap(vm=vm, snap=snap, rbd=rbd)
+
+    def _disk_clone_swap(self, vm:Vm, snap:VmDiskSnap, rbd):
+        '''
+        克隆回滚：从快照克隆新的系统盘，原系统盘归档（x_开头的名称，快照随之保留），新系统盘重命名为原系统盘名称，
+        添加后台flatten任务解除新系统盘对快照的克隆依赖
+
+        :param vm: 虚拟机对象，已关机
+        :param snap: 快照VmDiskSnap()
+        :param rbd: 快照所在pool的RbdManager()
+        :return:
+            True    # success
+
+        :raises: VmError
+        '''
+        ceph_pool = snap.ceph_pool
+        disk = vm.disk
+        snap_disk = snap.sys_disk
+        new_disk = f'{disk}_rollback'
+        data_pool = ceph_pool.data_pool if ceph_pool.has_data_pool else None
+        try:
+            rbd.remove_image(image_name=new_disk)   # 之前回滚失败遗留的克隆image
+            rbd.protect_snap(image_name=snap_disk, snap=snap.snap)
+            rbd.clone_image(snap_image_name=snap_disk, snap_name=snap.snap, new_image_name=new_disk,
+                            data_pool=data_pool, features=ceph_pool.rbd_features_mask)
+        except RadosError as e:
+            raise VmError(msg=f'从快照克隆系统盘失败，{str(e)}')
+
+        ok, archived = rename_sys_disk_delete(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name, disk_name=disk)
+        if not ok:
+            try:
+                rbd.remove_image(image_name=new_disk)
+            except RadosError:
+                pass
+            raise VmError(msg='归档原系统盘失败')
+
+        try:
+            rbd.rename_image(image_name=new_disk, new_name=disk)
+        except RadosError as e:
+            try:
+                rbd.rename_image(image_name=archived, new_name=disk)
+                rbd.remove_image(image_name=new_disk)
+            except RadosError:
+                pass
+            raise VmError(msg=f'替换系统盘失败，{str(e)}')
+
+        # 原系统盘的快照随原系统盘归档
+        VmDiskSnap.objects.filter(Q(disk=disk) | Q(vm=vm, disk='')).update(disk=archived)
+        parent_disk = archived if snap_disk == disk else snap_disk
+        # flatten完成后，虚拟机已删除快照记录的父快照由DiskFlattenManager清理，归档的系统盘没有快照后由gc_rbd_images清理
+        try:
+            DiskFlattenManager().add_task(disk=disk, ceph_pool=ceph_pool, vm_uuid=vm.hex_uuid,
+                                          parent=f'{ceph_pool.pool_name}/{parent_disk}@{snap.snap}',
+                                          reason=DiskFlattenTask.REASON_SNAP_ROLLBACK, update=True)
+        except VmError:
+            pass    # 系统盘可以正常使用，之后可由flatten_sys_disk --days添加flatten任务
+
         return True
 
+    @staticmethod
+    def detach_clone_parent_snap(vm: Vm):
+        '''
+        系统盘是从快照克隆回滚的时，解除克隆父快照记录与虚拟机的关联；删除、重置、更换系统盘删除快照前调用
+
+        父快照有克隆子image（原系统盘）时rbd快照不能删除，解除关联的记录保留，
+        由DiskFlattenManager.remove_released_parent_snaps()在子image flatten或删除后清理
+
+        :param vm: 虚拟机对象
+        :return:
+            int     # 解除关联的快照记录数
+
+        :raises: VmError
+        '''
+        qs = VmDiskSnap.objects.filter(vm=vm).exclude(disk__in=['', vm.disk])
+        if not qs.exists():     # 没有克隆回滚过
+            return 0
+
+        pool = vm.image.ceph_pool
+        try:
+            rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+            parent = rbd.get_image_parent(image_name=vm.disk)
+        except RadosError as e:
+            raise VmError(msg=f'查询系统盘的克隆父快照失败，{str(e)}')
+        if not parent:
+            return 0
+
+        _, parent_disk, parent_snap = parent
+        count = 0
+        for snap in qs.filter(disk=parent_disk, snap=parent_snap):
+            snap.ceph_pool = snap.get_ceph_pool()
+            snap.vm = None
+            try:
+                snap.save(update_fields=['vm', 'ceph_pool'])
+            except Exception as e:
+                raise VmError(msg=f'解除克隆父快照记录与虚拟机的关联失败，{str(e)}')
+            count += 1
+
+        return count
+
     def migrate_create_vm(self, vm, new_host):
         """
         虚拟机迁移目标宿主机上创建虚拟机
@@ -481,13 +670,10 @@ class VmManager(VirtAPI):
                 image = vm.image
                 pool = image.ceph_pool
                 ceph = pool.ceph
-                xml_tpl = image.xml_tpl.xml  # 创建虚拟机的xml模板字符串
-                xml_desc = xml_tpl.format(name=vm_uuid, uuid=vm_uuid, mem=vm.mem, vcpu=vm.vcpu, ceph_uuid=ceph.uuid,
-                                          ceph_pool=pool.pool_name, diskname=vm.disk, ceph_username=ceph.username,
-                                          ceph_hosts_xml=ceph.hosts_xml, mac=vm.mac_ip.mac, bridge=vm.mac_ip.vlan.br)
-
-                if not ceph.has_auth:
-                    xml_desc = self._xml_remove_sys_disk_auth(xml_desc)
+                xml_desc = render_xml_template(
+                    image.xml_tpl, has_auth=ceph.has_auth, name=vm_uuid, uuid=vm_uuid, mem=vm.mem, vcpu=vm.vcpu,
+                    ceph_uuid=ceph.uuid, ceph_pool=pool.pool_name, diskname=vm.disk, ceph_username=ceph.username,
+                    ceph_hosts_xml=ceph.hosts_xml, mac=vm.mac_ip.mac, bridge=vm.mac_ip.vlan.br)
             except Exception as e:
                 raise VmError(msg=f'构建虚拟机xml错误，{str(e)}')
 
@@ -501,9 +687,9 @@ class VmManager(VirtAPI):
             new_vm_define_ok = True
 
             vm.host = new_host
-            vm.xml = xml_desc
+            vm.set_xml(xml_desc)
             try:
-                vm.save(update_fields=['host', 'xml'])
+                vm.save(update_fields=['host', 'xml', 'xml_version'])
             except Exception as e:
                 raise VmError(msg='更新虚拟机元数据失败')
 
@@ -540,12 +726,10 @@ class VmManager(VirtAPI):
             old_vm_xml_desc = self.get_vm_xml_desc(vm_uuid=vm_uuid, host_ipv4=vm.host.ipv4)
 
             # 虚拟机xml
-            xml_tpl = new_image.xml_tpl.xml  # 创建虚拟机的xml模板字符串
-            xml_desc = xml_tpl.format(name=vm_uuid, uuid=vm_uuid, mem=vm.mem, vcpu=vm.vcpu, ceph_uuid=new_ceph.uuid,
-                                      ceph_pool=new_pool_name, diskname=disk_name, ceph_username=new_ceph.username,
-                                      ceph_hosts_xml=new_ceph.hosts_xml, mac=vm.mac_ip.mac, bridge=vm.mac_ip.vlan.br)
-            if not new_ceph.has_auth:
-                xml_desc = self._xml_remove_sys_disk_auth(xml_desc)
+            xml_desc = render_xml_template(
+                new_image.xml_tpl, has_auth=new_ceph.has_auth, name=vm_uuid, uuid=vm_uuid, mem=vm.mem, vcpu=vm.vcpu,
+                ceph_uuid=new_ceph.uuid, ceph_pool=new_pool_name, diskname=disk_name, ceph_username=new_ceph.username,
+                ceph_hosts_xml=new_ceph.hosts_xml, mac=vm.mac_ip.mac, bridge=vm.mac_ip.vlan.br)
 
             rbd_manager = get_rbd_manager(ceph=new_ceph, pool_name=new_pool_name)
         except Exception as e:
@@ -556,7 +740,8 @@ class VmManager(VirtAPI):
         try:
             try:
                 rbd_manager.clone_image(snap_image_name=new_image.base_image, snap_name=new_image.snap,
-                                        new_image_name=disk_name, data_pool=new_data_pool)
+                                        new_image_name=disk_name, data_pool=new_data_pool,
+                                        features=new_pool.rbd_features_mask)
             except ImageExistsError as e:
                 pass
             new_disk_ok = True
@@ -568,9 +753,9 @@ class VmManager(VirtAPI):
             new_vm_define_ok = True
 
             vm.image = new_image
-            vm.xml = xml_desc
+            vm.set_xml(xml_desc)
             try:
-                vm.save(update_fields=['image', 'xml'])
+                vm.save(update_fields=['image', 'xml', 'xml_version'])
             except Exception as e:
                 raise VmError(msg='更新虚拟机元数据失败')
             return vm
@@ -649,66 +834,1754 @@ class VmArchiveManager:
         '''
         添加一个虚拟机的归档记录
 
-        :param vm: 虚拟机元数据对象
+        :param vm: 虚拟机元数据对象
+        :return:
+            VmArchive() # success
+
+        :raises:  VmError
+        '''
+        try:
+            host = vm.host
+            group = host.group
+            center = group.center
+            mac_ip = vm.mac_ip
+            vlan = mac_ip.vlan
+            image = vm.image
+            ceph_pool = image.ceph_pool
+
+            va = VmArchive(uuid=vm.get_uuid(), name=vm.name, vcpu=vm.vcpu, mem=vm.mem, disk=vm.disk, xml=vm.xml,
+                           mac=mac_ip.mac, ipv4=mac_ip.ipv4, vlan_id=vlan.id, br=vlan.br,
+                           image_id=image.id, image_parent=image.base_image, ceph_id=ceph_pool.ceph.id, ceph_pool=ceph_pool.pool_name,
+                           center_id=center.id, center_name=center.name, group_id=group.id, group_name=group.name,
+                           host_id=host.id, host_ipv4=host.ipv4, user=vm.user, create_time=vm.create_time, remarks=vm.remarks)
+            va.save()
+        except Exception as e:
+            raise VmError(msg=str(e))
+        return va
+
+    @staticmethod
+    def get_vm_archive(vm: Vm):
+        return VmArchive.objects.filter(uuid=vm.get_uuid()).first()
+
+
+class VmLogManager:
+    '''
+    虚拟机错误日志记录管理
+    '''
+    def __init__(self):
+        self.vm_log = VmLog()
+
+    @property
+    def about(self):
+        return self.vm_log
+
+    def add_log(self, title:str, about:int, text:str):
+        '''
+        添加记录
+
+        :param title: 记录标题
+        :param about: 记录相关内容
+        :param text: 记录内容
+        :return:
+            VmLog()     # success
+            None        # failed
+        '''
+        about = VmLog.to_valid_about_value(about)
+        try:
+            log = VmLog(title=title, about=about, content=text)
+            log.save()
+        except Exception as e:
+            return None
+
+        return log
+
+
+class DiskFlattenManager:
+    """
+    系统盘flatten任务管理器
+
+    系统盘都是从系统镜像快照克隆的，克隆链过深影响读性能，并且镜像快照有克隆子image时无法删除；
+    后台任务在时间窗口内逐个flatten系统盘，解除与镜像快照的依赖。
+
+    注意：只按任务限速（任务之间间隔、开始任务前检查时间窗口），单个flatten的I/O不限速，
+    由librbd按rbd_concurrent_management_ops并发复制数据；已开始的flatten不会因时间窗口结束而中断
+    """
+    VmError = VmError
+
+    @staticmethod
+    def get_task_queryset():
+        """
+        flatten任务查询集
+        :return: QuerySet()
+        """
+        return DiskFlattenTask.objects.all()
+
+    def add_task(self, disk: str, ceph_pool, vm_uuid: str = '', parent: str = '',
+                 reason: int = DiskFlattenTask.REASON_AGE, update: bool = False):
+        """
+        添加一个系统盘flatten任务，系统盘已有未完成的任务时不重复添加
+
+        :param disk: 系统盘rbd image名称
+        :param ceph_pool: 系统盘所在的CephPool()
+        :param vm_uuid: 虚拟机uuid
+        :param parent: 父镜像快照, 格式：pool/image@snap
+        :param reason: 添加任务的原因
+        :param update: 已有等待中的任务时，是否更新任务的父镜像快照和原因（系统盘被重新克隆了）
+        :return:
+            (DiskFlattenTask(), created:bool)
+
+        :raises: VmError
+        """
+        try:
+            task = self.get_task_queryset().filter(
+                disk=disk, ceph_pool=ceph_pool,
+                status__in=[DiskFlattenTask.STATUS_WAIT, DiskFlattenTask.STATUS_RUNNING]).first()
+            if task:
+                if update and task.status == DiskFlattenTask.STATUS_WAIT:
+                    task.parent = parent
+                    task.reason = reason
+                    task.save(update_fields=['parent', 'reason'])
+                return task, False
+
+            task = DiskFlattenTask(disk=disk, ceph_pool=ceph_pool, vm_uuid=vm_uuid, parent=parent, reason=reason)
+            task.save()
+        except Exception as e:
+            raise VmError(msg=f'添加系统盘flatten任务失败，{str(e)}')
+
+        return task, True
+
+    def add_aged_vm_tasks(self, days: int):
+        """
+        为创建时间超过指定天数的虚拟机系统盘添加flatten任务，已有任务（失败的除外）的系统盘不再添加
+
+        :param days: 天数
+        :return:
+            int     # 新添加的任务数
+
+        :raises: VmError
+        """
+        before = timezone.now() - timedelta(days=days)
+        exclude_disks = self.get_task_queryset().exclude(status=DiskFlattenTask.STATUS_FAILED).values('disk')
+        qs = Vm.objects.filter(create_time__lt=before).exclude(disk__in=exclude_disks).values_list(
+            'uuid', 'disk', 'image__ceph_pool_id')
+
+        tasks = []
+        try:
+            for vm_uuid, disk, pool_id in qs.iterator():
+                tasks.append(DiskFlattenTask(vm_uuid=vm_uuid, disk=disk, ceph_pool_id=pool_id,
+                                             reason=DiskFlattenTask.REASON_AGE))
+            DiskFlattenTask.objects.bulk_create(tasks, batch_size=500)
+        except Exception as e:
+            raise VmError(msg=f'添加系统盘flatten任务失败，{str(e)}')
+
+        return len(tasks)
+
+    def add_image_children_tasks(self, image):
+        """
+        为系统镜像所有快照的克隆子image（系统盘）添加flatten任务，用于镜像快照替换前解除系统盘的依赖
+
+        :param image: 系统镜像Image()
+        :return:
+            int     # 新添加的任务数
+
+        :raises: VmError
+        """
+        pool = image.ceph_pool
+        ceph = pool.ceph
+        try:
+            rbd = get_rbd_manager(ceph=ceph, pool_name=pool.pool_name)
+            snaps = rbd.list_image_snaps(image.base_image)
+            children = []
+            for snap in snaps:
+                for child_pool, child in rbd.list_snap_children(image_name=image.base_image, snap=snap['name']):
+                    children.append((child_pool, child, f'{pool.pool_name}/{image.base_image}@{snap["name"]}'))
+        except RadosError as e:
+            raise VmError(msg=f'查询系统镜像快照的克隆image失败，{str(e)}')
+
+        pools = {p.pool_name: p for p in CephPool.objects.filter(ceph=ceph).all()}
+        disk_vms = dict(Vm.objects.filter(disk__in=[c[1] for c in children]).values_list('disk', 'uuid'))
+        count = 0
+        for child_pool, child, parent in children:
+            _, created = self.add_task(disk=child, ceph_pool=pools.get(child_pool), vm_uuid=disk_vms.get(child, ''),
+                                       parent=parent, reason=DiskFlattenTask.REASON_IMAGE)
+            if created:
+                count += 1
+
+        return count
+
+    def remove_unused_image_snaps(self, image):
+        """
+        删除系统镜像没有克隆子image的旧快照，当前生效的快照和复制镜像增量复制的基础快照不删除
+
+        :param image: 系统镜像Image()
+        :return:
+            list    # 已删除的快照名称
+
+        :raises: VmError
+        """
+        pool = image.ceph_pool
+        removed = []
+        try:
+            rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+            for snap in rbd.list_image_snaps(image.base_image):
+                name = snap['name']
+                if name == image.snap or image.is_snap_replicated(name):
+                    continue
+                if rbd.list_snap_children(image_name=image.base_image, snap=name):
+                    continue
+
+                rbd.remove_snap(image_name=image.base_image, snap=name)
+                removed.append(name)
+        except RadosError as e:
+            raise VmError(msg=f'删除系统镜像旧快照失败，{str(e)}')
+
+        return removed
+
+    def snap_children_report(self, images):
+        """
+        统计系统镜像各快照的克隆子image数量
+
+        :param images: 系统镜像Image()的可迭代对象
+        :return:
+            [{'image': Image(), 'snap': str, 'current': bool, 'children': int, 'error': str}]
+        """
+        report = []
+        for image in images:
+            pool = image.ceph_pool
+            try:
+                rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+                for snap in rbd.list_image_snaps(image.base_image):
+                    name = snap['name']
+                    children = rbd.list_snap_children(image_name=image.base_image, snap=name)
+                    report.append({'image': image, 'snap': name, 'current': name == image.snap,
+                                   'children': len(children), 'error': ''})
+            except RadosError as e:
+                report.append({'image': image, 'snap': image.snap, 'current': True, 'children': -1, 'error': str(e)})
+
+        return report
+
+    def reset_running_tasks(self, hours: int):
+        """
+        执行中超过指定小时数的任务（执行任务的进程异常退出）重置为等待状态
+
+        :param hours: 小时数
+        :return:
+            int     # 重置的任务数
+        """
+        before = timezone.now() - timedelta(hours=hours)
+        return self.get_task_queryset().filter(status=DiskFlattenTask.STATUS_RUNNING, start_time__lt=before).update(
+            status=DiskFlattenTask.STATUS_WAIT, start_time=None)
+
+    def clear_disk_tasks(self, disk: str):
+        """
+        删除系统盘的flatten任务记录，系统盘被重新克隆时（重置、更换系统）旧记录失效
+
+        :param disk: 系统盘名称
+        """
+        try:
+            self.get_task_queryset().filter(disk=disk).exclude(status=DiskFlattenTask.STATUS_RUNNING).delete()
+        except Exception:
+            pass
+
+    @staticmethod
+    def remove_released_parent_snaps(disk: str = ''):
+        """
+        删除已解除与虚拟机关联、且没有克隆子image的克隆回滚父快照（见VmManager.detach_clone_parent_snap()），
+        归档的系统盘没有快照记录后由gc_rbd_images清理
+
+        :param disk: 只处理此归档系统盘的快照，默认所有
+        :return:
+            int     # 删除的快照数
+        """
+        qs = VmDiskSnap.objects.select_related('ceph_pool__ceph').filter(vm=None, disk__startswith='x_')
+        if disk:
+            qs = qs.filter(disk=disk)
+
+        count = 0
+        rbd_managers = {}
+        for snap in qs:
+            pool = snap.ceph_pool
+            if pool is None:
+                continue
+            try:
+                rbd = rbd_managers.get(pool.id)
+                if rbd is None:
+                    rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+                    rbd_managers[pool.id] = rbd
+                if rbd.list_snap_children(image_name=snap.disk, snap=snap.snap):
+                    continue
+                snap.delete()
+            except Exception:
+                continue
+            count += 1
+
+        return count
+
+    @staticmethod
+    def in_time_windows(windows: list, now=None):
+        """
+        当前时间是否在时间窗口内
+
+        :param windows: 时间窗口列表[(datetime.time, datetime.time)]，开始时间大于结束时间表示跨午夜；空列表不限制
+        :param now: 当前时间datetime.time, 默认本地当前时间
+        :return:
+            True    # 在时间窗口内
+            False   # 不在
+        """
+        if not windows:
+            return True
+
+        if now is None:
+            now = timezone.localtime().time()
+
+        for start, end in windows:
+            if start <= end:
+                if start <= now < end:
+                    return True
+            elif now >= start or now < end:
+                return True
+
+        return False
+
+    def run_tasks(self, max_count: int = 0, interval: float = 0, windows: list = None):
+        """
+        按顺序执行等待中的flatten任务
+
+        每个任务开始前和结束后都检查时间窗口，不在窗口内时停止；执行中的任务会执行完，
+        所以窗口结束时间应给最后一个任务留出余量
+
+        :param max_count: 本次最多执行任务数，0不限制
+        :param interval: 两个任务之间的间隔秒数，只控制任务的频率，不限制单个flatten的I/O
+        :param windows: 允许执行的时间窗口，见in_time_windows()
+        :return:
+            (ok:int, failed:int)
+        """
+        ok_count = 0
+        failed_count = 0
+        rbd_managers = {}
+        while not max_count or (ok_count + failed_count) < max_count:
+            if not self.in_time_windows(windows):
+                break
+
+            task = self.get_task_queryset().select_related('ceph_pool__ceph').filter(
+                status=DiskFlattenTask.STATUS_WAIT).first()
+            if task is None:
+                break
+
+            # 多个进程同时执行时，只有更新状态成功的进程执行此任务
+            rows = self.get_task_queryset().filter(id=task.id, status=DiskFlattenTask.STATUS_WAIT).update(
+                status=DiskFlattenTask.STATUS_RUNNING, start_time=timezone.now())
+            if rows != 1:
+                continue
+
+            if self._run_task(task=task, rbd_managers=rbd_managers):
+                ok_count += 1
+            else:
+                failed_count += 1
+
+            if not self.in_time_windows(windows):
+                break
+
+            if interval > 0:
+                time.sleep(interval)
+
+        return ok_count, failed_count
+
+    def _run_task(self, task, rbd_managers: dict):
+        """
+        执行一个flatten任务
+
+        :param task: DiskFlattenTask()
+        :param rbd_managers: RbdManager缓存，{pool_id: RbdManager()}
+        :return:
+            True    # success
+            False   # failed
+        """
+        pool = task.ceph_pool
+        try:
+            if pool is None:
+                raise RadosError('can not get ceph pool')
+
+            rbd = rbd_managers.get(pool.id)
+            if rbd is None:
+                rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+                rbd_managers[pool.id] = rbd
+
+            parent = rbd.get_image_parent(image_name=task.disk)
+            if parent:
+                if not task.parent:
+                    task.parent = f'{parent[0]}/{parent[1]}@{parent[2]}'
+                rbd.flatten_image(image_name=task.disk)
+                task.message = 'flatten完成'
+                if parent[1].startswith('x_'):     # 克隆回滚的父快照在归档的系统盘上
+                    self.remove_released_parent_snaps(disk=parent[1])
+            else:
+                task.message = '不是克隆的image，无需flatten'
+            task.status = DiskFlattenTask.STATUS_OK
+        except RadosError as e:
+            task.status = DiskFlattenTask.STATUS_FAILED
+            task.message = str(e)
+
+        task.end_time = timezone.now()
+        try:
+            task.save(update_fields=['status', 'parent', 'message', 'end_time'])
+        except Exception:
+            pass
+
+        return task.status == DiskFlattenTask.STATUS_OK
+
+
+class CenterMigrateManager:
+    """
+    虚拟机跨分中心迁移管理器
+
+    源和目标分中心的ceph集群不同，不能共享系统盘和云硬盘；虚拟机运行中先全量复制硬盘到目标ceph pool，
+    再做若干次增量同步，关机后最后同步一次变化的数据，在目标宿主机组重新创建虚拟机，停机时间只包括最后一次同步
+    """
+    VmError = VmError
+    SNAP_PREFIX = 'center-migrate'
+    SYNC_ENOUGH_SIZE = 64 * 1024 ** 2   # 一次增量同步的数据量小于此值时不再继续增量同步，可以关机
+    SHUTDOWN_POLL_INTERVAL = 2
+
+    def __init__(self):
+        self._vm_manager = VmManager()
+        self._host_manager = HostManager()
+        self._group_manager = GroupManager()
+        self._image_manager = ImageManager()
+        self._vdisk_manager = VdiskManager()
+        self._vlan_manager = VlanManager()
+
+    @staticmethod
+    def get_task_queryset():
+        """
+        跨分中心迁移任务查询集
+        :return: QuerySet()
+        """
+        return CenterMigrateTask.objects.all()
+
+    def add_task(self, vm_uuid: str, group_id: int = 0, host_id: int = 0, image_id: int = 0, quota_id: int = 0,
+                 vlan_id: int = 0, sync_rounds: int = 2):
+        """
+        添加一个虚拟机跨分中心迁移任务
+
+        :param vm_uuid: 虚拟机uuid
+        :param group_id: 目标宿主机组id，和host_id必须有一个有效
+        :param host_id: 目标宿主机id
+        :param image_id: 目标分中心的系统镜像id，默认目标分中心与虚拟机镜像同名的镜像
+        :param quota_id: 挂载的云硬盘迁移到的存储池id，默认目标宿主机组的第一个存储池
+        :param vlan_id: 目标子网id，默认原IP的子网属于目标分中心时保留原IP，否则自动分配
+        :param sync_rounds: 关机前最多增量同步次数
+        :return:
+            CenterMigrateTask()
+
+        :raises: VmError
+        """
+        vm = self._vm_manager.get_vm_by_uuid(vm_uuid=vm_uuid, related_fields=(
+            'host__group', 'image__ceph_pool__ceph', 'mac_ip__vlan'))
+        if not vm:
+            raise VmError(msg='虚拟机不存在')
+        if vm.locked_by:
+            raise VmError(msg=f'虚拟机正在执行{vm.locked_by}')
+
+        try:
+            host = self._host_manager.get_host_by_id(host_id=host_id) if host_id else None
+            group = host.group if host else self._group_manager.get_group_by_id(group_id=group_id)
+        except ComputeError as e:
+            raise VmError(msg=str(e))
+        if host_id and not host:
+            raise VmError(msg='目标宿主机不存在')
+        if not group:
+            raise VmError(msg='目标宿主机组不存在')
+
+        center_id = group.center_id
+        if center_id == vm.host.group.center_id:
+            raise VmError(msg='目标宿主机组和虚拟机在同一个分中心，请使用虚拟机迁移')
+
+        if self.get_task_queryset().filter(vm_uuid=vm.hex_uuid, status__in=[
+                CenterMigrateTask.STATUS_WAIT, CenterMigrateTask.STATUS_RUNNING]).exists():
+            raise VmError(msg='虚拟机已有未完成的跨分中心迁移任务')
+
+        if vm.pci_devices.exists():
+            raise VmError(msg='请先卸载主机挂载的PCI设备')
+
+        # 目标系统镜像
+        try:
+            if image_id:
+                image = self._image_manager.get_image_by_id(image_id=image_id, related_fields=('ceph_pool__ceph',))
+            else:
+                image = self._image_manager.get_image_queryset().select_related('ceph_pool__ceph').filter(
+                    name=vm.image.name, ceph_pool__ceph__center_id=center_id).first()
+        except ImageError as e:
+            raise VmError(msg=str(e))
+        if not image:
+            raise VmError(msg='目标分中心没有可用的系统镜像')
+        if image.ceph_pool.ceph.center_id != center_id:
+            raise VmError(msg='系统镜像不属于目标分中心')
+
+        # 云硬盘
+        quota = None
+        vdisks = list(vm.vdisks)
+        if vdisks:
+            if VdiskSnap.objects.filter(vdisk__in=vdisks).exists():
+                raise VmError(msg='请先删除挂载的云硬盘的快照')
+
+            if quota_id:
+                quota = self._vdisk_manager.get_quota_queryset().filter(id=quota_id).first()
+            else:
+                quota = self._vdisk_manager.choose_quota_by_group(group=group, size=max(v.size for v in vdisks))
+            if not quota:
+                raise VmError(msg='目标宿主机组没有可用的云硬盘存储池')
+            if quota.group_id != group.id:
+                raise VmError(msg='云硬盘存储池不属于目标宿主机组')
+
+            for vdisk in vdisks:
+                if not quota.check_disk_size_limit(size=vdisk.size):
+                    raise VmError(msg=f'云硬盘<{vdisk.uuid}>超过目标存储池单块云硬盘容量限制')
+            if not quota.meet_needs(size=sum(v.size for v in vdisks)):
+                raise VmError(msg='目标云硬盘存储池容量不足')
+
+        # 子网
+        vlan = None
+        if vlan_id:
+            try:
+                vlan = self._vlan_manager.get_vlan_by_id(vlan_id=vlan_id)
+            except NetworkError as e:
+                raise VmError(msg=str(e))
+            if not vlan:
+                raise VmError(msg='目标子网不存在')
+            if vlan.center_id != center_id:
+                raise VmError(msg='子网不属于目标分中心')
+
+        try:
+            task = CenterMigrateTask(vm_uuid=vm.hex_uuid, dst_group=group, dst_host=host, dst_image=image,
+                                     dst_quota=quota, dst_vlan=vlan, sync_rounds=max(sync_rounds, 0))
+            task.save()
+        except Exception as e:
+            raise VmError(msg=f'添加跨分中心迁移任务失败，{str(e)}')
+
+        return task
+
+    def reset_running_tasks(self, hours: int):
+        """
+        执行中超过指定小时数的任务（执行任务的进程异常退出）标记为失败，解除虚拟机的锁定，已复制的数据需要人工清理
+
+        :param hours: 小时数
+        :return:
+            int     # 标记的任务数
+        """
+        before = timezone.now() - timedelta(hours=hours)
+        count = 0
+        tasks = self.get_task_queryset().filter(status=CenterMigrateTask.STATUS_RUNNING, start_time__lt=before)
+        for task in tasks:
+            rows = self.get_task_queryset().filter(id=task.id, status=CenterMigrateTask.STATUS_RUNNING).update(
+                status=CenterMigrateTask.STATUS_FAILED, end_time=timezone.now(), message='执行任务的进程异常退出')
+            if rows:
+                Vm.objects.filter(uuid=task.vm_uuid, locked_by=self._lock_reason(task)).update(locked_by='')
+                count += 1
+
+        return count
+
+    @staticmethod
+    def _lock_reason(task):
+        return f'跨分中心迁移任务<{task.id}>'
+
+    def run_tasks(self, max_count: int = 0, shutdown_timeout: int = 300):
+        """
+        按顺序执行等待中的跨分中心迁移任务
+
+        :param max_count: 本次最多执行任务数，0不限制
+        :param shutdown_timeout: 等待虚拟机关机的最长秒数
+        :return:
+            (ok:int, failed:int)
+        """
+        ok_count = 0
+        failed_count = 0
+        while not max_count or (ok_count + failed_count) < max_count:
+            task = self.get_task_queryset().filter(status=CenterMigrateTask.STATUS_WAIT).order_by('id').first()
+            if task is None:
+                break
+
+            # 多个进程同时执行时，只有更新状态成功的进程执行此任务
+            rows = self.get_task_queryset().filter(id=task.id, status=CenterMigrateTask.STATUS_WAIT).update(
+                status=CenterMigrateTask.STATUS_RUNNING, start_time=timezone.now())
+            if rows != 1:
+                continue
+
+            task.status = CenterMigrateTask.STATUS_RUNNING
+            if self.run_task(task=task, shutdown_timeout=shutdown_timeout):
+                ok_count += 1
+            else:
+                failed_count += 1
+
+        return ok_count, failed_count
+
+    def run_task(self, task, shutdown_timeout: int = 300):
+        """
+        执行一个已标记为执行中的跨分中心迁移任务，迁移失败时清理目标ceph pool中已复制的硬盘，恢复虚拟机运行状态
+
+        :param task: CenterMigrateTask()
+        :param shutdown_timeout: 等待虚拟机关机的最长秒数
+        :return:
+            True    # success
+            False   # failed
+        """
+        disks = []
+        vm = None
+        locked = False
+        stopped = False
+        lock_reason = self._lock_reason(task)
+        try:
+            vm = self._vm_manager.get_vm_by_uuid(vm_uuid=task.vm_uuid, related_fields=(
+                'host__group', 'image__ceph_pool__ceph', 'mac_ip__vlan', 'user'))
+            if not vm:
+                raise VmError(msg='虚拟机不存在')
+            # 迁移期间锁定虚拟机，不能操作虚拟机和挂载、卸载硬盘
+            if not vm.lock(lock_reason):
+                raise VmError(msg=f'虚拟机正在执行其他操作({vm.locked_by})')
+            locked = True
+            if vm.pci_devices.exists():
+                raise VmError(msg='请先卸载主机挂载的PCI设备')
+
+            disks = self._get_task_disks(task=task, vm=vm)
+
+            self._set_stage(task, CenterMigrateTask.STAGE_COPY)
+            self._create_dst_disks(disks)
+            self._sync_disks(task=task, disks=disks)
+
+            self._set_stage(task, CenterMigrateTask.STAGE_SYNC)
+            for _ in range(task.sync_rounds):
+                if self._sync_disks(task=task, disks=disks) < self.SYNC_ENOUGH_SIZE:
+                    break
+
+            self._set_stage(task, CenterMigrateTask.STAGE_SHUTDOWN)
+            stopped = self._shutdown_vm(vm=vm, timeout=shutdown_timeout)
+            down_start = time.time()
+            # 锁定前已在执行的挂载、卸载可能改变了硬盘列表，关机后以最新的为准
+            disks = self._refresh_task_disks(task=task, vm=vm, disks=disks)
+
+            self._set_stage(task, CenterMigrateTask.STAGE_FINAL_SYNC)
+            self._sync_disks(task=task, disks=disks)
+
+            self._set_stage(task, CenterMigrateTask.STAGE_SWITCH)
+            log_msg = self._switch_vm(task=task, vm=vm, disks=disks, start=stopped)
+            task.downtime = time.time() - down_start
+        except Exception as e:  # 任何错误都要清理已复制的硬盘，恢复虚拟机运行状态，任务标记为失败
+            self._remove_dst_disks(disks)
+            if stopped:
+                try:
+                    self._vm_manager.start(host_ipv4=vm.host.ipv4, vm_uuid=vm.hex_uuid)
+                except Exception:
+                    pass
+            task.status = CenterMigrateTask.STATUS_FAILED
+            task.message = str(e)
+        else:
+            task.status = CenterMigrateTask.STATUS_OK
+            task.stage = CenterMigrateTask.STAGE_DONE
+            task.message = log_msg or '迁移正常'
+        finally:
+            self._remove_src_snaps(disks)
+            if locked:
+                vm.unlock(lock_reason)
+
+        task.end_time = timezone.now()
+        try:
+            task.save(update_fields=['status', 'stage', 'copied', 'downtime', 'message', 'end_time'])
+        except Exception:
+            pass
+
+        return task.status == CenterMigrateTask.STATUS_OK
+
+    @staticmethod
+    def _set_stage(task, stage: int):
+        task.stage = stage
+        try:
+            task.save(update_fields=['stage', 'copied'])
+        except Exception:
+            pass
+
+    @staticmethod
+    def _get_task_disks(task, vm):
+        """
+        虚拟机要复制的系统盘和云硬盘
+
+        :return:
+            [{'name': str, 'src': RbdManager(), 'dst': RbdManager(), 'data_pool': str, 'features': int,
+              'vdisk': Vdisk() or None, 'snap': str, 'created': bool}]
+        :raises: VmError, RadosError
+        """
+        rbd_managers = {}
+
+        def get_rbd(pool):
+            rbd = rbd_managers.get(pool.id)
+            if rbd is None:
+                rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+                rbd_managers[pool.id] = rbd
+            return rbd
+
+        def new_disk(name, src_pool, dst_pool, vdisk=None):
+            return {'name': name, 'src': get_rbd(src_pool), 'dst': get_rbd(dst_pool),
+                    'data_pool': dst_pool.data_pool if dst_pool.has_data_pool else None,
+                    'features': dst_pool.rbd_features_mask,
+                    'vdisk': vdisk, 'snap': None, 'created': False}
+
+        disks = [new_disk(vm.disk, vm.image.ceph_pool, task.dst_image.ceph_pool)]
+        for vdisk in vm.vdisks.select_related('quota__cephpool__ceph'):
+            if task.dst_quota is None:
+                raise VmError(msg='虚拟机挂载了云硬盘，任务未指定目标云硬盘存储池')
+            disks.append(new_disk(vdisk.uuid, vdisk.quota.cephpool, task.dst_quota.cephpool, vdisk=vdisk))
+
+        return disks
+
+    @staticmethod
+    def _create_dst_disks(disks: list):
+        """
+        在目标ceph pool创建与源硬盘大小相同的空image
+
+        :raises: VmError, RadosError
+        """
+        for disk in disks:
+            if disk['created']:
+                continue
+            size = disk['src'].get_image_meta(disk['name']).size
+            if not disk['dst'].create_image(name=disk['name'], size=size, data_pool=disk['data_pool'],
+                                            features=disk['features']):
+                raise VmError(msg=f'目标ceph pool已存在rbd image<{disk["name"]}>')
+            disk['created'] = True
+
+    def _refresh_task_disks(self, task, vm, disks: list):
+        """
+        重新获取虚拟机的硬盘列表；已卸载的硬盘清理已复制的数据和快照，新挂载的硬盘创建目标image，在最后一次同步时全量复制
+
+        :return:
+            list    # 最新的硬盘列表
+        :raises: VmError, RadosError
+        """
+        old_disks = {d['name']: d for d in disks}
+        new_disks = []
+        for disk in self._get_task_disks(task=task, vm=vm):
+            old = old_disks.pop(disk['name'], None)
+            if old is not None:
+                old['vdisk'] = disk['vdisk']
+                disk = old
+            new_disks.append(disk)
+
+        removed = list(old_disks.values())
+        self._remove_src_snaps(removed)
+        self._remove_dst_disks(removed)
+        # 先更新调用方的列表，失败时能清理新创建的目标image
+        disks[:] = new_disks
+        self._create_dst_disks(disks)
+        return disks
+
+    def _sync_disks(self, task, disks: list):
+        """
+        所有硬盘创建新快照，复制相对于上一个快照变化的数据到目标image，删除上一个快照
+
+        :return:
+            int     # 复制的数据量
+        :raises: RadosError
+        """
+        snap = f'{self.SNAP_PREFIX}-{task.id}-{timezone.now().strftime("%Y%m%d_%H%M%S_%f")}'
+        created = []
+        copied = 0
+        try:
+            for disk in disks:
+                disk['src'].create_snap(image_name=disk['name'], snap_name=snap)
+                created.append(disk)
+
+            for disk in disks:
+                from_snap = disk['snap']
+                copied += sync_image_changes(src_rbd=disk['src'], image_name=disk['name'], snap=snap,
+                                             dst_rbd=disk['dst'], from_snap=from_snap)
+                disk['snap'] = snap
+                if from_snap:
+                    disk['src'].remove_snap(image_name=disk['name'], snap=from_snap)
+        except Exception:
+            for disk in created:    # 未同步完成的新快照
+                if disk['snap'] != snap:
+                    try:
+                        disk['src'].remove_snap(image_name=disk['name'], snap=snap)
+                    except RadosError:
+                        pass
+            raise
+
+        task.copied += copied
+        return copied
+
+    def _shutdown_vm(self, vm, timeout: int):
+        """
+        关闭运行中的虚拟机，等待关机完成
+
+        :return:
+            True    # 虚拟机由此关机
+            False   # 虚拟机原来未运行
+        :raises: VmError
+        """
+        domain = self._vm_manager.get_vm_domain(host_ipv4=vm.host.ipv4, vm_uuid=vm.hex_uuid)
+        try:
+            if not domain.is_running():
+                return False
+
+            domain.shutdown()
+            deadline = time.time() + timeout
+            while not domain.is_shutoff():
+                if time.time() > deadline:
+                    raise VmError(msg=f'等待虚拟机关机超时({timeout}s)')
+                time.sleep(self.SHUTDOWN_POLL_INTERVAL)
+        except VirtError as e:
+            raise VmError(msg=f'关闭虚拟机失败，{str(e)}')
+
+        return True
+
+    def _switch_vm(self, task, vm, disks: list, start: bool):
+        """
+        在目标宿主机上创建虚拟机，更新虚拟机和云硬盘元数据；之后清理源宿主机上的虚拟机和源ceph集群中的硬盘，
+        清理失败不影响迁移结果，记录在返回的信息中
+
+        :param start: 是否启动目标宿主机上的虚拟机
+        :return:
+            str     # 清理失败的信息
+        :raises: VmError
+        """
+        vm_uuid = vm.hex_uuid
+        old_host = vm.host
+        old_macip = vm.mac_ip
+        old_image = vm.image
+        old_pool = old_image.ceph_pool
+        old_vlan = old_macip.vlan
+        vdisks = [(d['vdisk'], d['vdisk'].quota) for d in disks if d['vdisk']]
+
+        keep_ip = task.dst_vlan is None and old_vlan is not None and old_vlan.center_id == task.dst_group.center_id
+        vlan = old_vlan if keep_ip else task.dst_vlan
+        ip_public = old_vlan.is_public() if (vlan is None and old_vlan) else None
+        try:
+            new_host, new_macip = HostMacIPScheduler().schedule(
+                vcpu=vm.vcpu, mem=vm.mem, groups=[task.dst_group], host=task.dst_host, vlan=vlan,
+                need_mac_ip=not keep_ip, ip_public=ip_public)
+        except ScheduleError as e:
+            raise VmError(msg=f'申请目标宿主机资源失败，{str(e)}')
+        macip = old_macip if keep_ip else new_macip
+
+        claimed = []
+        new_vm_defined = False
+        try:
+            if macip is None:
+                raise VmError(msg='目标分中心没有可用的IP')
+
+            for vdisk, _ in vdisks:
+                if not task.dst_quota.claim(size=vdisk.size):
+                    raise VmError(msg='目标云硬盘存储池容量不足')
+                claimed.append(vdisk.size)
+
+            image = task.dst_image
+            pool = image.ceph_pool
+            ceph = pool.ceph
+            xml_desc = render_xml_template(
+                image.xml_tpl, has_auth=ceph.has_auth, name=vm_uuid, uuid=vm_uuid, mem=vm.mem, vcpu=vm.vcpu,
+                ceph_uuid=ceph.uuid, ceph_pool=pool.pool_name, diskname=vm.disk, ceph_username=ceph.username,
+                ceph_hosts_xml=ceph.hosts_xml, mac=macip.mac, bridge=macip.vlan.br)
+
+            try:
+                self._vm_manager.define(host_ipv4=new_host.ipv4, xml_desc=xml_desc)
+            except VirtError as e:
+                raise VmError(msg=f'目标宿主机创建虚拟机失败，{str(e)}')
+            new_vm_defined = True
+
+            # 源系统盘快照记录的ceph pool，虚拟机元数据更新后还能找到源系统盘
+            VmDiskSnap.objects.filter(vm=vm, ceph_pool=None).update(ceph_pool=old_pool)
+            try:
+                with transaction.atomic():
+                    vm.host = new_host
+                    vm.image = image
+                    vm.mac_ip = macip
+                    vm.set_xml(xml_desc)
+                    vm.save(update_fields=['host', 'image', 'mac_ip', 'xml', 'xml_version'])
+                    for vdisk, _ in vdisks:
+                        vdisk.quota = task.dst_quota
+                        vdisk.save(update_fields=['quota'])
+            except Exception as e:
+                raise VmError(msg=f'更新虚拟机元数据失败，{str(e)}')
+        except Exception as e:
+            if new_vm_defined:
+                try:
+                    self._vm_manager.undefine(host_ipv4=new_host.ipv4, vm_uuid=vm_uuid)
+                except VirtError:
+                    pass
+            new_host.free(vcpu=vm.vcpu, mem=vm.mem)
+            if new_macip:
+                new_macip.set_free()
+            for size in claimed:
+                task.dst_quota.free(size=size)
+            vm.host = old_host
+            vm.image = old_image
+            vm.mac_ip = old_macip
+            raise VmError(msg=str(e))
+
+        new_host.vm_created_num_add_1()  # 宿主机虚拟机数+1
+        log_msg = ''
+        if not keep_ip and not old_macip.set_free():
+            log_msg += f'原mac ip({old_macip.ipv4})释放失败;\n'
+
+        # 向虚拟机挂载硬盘
+        for vdisk, old_quota in vdisks:
+            old_quota.free(size=vdisk.size)
+            try:
+                self._vm_manager.mount_disk(vm=vm, disk_xml=vdisk.xml_desc(dev=vdisk.dev))
+            except VmError as e:
+                log_msg += f'vdisk(uuid={vdisk.uuid}) 挂载失败,err={str(e)}；\n'
+
+        # 删除原宿主机上的虚拟机
+        src_vm_undefined = False
+        try:
+            if not self._vm_manager.undefine(host_ipv4=old_host.ipv4, vm_uuid=vm_uuid):
+                raise VirtError(msg='删除原宿主机上的虚拟机失败')
+            src_vm_undefined = True
+            old_host.vm_created_num_sub_1()  # 宿主机虚拟机数-1
+        except VirtError as e:
+            log_msg += f'源host({old_host.ipv4})上的vm(uuid={vm_uuid})删除失败，err={str(e)};\n'
+        if not old_host.free(vcpu=vm.vcpu, mem=vm.mem):
+            log_msg += f'源host({old_host.ipv4})资源(vcpu={vm.vcpu}, mem={vm.mem}MB)释放失败;\n'
+
+        # 源ceph集群中的硬盘，系统盘归档，云硬盘移入回收站
+        deleted, failed = vm.sys_snaps.bulk_delete()
+        if failed:
+            log_msg += f'源系统盘快照删除失败：{";".join(s.snap for s, _ in failed)};\n'
+        self._remove_src_snaps(disks)
+        for disk in disks:  # 备份链的快照在源硬盘上，之后在目标ceph pool做全量备份
+            disk_type = BackupChain.TYPE_VDISK if disk['vdisk'] else BackupChain.TYPE_SYS_DISK
+            try:
+                BackupChain.release_disk(disk_type=disk_type, disk=disk['name'])
+            except RadosError as e:
+                log_msg += f'源硬盘({disk["name"]})的备份快照删除失败，err={str(e)};\n'
+            BackupChain.objects.filter(disk_type=disk_type, disk=disk['name']).update(
+                ceph_pool=task.dst_quota.cephpool if disk['vdisk'] else task.dst_image.ceph_pool)
+        ok, _ = rename_sys_disk_delete(ceph=old_pool.ceph, pool_name=old_pool.pool_name, disk_name=vm.disk)
+        if not ok:
+            log_msg += f'源系统盘({vm.disk})归档失败;\n'
+        for disk in disks[1:]:
+            try:
+                disk['src'].trash_move(image_name=disk['name'], delay=getattr(settings, 'RBD_TRASH_DELAY', 0))
+            except RadosError as e:
+                log_msg += f'源云硬盘({disk["name"]})删除失败，err={str(e)};\n'
+
+        if start:
+            try:
+                self._vm_manager.start(host_ipv4=new_host.ipv4, vm_uuid=vm_uuid)
+            except VirtError as e:
+                log_msg += f'目标宿主机上的虚拟机启动失败，err={str(e)};\n'
+
+        try:
+            MigrateLog(vm_uuid=vm_uuid, src_host_id=old_host.id, src_host_ipv4=old_host.ipv4,
+                       dst_host_id=new_host.id, dst_host_ipv4=new_host.ipv4, result=not log_msg,
+                       content=log_msg or '跨分中心迁移正常', src_undefined=src_vm_undefined).save()
+        except Exception:
+            pass
+
+        return log_msg
+
+    @staticmethod
+    def _remove_src_snaps(disks: list):
+        """
+        删除源硬盘上用于同步的快照，忽略错误
+        """
+        for disk in disks:
+            if disk['snap']:
+                try:
+                    disk['src'].remove_snap(image_name=disk['name'], snap=disk['snap'])
+                except RadosError:
+                    pass
+                disk['snap'] = None
+
+    @staticmethod
+    def _remove_dst_disks(disks: list):
+        """
+        迁移失败，删除目标ceph pool中已创建的硬盘，忽略错误
+        """
+        for disk in disks:
+            if disk['created']:
+                try:
+                    disk['dst'].remove_image(image_name=disk['name'])
+                except RadosError:
+                    pass
+                disk['created'] = False
+
+
+class DiskTrimManager:
+    """
+    虚拟机硬盘空间回收管理器
+
+    虚拟机内删除的数据不会释放ceph中已分配的空间；硬盘开启discard='unmap'后，通过guest agent在运行中的虚拟机内
+    执行fstrim，释放的数据块由librbd discard；按宿主机分批限速执行，记录rbd image已分配数据大小的变化
+    """
+    VmError = VmError
+
+    @staticmethod
+    def get_log_queryset():
+        """
+        硬盘空间回收记录查询集
+        :return: QuerySet()
+        """
+        return DiskTrimLog.objects.all()
+
+    @staticmethod
+    def xml_enable_discard(xml_desc: str):
+        """
+        xml中所有硬盘的driver节点设置discard='unmap'
+
+        :param xml_desc: 虚拟机xml或xml模板
+        :return:
+            (xml_desc:str, changed:bool)
+        :raises: VmError
+        """
+        xml = XMLEditor()
+        if not xml.set_xml(xml_desc):
+            raise VmError(msg='xml文本无效')
+
+        if not xml.enable_disk_discard():
+            return xml_desc, False
+
+        return xml.to_xml(), True
+
+    def enable_templates_discard(self):
+        """
+        虚拟机xml模板的硬盘开启discard，之后创建（或重建xml）的虚拟机生效
+
+        :return:
+            int     # 修改的模板数
+        """
+        count = 0
+        for tpl in VmXmlTemplate.objects.all():
+            try:
+                xml_desc, changed = self.xml_enable_discard(tpl.xml)
+            except VmError:
+                continue
+
+            if changed:
+                tpl.xml = xml_desc
+                tpl.save(update_fields=['xml', 'update_time'])
+                count += 1
+
+        return count
+
+    def enable_vm_discard(self, vm: Vm):
+        """
+        宿主机上虚拟机持久化定义的硬盘开启discard，运行中的虚拟机关机再开机后生效；同时更新虚拟机元数据的xml
+
+        :param vm: 虚拟机Vm()
+        :return:
+            True    # 已修改
+            False   # 已开启，无需修改
+        :raises: VmError
+        """
+        host_ipv4 = vm.host.ipv4
+        try:
+            xml_desc = VmManager.get_vm_domain(host_ipv4=host_ipv4, vm_uuid=vm.hex_uuid).inactive_xml_desc()
+            xml_desc, changed = self.xml_enable_discard(xml_desc)
+            if changed:
+                VmManager().define(host_ipv4=host_ipv4, xml_desc=xml_desc)
+        except VirtError as e:
+            raise VmError(msg=f'虚拟机硬盘开启discard失败，{str(e)}')
+
+        if changed:
+            VmManager.save_vm_xml(vm=vm, xml_desc=xml_desc)
+
+        return changed
+
+    def run_trims(self, vms, batch: int = 2, interval: float = 10, workers: int = 4):
+        """
+        在运行中的虚拟机内执行fstrim，不同宿主机并发执行，同一个宿主机上的虚拟机逐个执行，每执行batch个后暂停interval秒
+
+        :param vms: 虚拟机Vm()的可迭代对象
+        :param batch: 每个宿主机每批执行的虚拟机数
+        :param interval: 两批之间的间隔秒数，限制discard对ceph集群的压力
+        :param workers: 同时执行的宿主机数
+        :return:
+            [DiskTrimLog()]
+        """
+        host_vms = {}
+        for vm in vms:
+            host_vms.setdefault(vm.host_id, []).append(vm)
+
+        logs = []
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = [executor.submit(self._trim_host_vms_in_thread, vms, batch, interval)
+                       for vms in host_vms.values()]
+            for future in futures:
+                logs += future.result()
+
+        return logs
+
+    def _trim_host_vms_in_thread(self, vms: list, batch: int, interval: float):
+        try:
+            return self._trim_host_vms(vms=vms, batch=batch, interval=interval)
+        finally:
+            connection.close()  # 线程结束，关闭线程的数据库连接
+
+    def _trim_host_vms(self, vms: list, batch: int, interval: float):
+        """
+        逐个在一个宿主机上运行中的虚拟机内执行fstrim，未运行的虚拟机跳过
+
+        :return:
+            [DiskTrimLog()]
+        """
+        logs = []
+        rbd_managers = {}
+        done = 0
+        for vm in vms:
+            try:
+                if not VmManager.get_vm_domain(host_ipv4=vm.host.ipv4, vm_uuid=vm.hex_uuid).is_running():
+                    continue
+            except VirtError:
+                continue
+
+            if done and batch > 0 and done % batch == 0 and interval > 0:
+                time.sleep(interval)
+            logs += self.trim_vm(vm=vm, rbd_managers=rbd_managers)
+            done += 1
+
+        return logs
+
+    def trim_vm(self, vm: Vm, rbd_managers: dict = None):
+        """
+        在运行中的虚拟机内执行fstrim，记录系统盘和挂载的云硬盘已分配数据大小的变化
+
+        :param vm: 虚拟机Vm()
+        :param rbd_managers: RbdManager缓存，{pool_id: RbdManager()}
+        :return:
+            [DiskTrimLog()]
+        """
+        if rbd_managers is None:
+            rbd_managers = {}
+
+        disks = [(vm.image.ceph_pool, vm.disk)]
+        for vdisk in vm.vdisks.select_related('quota__cephpool__ceph'):
+            disks.append((vdisk.quota.cephpool, vdisk.uuid))
+
+        used_before = [self._get_used_size(pool=pool, disk=disk, rbd_managers=rbd_managers) for pool, disk in disks]
+        try:
+            VmManager.get_vm_domain(host_ipv4=vm.host.ipv4, vm_uuid=vm.hex_uuid).fstrim()
+            trim_err = ''
+        except VirtError as e:
+            trim_err = f'fstrim失败，{str(e)}'
+
+        logs = []
+        for (pool, disk), (before, err) in zip(disks, used_before):
+            if trim_err:
+                after, err = before, trim_err
+            elif not err:
+                after, err = self._get_used_size(pool=pool, disk=disk, rbd_managers=rbd_managers)
+            else:
+                after = before
+            logs.append(DiskTrimLog(vm_uuid=vm.hex_uuid, disk=disk, ceph_pool=pool, used_before=before,
+                                    used_after=after, reclaimed=max(before - after, 0), result=not err, message=err))
+
+        try:
+            DiskTrimLog.objects.bulk_create(logs)
+        except Exception:
+            pass
+
+        return logs
+
+    @staticmethod
+    def _get_used_size(pool, disk: str, rbd_managers: dict):
+        """
+        :return:
+            (used:int, err:str)
+        """
+        try:
+            rbd = rbd_managers.get(pool.id)
+            if rbd is None:
+                rbd = get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name)
+                rbd_managers[pool.id] = rbd
+            return rbd.get_image_used_size(image_name=disk), ''
+        except RadosError as e:
+            return 0, f'获取已用空间失败，{str(e)}'
+
+    def pool_reclaimed_report(self, days: int = 0):
+        """
+        各ceph pool回收的空间统计
+
+        :param days: 只统计最近的天数，0不限制
+        :return:
+            [{'ceph_pool': CephPool(), 'reclaimed': int, 'count': int}]
+        """
+        qs = self.get_log_queryset().filter(result=True)
+        if days > 0:
+            qs = qs.filter(create_time__gte=timezone.now() - timedelta(days=days))
+
+        stats = qs.values('ceph_pool_id').annotate(reclaimed=Sum('reclaimed'), count=Count('id'))
+        pools = {p.id: p for p in CephPool.objects.select_related('ceph').all()}
+        return [{'ceph_pool': pools.get(s['ceph_pool_id']), 'reclaimed': s['reclaimed'], 'count': s['count']}
+                for s in stats]
+
+
+class VmJobManager:
+    """
+    虚拟机异步任务管理器
+
+    创建、删除、迁移虚拟机和更换、重置系统盘由任务执行进程（manage.py run_vm_jobs）执行，与web服务分开部署和扩展；
+    执行进程定时更新心跳时间，心跳超时的任务视为执行进程异常退出，根据检查点确认操作已完成，
+    或者回滚已申请的资源后重新执行，超过最大执行次数时失败
+    """
+    VmError = VmError
+
+    @staticmethod
+    def get_job_queryset():
+        """
+        虚拟机异步任务查询集
+        :return: QuerySet()
+        """
+        return VmJob.objects.select_related('user').all()
+
+    def get_user_job(self, job_id: int, user):
+        """
+        获取用户有访问权的任务
+
+        :return:
+            VmJob()
+        :raises: VmError
+        """
+        job = self.get_job_queryset().filter(id=job_id).first()
+        if job is None:
+            raise VmError(code=404, msg='任务不存在')
+        if job.user_id != user.id and not user.is_superuser:
+            raise VmError(code=403, msg='当前用户没有权限访问此任务')
+
+        return job
+
+    def add_job(self, action: int, user, vm_uuid: str = '', **params):
+        """
+        添加一个虚拟机异步任务；创建虚拟机时预先分配虚拟机uuid，其他操作先检查虚拟机的访问权限
+
+        :param action: 操作，VmJob.ACTION_*
+        :param user: 用户
+        :param vm_uuid: 虚拟机uuid
+        :param params: 操作的参数
+        :return:
+            VmJob()
+        :raises: VmError
+        """
+        if action not in dict(VmJob.CHOICES_ACTION):
+            raise VmError(msg='无效的任务操作')
+
+        api = VmAPI()
+        if action == VmJob.ACTION_CREATE:
+            vm_uuid = api.new_uuid_obj().hex
+        else:
+            vm = api._get_user_perms_vm(vm_uuid=vm_uuid, user=user)
+            vm_uuid = vm.hex_uuid
+            if VmJob.objects.filter(vm_uuid=vm_uuid, status__in=[VmJob.STATUS_WAIT, VmJob.STATUS_RUNNING]).exists():
+                raise VmError(code=409, msg='虚拟机有未完成的任务，请稍后重试')
+
+        job = VmJob(action=action, vm_uuid=vm_uuid, user=user, params=json.dumps(params))
+        try:
+            job.save()
+        except Exception as e:
+            raise VmError(msg=f'添加任务失败，{str(e)}')
+
+        return job
+
+    @staticmethod
+    def claim_job(worker: str):
+        """
+        领取一个等待执行的任务，同一个虚拟机的任务按顺序逐个执行；多个执行进程通过条件更新竞争，只有一个能领取成功
+
+        :param worker: 执行进程标识
+        :return:
+            VmJob()
+            None    # 没有可执行的任务
+        """
+        running = VmJob.objects.filter(status=VmJob.STATUS_RUNNING).values('vm_uuid')
+        jobs = VmJob.objects.filter(status=VmJob.STATUS_WAIT).exclude(vm_uuid__in=running).order_by('id')[:10]
+        for job in jobs:
+            now = timezone.now()
+            ok = VmJob.objects.filter(id=job.id, status=VmJob.STATUS_WAIT).update(
+                status=VmJob.STATUS_RUNNING, worker=worker, heartbeat=now, start_time=now,
+                attempts=F('attempts') + 1)
+            if ok:
+                job.refresh_from_db()
+                return job
+
+        return None
+
+    @staticmethod
+    def heartbeat(worker: str):
+        """
+        更新执行进程所有执行中的任务的心跳时间
+        """
+        VmJob.objects.filter(status=VmJob.STATUS_RUNNING, worker=worker).update(heartbeat=timezone.now())
+
+    def run_job(self, job: VmJob):
+        """
+        执行一个已领取的任务，每个检查点保存到任务记录
+
+        :param job: VmJob()
+        :return:
+            VmJob()
+        """
+        def checkpoint(step: str, **data):
+            cp = job.get_checkpoint()
+            cp.update(data)
+            job.step = step
+            job.checkpoint = json.dumps(cp)
+            job.save(update_fields=['step', 'checkpoint'])
+
+        api = VmAPI()
+        params = job.get_params()
+        user = job.user
+        try:
+            if job.action == VmJob.ACTION_CREATE:
+                api.create_vm(user=user, vm_uuid=job.vm_uuid, checkpoint=checkpoint, **params)
+            elif job.action == VmJob.ACTION_DELETE:
+                api.delete_vm(vm_uuid=job.vm_uuid, user=user, force=params.get('force', False), checkpoint=checkpoint)
+            elif job.action == VmJob.ACTION_MIGRATE and params.get('live'):
+                api.live_migrate_vm(
+                    vm_uuid=job.vm_uuid, host_id=params['host_id'], user=user, bandwidth=params.get('bandwidth'),
+                    max_downtime=params.get('max_downtime'), checkpoint=checkpoint,
+                    progress=lambda stats: checkpoint('migrating', progress=self.migrate_progress(stats)))
+            elif job.action == VmJob.ACTION_MIGRATE:
+                api.migrate_vm(vm_uuid=job.vm_uuid, host_id=params['host_id'], user=user, checkpoint=checkpoint)
+            elif job.action == VmJob.ACTION_CHANGE_SYS_DISK:
+                api.change_sys_disk(vm_uuid=job.vm_uuid, image_id=params['image_id'], user=user,
+                                    checkpoint=checkpoint)
+            elif job.action == VmJob.ACTION_RESET_SYS_DISK:
+                api.reset_sys_disk(vm_uuid=job.vm_uuid, user=user, checkpoint=checkpoint)
+            else:
+                raise VmError(msg='无效的任务操作')
+        except Exception as e:
+            self._finish_job(job, ok=False, message=str(e))
+        else:
+            self._finish_job(job, ok=True)
+
+        return job
+
+    @staticmethod
+    def migrate_progress(stats: dict):
+        """
+        热迁移进度，从libvirt jobStats中提取
+
+        :return:
+            {'elapsed': int, 'total': int, 'processed': int, 'remaining': int, 'dirty_rate': int, 'iteration': int}
+            # 时间单位毫秒，数据单位Bytes，dirty_rate单位页/秒
+        """
+        return {
+            'elapsed': stats.get('time_elapsed', 0),
+            'total': stats.get('data_total', 0),
+            'processed': stats.get('data_processed', 0),
+            'remaining': stats.get('data_remaining', 0),
+            'dirty_rate': stats.get('memory_dirty_rate', 0),
+            'iteration': stats.get('memory_iteration', 0),
+        }
+
+    @staticmethod
+    def _finish_job(job: VmJob, ok: bool, message: str = ''):
+        job.status = VmJob.STATUS_OK if ok else VmJob.STATUS_FAILED
+        job.end_time = timezone.now()
+        job.message = message
+        job.save(update_fields=['status', 'end_time', 'message'])
+
+    def recover_jobs(self, timeout: int = None, max_attempts: int = None):
+        """
+        处理心跳超时的执行中任务：操作已完成的标记完成，未完成的回滚已申请的资源后重新等待执行
+
+        :param timeout: 心跳超时秒数，默认settings.VM_JOB_HEARTBEAT_TIMEOUT
+        :param max_attempts: 最大执行次数，默认settings.VM_JOB_MAX_ATTEMPTS
+        :return:
+            [VmJob()]   # 处理的任务
+        """
+        if timeout is None:
+            timeout = getattr(settings, 'VM_JOB_HEARTBEAT_TIMEOUT', 120)
+        if max_attempts is None:
+            max_attempts = getattr(settings, 'VM_JOB_MAX_ATTEMPTS', 3)
+
+        jobs = []
+        deadline = timezone.now() - timedelta(seconds=timeout)
+        for job in self.get_job_queryset().filter(status=VmJob.STATUS_RUNNING, heartbeat__lt=deadline):
+            # 多个执行进程同时检查时，只有一个处理
+            if not VmJob.objects.filter(id=job.id, status=VmJob.STATUS_RUNNING, heartbeat=job.heartbeat).update(
+                    heartbeat=timezone.now()):
+                continue
+
+            try:
+                done, message = self._recover_job(job)
+            except Exception as e:
+                self._finish_job(job, ok=False, message=f'执行进程异常退出，回滚失败，{str(e)}')
+                jobs.append(job)
+                continue
+
+            if done is None:
+                continue    # 操作仍在进行中（如热迁移），心跳超时后再检查
+            if done:
+                self._finish_job(job, ok=True, message=message)
+            elif job.attempts >= max_attempts:
+                self._finish_job(job, ok=False, message=f'执行进程异常退出，已回滚；{message}')
+            else:
+                job.status = VmJob.STATUS_WAIT
+                job.step = ''
+                job.checkpoint = '{}'
+                job.worker = ''
+                job.message = f'执行进程异常退出，已回滚，等待重新执行；{message}'
+                job.save(update_fields=['status', 'step', 'checkpoint', 'worker', 'message'])
+            jobs.append(job)
+
+        return jobs
+
+    def _recover_job(self, job: VmJob):
+        """
+        根据检查点处理执行进程异常退出的任务
+
+        :return:
+            (done:bool or None, message:str)    # done: 操作已完成；None: 操作仍在进行中
+        :raises: Exception
+        """
+        vm = Vm.objects.select_related('host', 'image__ceph_pool__ceph').filter(uuid=job.vm_uuid).first()
+        cp = job.get_checkpoint()
+        if job.action == VmJob.ACTION_CREATE:
+            return self._recover_create(job=job, vm=vm, cp=cp)
+        if vm is None:
+            if job.action == VmJob.ACTION_DELETE and job.step == 'deleted':
+                self._add_check_log(job=job, cp=cp, text='虚拟机元数据已删除，宿主机资源和mac ip可能未释放')
+                return True, '虚拟机已删除，资源释放情况未知，已记录日志'
+            return True, '虚拟机已不存在'
+
+        if job.action == VmJob.ACTION_DELETE:
+            return False, ''    # 虚拟机元数据未删除，重新执行删除
+        if job.action == VmJob.ACTION_MIGRATE:
+            return self._recover_migrate(job=job, vm=vm, cp=cp)
+        return self._recover_sys_disk(job=job, vm=vm, cp=cp)
+
+    def _recover_create(self, job: VmJob, vm, cp: dict):
+        vm_manager = VmManager()
+        if vm is not None:
+            # 虚拟机元数据已创建，确保宿主机上定义了虚拟机
+            if job.step != 'created':
+                vm_manager.define(host_ipv4=vm.host.ipv4, xml_desc=vm.xml)
+                vm.host.vm_created_num_add_1()
+            return True, ''
+        if not cp:
+            return False, ''    # 未申请资源
+
+        if cp.get('disk'):
+            pool = CephPool.objects.select_related('ceph').filter(id=cp['ceph_pool_id']).first()
+            if pool:
+                get_rbd_manager(ceph=pool.ceph, pool_name=pool.pool_name).remove_image(image_name=cp['disk'])
+        if cp.get('macip_id'):
+            MacIPManager().free_used_ip(ip_id=cp['macip_id'])
+        if cp.get('host_id'):
+            HostManager().free_to_host(host_id=cp['host_id'], vcpu=cp['vcpu'], mem=cp['mem'])
+        return False, '已释放申请的宿主机资源、mac ip和系统盘'
+
+    def _recover_migrate(self, job: VmJob, vm: Vm, cp: dict):
+        dst_host_id = cp.get('host_id')
+        if not dst_host_id:
+            return False, ''
+
+        if vm.host_id == dst_host_id:
+            if job.step != 'done':
+                self._add_check_log(job=job, cp=cp, text=f'虚拟机已迁移到宿主机（id={dst_host_id}），'
+                                                         f'源宿主机（id={cp.get("src_host_id")}）上的虚拟机和资源可能未清理')
+            return True, ''
+
+        dst_host = HostManager().get_host_by_id(host_id=dst_host_id)
+        if cp.get('live'):
+            # libvirt中的热迁移不随执行进程退出而中止
+            try:
+                stats = VmManager.get_vm_domain(host_ipv4=vm.host.ipv4, vm_uuid=job.vm_uuid).job_stats()
+                if stats.get('type', 0) != 0:     # VIR_DOMAIN_JOB_NONE
+                    return None, ''
+            except VirDomainNotExist:
+                pass
+            try:
+                migrated = bool(dst_host) and VmManager.get_vm_domain(
+                    host_ipv4=dst_host.ipv4, vm_uuid=job.vm_uuid).is_running()
+            except VirDomainNotExist:
+                migrated = False
+            if migrated:
+                VmAPI().live_migrate_finish(vm=vm, old_host=vm.host, new_host=dst_host)
+                return True, '热迁移已完成'
+        elif dst_host:
+            VmManager().undefine(host_ipv4=dst_host.ipv4, vm_uuid=job.vm_uuid)
+        HostManager().free_to_host(host_id=dst_host_id, vcpu=cp['vcpu'], mem=cp['mem'])
+        return False, '已释放目标宿主机资源'
+
+    def _recover_sys_disk(self, job: VmJob, vm: Vm, cp: dict):
+        if not cp.get('deleted_disk'):
+            return False, ''    # 原系统盘未改名，没有需要回滚的
+
+        old_pool = CephPool.objects.select_related('ceph').get(id=cp['old_pool_id'])
+        old_rbd = get_rbd_manager(ceph=old_pool.ceph, pool_name=old_pool.pool_name)
+        new_pool = Image.objects.select_related('ceph_pool__ceph').get(id=cp['image_id']).ceph_pool
+        new_rbd = get_rbd_manager(ceph=new_pool.ceph, pool_name=new_pool.pool_name)
+        # 更换镜像时，新系统盘克隆后才更新虚拟机元数据的镜像
+        if vm.image_id == cp['image_id'] and new_rbd.image_exists(image_name=cp['disk']):
+            if job.step != 'done':
+                self._add_check_log(job=job, cp=cp, text='系统盘已更换，挂载的云硬盘和PCI设备可能需要重新挂载')
+            DiskFlattenManager().clear_disk_tasks(disk=cp['disk'])
+            return True, ''
+
+        if not old_rbd.image_exists(image_name=cp['deleted_disk']):
+            raise VmError(msg=f'原系统盘{cp["deleted_disk"]}不存在')
+
+        # 删除未完成的新系统盘，原系统盘改回原名，宿主机上恢复原虚拟机定义
+        new_rbd.remove_image(image_name=cp['disk'])
+        old_rbd.rename_image(image_name=cp['deleted_disk'], new_name=cp['disk'])
+        VmManager().define(host_ipv4=vm.host.ipv4, xml_desc=vm.xml)
+        return False, '原系统盘已恢复'
+
+    @staticmethod
+    def _add_check_log(job: VmJob, cp: dict, text: str):
+        log_manager = VmLogManager()
+        msg = f'{job.get_action_display()}任务（id={job.id}），虚拟机uuid={job.vm_uuid}，执行进程异常退出；{text}，' \
+              f'请核对并手动处理；检查点：{job.step}，{json.dumps(cp)}'
+        log_manager.add_log(title='虚拟机异步任务执行进程异常退出', about=log_manager.about.ABOUT_NORMAL, text=msg)
+
+
+class HostEvacuateManager:
+    """
+    宿主机疏散管理器
+
+    宿主机进入维护模式后不再调度创建或迁入虚拟机，通过调度器一次计算宿主机上所有虚拟机的目标宿主机；
+    任务执行进程（manage.py run_vm_jobs）定时分派，按源宿主机和目标宿主机的并行数限制为虚拟机添加迁移异步任务，
+    并同步异步任务的进度和结果
+    """
+    VmError = VmError
+
+    @staticmethod
+    def get_task_queryset():
+        """
+        宿主机疏散任务查询集
+        :return: QuerySet()
+        """
+        return HostEvacuation.objects.select_related('host', 'user').all()
+
+    def add_task(self, host_id: int, user, source_limit: int = 2, target_limit: int = 1):
+        """
+        宿主机进入维护模式，添加疏散任务，并计算所有虚拟机的目标宿主机
+
+        :param host_id: 宿主机id
+        :param user: 用户，需要是超级用户
+        :param source_limit: 同时从宿主机迁出的虚拟机数
+        :param target_limit: 同时迁入一个目标宿主机的虚拟机数
+        :return:
+            HostEvacuation()
+
+        :raises: VmError
+        """
+        if not user.is_superuser:
+            raise VmError(code=403, msg='只有超级用户可以疏散宿主机')
+
+        try:
+            host = HostManager().get_host_by_id(host_id=host_id)
+        except ComputeError as e:
+            raise VmError(msg=str(e))
+        if not host:
+            raise VmError(code=404, msg='宿主机不存在')
+
+        if self.get_task_queryset().filter(host=host, status__in=[
+                HostEvacuation.STATUS_WAIT, HostEvacuation.STATUS_RUNNING, HostEvacuation.STATUS_PAUSED]).exists():
+            raise VmError(code=409, msg='宿主机已有未完成的疏散任务')
+
+        try:
+            with transaction.atomic():
+                host.maintenance = True
+                host.save(update_fields=['maintenance'])
+                task = HostEvacuation(host=host, user=user, source_limit=max(source_limit, 1),
+                                      target_limit=max(target_limit, 1))
+                task.save()
+                HostEvacuationVm.objects.bulk_create([
+                    HostEvacuationVm(evacuation=task, vm_uuid=uuid) for uuid in
+                    Vm.objects.filter(host=host).values_list('uuid', flat=True)])
+        except Exception as e:
+            raise VmError(msg=f'添加宿主机疏散任务失败，{str(e)}')
+
+        self.plan_task(task)
+        return task
+
+    @staticmethod
+    def plan_task(task: HostEvacuation):
+        """
+        为等待迁移的虚拟机一次计算目标宿主机；已不在此宿主机的虚拟机标记完成，不能迁移的标记失败
+
+        :param task: HostEvacuation()
+        :return:
+            int     # 有目标宿主机的虚拟机数
+        :raises: VmError
+        """
+        items = {i.vm_uuid: i for i in task.items.filter(status=HostEvacuationVm.STATUS_WAIT)}
+        vms = Vm.objects.select_related('mac_ip').filter(uuid__in=items.keys(), host_id=task.host_id).annotate(
+            pci_count=Count('device_set'))
+        vms = {vm.uuid: vm for vm in vms}
+        try:
+            placement = HostMacIPScheduler().schedule_migrate_batch(
+                vms=[vm for vm in vms.values() if not vm.pci_count], group=task.host.group,
+                exclude_host_ids=(task.host_id,))
+        except ScheduleError as e:
+            raise VmError(msg=str(e))
+
+        now = timezone.now()
+        for vm_uuid, item in items.items():
+            vm = vms.get(vm_uuid)
+            item.dst_host = placement.get(vm_uuid)
+            if vm is None:
+                item.status = HostEvacuationVm.STATUS_OK
+                item.message = '虚拟机已不在此宿主机'
+            elif vm.pci_count:
+                item.status = HostEvacuationVm.STATUS_FAILED
+                item.message = '请先卸载主机挂载的PCI设备'
+            elif item.dst_host is None:
+                item.status = HostEvacuationVm.STATUS_FAILED
+                item.message = '没有满足资源需求和子网的目标宿主机'
+            else:
+                item.message = ''
+                continue
+            item.end_time = now
+        HostEvacuationVm.objects.bulk_update(items.values(), fields=['dst_host', 'status', 'end_time', 'message'])
+
+        return len(placement)
+
+    def pause_task(self, task_id: int):
+        """
+        暂停疏散任务，不再开始新的迁移，迁移中的虚拟机继续完成
+
+        :return:
+            True    # success
+            False   # 任务不是等待或执行中
+        """
+        return self.get_task_queryset().filter(id=task_id, status__in=[
+            HostEvacuation.STATUS_WAIT, HostEvacuation.STATUS_RUNNING]).update(status=HostEvacuation.STATUS_PAUSED) > 0
+
+    def resume_task(self, task_id: int):
+        """
+        继续暂停或有迁移失败的疏散任务，迁移失败的虚拟机重新迁移，重新计算未迁移虚拟机的目标宿主机
+
+        :return:
+            True    # success
+            False   # 任务不是暂停或有失败的状态
+        :raises: VmError
+        """
+        task = self.get_task_queryset().filter(id=task_id, status__in=[
+            HostEvacuation.STATUS_PAUSED, HostEvacuation.STATUS_FAILED]).first()
+        if task is None:
+            return False
+
+        task.items.filter(status=HostEvacuationVm.STATUS_FAILED).update(
+            status=HostEvacuationVm.STATUS_WAIT, job=None, progress=0, start_time=None, end_time=None, message='')
+        self.plan_task(task)
+        return self.get_task_queryset().filter(id=task.id, status=task.status).update(
+            status=HostEvacuation.STATUS_WAIT, end_time=None, message='') > 0
+
+    def dispatch_tasks(self):
+        """
+        分派所有未完成的疏散任务，由任务执行进程定时调用；多个执行进程同时分派时，通过锁定任务记录逐个执行
+
         :return:
-            VmArchive() # success
+            [HostEvacuation()]  # 本次结束的任务
+        """
+        finished = []
+        task_ids = self.get_task_queryset().filter(status__in=[
+            HostEvacuation.STATUS_WAIT, HostEvacuation.STATUS_RUNNING, HostEvacuation.STATUS_PAUSED]
+        ).values_list('id', flat=True)
+        for task_id in list(task_ids):
+            try:
+                with transaction.atomic():
+                    task = self.get_task_queryset().select_for_update().get(id=task_id)
+                    if self._dispatch_task(task):
+                        finished.append(task)
+            except Exception as e:
+                HostEvacuation.objects.filter(id=task_id).update(message=f'分派迁移出错，{str(e)}')
 
-        :raises:  VmError
-        '''
-        try:
-            host = vm.host
-            group = host.group
-            center = group.center
-            mac_ip = vm.mac_ip
-            vlan = mac_ip.vlan
-            image = vm.image
-            ceph_pool = image.ceph_pool
+        return finished
 
-            va = VmArchive(uuid=vm.get_uuid(), name=vm.name, vcpu=vm.vcpu, mem=vm.mem, disk=vm.disk, xml=vm.xml,
-                           mac=mac_ip.mac, ipv4=mac_ip.ipv4, vlan_id=vlan.id, br=vlan.br,
-                           image_id=image.id, image_parent=image.base_image, ceph_id=ceph_pool.ceph.id, ceph_pool=ceph_pool.pool_name,
-                           center_id=center.id, center_name=center.name, group_id=group.id, group_name=group.name,
-                           host_id=host.id, host_ipv4=host.ipv4, user=vm.user, create_time=vm.create_time, remarks=vm.remarks)
-            va.save()
-        except Exception as e:
-            raise VmError(msg=str(e))
-        return va
+    def _dispatch_task(self, task: HostEvacuation):
+        """
+        同步迁移中虚拟机的异步任务状态，开始新的迁移，全部结束时完成任务
 
-    @staticmethod
-    def get_vm_archive(vm: Vm):
-        return VmArchive.objects.filter(uuid=vm.get_uuid()).first()
+        :return:
+            True    # 任务已结束
+            False
+        """
+        if task.status == HostEvacuation.STATUS_WAIT:
+            task.status = HostEvacuation.STATUS_RUNNING
+            task.start_time = task.start_time or timezone.now()
+            task.save(update_fields=['status', 'start_time'])
 
+        self._sync_running_items(task)
+        if task.status == HostEvacuation.STATUS_RUNNING:
+            self._start_items(task)
 
-class VmLogManager:
-    '''
-    虚拟机错误日志记录管理
-    '''
-    def __init__(self):
-        self.vm_log = VmLog()
+        progress = task.get_progress()
+        if progress['wait'] or progress['running'] or task.status != HostEvacuation.STATUS_RUNNING:
+            return False
 
-    @property
-    def about(self):
-        return self.vm_log
+        task.status = HostEvacuation.STATUS_FAILED if progress['failed'] else HostEvacuation.STATUS_OK
+        task.end_time = timezone.now()
+        task.message = f'共{progress["total"]}个虚拟机，完成{progress["ok"]}个，失败{progress["failed"]}个'
+        task.save(update_fields=['status', 'end_time', 'message'])
+        return True
 
-    def add_log(self, title:str, about:int, text:str):
-        '''
-        添加记录
+    @staticmethod
+    def _sync_running_items(task: HostEvacuation):
+        for item in task.items.select_related('job').filter(status=HostEvacuationVm.STATUS_RUNNING):
+            job = item.job
+            if job is None:
+                item.status = HostEvacuationVm.STATUS_FAILED
+                item.message = '迁移任务已删除'
+            elif job.is_finished:
+                item.status = HostEvacuationVm.STATUS_OK if job.status == VmJob.STATUS_OK else \
+                    HostEvacuationVm.STATUS_FAILED
+                item.message = job.message
+                if item.status == HostEvacuationVm.STATUS_OK:
+                    item.progress = 100
+            else:
+                stats = job.get_checkpoint().get('progress')
+                if stats and stats.get('total'):
+                    item.progress = min(int(stats['processed'] * 100 / stats['total']), 99)
+                item.save(update_fields=['progress'])
+                continue
 
-        :param title: 记录标题
-        :param about: 记录相关内容
-        :param text: 记录内容
-        :return:
-            VmLog()     # success
-            None        # failed
-        '''
-        about = VmLog.to_valid_about_value(about)
-        try:
-            log = VmLog(title=title, about=about, content=text)
-            log.save()
-        except Exception as e:
-            return None
+            item.end_time = timezone.now()
+            item.save(update_fields=['status', 'progress', 'end_time', 'message'])
 
-        return log
+    @staticmethod
+    def _start_items(task: HostEvacuation):
+        """
+        按源宿主机和目标宿主机的并行数限制，为等待的虚拟机添加迁移异步任务；目标宿主机的并行数包括其他疏散任务迁入的
+        """
+        running = task.items.filter(status=HostEvacuationVm.STATUS_RUNNING).count()
+        if running >= task.source_limit:
+            return
+
+        busy = dict(HostEvacuationVm.objects.filter(status=HostEvacuationVm.STATUS_RUNNING).values_list(
+            'dst_host_id').annotate(c=Count('id')).order_by())
+        job_manager = VmJobManager()
+        for item in task.items.filter(status=HostEvacuationVm.STATUS_WAIT).exclude(dst_host=None):
+            if running >= task.source_limit:
+                break
+            if busy.get(item.dst_host_id, 0) >= task.target_limit:
+                continue
+
+            try:
+                if not Vm.objects.filter(uuid=item.vm_uuid, host_id=task.host_id).exists():
+                    raise VmNotExistError(msg='虚拟机已不在此宿主机')
+                item.live = VmManager().is_running(host_ipv4=task.host.ipv4, vm_uuid=item.vm_uuid)
+                item.job = job_manager.add_job(action=VmJob.ACTION_MIGRATE, user=task.user, vm_uuid=item.vm_uuid,
+                                               host_id=item.dst_host_id, live=item.live)
+            except VmNotExistError as e:
+                item.status = HostEvacuationVm.STATUS_OK
+                item.message = str(e)
+                item.end_time = timezone.now()
+            except (VmError, VirtError) as e:
+                if getattr(e, 'code', 0) == 409:
+                    continue    # 虚拟机有未完成的其他任务，下次再分派
+                item.status = HostEvacuationVm.STATUS_FAILED
+                item.message = str(e)
+                item.end_time = timezone.now()
+            else:
+                item.status = HostEvacuationVm.STATUS_RUNNING
+                item.start_time = timezone.now()
+                running += 1
+                busy[item.dst_host_id] = busy.get(item.dst_host_id, 0) + 1
+            item.save(update_fields=['live', 'job', 'status', 'start_time', 'end_time', 'message'])
 
 
 class FlavorManager:
@@ -798,13 +2671,14 @@ class VmAPI:
         except RadosError as e:
             raise VmError(msg=str(e))
 
-    def _get_user_perms_vm(self, vm_uuid: str, user, related_fields: tuple = ()):
+    def _get_user_perms_vm(self, vm_uuid: str, user, related_fields: tuple = (), allow_locked: bool = False):
         """
         获取用户有访问权的的虚拟机
 
         :param vm_uuid: 虚拟机uuid
         :param user: 用户
         :param related_fields: 外键字段；外键字段直接一起获取，而不是惰性的用时再获取
+        :param allow_locked: 是否允许虚拟机处于锁定状态（正在执行跨分中心迁移等后台操作），默认不允许
         :return:
             Vm()   # success
 
@@ -815,9 +2689,19 @@ class VmAPI:
             raise VmNotExistError(msg='虚拟机不存在')
         if not vm.user_has_perms(user=user):
             raise VmError(msg='当前用户没有权限访问此虚拟机')
+        if not allow_locked:
+            self._check_vm_unlocked(vm)
 
         return vm
 
+    @staticmethod
+    def _check_vm_unlocked(vm):
+        """
+        :raises: VmError    # 虚拟机正在执行后台操作
+        """
+        if vm.locked_by:
+            raise VmError(code=409, msg=f'虚拟机正在执行{vm.locked_by}，暂不能操作')
+
     def _get_user_shutdown_vm(self, vm_uuid: str, user, related_fields: tuple = ()):
         """
         获取用户有访问权的 关闭状态的 虚拟机
@@ -974,7 +2858,7 @@ class VmAPI:
         raise VmError(msg='必须指定一个有效的center id或者group id或者host id')
 
     def create_vm(self, image_id: int, vcpu: int, mem: int, vlan_id: int, user, center_id=None, group_id=None,
-                  host_id=None, ipv4=None, remarks=None, ip_public=None, **kwargs):
+                  host_id=None, ipv4=None, remarks=None, ip_public=None, vm_uuid=None, checkpoint=None, **kwargs):
         '''
         创建一个虚拟机
 
@@ -995,6 +2879,8 @@ class VmAPI:
         :param ipv4:  指定要创建的虚拟机ip
         :param remarks: 备注
         :param ip_public: 指定分配公网或私网ip；默认None（不指定），True(公网)，False(私网)
+        :param vm_uuid: 虚拟机uuid，默认None自动生成；异步任务预先分配
+        :param checkpoint: 检查点回调，checkpoint(step:str, **data)，异步任务记录已申请的资源
         :return:
             Vm()
             raise VmError
@@ -1015,9 +2901,10 @@ class VmAPI:
         # 权限检查
         groups, host_or_none = self._get_groups_host_check_perms(center_id=center_id, group_id=group_id, host_id=host_id, user=user)
         image = self._get_image(image_id)    # 镜像
+        image = self._image_manager.choose_image_copy(image)    # 系统盘所在的pool，按pool剩余容量和负载选择
 
-        vm_uuid_obj = self.new_uuid_obj()
-        vm_uuid = vm_uuid_obj.hex
+        if not vm_uuid:
+            vm_uuid = self.new_uuid_obj().hex
 
         ceph_pool = image.ceph_pool
         pool_name = ceph_pool.pool_name
@@ -1051,13 +2938,18 @@ class VmAPI:
                 raise VmError(msg='申请mac ip失败')
             if not vlan:
                 vlan = macip.vlan
+            if checkpoint:
+                checkpoint('scheduled', host_id=host.id, vcpu=vcpu, mem=mem, macip_id=macip.id)
 
             # 创建虚拟机的系统镜像disk
             try:
-                rbd_manager.clone_image(snap_image_name=image.base_image, snap_name=image.snap, new_image_name=vm_uuid, data_pool=data_pool)
+                rbd_manager.clone_image(snap_image_name=image.base_image, snap_name=image.snap, new_image_name=vm_uuid,
+                                        data_pool=data_pool, features=ceph_pool.rbd_features_mask)
                 diskname = vm_uuid
             except RadosError as e:
                 raise VmError(msg=f'clone image error, {str(e)}')
+            if checkpoint:
+                checkpoint('cloned', ceph_pool_id=ceph_pool.id, disk=diskname)
 
             # 创建虚拟机
             vm = self._create_vm2(vm_uuid=vm_uuid, diskname=diskname, vcpu=vcpu, mem=mem, image=image,
@@ -1075,6 +2967,8 @@ class VmAPI:
 
             raise VmError(msg=str(e))
 
+        if checkpoint:
+            checkpoint('created')
         host.vm_created_num_add_1()  # 宿主机已创建虚拟机数量+1
         return vm
 
@@ -1102,18 +2996,18 @@ class VmAPI:
         ceph_config = ceph_pool.ceph
 
         # 虚拟机xml
-        xml_tpl = image.xml_tpl.xml  # 创建虚拟机的xml模板字符串
-        xml_desc = xml_tpl.format(name=vm_uuid, uuid=vm_uuid, mem=mem, vcpu=vcpu, ceph_uuid=ceph_config.uuid,
-                                  ceph_pool=pool_name, diskname=diskname, ceph_username=ceph_config.username,
-                                  ceph_hosts_xml=ceph_config.hosts_xml, mac=macip.mac, bridge=vlan.br)
-
         try:
-            if not ceph_config.has_auth:
-                xml_desc = self._vm_manager._xml_remove_sys_disk_auth(xml_desc)
+            xml_desc = render_xml_template(
+                image.xml_tpl, has_auth=ceph_config.has_auth, name=vm_uuid, uuid=vm_uuid, mem=mem, vcpu=vcpu,
+                ceph_uuid=ceph_config.uuid, ceph_pool=pool_name, diskname=diskname, ceph_username=ceph_config.username,
+                ceph_hosts_xml=ceph_config.hosts_xml, mac=macip.mac, bridge=vlan.br)
+        except XMLError as e:
+            raise VmError(msg=f'构建虚拟机xml错误，{str(e)}')
 
+        try:
             # 创建虚拟机元数据
             vm = Vm(uuid=vm_uuid, name=vm_uuid, vcpu=vcpu, mem=mem, disk=diskname, user=user,
-                    remarks=remarks, host=host, mac_ip=macip, xml=xml_desc, image=image)
+                    remarks=remarks, host=host, mac_ip=macip, xml=xml_desc, xml_version=1, image=image)
             vm.save()
         except Exception as e:
             raise VmError(msg=f'创建虚拟机元数据错误,{str(e)}')
@@ -1127,13 +3021,14 @@ class VmAPI:
 
         return vm
 
-    def delete_vm(self, vm_uuid:str, user=None, force=False):
+    def delete_vm(self, vm_uuid:str, user=None, force=False, checkpoint=None):
         '''
         删除一个虚拟机
 
         :param vm_uuid: 虚拟机uuid
         :param user: 用户
         :param force:   是否强制删除， 会强制关闭正在运行的虚拟机
+        :param checkpoint: 检查点回调，checkpoint(step:str, **data)
         :return:
             True
             raise VmError
@@ -1158,11 +3053,11 @@ class VmAPI:
             except VirtError as e:
                 raise VmError(msg='强制关闭虚拟机失败')
 
-        # 删除系统盘快照
+        # 删除系统盘快照，关闭系统盘的备份链
         try:
-            snaps = vm.sys_disk_snaps.all()
-            for snap in snaps:
-                snap.delete()
+            self._vm_manager.detach_clone_parent_snap(vm)
+            vm.sys_snaps.delete()
+            BackupChain.release_disk(disk_type=BackupChain.TYPE_SYS_DISK, disk=vm.disk, close=True)
         except Exception as e:
             raise VmError(msg=f'删除虚拟机系统盘快照失败,{str(e)}')
 
@@ -1192,6 +3087,9 @@ class VmAPI:
             log_manager.add_log(title='删除虚拟机元数据失败', about=log_manager.about.ABOUT_VM_METADATA, text=msg)
             raise VmError(msg='删除虚拟机元数据失败')
 
+        if checkpoint:
+            checkpoint('deleted', host_id=host.id, vcpu=vm.vcpu, mem=vm.mem, macip_id=vm.mac_ip_id)
+
         # 宿主机已创建虚拟机数量-1
         if not host.vm_created_num_sub_1():
             msg = f'虚拟机（uuid={vm.get_uuid()}）已删除，并归档，宿主机（id={host.id}; ipv4={host.ipv4}）已创建虚拟机数量-1失败, 请手动-1。'
@@ -1220,20 +3118,25 @@ class VmAPI:
 
         # vm系统盘RBD镜像修改了已删除归档的名称
         vm_ahv.rename_sys_disk_archive()
+        if checkpoint:
+            checkpoint('released')
         return True
 
     def edit_vm_vcpu_mem(self, vm_uuid:str, vcpu:int=0, mem:int=0, user=None, force=False):
         '''
         修改虚拟机vcpu和内存大小
 
+        运行中的虚拟机在xml中配置的最大vcpu和内存（模板max_vcpu、max_mem）内热调整，vcpu热插拔，内存balloon；
+        不能热调整时只修改持久化定义，下次启动虚拟机生效
+
         :param vm_uuid: 虚拟机uuid
         :param vcpu:要修改的vcpu数，默认0 不修改
         :param mem: 要修改的内存大小，默认0 不修改
         :param user: 用户
-        :param force:   是否强制修改, 会强制关闭正在运行的虚拟机
+        :param force: 不能热调整时是否强制关闭正在运行的虚拟机后修改
         :return:
-            True
-            raise VmError
+            True        # 已生效
+            False       # 虚拟机运行中不能热调整，重启虚拟机后生效
 
         :raise VmError
         '''
@@ -1244,6 +3147,8 @@ class VmAPI:
             return True
 
         vm = self._get_user_perms_vm(vm_uuid=vm_uuid, user=user, related_fields=('host', 'user'))
+        vcpu = vcpu if vcpu > 0 else vm.vcpu
+        mem = mem if mem > 0 else vm.mem
         # 没有变化直接返回
         if vm.vcpu == vcpu and vm.mem == mem:
             return True
@@ -1255,78 +3160,118 @@ class VmAPI:
             run = domain.is_running()
         except VirtError as e:
             raise VmError(msg='获取虚拟机运行状态失败')
-        if run:
-            if not force:
-                raise VmRunningError(msg='虚拟机正在运行，请先关闭虚拟机')
-            try:
-                domain.poweroff()
-            except VirtError as e:
-                raise VmError(msg='强制关闭虚拟机失败')
 
-        xml_desc = domain.xml_desc()
-        try:
-            # 修改vcpu
-            if vcpu > 0 and vcpu != vm.vcpu:
-                # vcpu增大
-                if vcpu > vm.vcpu:
-                    vcpu_need = vcpu - vm.vcpu
-                    # 宿主机是否满足资源需求
-                    if not host.meet_needs(vcpu=vcpu_need, mem=0):
-                        raise VmError(msg='宿主机已没有足够的vcpu资源')
+        # 增加的资源先向宿主机申请，修改失败时释放；减少的资源修改成功后释放
+        vcpu_need = vcpu - vm.vcpu
+        mem_need = mem - vm.mem
+        if vcpu_need > 0 and not host.meet_needs(vcpu=vcpu_need, mem=0):
+            raise VmError(msg='宿主机已没有足够的vcpu资源')
+        if mem_need > 0 and not host.meet_needs(vcpu=0, mem=mem_need):
+            raise VmError(msg='宿主机已没有足够的内存资源')
+        if not host.claim(vcpu=vcpu_need, mem=mem_need):
+            raise VmError(msg='向宿主机申请vcpu和内存资源失败')
 
-                    if not host.claim(vcpu=vcpu_need, mem=0):
-                        raise VmError(msg='向宿主机申请的vcpu资源失败')
-                else:
-                    vcpu_free = vm.vcpu - vcpu
-                    if not host.free(vcpu=vcpu_free, mem=0):
-                        raise VmError(msg='释放宿主机vcpu资源失败')
+        try:
+            effective = self._resize_vm_domain(vm=vm, domain=domain, vcpu=vcpu, mem=mem, running=run, force=force)
+        except VmError as e:
+            host.free(vcpu=vcpu_need, mem=mem_need)
+            raise e
 
-                try:
-                    xml_desc = self._vm_manager._xml_edit_vcpu(xml_desc=xml_desc, vcpu=vcpu)
-                except VmError as e:
-                    raise e
+        if not host.free(vcpu=-vcpu_need, mem=-mem_need):
+            raise VmError(msg='释放宿主机vcpu和内存资源失败')
 
-                vm.vcpu = vcpu
+        vm.vcpu = vcpu
+        vm.mem = mem
+        try:
+            vm.save()
+        except Exception as e:
+            raise VmError(msg=f'修改虚拟机元数据失败, {str(e)}')
 
-            if mem > 0 and mem != vm.mem:
-                # vcpu增大
-                if mem > vm.mem:
-                    mem_need = mem - vm.mem
-                    # 宿主机是否满足资源需求
-                    if not host.meet_needs(vcpu=0, mem=mem_need):
-                        raise VmError(msg='宿主机已没有足够的内存资源')
+        return effective
 
-                    if not host.claim(vcpu=0, mem=mem_need):
-                        raise VmError(msg='向宿主机申请的内存资源失败')
-                else:
-                    mem_free = vm.mem - mem
-                    if not host.free(vcpu=0, mem=mem_free):
-                        raise VmError(msg='释放宿主机内存资源失败')
+    def _resize_vm_domain(self, vm, domain, vcpu: int, mem: int, running: bool, force: bool = False):
+        '''
+        修改宿主机上虚拟机的vcpu和内存，并更新虚拟机缓存的xml（不保存）
 
-                try:
-                    xml_desc = self._vm_manager._xml_edit_mem(xml_desc=xml_desc, mem=mem)
-                except VmError as e:
-                    raise e
+        :param running: 虚拟机是否运行中
+        :param force: 不能热调整时是否强制关闭虚拟机
+        :return:
+            True        # 已生效
+            False       # 只修改了持久化定义，重启虚拟机后生效
 
-                vm.mem = mem
+        :raise VmError
+        '''
+        xml = XMLEditor()
+        try:
+            if not xml.set_xml(domain.xml_desc()):
+                raise VmError(msg='虚拟机xml文本无效')
+        except VirtError as e:
+            raise VmError(msg=f'获取虚拟机xml失败，{str(e)}')
 
-            # 创建虚拟机
+        if running:
             try:
-                if not self._vm_manager.define(host_ipv4=host.ipv4, xml_desc=xml_desc):
-                    raise VmError(msg='修改虚拟机失败')
-            except VirtError as e:
-                raise VmError(msg='修改虚拟机失败')
+                cur_vcpu, max_vcpu = xml.get_vcpu()
+                cur_mem, max_mem = xml.get_memory()
+            except XMLError as e:
+                raise VmError(msg=f'虚拟机{str(e)}')
 
-            vm.xml = xml_desc
-        except VmError as e:
-                raise e
+            if vcpu <= max_vcpu and mem <= max_mem:
+                vcpu_changed = False
+                try:
+                    if vcpu != cur_vcpu:
+                        domain.set_vcpus(vcpu, live=True)
+                        vcpu_changed = True
+                    if mem != cur_mem:
+                        domain.set_memory(mem, live=True)
+                    live_ok = True
+                except VirtError as e:
+                    live_ok = False     # 如虚拟机内没有balloon驱动、不支持vcpu热拔出
+
+                if not live_ok and vcpu_changed:
+                    # vcpu已热修改但内存失败，回滚vcpu，避免运行中的虚拟机只生效了一半
+                    try:
+                        domain.set_vcpus(cur_vcpu, live=True)
+                    except VirtError as e:
+                        raise VmError(msg=f'vcpu已热修改为{vcpu}，但修改内存失败且回滚vcpu失败，{str(e)}')
+
+                if live_ok:
+                    try:
+                        xml.set_vcpu(vcpu)
+                        xml.set_memory(mem)
+                    except XMLError as e:
+                        raise VmError(msg=f'修改xml文本错误，{str(e)}')
+                    vm.set_xml(xml.to_xml())
+                    return True
+
+            if force:
+                try:
+                    domain.poweroff()
+                except VirtError as e:
+                    raise VmError(msg='强制关闭虚拟机失败')
+                running = False
+            else:
+                # 修改持久化定义，下次启动生效
+                try:
+                    if not xml.set_xml(domain.inactive_xml_desc()):
+                        raise VmError(msg='虚拟机xml文本无效')
+                except VirtError as e:
+                    raise VmError(msg=f'获取虚拟机xml失败，{str(e)}')
 
         try:
-            vm.save()
-        except Exception as e:
-            raise VmError(msg=f'修改虚拟机元数据失败, {str(e)}')
+            xml.set_vcpu(vcpu)
+            xml.set_memory(mem)
+        except XMLError as e:
+            raise VmError(msg=f'修改xml文本错误，{str(e)}')
 
-        return True
+        xml_desc = xml.to_xml()
+        try:
+            if not self._vm_manager.define(host_ipv4=vm.host.ipv4, xml_desc=xml_desc):
+                raise VmError(msg='修改虚拟机失败')
+        except VirtError as e:
+            raise VmError(msg='修改虚拟机失败')
+
+        vm.set_xml(xml_desc)
+        return not running
 
     def vm_operations(self, vm_uuid:str, op:str, user):
         '''
@@ -1423,24 +3368,24 @@ class VmAPI:
         if host.group != vdisk.quota.group:
             raise VmError(msg='虚拟机和硬盘不再同一个机组')
 
-        disk_list, dev_list = self._vm_manager.get_vm_vdisk_dev_list(vm=vm)
-        if vdisk_uuid in disk_list:
+        # 根据元数据分配dev，硬盘元数据和虚拟机建立挂载关系
+        dev, mounted = self._vm_manager.claim_vdisk_dev(vm=vm, vdisk_uuid=vdisk_uuid)
+        if mounted:
             return vdisk
 
-        dev = self._vm_manager.new_vdisk_dev(dev_list)
-        if not dev:
-            raise VmError(msg='不能挂载更多的硬盘了')
-
-        # 硬盘元数据和虚拟机建立挂载关系
-        try:
-            self._vdisk_manager.mount_to_vm(vdisk_uuid=vdisk_uuid, vm=vm, dev=dev)
-        except VdiskError as e:
-            raise VmError(msg=str(e))
-
         # 向虚拟机挂载硬盘
         try:
-            xml = vdisk.xml_desc(dev=dev)
-            self._vm_manager.mount_disk(vm=vm, disk_xml=xml)
+            try:
+                self._vm_manager.mount_disk(vm=vm, disk_xml=vdisk.xml_desc(dev=dev), ignore_exists=False)
+            except VmError as e:
+                if 'exist' not in str(e):
+                    raise e
+                # dev已被占用（元数据与宿主机上虚拟机的xml不一致），按宿主机上的xml重新分配后再挂载
+                disk_list, dev_list = self._vm_manager.get_vm_vdisk_dev_list(vm=vm, live=True)
+                if vdisk_uuid not in disk_list:
+                    self._vdisk_manager.umount_from_vm(vdisk_uuid=vdisk_uuid)
+                    dev, _ = self._vm_manager.claim_vdisk_dev(vm=vm, vdisk_uuid=vdisk_uuid, exclude_devs=dev_list)
+                    self._vm_manager.mount_disk(vm=vm, disk_xml=vdisk.xml_desc(dev=dev))
         except (VmError, Exception) as e:
             try:
                 self._vdisk_manager.umount_from_vm(vdisk_uuid=vdisk_uuid)
@@ -1452,14 +3397,6 @@ class VmAPI:
                 log_manager.add_log(title='硬盘与虚拟机解除挂载关系失败', about=log_manager.about.ABOUT_VM_DISK, text=msg)
             raise VmError(msg=str(e))
 
-        # 更新vm元数据中的xml
-        try:
-            xml_desc = self._vm_manager.get_vm_xml_desc(vm_uuid=vm.get_uuid(), host_ipv4=vm.host.ipv4)
-            vm.xml = xml_desc
-            vm.save(update_fields=['xml'])
-        except Exception:
-            pass
-
         return vdisk
 
     def umount_disk(self, vdisk_uuid:str, user):
@@ -1490,6 +3427,7 @@ class VmAPI:
 
         if not vm.user_has_perms(user=user):
             raise VmError(msg='当前用户没有权限访问此虚拟机')
+        self._check_vm_unlocked(vm)
 
         # 虚拟机的状态
         host = vm.host
@@ -1518,14 +3456,6 @@ class VmAPI:
                 pass
             raise VmError(msg=str(e))
 
-        # 更新vm元数据中的xml
-        try:
-            xml_desc = domain.xml_desc()
-            vm.xml = xml_desc
-            vm.save(update_fields=['xml'])
-        except Exception:
-            pass
-
         return vdisk
 
     def create_vm_sys_snap(self, vm_uuid:str, remarks:str, user):
@@ -1552,6 +3482,46 @@ class VmAPI:
         snap = self._vm_manager.create_sys_disk_snap(vm=vm, remarks=remarks)
         return snap
 
+    def get_sys_disk_reader(self, vm_uuid: str, user, snap_id: int = 0):
+        """
+        获取虚拟机系统盘或系统盘快照数据的流式读取对象，用于导出下载；导出系统盘当前数据时虚拟机需要处于关机状态
+
+        :param vm_uuid: 虚拟机uuid
+        :param user: 用户
+        :param snap_id: 系统盘快照id，默认0导出系统盘当前数据
+        :return:
+            (RbdImageStreamReader(), filename)     # success
+
+        :raises: VmError
+        """
+        if snap_id:
+            vm = self._get_user_perms_vm(vm_uuid=vm_uuid, user=user, related_fields=('image__ceph_pool__ceph',),
+                                         allow_locked=True)
+            snap = vm.sys_disk_snaps.select_related('ceph_pool__ceph').filter(id=snap_id).first()
+            if not snap:
+                raise VmError(msg='虚拟机系统盘快照不存在')
+            ceph_pool = snap.get_ceph_pool()
+            disk = snap.sys_disk
+            snap_name = snap.snap
+            filename = f'{disk}@{snap_name}.raw'
+        else:
+            vm = self._get_user_shutdown_vm(vm_uuid=vm_uuid, user=user, related_fields=('host', 'image__ceph_pool__ceph'))
+            ceph_pool = vm.image.ceph_pool
+            disk = vm.disk
+            snap_name = None
+            filename = f'{disk}.raw'
+
+        if not ceph_pool or not ceph_pool.ceph:
+            raise VmError(msg='没有获取到系统盘所在的ceph pool')
+
+        rbd = self.get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+        try:
+            reader = rbd.open_image_reader(image_name=disk, snap=snap_name)
+        except RadosError as e:
+            raise VmError(msg=f'打开系统盘失败，{str(e)}')
+
+        return reader, filename
+
     def vm_rollback_to_snap(self, vm_uuid:str, snap_id:int, user):
         '''
         回滚虚拟机系统盘到指定快照
@@ -1595,6 +3565,7 @@ class VmAPI:
             return True
         if not vm.user_has_perms(user=user):
             raise VmError(msg='当前用户没有权限访问此虚拟机')
+        self._check_vm_unlocked(vm)
 
         # 虚拟机的状态
         host = vm.host
@@ -1613,12 +3584,8 @@ class VmAPI:
             raise VmError(msg=str(e))
 
         # 更新vm元数据中的xml
-        try:
-            xml_desc = domain.xml_desc()
-            vm.xml = xml_desc
-            vm.save(update_fields=['xml'])
-        except Exception:
-            pass
+        device_xml = self._pci_manager.device_wrapper(device).xml_desc
+        self._vm_manager.update_vm_xml_device(vm=vm, device_xml=device_xml, attach=False)
 
         return device
 
@@ -1654,22 +3621,19 @@ class VmAPI:
             raise VmError(msg=str(e))
 
         # 更新vm元数据中的xml
-        try:
-            xml_desc = self._vm_manager.get_vm_xml_desc(vm_uuid=vm.get_uuid(), host_ipv4=vm.host.ipv4)
-            vm.xml = xml_desc
-            vm.save(update_fields=['xml'])
-        except Exception:
-            pass
+        device_xml = self._pci_manager.device_wrapper(device).xml_desc
+        self._vm_manager.update_vm_xml_device(vm=vm, device_xml=device_xml, attach=True)
 
         return device
 
-    def change_sys_disk(self, vm_uuid: str, image_id: int, user):
+    def change_sys_disk(self, vm_uuid: str, image_id: int, user, checkpoint=None):
         """
         更换虚拟机系统镜像
 
         :param vm_uuid: 虚拟机uuid
         :param image_id: 系统镜像id
         :param user: 用户
+        :param checkpoint: 检查点回调，checkpoint(step:str, **data)
         :return:
             Vm()   # success
 
@@ -1681,16 +3645,18 @@ class VmAPI:
         new_image = self._get_image(image_id)  # 镜像
         # 同一个iamge
         if new_image.pk == vm.image.pk:
-            return self._reset_vm_sys_disk(vm)
+            return self._reset_vm_sys_disk(vm, checkpoint=checkpoint)
 
         # vm和image是否在同一个分中心
         host = vm.host
         if host.group.center_id != new_image.ceph_pool.ceph.center_id:
             raise VmError(msg='虚拟机和系统镜像不在同一个分中心')
 
-        # 删除快照记录
+        # 删除快照记录和备份链的快照，备份链下一次对新系统盘做全量备份
         try:
+            self._vm_manager.detach_clone_parent_snap(vm)
             vm.sys_snaps.delete()
+            BackupChain.release_disk(disk_type=BackupChain.TYPE_SYS_DISK, disk=vm.disk)
         except Exception as e:
             raise VmError(msg=f'删除虚拟机系统盘快照失败，{str(e)}')
 
@@ -1702,6 +3668,9 @@ class VmAPI:
         ok, deleted_disk = rename_sys_disk_delete(ceph=old_ceph, pool_name=old_pool_name, disk_name=disk_name)
         if not ok:
             raise VmError(msg='虚拟机系统盘重命名失败')
+        if checkpoint:
+            checkpoint('renamed', disk=disk_name, deleted_disk=deleted_disk, old_pool_id=old_pool.id,
+                       image_id=new_image.id)
 
         try:
             vm = self._vm_manager.reset_image_create_vm(vm=vm, new_image=new_image)
@@ -1710,6 +3679,10 @@ class VmAPI:
             rename_image(ceph=old_ceph, pool_name=old_pool_name, image_name=deleted_disk, new_name=disk_name)
             raise VmError(msg=str(e))
 
+        DiskFlattenManager().clear_disk_tasks(disk=disk_name)   # 系统盘重新克隆了，旧的flatten任务记录失效
+        BackupChain.objects.filter(disk_type=BackupChain.TYPE_SYS_DISK, disk=disk_name).update(
+            ceph_pool=new_image.ceph_pool)
+
         # 向虚拟机挂载硬盘
         for vdisk in vm.vdisks:
             vdisk_xml = vdisk.xml_desc(dev=vdisk.dev)
@@ -1724,24 +3697,21 @@ class VmAPI:
                 self._pci_manager.mount_to_vm(vm=vm, device=dev)
             except DeviceError as e:
                 raise VmError(msg=str(e))
+            self._vm_manager.update_vm_xml_device(
+                vm=vm, device_xml=self._pci_manager.device_wrapper(dev).xml_desc, attach=True)
 
-        # 更新vm元数据中的xml
-        try:
-            xml_desc = self._vm_manager.get_vm_xml_desc(vm_uuid=vm.get_uuid(), host_ipv4=vm.host.ipv4)
-            vm.xml = xml_desc
-            vm.save(update_fields=['xml'])
-        except Exception:
-            pass
-
+        if checkpoint:
+            checkpoint('done')
         return vm
 
-    def migrate_vm(self, vm_uuid: str, host_id: int, user):
+    def migrate_vm(self, vm_uuid: str, host_id: int, user, checkpoint=None):
         """
         迁移虚拟机
 
         :param vm_uuid: 虚拟机uuid
         :param host_id: 宿主机id
         :param user: 用户
+        :param checkpoint: 检查点回调，checkpoint(step:str, **data)
         :return:
             Vm()   # success
 
@@ -1750,29 +3720,16 @@ class VmAPI:
         vm = self._get_user_shutdown_vm(vm_uuid=vm_uuid, user=user, related_fields=(
             'user', 'host__group', 'image__ceph_pool__ceph'))
 
-        # 是否同宿主机组
         old_host = vm.host
-        try:
-            new_host = self._host_manager.get_host_by_id(host_id=host_id)
-        except ComputeError as e:
-            raise VmError(msg=str(e))
-        if not new_host:
-            raise VmError(msg='指定的目标宿主机不存在')
-
-        if old_host.id == new_host.id:
-            raise VmError(msg='不能在同一个宿主机上迁移')
-        if new_host.group_id != old_host.group_id:
-            raise VmError(msg='目标宿主机和云主机宿主机不在同一个机组')
-
-        # PCI设备
-        if vm.pci_devices.exists():
-            raise VmError(msg='请先卸载主机挂载的PCI设备')
+        self._check_migrate_dst_host(vm=vm, host_id=host_id)
 
         # 目标宿主机资源申请
         try:
             new_host = self._host_manager.claim_from_host(host_id=host_id, vcpu=vm.vcpu, mem=vm.mem)
         except ComputeError as e:
             raise VmError(msg=str(e))
+        if checkpoint:
+            checkpoint('claimed', host_id=new_host.id, vcpu=vm.vcpu, mem=vm.mem)
 
         # 目标宿主机创建虚拟机
         try:
@@ -1782,6 +3739,8 @@ class VmAPI:
             new_host.free(vcpu=vm.vcpu, mem=vm.mem)
             raise VmError(msg=str(e))
 
+        if checkpoint:
+            checkpoint('created', src_host_id=old_host.id)
         new_host.vm_created_num_add_1()  # 宿主机虚拟机数+1
 
         log_msg = ''
@@ -1799,15 +3758,6 @@ class VmAPI:
                     except VdiskError as e2:
                         log_msg += f'vdisk(uuid={vdisk.uuid})和vm(uuid={vm_uuid}元数据挂载关系解除失败),err={str(e2)}；\n'
 
-            # 如果挂载了硬盘，更新vm元数据中的xml
-            if vdisks:
-                try:
-                    xml_desc = self._vm_manager.get_vm_xml_desc(vm_uuid=vm.get_uuid(), host_ipv4=vm.host.ipv4)
-                    vm.xml = xml_desc
-                    vm.save(update_fields=['xml'])
-                except Exception:
-                    pass
-
         # 删除原宿主机上的虚拟机
         src_vm_undefined = False
         try:
@@ -1836,21 +3786,154 @@ class VmAPI:
         except Exception as e:
             pass
 
+        if checkpoint:
+            checkpoint('done')
+        return vm
+
+    def _check_migrate_dst_host(self, vm: Vm, host_id: int):
+        """
+        检查虚拟机是否可以迁移到目标宿主机
+
+        :return:
+            Host()  # 目标宿主机
+        :raises: VmError
+        """
+        try:
+            new_host = self._host_manager.get_host_by_id(host_id=host_id)
+        except ComputeError as e:
+            raise VmError(msg=str(e))
+        if not new_host:
+            raise VmError(msg='指定的目标宿主机不存在')
+
+        # 是否同宿主机组
+        old_host = vm.host
+        if old_host.id == new_host.id:
+            raise VmError(msg='不能在同一个宿主机上迁移')
+        if new_host.group_id != old_host.group_id:
+            raise VmError(msg='目标宿主机和云主机宿主机不在同一个机组')
+        if new_host.maintenance:
+            raise VmError(msg='目标宿主机处于维护模式')
+
+        # PCI设备
+        if vm.pci_devices.exists():
+            raise VmError(msg='请先卸载主机挂载的PCI设备')
+
+        return new_host
+
+    def live_migrate_vm(self, vm_uuid: str, host_id: int, user, bandwidth: int = None, max_downtime: int = None,
+                        progress=None, checkpoint=None):
+        """
+        热迁移运行中的虚拟机，系统盘和云硬盘为共享的ceph rbd，只迁移内存；
+        宿主机资源申请释放和迁移记录同冷迁移
+
+        :param vm_uuid: 虚拟机uuid
+        :param host_id: 目标宿主机id
+        :param user: 用户
+        :param bandwidth: 迁移带宽限制，单位MiB/s，默认None使用settings.VM_LIVE_MIGRATE_BANDWIDTH
+        :param max_downtime: 最长停机时间，单位毫秒，默认None使用settings.VM_LIVE_MIGRATE_MAX_DOWNTIME
+        :param progress: 进度回调函数，progress(stats: dict)，参数为libvirt jobStats
+        :param checkpoint: 检查点回调，checkpoint(step:str, **data)
+        :return:
+            Vm()   # success
+
+        :raises: VmError
+        """
+        vm = self._get_user_perms_vm(vm_uuid=vm_uuid, user=user, related_fields=(
+            'user', 'host__group', 'image__ceph_pool__ceph'))
+
+        old_host = vm.host
+        self._check_migrate_dst_host(vm=vm, host_id=host_id)
+        domain = self._vm_manager.get_vm_domain(host_ipv4=old_host.ipv4, vm_uuid=vm_uuid)
+        try:
+            running = domain.is_running()
+        except VirtError as e:
+            raise VmError(msg=f'获取虚拟机运行状态失败，{str(e)}')
+        if not running:
+            raise VmError(msg='虚拟机未运行，不能热迁移')
+
+        # 目标宿主机资源申请
+        try:
+            new_host = self._host_manager.claim_from_host(host_id=host_id, vcpu=vm.vcpu, mem=vm.mem)
+        except ComputeError as e:
+            raise VmError(msg=str(e))
+        if checkpoint:
+            checkpoint('claimed', host_id=new_host.id, vcpu=vm.vcpu, mem=vm.mem, live=True)
+
+        if bandwidth is None:
+            bandwidth = getattr(settings, 'VM_LIVE_MIGRATE_BANDWIDTH', 0)
+        if max_downtime is None:
+            max_downtime = getattr(settings, 'VM_LIVE_MIGRATE_MAX_DOWNTIME', 0)
+        try:
+            stats = domain.live_migrate(
+                dst_host_ip=new_host.ipv4, bandwidth=bandwidth, max_downtime=max_downtime,
+                compressed=getattr(settings, 'VM_LIVE_MIGRATE_COMPRESSED', False),
+                auto_converge=getattr(settings, 'VM_LIVE_MIGRATE_AUTO_CONVERGE', True),
+                timeout=getattr(settings, 'VM_LIVE_MIGRATE_TIMEOUT', 0), progress=progress)
+        except VirtError as e:
+            new_host.free(vcpu=vm.vcpu, mem=vm.mem)     # 迁移失败，虚拟机仍在源宿主机运行
+            raise VmError(msg=str(e))
+
+        if checkpoint:
+            checkpoint('created', src_host_id=old_host.id)
+        self.live_migrate_finish(vm=vm, old_host=old_host, new_host=new_host, stats=stats)
+        if checkpoint:
+            checkpoint('done')
         return vm
 
-    def _reset_vm_sys_disk(self, vm: Vm):
+    def live_migrate_finish(self, vm: Vm, old_host, new_host, stats: dict = None):
+        """
+        热迁移完成后，更新虚拟机元数据的宿主机，释放源宿主机资源，记录迁移日志
+
+        :param vm: 虚拟机Vm()
+        :param old_host: 源宿主机Host()
+        :param new_host: 目标宿主机Host()，资源已申请
+        :param stats: 迁移的jobStats
+        """
+        vm_uuid = vm.hex_uuid
+        new_host.vm_created_num_add_1()  # 宿主机虚拟机数+1
+        log_msg = ''
+        vm.host = new_host
+        try:
+            vm.set_xml(self._vm_manager.get_vm_xml_desc(vm_uuid=vm_uuid, host_ipv4=new_host.ipv4))
+        except VmError:
+            vm.xml_version = 0  # 迁移后的xml未同步
+        try:
+            vm.save(update_fields=['host', 'xml', 'xml_version'])
+        except Exception as e:
+            log_msg += f'vm(uuid={vm_uuid})已迁移到host({new_host.ipv4})，元数据更新失败，err={str(e)}；\n'
+
+        old_host.vm_created_num_sub_1()  # 宿主机虚拟机数-1
+        if not old_host.free(vcpu=vm.vcpu, mem=vm.mem):
+            log_msg += f'源host({old_host.ipv4})资源(vcpu={vm.vcpu}, mem={vm.mem}MB)释放失败;\n'
+
+        result = not log_msg
+        if result:
+            stats = stats or {}
+            log_msg = f'热迁移正常，停机时间{stats.get("downtime", "-")}ms，' \
+                      f'迁移数据{stats.get("data_processed", 0) / 1024 ** 2:.1f}MB'
+        try:
+            MigrateLog(vm_uuid=vm_uuid, src_host_id=old_host.id, src_host_ipv4=old_host.ipv4,
+                       dst_host_id=new_host.id, dst_host_ipv4=new_host.ipv4, result=result,
+                       content=log_msg, src_undefined=True).save()
+        except Exception as e:
+            pass
+
+    def _reset_vm_sys_disk(self, vm: Vm, checkpoint=None):
         """
         重置虚拟机系统盘，恢复到创建时状态
 
         :param vm: 虚拟机对象; type Vm
+        :param checkpoint: 检查点回调，checkpoint(step:str, **data)
         :return:
             Vm()   # success
 
         :raises: VmError
         """
-        # 删除快照记录
+        # 删除快照记录和备份链的快照，备份链下一次对新系统盘做全量备份
         try:
+            self._vm_manager.detach_clone_parent_snap(vm)
             vm.sys_snaps.delete()
+            BackupChain.release_disk(disk_type=BackupChain.TYPE_SYS_DISK, disk=vm.disk)
         except Exception as e:
             raise VmError(msg=f'删除虚拟机系统盘快照失败，{str(e)}')
 
@@ -1864,24 +3947,30 @@ class VmAPI:
         ok, deleted_disk = rename_sys_disk_delete(ceph=ceph, pool_name=pool_name, disk_name=disk_name)
         if not ok:
             raise VmError(msg='虚拟机系统盘重命名失败')
+        if checkpoint:
+            checkpoint('renamed', disk=disk_name, deleted_disk=deleted_disk, old_pool_id=pool.id, image_id=image.id)
 
         rbd_manager = get_rbd_manager(ceph=ceph, pool_name=pool_name)
         try:
             rbd_manager.clone_image(snap_image_name=image.base_image, snap_name=image.snap,
-                                    new_image_name=disk_name, data_pool=data_pool)
+                                    new_image_name=disk_name, data_pool=data_pool, features=pool.rbd_features_mask)
         except (RadosError, ImageExistsError) as e:
             # 原系统盘改回原名
             rename_image(ceph=ceph, pool_name=pool_name, image_name=deleted_disk, new_name=disk_name)
             raise VmError(msg=f'虚拟机系统盘创建失败, {str(e)}')
 
+        DiskFlattenManager().clear_disk_tasks(disk=disk_name)   # 系统盘重新克隆了，旧的flatten任务记录失效
+        if checkpoint:
+            checkpoint('done')
         return vm
 
-    def reset_sys_disk(self, vm_uuid: str, user):
+    def reset_sys_disk(self, vm_uuid: str, user, checkpoint=None):
         """
         重置虚拟机系统盘，恢复到创建时状态
 
         :param vm_uuid: 虚拟机uuid
         :param user: 用户
+        :param checkpoint: 检查点回调，checkpoint(step:str, **data)
         :return:
             Vm()   # success
 
@@ -1890,7 +3979,7 @@ class VmAPI:
         vm = self._get_user_shutdown_vm(vm_uuid=vm_uuid, user=user, related_fields=(
             'user', 'host__group', 'image__ceph_pool__ceph'))
 
-        return self._reset_vm_sys_disk(vm)
+        return self._reset_vm_sys_disk(vm, checkpoint=checkpoint)
 
     def vm_change_password(self, vm_uuid: str, user, username: str, password: str):
         """
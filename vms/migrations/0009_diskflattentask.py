@@ -0,0 +1,36 @@
+# Generated by Django 2.2.16 on 2026-10-18 23:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ceph', '0003_auto_20200211_0931'),
+        ('vms', '0008_flavor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiskFlattenTask',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('vm_uuid', models.CharField(blank=True, default='', max_length=36, verbose_name='虚拟机UUID')),
+                ('disk', models.CharField(max_length=100, verbose_name='系统盘名称')),
+                ('parent', models.CharField(blank=True, default='', help_text='格式：pool/image@snap', max_length=255, verbose_name='父镜像快照')),
+                ('reason', models.SmallIntegerField(choices=[(1, '系统盘创建时间超过期限'), (2, '系统镜像快照将被替换')], default=1, verbose_name='原因')),
+                ('status', models.SmallIntegerField(choices=[(0, '等待'), (1, '执行中'), (2, '完成'), (3, '失败')], default=0, verbose_name='状态')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('start_time', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('end_time', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('message', models.TextField(blank=True, default='', verbose_name='执行信息')),
+                ('ceph_pool', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='ceph.CephPool', verbose_name='CEPH POOL')),
+            ],
+            options={
+                'verbose_name': '系统盘flatten任务',
+                'verbose_name_plural': '系统盘flatten任务',
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0009_diskflattentask'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='diskflattentask',
+            name='reason',
+            field=models.SmallIntegerField(choices=[(1, '系统盘创建时间超过期限'), (2, '系统镜像快照将被替换'), (3, '云硬盘从快照克隆')], default=1, verbose_name='原因'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compute', '0004_host_real_cpu'),
+        ('image', '0003_auto_20191122_1541'),
+        ('vdisk', '0004_vdisksnap'),
+        ('network', '0005_vlan_tag'),
+        ('vms', '0010_diskflattentask_reason'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CenterMigrateTask',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('vm_uuid', models.CharField(max_length=36, verbose_name='虚拟机UUID')),
+                ('sync_rounds', models.SmallIntegerField(default=2, verbose_name='增量同步次数')),
+                ('status', models.SmallIntegerField(choices=[(0, '等待'), (1, '执行中'), (2, '完成'), (3, '失败')], default=0, verbose_name='状态')),
+                ('stage', models.SmallIntegerField(choices=[(0, '未开始'), (1, '全量复制'), (2, '增量同步'), (3, '关闭虚拟机'), (4, '关机后最后同步'), (5, '目标宿主机创建虚拟机'), (6, '结束')], default=0, verbose_name='阶段')),
+                ('copied', models.BigIntegerField(default=0, help_text='单位Bytes', verbose_name='已复制数据量')),
+                ('downtime', models.FloatField(default=0, help_text='单位秒', verbose_name='停机时间')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('start_time', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('end_time', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('message', models.TextField(blank=True, default='', verbose_name='执行信息')),
+                ('dst_group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='compute.Group', verbose_name='目标宿主机组')),
+                ('dst_host', models.ForeignKey(blank=True, help_text='为空时在目标宿主机组中自动选择', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='compute.Host', verbose_name='目标宿主机')),
+                ('dst_image', models.ForeignKey(help_text='目标分中心的系统镜像，系统盘复制到镜像所在的ceph pool', on_delete=django.db.models.deletion.CASCADE, related_name='+', to='image.Image', verbose_name='目标系统镜像')),
+                ('dst_quota', models.ForeignKey(blank=True, help_text='挂载的云硬盘复制到此存储池', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='vdisk.Quota', verbose_name='目标云硬盘存储池')),
+                ('dst_vlan', models.ForeignKey(blank=True, help_text='为空时，原IP的子网属于目标分中心则保留原IP，否则自动分配', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='network.Vlan', verbose_name='目标子网')),
+            ],
+            options={
+                'verbose_name': '虚拟机跨分中心迁移任务',
+                'verbose_name_plural': '虚拟机跨分中心迁移任务',
+                'ordering': ['-id'],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ceph', '0005_cephpool_rbd_features'),
+        ('vms', '0012_diskflattentask_reason_rollback'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiskTrimLog',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('vm_uuid', models.CharField(max_length=36, verbose_name='虚拟机UUID')),
+                ('disk', models.CharField(max_length=100, verbose_name='硬盘rbd image')),
+                ('used_before', models.BigIntegerField(default=0, help_text='单位Bytes', verbose_name='回收前已用空间')),
+                ('used_after', models.BigIntegerField(default=0, help_text='单位Bytes', verbose_name='回收后已用空间')),
+                ('reclaimed', models.BigIntegerField(default=0, help_text='单位Bytes', verbose_name='回收的空间')),
+                ('result', models.BooleanField(default=True, verbose_name='成功')),
+                ('message', models.TextField(blank=True, default='', verbose_name='执行信息')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='执行时间')),
+                ('ceph_pool', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='disk_trim_logs', to='ceph.CephPool', verbose_name='CEPH POOL')),
+            ],
+            options={
+                'verbose_name': '硬盘空间回收记录',
+                'verbose_name_plural': '硬盘空间回收记录',
+                'ordering': ['-id'],
+            },
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('vms', '0013_disktrimlog'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VmJob',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.SmallIntegerField(choices=[(1, '创建虚拟机'), (2, '删除虚拟机'), (3, '迁移虚拟机'), (4, '更换系统镜像'), (5, '重置系统盘')], verbose_name='操作')),
+                ('vm_uuid', models.CharField(db_index=True, help_text='创建虚拟机时为预先分配的uuid', max_length=36, verbose_name='虚拟机UUID')),
+                ('params', models.TextField(default='{}', help_text='json', verbose_name='任务参数')),
+                ('status', models.SmallIntegerField(choices=[(0, '等待'), (1, '执行中'), (2, '完成'), (3, '失败')], default=0, verbose_name='状态')),
+                ('step', models.CharField(blank=True, default='', max_length=32, verbose_name='检查点')),
+                ('checkpoint', models.TextField(default='{}', help_text='json，已申请的资源等回滚需要的信息', verbose_name='检查点数据')),
+                ('attempts', models.SmallIntegerField(default=0, verbose_name='执行次数')),
+                ('worker', models.CharField(blank=True, default='', max_length=100, verbose_name='执行进程')),
+                ('heartbeat', models.DateTimeField(blank=True, null=True, verbose_name='执行进程心跳时间')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('start_time', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('end_time', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('message', models.TextField(blank=True, default='', verbose_name='执行信息')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vm_jobs', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+            ],
+            options={
+                'verbose_name': '虚拟机异步任务',
+                'verbose_name_plural': '虚拟机异步任务',
+                'ordering': ['-id'],
+            },
+        ),
+    ]
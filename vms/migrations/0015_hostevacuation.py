@@ -0,0 +1,60 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:36
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('compute', '0005_host_maintenance'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('vms', '0014_vmjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostEvacuation',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_limit', models.SmallIntegerField(default=2, help_text='同时从此宿主机迁出的虚拟机数', validators=[django.core.validators.MinValueValidator(1)], verbose_name='源宿主机并行迁移数')),
+                ('target_limit', models.SmallIntegerField(default=1, help_text='同时迁入一个目标宿主机的虚拟机数，包括其他疏散任务迁入的', validators=[django.core.validators.MinValueValidator(1)], verbose_name='目标宿主机并行迁移数')),
+                ('status', models.SmallIntegerField(choices=[(0, '等待'), (1, '执行中'), (2, '已暂停'), (3, '完成'), (4, '有迁移失败的虚拟机')], default=0, verbose_name='状态')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('start_time', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('end_time', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('message', models.TextField(blank=True, default='', verbose_name='执行信息')),
+                ('host', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='evacuations', to='compute.Host', verbose_name='宿主机')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='创建者')),
+            ],
+            options={
+                'verbose_name': '宿主机疏散任务',
+                'verbose_name_plural': '宿主机疏散任务',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='HostEvacuationVm',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('vm_uuid', models.CharField(max_length=36, verbose_name='虚拟机UUID')),
+                ('live', models.BooleanField(default=False, verbose_name='热迁移')),
+                ('status', models.SmallIntegerField(choices=[(0, '等待'), (1, '迁移中'), (2, '完成'), (3, '失败')], default=0, verbose_name='状态')),
+                ('progress', models.SmallIntegerField(default=0, help_text='热迁移已传输内存的百分比', verbose_name='进度')),
+                ('start_time', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('end_time', models.DateTimeField(blank=True, null=True, verbose_name='结束时间')),
+                ('message', models.TextField(blank=True, default='', verbose_name='执行信息')),
+                ('dst_host', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='compute.Host', verbose_name='目标宿主机')),
+                ('evacuation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='vms.HostEvacuation', verbose_name='疏散任务')),
+                ('job', models.ForeignKey(blank=True, help_text='执行迁移的虚拟机异步任务', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='vms.VmJob', verbose_name='迁移任务')),
+            ],
+            options={
+                'verbose_name': '宿主机疏散虚拟机',
+                'verbose_name_plural': '宿主机疏散虚拟机',
+                'ordering': ['id'],
+                'unique_together': {('evacuation', 'vm_uuid')},
+            },
+        ),
+    ]
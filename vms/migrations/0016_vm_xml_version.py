@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0015_hostevacuation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vm',
+            name='xml_version',
+            field=models.IntegerField(default=0, help_text='EVCloud每次定义虚拟机或挂载、卸载设备后同步更新XML并加1；0为XML未与宿主机同步，不可信', verbose_name='XML版本'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-19 00:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vms', '0016_vm_xml_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vm',
+            name='locked_by',
+            field=models.CharField(blank=True, default='', help_text='非空时虚拟机正在执行此后台操作（如跨分中心迁移），不能操作虚拟机和挂载的硬盘', max_length=100, verbose_name='操作锁'),
+        ),
+    ]
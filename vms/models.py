@@ -1,11 +1,14 @@
+import json
+
 from django.db import models
+from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator
 
 from image.models import Image
-from compute.models import Host
+from compute.models import Host, Group
 from network.models import MacIP
 from ceph.managers import get_rbd_manager, CephClusterManager, RadosError
 from ceph.models import CephPool
@@ -32,6 +35,23 @@ def remove_image(ceph, pool_name: str, image_name: str):
     return True
 
 
+def trash_image(ceph, pool_name: str, image_name: str):
+    '''
+    镜像移入回收站，保留期内可以恢复，过期后由后台purge_rbd_trash命令清除
+
+    :return:
+        True    # success
+        False   # failed
+    '''
+    try:
+        rbd = get_rbd_manager(ceph=ceph, pool_name=pool_name)
+        rbd.trash_move(image_name=image_name, delay=getattr(settings, 'RBD_TRASH_DELAY', 0))
+    except (RadosError, Exception) as e:
+        return False
+
+    return True
+
+
 def rename_image(ceph, pool_name: str, image_name: str, new_name: str):
     '''
     重命名一个镜像
@@ -66,7 +86,11 @@ class Vm(models.Model):
 
     host = models.ForeignKey(to=Host, on_delete=models.CASCADE, verbose_name='宿主机')
     xml = models.TextField(verbose_name='虚拟机当前的XML', help_text='定义虚拟机的当前的XML内容')
+    xml_version = models.IntegerField(verbose_name='XML版本', default=0,
+                                      help_text='EVCloud每次定义虚拟机或挂载、卸载设备后同步更新XML并加1；0为XML未与宿主机同步，不可信')
     mac_ip = models.OneToOneField(to=MacIP, on_delete=models.CASCADE, related_name='ip_vm', verbose_name='MAC IP')
+    locked_by = models.CharField(verbose_name='操作锁', max_length=100, blank=True, default='',
+                                 help_text='非空时虚拟机正在执行此后台操作（如跨分中心迁移），不能操作虚拟机和挂载的硬盘')
 
     def __str__(self):
         return self.name
@@ -79,6 +103,40 @@ class Vm(models.Model):
     def get_uuid(self):
         return self.uuid
 
+    def lock(self, reason: str):
+        '''
+        锁定虚拟机，执行后台操作期间不能操作虚拟机
+
+        :param reason: 锁定的操作，如"跨分中心迁移任务<1>"
+        :return:
+            True    # success
+            False   # 已被其他操作锁定
+        '''
+        if not Vm.objects.filter(uuid=self.uuid, locked_by='').update(locked_by=reason):
+            return False
+        self.locked_by = reason
+        return True
+
+    def unlock(self, reason: str):
+        '''
+        解除锁定，只解除reason的锁定
+        '''
+        Vm.objects.filter(uuid=self.uuid, locked_by=reason).update(locked_by='')
+        if self.locked_by == reason:
+            self.locked_by = ''
+
+    @property
+    def xml_trusted(self):
+        '''xml缓存是否与宿主机上的虚拟机定义一致'''
+        return self.xml_version > 0 and bool(self.xml)
+
+    def set_xml(self, xml_desc: str):
+        '''
+        更新缓存的xml，版本号加1，需要调用者保存xml和xml_version字段
+        '''
+        self.xml = xml_desc
+        self.xml_version = max(self.xml_version, 0) + 1
+
     @property
     def hex_uuid(self):
         return self.get_uuid()
@@ -245,13 +303,11 @@ class VmArchive(models.Model):
         :return:None
         :raises: Exception
         '''
-        snaps = VmDiskSnap.objects.select_related('ceph_pool', 'ceph_pool__ceph').filter(disk=self.disk).all()
-        for snap in snaps:
-            snap.delete()
+        VmDiskSnap.objects.filter(disk=self.disk).delete()
 
     def rm_sys_disk(self):
         '''
-        删除系统盘，需要先删除所有系统盘快照
+        删除系统盘，需要先删除所有系统盘快照；系统盘移入回收站，由后台purge_rbd_trash命令清除
         :return:
             True    # success
             False   # failed
@@ -260,7 +316,7 @@ class VmArchive(models.Model):
         if not config:
             return False
 
-        return remove_image(ceph=config, pool_name=self.ceph_pool, image_name=self.disk)
+        return trash_image(ceph=config, pool_name=self.ceph_pool, image_name=self.disk)
 
     def rename_sys_disk_archive(self):
         '''
@@ -349,6 +405,88 @@ class VmLog(models.Model):
         return self.ABOUT_NORMAL
 
 
+class VmDiskSnapQuerySet(models.QuerySet):
+    '''
+    虚拟机系统盘快照查询集，批量删除时每个系统盘只打开一次rbd image
+    '''
+    def bulk_delete(self):
+        '''
+        批量删除快照，按(ceph pool, 系统盘)分组，一次删除一个系统盘的所有rbd快照，只删除rbd快照删除成功的数据库记录
+
+        :return:
+            (deleted:int, failed:list)    # failed = [(VmDiskSnap(), err_msg), ]
+        '''
+        groups = {}
+        failed = []
+        deleted_ids = []
+        for snap in self.select_related('ceph_pool__ceph', 'vm__image__ceph_pool__ceph'):
+            if not snap.snap:   # 没有rbd快照
+                deleted_ids.append(snap.id)
+                continue
+
+            try:
+                disk = snap.sys_disk
+            except Exception as e:
+                failed.append((snap, str(e)))
+                continue
+
+            ceph_pool = snap.get_ceph_pool()
+            if not ceph_pool or not ceph_pool.ceph:
+                failed.append((snap, 'can not get ceph pool'))
+                continue
+
+            groups.setdefault((ceph_pool.id, disk), []).append(snap)
+
+        rbd_managers = {}
+        for (pool_id, disk), snaps in groups.items():
+            ceph_pool = snaps[0].get_ceph_pool()
+            try:
+                rbd = rbd_managers.get(pool_id)
+                if rbd is None:
+                    rbd = get_rbd_manager(ceph=ceph_pool.ceph, pool_name=ceph_pool.pool_name)
+                    rbd_managers[pool_id] = rbd
+                removed, rbd_failed = rbd.remove_snaps(image_name=disk, snaps=[s.snap for s in snaps])
+            except (RadosError, Exception) as e:
+                failed += [(s, str(e)) for s in snaps]
+                continue
+
+            removed = set(removed)
+            rbd_failed = dict(rbd_failed)
+            for s in snaps:
+                if s.snap in removed:
+                    deleted_ids.append(s.id)
+                else:
+                    failed.append((s, rbd_failed.get(s.snap, 'unknown error')))
+
+        deleted = 0
+        if deleted_ids:
+            deleted, _ = self.model.objects.filter(id__in=deleted_ids).delete_db_rows()
+
+        return deleted, failed
+
+    def delete_db_rows(self):
+        '''
+        只删除数据库记录，不删除rbd快照
+        '''
+        return super().delete()
+
+    def delete(self):
+        '''
+        删除快照，同时删除rbd快照
+
+        :raises: Exception      # 有快照删除失败
+        '''
+        deleted, failed = self.bulk_delete()
+        if failed:
+            msg = ';'.join([f'{s.snap}({err})' for s, err in failed])
+            raise Exception(f'删除系统盘快照失败：{msg}')
+
+        return deleted, {self.model._meta.label: deleted}
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
 class VmDiskSnap(models.Model):
     '''
     虚拟机系统盘快照
@@ -361,6 +499,8 @@ class VmDiskSnap(models.Model):
     create_time = models.DateTimeField(auto_now_add=True, verbose_name='创建日期')
     remarks = models.TextField(default='', null=True, blank=True, verbose_name='备注')
 
+    objects = VmDiskSnapQuerySet.as_manager()
+
     class Meta:
         ordering = ['-id']
         verbose_name = '虚拟机系统盘快照'
@@ -514,3 +654,302 @@ class Flavor(models.Model):
     def __repr__(self):
         return f'Flavor<vcpus={self.vcpus}, ram={self.ram}>'
 
+
+
+class DiskFlattenTask(models.Model):
+    """
+    虚拟机系统盘flatten任务，解除系统盘与镜像快照的克隆依赖
+    """
+    STATUS_WAIT = 0
+    STATUS_RUNNING = 1
+    STATUS_OK = 2
+    STATUS_FAILED = 3
+    CHOICES_STATUS = (
+        (STATUS_WAIT, '等待'),
+        (STATUS_RUNNING, '执行中'),
+        (STATUS_OK, '完成'),
+        (STATUS_FAILED, '失败'),
+    )
+
+    REASON_AGE = 1
+    REASON_IMAGE = 2
+    REASON_VDISK_CLONE = 3
+    REASON_SNAP_ROLLBACK = 4
+    CHOICES_REASON = (
+        (REASON_AGE, '系统盘创建时间超过期限'),
+        (REASON_IMAGE, '系统镜像快照将被替换'),
+        (REASON_VDISK_CLONE, '云硬盘从快照克隆'),
+        (REASON_SNAP_ROLLBACK, '系统盘从快照克隆回滚'),
+    )
+
+    id = models.AutoField(verbose_name='ID', primary_key=True)
+    vm_uuid = models.CharField(verbose_name='虚拟机UUID', max_length=36, blank=True, default='')
+    disk = models.CharField(verbose_name='系统盘名称', max_length=100)
+    ceph_pool = models.ForeignKey(to=CephPool, on_delete=models.SET_NULL, null=True, verbose_name='CEPH POOL')
+    parent = models.CharField(verbose_name='父镜像快照', max_length=255, blank=True, default='',
+                              help_text='格式：pool/image@snap')
+    reason = models.SmallIntegerField(verbose_name='原因', choices=CHOICES_REASON, default=REASON_AGE)
+    status = models.SmallIntegerField(verbose_name='状态', choices=CHOICES_STATUS, default=STATUS_WAIT)
+    create_time = models.DateTimeField(verbose_name='创建时间', auto_now_add=True)
+    start_time = models.DateTimeField(verbose_name='开始时间', null=True, blank=True)
+    end_time = models.DateTimeField(verbose_name='结束时间', null=True, blank=True)
+    message = models.TextField(verbose_name='执行信息', default='', blank=True)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = '系统盘flatten任务'
+        verbose_name_plural = '系统盘flatten任务'
+
+    def __str__(self):
+        return f'{self.disk}({self.get_status_display()})'
+
+
+class CenterMigrateTask(models.Model):
+    """
+    虚拟机跨分中心迁移任务，虚拟机运行中全量复制和增量同步系统盘和云硬盘到目标ceph集群，关机后最后同步一次，
+    在目标宿主机组重新创建虚拟机
+    """
+    STATUS_WAIT = 0
+    STATUS_RUNNING = 1
+    STATUS_OK = 2
+    STATUS_FAILED = 3
+    CHOICES_STATUS = (
+        (STATUS_WAIT, '等待'),
+        (STATUS_RUNNING, '执行中'),
+        (STATUS_OK, '完成'),
+        (STATUS_FAILED, '失败'),
+    )
+
+    STAGE_WAIT = 0
+    STAGE_COPY = 1
+    STAGE_SYNC = 2
+    STAGE_SHUTDOWN = 3
+    STAGE_FINAL_SYNC = 4
+    STAGE_SWITCH = 5
+    STAGE_DONE = 6
+    CHOICES_STAGE = (
+        (STAGE_WAIT, '未开始'),
+        (STAGE_COPY, '全量复制'),
+        (STAGE_SYNC, '增量同步'),
+        (STAGE_SHUTDOWN, '关闭虚拟机'),
+        (STAGE_FINAL_SYNC, '关机后最后同步'),
+        (STAGE_SWITCH, '目标宿主机创建虚拟机'),
+        (STAGE_DONE, '结束'),
+    )
+
+    id = models.AutoField(verbose_name='ID', primary_key=True)
+    vm_uuid = models.CharField(verbose_name='虚拟机UUID', max_length=36)
+    dst_group = models.ForeignKey(to=Group, on_delete=models.CASCADE, verbose_name='目标宿主机组')
+    dst_host = models.ForeignKey(to=Host, on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+                                 verbose_name='目标宿主机', help_text='为空时在目标宿主机组中自动选择')
+    dst_image = models.ForeignKey(to=Image, on_delete=models.CASCADE, related_name='+', verbose_name='目标系统镜像',
+                                  help_text='目标分中心的系统镜像，系统盘复制到镜像所在的ceph pool')
+    dst_quota = models.ForeignKey(to='vdisk.Quota', on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+                                  verbose_name='目标云硬盘存储池', help_text='挂载的云硬盘复制到此存储池')
+    dst_vlan = models.ForeignKey(to='network.Vlan', on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+                                 verbose_name='目标子网', help_text='为空时，原IP的子网属于目标分中心则保留原IP，否则自动分配')
+    sync_rounds = models.SmallIntegerField(verbose_name='增量同步次数', default=2)
+    status = models.SmallIntegerField(verbose_name='状态', choices=CHOICES_STATUS, default=STATUS_WAIT)
+    stage = models.SmallIntegerField(verbose_name='阶段', choices=CHOICES_STAGE, default=STAGE_WAIT)
+    copied = models.BigIntegerField(verbose_name='已复制数据量', default=0, help_text='单位Bytes')
+    downtime = models.FloatField(verbose_name='停机时间', default=0, help_text='单位秒')
+    create_time = models.DateTimeField(verbose_name='创建时间', auto_now_add=True)
+    start_time = models.DateTimeField(verbose_name='开始时间', null=True, blank=True)
+    end_time = models.DateTimeField(verbose_name='结束时间', null=True, blank=True)
+    message = models.TextField(verbose_name='执行信息', default='', blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = '虚拟机跨分中心迁移任务'
+        verbose_name_plural = '虚拟机跨分中心迁移任务'
+
+    def __str__(self):
+        return f'{self.vm_uuid}({self.get_status_display()})'
+
+
+class DiskTrimLog(models.Model):
+    """
+    虚拟机内执行fstrim回收硬盘空间的记录，空间大小为rbd image已分配的数据大小
+    """
+    id = models.AutoField(verbose_name='ID', primary_key=True)
+    vm_uuid = models.CharField(verbose_name='虚拟机UUID', max_length=36)
+    disk = models.CharField(verbose_name='硬盘rbd image', max_length=100)
+    ceph_pool = models.ForeignKey(to=CephPool, on_delete=models.SET_NULL, null=True, related_name='disk_trim_logs',
+                                  verbose_name='CEPH POOL')
+    used_before = models.BigIntegerField(verbose_name='回收前已用空间', default=0, help_text='单位Bytes')
+    used_after = models.BigIntegerField(verbose_name='回收后已用空间', default=0, help_text='单位Bytes')
+    reclaimed = models.BigIntegerField(verbose_name='回收的空间', default=0, help_text='单位Bytes')
+    result = models.BooleanField(verbose_name='成功', default=True)
+    message = models.TextField(verbose_name='执行信息', default='', blank=True)
+    create_time = models.DateTimeField(verbose_name='执行时间', auto_now_add=True)
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = '硬盘空间回收记录'
+        verbose_name_plural = '硬盘空间回收记录'
+
+    def __str__(self):
+        return f'{self.disk}({self.reclaimed})'
+
+
+class VmJob(models.Model):
+    """
+    虚拟机异步任务，耗时的虚拟机操作由任务执行进程（manage.py run_vm_jobs）执行，请求立即返回任务id；
+    执行中的关键步骤记录检查点，执行进程异常退出后，根据检查点确认完成或回滚已申请的资源后重新执行
+    """
+    STATUS_WAIT = 0
+    STATUS_RUNNING = 1
+    STATUS_OK = 2
+    STATUS_FAILED = 3
+    CHOICES_STATUS = (
+        (STATUS_WAIT, '等待'),
+        (STATUS_RUNNING, '执行中'),
+        (STATUS_OK, '完成'),
+        (STATUS_FAILED, '失败'),
+    )
+
+    ACTION_CREATE = 1
+    ACTION_DELETE = 2
+    ACTION_MIGRATE = 3
+    ACTION_CHANGE_SYS_DISK = 4
+    ACTION_RESET_SYS_DISK = 5
+    CHOICES_ACTION = (
+        (ACTION_CREATE, '创建虚拟机'),
+        (ACTION_DELETE, '删除虚拟机'),
+        (ACTION_MIGRATE, '迁移虚拟机'),
+        (ACTION_CHANGE_SYS_DISK, '更换系统镜像'),
+        (ACTION_RESET_SYS_DISK, '重置系统盘'),
+    )
+
+    id = models.AutoField(verbose_name='ID', primary_key=True)
+    action = models.SmallIntegerField(verbose_name='操作', choices=CHOICES_ACTION)
+    vm_uuid = models.CharField(verbose_name='虚拟机UUID', max_length=36, db_index=True,
+                               help_text='创建虚拟机时为预先分配的uuid')
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='vm_jobs', verbose_name='用户')
+    params = models.TextField(verbose_name='任务参数', default='{}', help_text='json')
+    status = models.SmallIntegerField(verbose_name='状态', choices=CHOICES_STATUS, default=STATUS_WAIT)
+    step = models.CharField(verbose_name='检查点', max_length=32, blank=True, default='')
+    checkpoint = models.TextField(verbose_name='检查点数据', default='{}', help_text='json，已申请的资源等回滚需要的信息')
+    attempts = models.SmallIntegerField(verbose_name='执行次数', default=0)
+    worker = models.CharField(verbose_name='执行进程', max_length=100, blank=True, default='')
+    heartbeat = models.DateTimeField(verbose_name='执行进程心跳时间', null=True, blank=True)
+    create_time = models.DateTimeField(verbose_name='创建时间', auto_now_add=True)
+    start_time = models.DateTimeField(verbose_name='开始时间', null=True, blank=True)
+    end_time = models.DateTimeField(verbose_name='结束时间', null=True, blank=True)
+    message = models.TextField(verbose_name='执行信息', default='', blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = '虚拟机异步任务'
+        verbose_name_plural = '虚拟机异步任务'
+
+    def __str__(self):
+        return f'{self.get_action_display()}<{self.vm_uuid}>({self.get_status_display()})'
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_OK, self.STATUS_FAILED)
+
+    def get_params(self):
+        return json.loads(self.params or '{}')
+
+    def get_checkpoint(self):
+        return json.loads(self.checkpoint or '{}')
+
+
+class HostEvacuation(models.Model):
+    """
+    宿主机疏散任务，宿主机进入维护模式后，一次计算所有虚拟机的目标宿主机，按源和目标宿主机的并行数限制同时迁移多个虚拟机；
+    每个虚拟机的迁移作为虚拟机异步任务由执行进程（manage.py run_vm_jobs）执行，运行中的虚拟机热迁移，关机的虚拟机冷迁移；
+    暂停后不再开始新的迁移，继续时重新计算未迁移虚拟机的目标宿主机
+    """
+    STATUS_WAIT = 0
+    STATUS_RUNNING = 1
+    STATUS_PAUSED = 2
+    STATUS_OK = 3
+    STATUS_FAILED = 4
+    CHOICES_STATUS = (
+        (STATUS_WAIT, '等待'),
+        (STATUS_RUNNING, '执行中'),
+        (STATUS_PAUSED, '已暂停'),
+        (STATUS_OK, '完成'),
+        (STATUS_FAILED, '有迁移失败的虚拟机'),
+    )
+
+    id = models.AutoField(verbose_name='ID', primary_key=True)
+    host = models.ForeignKey(to=Host, on_delete=models.CASCADE, related_name='evacuations', verbose_name='宿主机')
+    user = models.ForeignKey(to=User, on_delete=models.CASCADE, related_name='+', verbose_name='创建者')
+    source_limit = models.SmallIntegerField(verbose_name='源宿主机并行迁移数', default=2,
+                                            validators=[MinValueValidator(1)], help_text='同时从此宿主机迁出的虚拟机数')
+    target_limit = models.SmallIntegerField(verbose_name='目标宿主机并行迁移数', default=1,
+                                            validators=[MinValueValidator(1)],
+                                            help_text='同时迁入一个目标宿主机的虚拟机数，包括其他疏散任务迁入的')
+    status = models.SmallIntegerField(verbose_name='状态', choices=CHOICES_STATUS, default=STATUS_WAIT)
+    create_time = models.DateTimeField(verbose_name='创建时间', auto_now_add=True)
+    start_time = models.DateTimeField(verbose_name='开始时间', null=True, blank=True)
+    end_time = models.DateTimeField(verbose_name='结束时间', null=True, blank=True)
+    message = models.TextField(verbose_name='执行信息', default='', blank=True)
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = '宿主机疏散任务'
+        verbose_name_plural = '宿主机疏散任务'
+
+    def __str__(self):
+        return f'{self.host}({self.get_status_display()})'
+
+    def get_progress(self):
+        """
+        各状态的虚拟机数
+
+        :return:
+            {'total': int, 'wait': int, 'running': int, 'ok': int, 'failed': int}
+        """
+        counts = dict(self.items.values_list('status').annotate(c=models.Count('id')).order_by())
+        return {
+            'total': sum(counts.values()),
+            'wait': counts.get(HostEvacuationVm.STATUS_WAIT, 0),
+            'running': counts.get(HostEvacuationVm.STATUS_RUNNING, 0),
+            'ok': counts.get(HostEvacuationVm.STATUS_OK, 0),
+            'failed': counts.get(HostEvacuationVm.STATUS_FAILED, 0),
+        }
+
+
+class HostEvacuationVm(models.Model):
+    """
+    宿主机疏散任务中一个虚拟机的迁移
+    """
+    STATUS_WAIT = 0
+    STATUS_RUNNING = 1
+    STATUS_OK = 2
+    STATUS_FAILED = 3
+    CHOICES_STATUS = (
+        (STATUS_WAIT, '等待'),
+        (STATUS_RUNNING, '迁移中'),
+        (STATUS_OK, '完成'),
+        (STATUS_FAILED, '失败'),
+    )
+
+    id = models.AutoField(verbose_name='ID', primary_key=True)
+    evacuation = models.ForeignKey(to=HostEvacuation, on_delete=models.CASCADE, related_name='items',
+                                   verbose_name='疏散任务')
+    vm_uuid = models.CharField(verbose_name='虚拟机UUID', max_length=36)
+    dst_host = models.ForeignKey(to=Host, on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+                                 verbose_name='目标宿主机')
+    live = models.BooleanField(verbose_name='热迁移', default=False)
+    job = models.ForeignKey(to=VmJob, on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+                            verbose_name='迁移任务', help_text='执行迁移的虚拟机异步任务')
+    status = models.SmallIntegerField(verbose_name='状态', choices=CHOICES_STATUS, default=STATUS_WAIT)
+    progress = models.SmallIntegerField(verbose_name='进度', default=0, help_text='热迁移已传输内存的百分比')
+    start_time = models.DateTimeField(verbose_name='开始时间', null=True, blank=True)
+    end_time = models.DateTimeField(verbose_name='结束时间', null=True, blank=True)
+    message = models.TextField(verbose_name='执行信息', default='', blank=True)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = '宿主机疏散虚拟机'
+        verbose_name_plural = '宿主机疏散虚拟机'
+        unique_together = ('evacuation', 'vm_uuid')
+
+    def __str__(self):
+        return f'{self.vm_uuid}({self.get_status_display()})'
@@ -79,6 +79,9 @@ class HostMacIPScheduler:
         if not host:
             raise NoHostError(msg='host参数无效')
 
+        if host.maintenance:
+            raise NoHostError(msg='宿主机处于维护模式')
+
         # 宿主机是否满足资源需求
         if not host.meet_needs(vcpu=vcpu, mem=mem):
             raise NoHostError(msg='没有足够资源的宿主机可用')
@@ -248,5 +251,43 @@ class HostMacIPScheduler:
         except (ComputeError, Exception) as e:
             raise ScheduleError(msg=f'获取宿主机list错误，{str(e)}')
 
-        return host_list
+        return [h for h in host_list if not h.maintenance]   # 维护模式的宿主机不参与调度
+
+    def schedule_migrate_batch(self, vms: list, group, exclude_host_ids=()):
+        '''
+        一次为多个虚拟机计算迁移的目标宿主机，不申请资源，迁移时再向目标宿主机申请
+
+        虚拟机按内存从大到小依次放置到剩余内存最多的宿主机，已放置的虚拟机占用的资源计入宿主机，
+        目标宿主机需要包含虚拟机IP所属的子网
+
+        :param vms: 虚拟机列表 [Vm()]
+        :param group: 宿主机组 Group()，只调度到此组的宿主机
+        :param exclude_host_ids: 排除的宿主机id，如源宿主机
+        :return:
+            {vm_uuid: Host()}   # 没有满足要求的宿主机的虚拟机不在结果中
+
+        :raises: ScheduleError
+        '''
+        hosts = {h.id: h for h in self._get_host_list(group=group) if h.id not in exclude_host_ids}
+        host_vlans = {}
+        free = {}
+        for h in hosts.values():
+            host_vlans[h.id] = set(h.vlans.values_list('id', flat=True))
+            free[h.id] = [h.vcpu_total - h.vcpu_allocated, h.mem_total - h.mem_reserved - h.mem_allocated,
+                          h.vm_limit - h.vm_created]
+
+        placement = {}
+        for vm in sorted(vms, key=lambda v: (v.mem, v.vcpu), reverse=True):
+            candidates = [hid for hid, (vcpu, mem, num) in free.items()
+                          if vcpu >= vm.vcpu and mem >= vm.mem and num >= 1 and vm.mac_ip.vlan_id in host_vlans[hid]]
+            if not candidates:
+                continue
+
+            hid = max(candidates, key=lambda i: (free[i][1], free[i][0]))
+            free[hid][0] -= vm.vcpu
+            free[hid][1] -= vm.mem
+            free[hid][2] -= 1
+            placement[vm.hex_uuid] = hosts[hid]
+
+        return placement
 
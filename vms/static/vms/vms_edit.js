@@ -62,7 +62,7 @@
             contentType: 'application/json',
             success: function (data, status, xhr) {
                 if (xhr.status === 200){
-                    alert('修改成功');
+                    alert(data.live === false ? '修改成功，重启虚拟机后生效' : '修改成功');
                     location.reload();
                 }else{
                     alert("创建失败！" + data.code_text);
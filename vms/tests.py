@@ -1,3 +1,490 @@
-from django.test import TestCase
+import threading
+from datetime import time
+from unittest import mock
+from xml.etree import ElementTree
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+
+from ceph.models import CephCluster, CephPool
+from compute.models import Center, Group, Host
+from image.models import Image, ImageType, VmXmlTemplate
+from network.models import MacIP, NetworkType, Vlan
+from utils.ev_libvirt.virt import SingleFlight, VirtError
+from .manager import CenterMigrateManager, DiskFlattenManager, VmAPI
+from .models import CenterMigrateTask, DiskFlattenTask, Vm
+from .xml import XMLEditor, XMLError, render_xml_template
+
+
+class InTimeWindowsTests(SimpleTestCase):
+    def test_no_windows(self):
+        self.assertTrue(DiskFlattenManager.in_time_windows([], now=time(12, 0)))
+        self.assertTrue(DiskFlattenManager.in_time_windows(None, now=time(12, 0)))
+
+    def test_same_day_window(self):
+        windows = [(time(1, 0), time(6, 0))]
+        self.assertTrue(DiskFlattenManager.in_time_windows(windows, now=time(1, 0)))
+        self.assertTrue(DiskFlattenManager.in_time_windows(windows, now=time(5, 59)))
+        self.assertFalse(DiskFlattenManager.in_time_windows(windows, now=time(6, 0)))
+        self.assertFalse(DiskFlattenManager.in_time_windows(windows, now=time(0, 59)))
+
+    def test_cross_midnight_window(self):
+        windows = [(time(22, 0), time(2, 0))]
+        self.assertTrue(DiskFlattenManager.in_time_windows(windows, now=time(23, 30)))
+        self.assertTrue(DiskFlattenManager.in_time_windows(windows, now=time(0, 0)))
+        self.assertTrue(DiskFlattenManager.in_time_windows(windows, now=time(1, 59)))
+        self.assertFalse(DiskFlattenManager.in_time_windows(windows, now=time(2, 0)))
+        self.assertFalse(DiskFlattenManager.in_time_windows(windows, now=time(12, 0)))
+
+    def test_multiple_windows(self):
+        windows = [(time(1, 0), time(2, 0)), (time(13, 0), time(14, 0))]
+        self.assertTrue(DiskFlattenManager.in_time_windows(windows, now=time(13, 30)))
+        self.assertFalse(DiskFlattenManager.in_time_windows(windows, now=time(3, 0)))
+
+
+class FlattenRunTasksTests(TestCase):
+    def setUp(self):
+        DiskFlattenTask.objects.bulk_create([DiskFlattenTask(disk=f'disk{i}') for i in range(3)])
+        self.manager = DiskFlattenManager()
+        p = mock.patch.object(self.manager, '_run_task', return_value=True)
+        self.run_task = p.start()
+        self.addCleanup(p.stop)
+
+    @mock.patch('vms.manager.time.sleep')
+    def test_window_closed_after_task(self, sleep):
+        with mock.patch.object(DiskFlattenManager, 'in_time_windows', side_effect=[True, False]):
+            self.assertEqual(self.manager.run_tasks(interval=10, windows=[(time(1), time(6))]), (1, 0))
+        self.assertEqual(self.run_task.call_count, 1)
+        sleep.assert_not_called()   # 窗口已结束，不再等待下一个任务
+        self.assertEqual(DiskFlattenTask.objects.filter(status=DiskFlattenTask.STATUS_WAIT).count(), 2)
+
+    @mock.patch('vms.manager.time.sleep')
+    def test_interval(self, sleep):
+        self.assertEqual(self.manager.run_tasks(max_count=2, interval=10), (2, 0))
+        self.assertEqual(sleep.call_args_list, [mock.call(10), mock.call(10)])
+
+
+DOMAIN_XML = """<domain type="kvm" xmlns:qemu="http://libvirt.org/schemas/domain/qemu/1.0">
+  <name>vm</name>
+  <vcpu current="2">8</vcpu>
+  <memory unit="GiB">8</memory>
+  <currentMemory unit="MiB">2048</currentMemory>
+  <devices>
+    <disk type="network" device="disk">
+      <auth username="admin"><secret type="ceph" uuid="u"/></auth>
+      <source protocol="rbd" name="pool/sys"/>
+      <target dev="vda" bus="virtio"/>
+    </disk>
+    <hostdev mode="subsystem" type="pci">
+      <source><address domain="0x0000" bus="0x3b" slot="0x00" function="0x1"/></source>
+    </hostdev>
+  </devices>
+  <qemu:commandline><qemu:arg value="-s"/></qemu:commandline>
+</domain>"""
+
+VDISK_XML = '<disk type="network" device="disk"><source protocol="rbd" name="pool/data"/>' \
+            '<target dev="vdb" bus="virtio"/></disk>'
+
+
+class XMLEditorTests(SimpleTestCase):
+    def test_invalid_xml(self):
+        xml = XMLEditor()
+        self.assertFalse(xml.set_xml('<domain>'))
+        self.assertIsNone(xml.get_root())
+
+    def test_namespace_prefix_kept(self):
+        xml = XMLEditor(DOMAIN_XML)
+        out = xml.to_xml()
+        self.assertIn('<qemu:commandline>', out)
+        self.assertIn('xmlns:qemu="http://libvirt.org/schemas/domain/qemu/1.0"', out)
+        self.assertNotIn('ns0', out)
+        root = ElementTree.fromstring(out)
+        self.assertIsNotNone(root.find('{http://libvirt.org/schemas/domain/qemu/1.0}commandline'))
+
+    def test_namespace_not_registered_globally(self):
+        XMLEditor('<domain xmlns:evtest="urn:evcloud:test"><evtest:a/></domain>')
+        self.assertNotIn('urn:evcloud:test', ElementTree._namespace_map)
+
+    def test_ns_prefix(self):
+        # ns0等前缀不能用ElementTree.register_namespace()注册
+        xml = XMLEditor()
+        self.assertTrue(xml.set_xml('<domain xmlns:ns0="urn:a"><ns0:x/><devices/></domain>'))
+        self.assertEqual(xml.to_xml(), '<domain xmlns:ns0="urn:a"><ns0:x /><devices /></domain>')
+
+    def test_default_namespace_scope(self):
+        xml = XMLEditor('<domain><metadata><a xmlns="urn:a"><b/></a><c/></metadata></domain>')
+        root = ElementTree.fromstring(xml.to_xml())
+        self.assertIsNotNone(root.find('metadata/{urn:a}a/{urn:a}b'))
+        self.assertIsNotNone(root.find('metadata/c'))
+
+    def test_list_disks_and_hostdevs(self):
+        xml = XMLEditor(DOMAIN_XML)
+        self.assertEqual(xml.list_disks(), [
+            {'device': 'disk', 'type': 'network', 'source': 'pool/sys', 'dev': 'vda', 'bus': 'virtio'}])
+        self.assertEqual(xml.list_hostdevs(), [{'domain': 0, 'bus': 0x3b, 'slot': 0, 'function': 1}])
+
+    def test_attach_detach_device(self):
+        xml = XMLEditor(DOMAIN_XML)
+        xml.attach_device(VDISK_XML)
+        xml.attach_device(VDISK_XML.replace('pool/data', 'pool/data2'))    # 同一个dev替换
+        self.assertEqual([d['source'] for d in xml.list_disks()], ['pool/sys', 'pool/data2'])
+
+        self.assertTrue(xml.detach_device(VDISK_XML))
+        self.assertFalse(xml.detach_device(VDISK_XML))
+        self.assertEqual([d['dev'] for d in xml.list_disks()], ['vda'])
+        self.assertTrue(xml.detach_device(
+            '<hostdev mode="subsystem" type="pci"><source>'
+            '<address domain="0" bus="59" slot="0" function="1"/></source></hostdev>'))
+        self.assertEqual(xml.list_hostdevs(), [])
+
+        with self.assertRaises(XMLError):
+            xml.attach_device('<disk>')
+        with self.assertRaises(XMLError):
+            XMLEditor('<domain/>').attach_device(VDISK_XML)
+
+    def test_remove_sys_disk_auth(self):
+        xml = XMLEditor(DOMAIN_XML)
+        self.assertTrue(xml.remove_sys_disk_auth())
+        self.assertFalse(xml.remove_sys_disk_auth())
+        self.assertNotIn('<auth', xml.to_xml())
+
+    def test_enable_disk_discard(self):
+        xml = XMLEditor(DOMAIN_XML)
+        self.assertTrue(xml.enable_disk_discard())
+        self.assertFalse(xml.enable_disk_discard())
+        self.assertEqual(xml.get_root().find('devices/disk/driver').get('discard'), 'unmap')
+
+
+TEMPLATE_XML = """<domain type="kvm">
+  <name>{name}</name>
+  <vcpu current="{vcpu}">{max_vcpu}</vcpu>
+  <memory unit="MiB">{max_mem}</memory>
+  <currentMemory unit="MiB">{mem}</currentMemory>
+  <devices>
+    <disk type="network" device="disk">
+      <auth username="{ceph_username}"><secret type="ceph" uuid="{ceph_uuid}"/></auth>
+      <source protocol="rbd" name="{ceph_pool}/{diskname}">{ceph_hosts_xml}</source>
+      <target dev="vda" bus="virtio"/>
+    </disk>
+  </devices>
+</domain>"""
+
+TEMPLATE_VALUES = {
+    'name': 'vm', 'uuid': 'u', 'vcpu': 2, 'mem': 2048, 'ceph_uuid': 'c', 'ceph_pool': 'p', 'diskname': 'd',
+    'ceph_username': 'admin', 'ceph_hosts_xml': '', 'mac': 'm', 'bridge': 'b'}
+
+
+class RenderXMLTemplateTests(SimpleTestCase):
+    def test_render(self):
+        tpl = VmXmlTemplate(id=-1, xml=TEMPLATE_XML, max_vcpu=8, max_mem=1024)
+        xml = XMLEditor(render_xml_template(tpl, **TEMPLATE_VALUES))
+        self.assertEqual(xml.get_vcpu(), (2, 8))
+        self.assertEqual(xml.get_memory(), (2048, 2048))    # max_mem不小于mem
+        self.assertEqual(xml.list_disks()[0]['source'], 'p/d')
+
+    def test_no_auth(self):
+        tpl = VmXmlTemplate(id=-2, xml=TEMPLATE_XML)
+        self.assertIn('<auth', render_xml_template(tpl, has_auth=True, **TEMPLATE_VALUES))
+        self.assertNotIn('<auth', render_xml_template(tpl, has_auth=False, **TEMPLATE_VALUES))
+
+    def test_recompile_on_xml_change(self):
+        # 只修改xml字段、修改时间不变时也要重新编译
+        tpl = VmXmlTemplate(id=-3, xml=TEMPLATE_XML)
+        self.assertNotIn('discard', render_xml_template(tpl, **TEMPLATE_VALUES))
+        tpl.xml = TEMPLATE_XML.replace('<target dev="vda"', '<driver discard="unmap"/><target dev="vda"')
+        self.assertIn('discard="unmap"', render_xml_template(tpl, **TEMPLATE_VALUES))
+
+    def test_invalid_template(self):
+        with self.assertRaises(XMLError):
+            render_xml_template(VmXmlTemplate(id=-4, xml='<domain>{unknown}<devices/></domain>'))
+        with self.assertRaises(XMLError):
+            render_xml_template(VmXmlTemplate(id=-5, xml='<vm><devices/></vm>'))
+        with self.assertRaises(XMLError):   # 缺少变量的值
+            render_xml_template(VmXmlTemplate(id=-6, xml=TEMPLATE_XML), name='vm')
+
+
+class XMLEditorResizeTests(SimpleTestCase):
+    def test_get_vcpu_memory(self):
+        xml = XMLEditor(DOMAIN_XML)
+        self.assertEqual(xml.get_vcpu(), (2, 8))
+        self.assertEqual(xml.get_memory(), (2048, 8192))
+
+        xml = XMLEditor('<domain><vcpu>4</vcpu><memory>4194304</memory></domain>')
+        self.assertEqual(xml.get_vcpu(), (4, 4))
+        self.assertEqual(xml.get_memory(), (4096, 4096))    # 默认单位KiB
+
+    def test_set_vcpu_within_max(self):
+        xml = XMLEditor(DOMAIN_XML)
+        xml.set_vcpu(6)
+        self.assertEqual(xml.get_vcpu(), (6, 8))
+
+    def test_set_vcpu_over_max(self):
+        xml = XMLEditor(DOMAIN_XML)
+        xml.set_vcpu(16)
+        self.assertEqual(xml.get_vcpu(), (16, 16))
+        self.assertNotIn('current', xml.get_root().find('vcpu').attrib)
+
+    def test_set_vcpu_without_current(self):
+        xml = XMLEditor('<domain><vcpu>4</vcpu></domain>')
+        xml.set_vcpu(2)
+        self.assertEqual(xml.get_vcpu(), (2, 2))
+
+    def test_set_memory_within_max(self):
+        xml = XMLEditor(DOMAIN_XML)
+        xml.set_memory(4096)
+        self.assertEqual(xml.get_memory(), (4096, 8192))
+        self.assertEqual(xml.get_root().find('memory').get('unit'), 'GiB')
+
+    def test_set_memory_over_max(self):
+        xml = XMLEditor(DOMAIN_XML)
+        xml.set_memory(16384)
+        self.assertEqual(xml.get_memory(), (16384, 16384))
+
+    def test_set_memory_without_balloon_range(self):
+        # currentMemory等于memory时不能热调整，都修改
+        xml = XMLEditor('<domain><memory unit="MiB">2048</memory><currentMemory unit="MiB">2048</currentMemory>'
+                        '</domain>')
+        xml.set_memory(1024)
+        self.assertEqual(xml.get_memory(), (1024, 1024))
+
+    def test_invalid_values(self):
+        with self.assertRaises(XMLError):
+            XMLEditor('<domain><vcpu>x</vcpu></domain>').get_vcpu()
+        with self.assertRaises(XMLError):
+            XMLEditor('<domain><memory unit="XiB">1</memory></domain>').get_memory()
+        with self.assertRaises(XMLError):
+            XMLEditor('<domain/>').set_vcpu(1)
+
+
+class ResizeVmDomainTests(SimpleTestCase):
+    def setUp(self):
+        self.api = VmAPI.__new__(VmAPI)
+        self.api._vm_manager = mock.Mock()
+        self.vm = mock.Mock()
+        self.domain = mock.Mock()
+        self.domain.xml_desc.return_value = DOMAIN_XML
+        self.domain.inactive_xml_desc.return_value = DOMAIN_XML
+
+    def cached_xml(self):
+        return XMLEditor(self.vm.set_xml.call_args[0][0])
+
+    def test_live(self):
+        self.assertTrue(self.api._resize_vm_domain(self.vm, self.domain, vcpu=4, mem=4096, running=True))
+        self.domain.set_vcpus.assert_called_once_with(4, live=True)
+        self.domain.set_memory.assert_called_once_with(4096, live=True)
+        self.api._vm_manager.define.assert_not_called()
+        self.assertEqual(self.cached_xml().get_vcpu(), (4, 8))
+
+    def test_memory_failed_rollback_vcpu(self):
+        self.domain.set_memory.side_effect = VirtError('no balloon')
+        self.assertFalse(self.api._resize_vm_domain(self.vm, self.domain, vcpu=4, mem=4096, running=True))
+        self.assertEqual(self.domain.set_vcpus.call_args_list, [mock.call(4, live=True), mock.call(2, live=True)])
+        self.api._vm_manager.define.assert_called_once()
+        self.assertEqual(self.cached_xml().get_vcpu(), (4, 8))
+        self.assertEqual(self.cached_xml().get_memory(), (4096, 8192))
+
+    def test_rollback_failed(self):
+        self.domain.set_memory.side_effect = VirtError('no balloon')
+        self.domain.set_vcpus.side_effect = [None, VirtError('unplug')]
+        with self.assertRaises(VmAPI.VmError):
+            self.api._resize_vm_domain(self.vm, self.domain, vcpu=4, mem=4096, running=True)
+        self.api._vm_manager.define.assert_not_called()
+        self.vm.set_xml.assert_not_called()
+
+
+class SingleFlightTests(SimpleTestCase):
+    def concurrent_do(self, flight, func, count=5):
+        """count个线程同时以相同key调用，func执行中等待所有线程都已调用"""
+        results = []
+        errors = []
+
+        def run():
+            try:
+                results.append(flight.do(key=('status', 'h', 'u'), func=func))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=10)
+        return results, errors
+
+    def wait_shared(self, flight, count):
+        for _ in range(500):
+            if flight.get_stats()['shared'] >= count:
+                return
+            threading.Event().wait(0.01)
+
+    def test_coalesce_result(self):
+        flight = SingleFlight(name='test')
+        executed = []
+
+        def func():
+            executed.append(1)
+            self.wait_shared(flight, 4)
+            return 'running'
+
+        results, errors = self.concurrent_do(flight, func)
+        self.assertEqual(results, ['running'] * 5)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(executed), 1)
+        stats = flight.get_stats()
+        self.assertEqual((stats['calls'], stats['executed'], stats['shared']), (5, 1, 4))
+        self.assertEqual(stats['coalesced_ratio'], 0.8)
+
+    def test_coalesce_error(self):
+        flight = SingleFlight()
+        error = ValueError('libvirt error')
+
+        def func():
+            self.wait_shared(flight, 2)
+            raise error
+
+        results, errors = self.concurrent_do(flight, func, count=3)
+        self.assertEqual(results, [])
+        self.assertEqual(errors, [error] * 3)
+        # 异常不缓存
+        self.assertEqual(flight.do(key=('status', 'h', 'u'), func=lambda: 'ok', ttl=10), 'ok')
+
+    def test_no_ttl(self):
+        flight = SingleFlight()
+        values = iter([1, 2])
+        self.assertEqual(flight.do(key=('k',), func=lambda: next(values)), 1)
+        self.assertEqual(flight.do(key=('k',), func=lambda: next(values)), 2)
+
+    def test_ttl(self):
+        flight = SingleFlight()
+        values = iter([1, 2, 3])
+        self.assertEqual(flight.do(key=('k',), func=lambda: next(values), ttl=10), 1)
+        self.assertEqual(flight.do(key=('k',), func=lambda: next(values), ttl=10), 1)
+        self.assertEqual(flight.do(key=('other',), func=lambda: next(values), ttl=10), 2)
+        self.assertEqual(flight.get_stats()['cached'], 1)
+
+        flight.forget(lambda key: key == ('k',))
+        self.assertEqual(flight.do(key=('k',), func=lambda: next(values), ttl=10), 3)
+
+    def test_ttl_expired(self):
+        flight = SingleFlight()
+        values = iter([1, 2])
+        self.assertEqual(flight.do(key=('k',), func=lambda: next(values), ttl=0.01), 1)
+        threading.Event().wait(0.02)
+        self.assertEqual(flight.do(key=('k',), func=lambda: next(values), ttl=0.01), 2)
+
+    def test_forget_running_call(self):
+        # 执行中的调用被清除后，结果不缓存
+        flight = SingleFlight()
+        values = iter([1, 2])
+
+        def func():
+            flight.forget(lambda key: True)
+            return next(values)
+
+        self.assertEqual(flight.do(key=('k',), func=func, ttl=10), 1)
+        self.assertEqual(flight.do(key=('k',), func=lambda: next(values), ttl=10), 2)
+
+
+class FakeRbd:
+    """
+    记录调用的RbdManager替代对象
+    """
+    def __init__(self, pool_name):
+        self.pool_name = pool_name
+        self.images = {}    # {name: size}
+        self.snaps = set()  # {(image_name, snap)}
+
+    def get_image_meta(self, name):
+        return mock.Mock(size=self.images[name])
+
+    def create_image(self, name, size, data_pool=None, features=None):
+        if name in self.images:
+            return False
+        self.images[name] = size
+        return True
+
+    def remove_image(self, image_name):
+        self.images.pop(image_name, None)
+
+    def create_snap(self, image_name, snap_name):
+        self.snaps.add((image_name, snap_name))
+
+    def remove_snap(self, image_name, snap):
+        self.snaps.discard((image_name, snap))
+
+
+class CenterMigrateRunTaskTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create(username='test')
+        ceph_clusters = []
+        for name in ('src', 'dst'):
+            center = Center.objects.create(name=name, location=name)
+            ceph_clusters.append(CephCluster(name=name, center=center))
+        CephCluster.objects.bulk_create(ceph_clusters)
+        src_ceph, dst_ceph = CephCluster.objects.order_by('id')
+        src_group = Group.objects.create(center=src_ceph.center, name='src')
+        self.dst_group = Group.objects.create(center=dst_ceph.center, name='dst')
+
+        img_type = ImageType.objects.create(name='linux')
+        tpl = VmXmlTemplate.objects.create(name='tpl')
+        src_image = Image.objects.create(name='centos', version='8', type=img_type, xml_tpl=tpl,
+                                         ceph_pool=CephPool.objects.create(pool_name='src_pool', ceph=src_ceph))
+        self.dst_image = Image.objects.create(name='centos', version='8', type=img_type, xml_tpl=tpl,
+                                              ceph_pool=CephPool.objects.create(pool_name='dst_pool', ceph=dst_ceph))
+
+        vlan = Vlan.objects.create(name='v', br='br0', net_type=NetworkType.objects.create(name='n'),
+                                   subnet_ip='10.0.0.0', net_mask='255.255.255.0', gateway='10.0.0.1',
+                                   dns_server='8.8.8.8')
+        host = Host.objects.create(group=src_group, ipv4='10.0.1.1', vcpu_total=8, mem_total=8192, vm_limit=10)
+        mac_ip = MacIP.objects.create(vlan=vlan, mac='c8:00:0a:00:00:02', ipv4='10.0.0.2')
+        self.vm = Vm.objects.create(uuid='a' * 32, name='vm', vcpu=1, mem=1024, disk='a' * 32, image=src_image,
+                                    user=user, host=host, mac_ip=mac_ip, xml='')
+        self.task = CenterMigrateTask.objects.create(
+            vm_uuid=self.vm.uuid, dst_group=self.dst_group, dst_image=self.dst_image, sync_rounds=1,
+            status=CenterMigrateTask.STATUS_RUNNING)
+
+        self.rbds = {'src_pool': FakeRbd('src_pool'), 'dst_pool': FakeRbd('dst_pool')}
+        self.rbds['src_pool'].images[self.vm.disk] = 1024
+        patches = [
+            mock.patch('vms.manager.get_rbd_manager', side_effect=lambda ceph, pool_name: self.rbds[pool_name]),
+            mock.patch.object(CenterMigrateManager, '_shutdown_vm', return_value=False),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def run_task(self):
+        ok = CenterMigrateManager().run_task(task=self.task)
+        self.task.refresh_from_db()
+        self.vm.refresh_from_db()
+        return ok
+
+    def test_ok(self):
+        with mock.patch('vms.manager.sync_image_changes', return_value=512) as sync, \
+                mock.patch.object(CenterMigrateManager, '_switch_vm', return_value='') as switch:
+            self.assertTrue(self.run_task())
+
+        self.assertEqual(sync.call_count, 3)    # 全量复制、增量同步、关机后最后同步
+        switch.assert_called_once()
+        self.assertEqual(self.task.status, CenterMigrateTask.STATUS_OK)
+        self.assertEqual(self.task.copied, 512 * 3)
+        self.assertEqual(self.rbds['dst_pool'].images, {self.vm.disk: 1024})
+        self.assertEqual(self.rbds['src_pool'].snaps, set())   # 同步用的快照已删除
+        self.assertEqual(self.vm.locked_by, '')
+
+    def test_unexpected_error(self):
+        with mock.patch('vms.manager.sync_image_changes', side_effect=RuntimeError('sync error')):
+            self.assertFalse(self.run_task())
+
+        self.assertEqual(self.task.status, CenterMigrateTask.STATUS_FAILED)
+        self.assertEqual(self.task.message, 'sync error')
+        self.assertEqual(self.rbds['dst_pool'].images, {})     # 已创建的目标硬盘已删除
+        self.assertEqual(self.rbds['src_pool'].snaps, set())
+        self.assertEqual(self.vm.locked_by, '')
+
+    def test_vm_locked(self):
+        self.vm.lock('other')
+        self.assertFalse(self.run_task())
+        self.assertEqual(self.task.status, CenterMigrateTask.STATUS_FAILED)
+        self.assertEqual(self.vm.locked_by, 'other')
+        self.assertEqual(self.rbds['dst_pool'].images, {})
@@ -1,9 +1,28 @@
-from xml.dom import minidom
+from string import Formatter
+from xml.etree import ElementTree
+
+
+class XMLError(Exception):
+    '''
+    xml文本无效或缺少需要的节点
+    '''
+    pass
+
 
 class XMLEditor(object):
     '''
     xml文本编辑器
+
+    基于ElementTree，一次解析后可以多次查询和修改，最后调用to_xml()序列化一次
     '''
+    XML_NS = 'http://www.w3.org/XML/1998/namespace'
+
+    def __init__(self, xml_desc: str = None):
+        self._root = None
+        self._namespaces = {}   # {uri: prefix}，xml中声明的命名空间，''为默认命名空间
+        if xml_desc is not None:
+            self.set_xml(xml_desc)
+
     def set_xml(self, xml_desc):
         '''
         设置要处理的xml文本
@@ -12,55 +31,433 @@ class XMLEditor(object):
             True: 成功
             False: 输入的xml文本无效
         '''
+        # 记录xml中声明的命名空间前缀，序列化时保留原前缀（如qemu:commandline），而不是ns0；
+        # 不使用ElementTree.register_namespace()，全局注册会影响其他xml，且ns0等前缀不能注册
+        parser = ElementTree.XMLPullParser(events=('start-ns', 'end'))
+        root = None
+        namespaces = {}
         try:
-            self._dom = minidom.parseString(xml_desc)
+            parser.feed(xml_desc)
+            parser.close()
+            for event, data in parser.read_events():
+                if event == 'end':
+                    root = data
+                else:
+                    prefix, uri = data
+                    if uri not in namespaces:
+                        namespaces[uri] = prefix
         except Exception as e:
+            self._root = None
+            self._namespaces = {}
             return False
-        else:
-            return True
 
-    def get_dom(self):
+        self._root = root
+        self._namespaces = namespaces
+        return root is not None
+
+    def get_root(self):
         '''
-        获取xml的文档对象模型dom
+        获取根节点
         :return:
-            success: minidom.Document()
-            failed: None
+            Element()
+            None
         '''
-        try:
-            return self._dom
-        except:
-            pass
+        return self._root
 
-        return None
+    def to_xml(self):
+        '''
+        序列化为xml文本
 
-    def get_root(self):
+        :return: str
         '''
-        获取根node节点
-        :return:
+        if not self._namespaces:
+            return ElementTree.tostring(self._root, encoding='unicode')
+
+        return ElementTree.tostring(self._prefixed_copy(), encoding='unicode')
+
+    def _prefixed_copy(self):
+        '''
+        复制节点树，{uri}tag格式的命名空间替换为xml中声明的前缀prefix:tag，在根节点声明前缀；
+        默认命名空间在其作用范围的节点上声明；没有声明过的命名空间使用ns0、ns1...前缀
         '''
-        if self._dom:
-            return self._dom.documentElement
-        return None
+        prefixes = {uri: prefix for uri, prefix in self._namespaces.items() if prefix}
+        defaults = {uri for uri, prefix in self._namespaces.items() if not prefix}
+        used = set(prefixes.values())
+        declares = {}     # {prefix: uri}
+
+        def get_prefix(uri):
+            if uri == self.XML_NS:
+                return 'xml'
+            prefix = prefixes.get(uri)
+            if prefix is None:
+                i = 0
+                while f'ns{i}' in used:
+                    i += 1
+                prefix = prefixes[uri] = f'ns{i}'
+                used.add(prefix)
+            declares[prefix] = uri
+            return prefix
+
+        def split(name):
+            if name[:1] != '{':
+                return None, name
+            uri, local = name[1:].split('}', 1)
+            return uri, local
+
+        def copy(node, default_uri):
+            attrib = {}
+            for key, value in node.attrib.items():
+                uri, local = split(key)
+                attrib[local if uri is None else f'{get_prefix(uri)}:{local}'] = value
 
-    def get_node_list(self, tag_path:str):
+            tag = node.tag
+            if isinstance(tag, str):
+                uri, tag = split(tag)
+                if uri in defaults:
+                    if uri != default_uri:
+                        attrib['xmlns'] = default_uri = uri
+                elif uri is not None:
+                    tag = f'{get_prefix(uri)}:{tag}'
+                elif default_uri:
+                    attrib['xmlns'] = default_uri = ''
+
+            new = ElementTree.Element(tag, attrib)
+            new.text = node.text
+            new.tail = node.tail
+            new.extend(copy(child, default_uri) for child in node)
+            return new
+
+        root = copy(self._root, '')
+        root.attrib = {**{f'xmlns:{p}': uri for p, uri in declares.items()}, **root.attrib}
+        return root
+
+    def get_node_list(self, tag_path: str):
         '''
         获取指定节点
 
-        :param tag_path:   格式如：tag_name/tag_name/tag_name
+        :param tag_path:   格式如：tag_name/tag_name/tag_name，相对根节点
         :return:
-            NodeList()  # success
+            [Element()]  # success
             None        # not found
         '''
         tag_path = tag_path.strip('/')
-        tag_names = tag_path.split('/')
-        if len(tag_names) <= 0:
+        if not tag_path:
             return None
 
-        node_list = [self._dom,]
-        for tag in tag_names:
-            p_node = node_list[0]
-            node_list = p_node.getElementsByTagName(tag)
-            if len(node_list) <= 0: # 未找到节点
-                return None
+        nodes = self._root.findall(tag_path)
+        return nodes if nodes else None
+
+    def _get_devices(self):
+        devices = self._root.find('devices')
+        if devices is None:
+            raise XMLError('xml文本无效, 未找到devices节点')
+        return devices
+
+    def _get_vcpu_node(self):
+        node = self._root.find('vcpu')
+        if node is None:
+            raise XMLError('xml文本无效, 未找到vcpu节点')
+        return node
+
+    def get_vcpu(self):
+        '''
+        vcpu数
+
+        :return:
+            (current:int, maximum:int)    # 没有current属性时current等于maximum
+        :raises: XMLError
+        '''
+        node = self._get_vcpu_node()
+        try:
+            maximum = int(node.text)
+            current = int(node.get('current', maximum))
+        except (TypeError, ValueError):
+            raise XMLError('xml文本无效, vcpu节点的值不是整数')
+        return current, maximum
+
+    def set_vcpu(self, vcpu: int):
+        '''
+        修改vcpu节点；模板配置了current属性（可热调整）并且vcpu不超过最大值时只修改current，否则修改最大值
+
+        :raises: XMLError
+        '''
+        node = self._get_vcpu_node()
+        if 'current' in node.attrib and vcpu <= self.get_vcpu()[1]:
+            node.set('current', str(vcpu))
+        else:
+            node.attrib.pop('current', None)
+            node.text = str(vcpu)
+
+    @staticmethod
+    def _memory_mib(node):
+        unit = node.get('unit', 'KiB')
+        scale = {'b': 1 / 1024 ** 2, 'bytes': 1 / 1024 ** 2, 'kib': 1 / 1024, 'k': 1 / 1024, 'kb': 1000 / 1024 ** 2,
+                 'mib': 1, 'm': 1, 'mb': 1000 ** 2 / 1024 ** 2, 'gib': 1024, 'g': 1024, 'gb': 1000 ** 3 / 1024 ** 2}
+        try:
+            return int(int(node.text) * scale[unit.lower()])
+        except (TypeError, ValueError, KeyError):
+            raise XMLError(f'xml文本无效, {node.tag}节点的值或单位无效')
+
+    def get_memory(self):
+        '''
+        内存大小，单位MiB
+
+        :return:
+            (current:int, maximum:int)    # currentMemory和memory节点的值，没有currentMemory节点时current等于maximum
+        :raises: XMLError
+        '''
+        node = self._root.find('memory')
+        if node is None:
+            raise XMLError('xml文本无效, 未找到memory节点')
+        maximum = self._memory_mib(node)
+        node = self._root.find('currentMemory')
+        current = maximum if node is None else self._memory_mib(node)
+        return current, maximum
+
+    def set_memory(self, mem: int):
+        '''
+        修改memory和currentMemory节点，单位MiB；模板配置了大于currentMemory的memory（可balloon热调整）并且mem不超过
+        memory时只修改currentMemory，否则都修改
+
+        :raises: XMLError
+        '''
+        current, maximum = self.get_memory()
+        nodes = [self._root.find('currentMemory')]
+        if not (current < maximum and mem <= maximum):
+            nodes.append(self._root.find('memory'))
+        for node in nodes:
+            if node is not None:
+                node.set('unit', 'MiB')
+                node.text = str(mem)
+
+    def list_disks(self):
+        '''
+        所有硬盘设备
+
+        :return:
+            [{'device': str, 'type': str, 'source': str, 'dev': str, 'bus': str}]  # source为rbd的pool/image或文件路径
+        :raises: XMLError
+        '''
+        disks = []
+        for disk in self._get_devices().findall('disk'):
+            source = disk.find('source')
+            target = disk.find('target')
+            if source is None:
+                src = ''
+            else:
+                src = source.get('name') or source.get('file') or source.get('dev') or ''
+            disks.append({
+                'device': disk.get('device', 'disk'),
+                'type': disk.get('type', ''),
+                'source': src,
+                'dev': target.get('dev', '') if target is not None else '',
+                'bus': target.get('bus', '') if target is not None else '',
+            })
+
+        return disks
+
+    def list_hostdevs(self):
+        '''
+        所有直通的PCI设备
+
+        :return:
+            [{'domain': int, 'bus': int, 'slot': int, 'function': int}]
+        :raises: XMLError
+        '''
+        hostdevs = []
+        for hostdev in self._get_devices().findall('hostdev'):
+            address = hostdev.find('source/address')
+            if hostdev.get('type') != 'pci' or address is None:
+                continue
+            hostdevs.append({k: int(address.get(k, '0'), 0) for k in ('domain', 'bus', 'slot', 'function')})
+
+        return hostdevs
+
+    def remove_sys_disk_auth(self):
+        '''
+        去除第一个硬盘（系统盘）节点的ceph认证auth节点
+
+        :return:
+            True    # 已去除
+            False   # 没有auth节点
+        :raises: XMLError
+        '''
+        disk = self._get_devices().find('disk')
+        if disk is None:
+            raise XMLError('xml文本无效, 未找到devices>disk节点')
+        auth = disk.find('auth')
+        if auth is None:
+            return False
+
+        disk.remove(auth)
+        return True
+
+    @staticmethod
+    def _same_device(a, b):
+        '''
+        两个设备节点是否是同一个设备：硬盘比较target dev，PCI设备比较source address，网卡比较mac
+        '''
+        if a.tag != b.tag:
+            return False
+        if a.tag == 'disk':
+            path, attrs = 'target', ('dev',)
+        elif a.tag == 'hostdev':
+            path, attrs = 'source/address', ('domain', 'bus', 'slot', 'function')
+        elif a.tag == 'interface':
+            path, attrs = 'mac', ('address',)
+        else:
+            return ElementTree.tostring(a) == ElementTree.tostring(b)
+
+        na, nb = a.find(path), b.find(path)
+        if na is None or nb is None:
+            return False
+        if a.tag == 'hostdev':     # 地址可能是0x01或1
+            try:
+                return all(int(na.get(k, '0'), 0) == int(nb.get(k, '0'), 0) for k in attrs)
+            except ValueError:
+                return False
+        return all(na.get(k, '').lower() == nb.get(k, '').lower() for k in attrs)
+
+    def attach_device(self, device_xml: str):
+        '''
+        devices节点中添加设备，已有同一设备时替换
+
+        :param device_xml: 设备xml，如disk、hostdev
+        :raises: XMLError
+        '''
+        try:
+            device = ElementTree.fromstring(device_xml)
+        except ElementTree.ParseError as e:
+            raise XMLError(f'设备xml无效，{str(e)}')
+
+        devices = self._get_devices()
+        for i, node in enumerate(devices):
+            if self._same_device(node, device):
+                devices[i] = device
+                return
+        devices.append(device)
+
+    def detach_device(self, device_xml: str):
+        '''
+        从devices节点中移除设备
+
+        :param device_xml: 设备xml，如disk、hostdev
+        :return:
+            True    # 已移除
+            False   # 没有此设备
+        :raises: XMLError
+        '''
+        try:
+            device = ElementTree.fromstring(device_xml)
+        except ElementTree.ParseError as e:
+            raise XMLError(f'设备xml无效，{str(e)}')
+
+        devices = self._get_devices()
+        for node in devices:
+            if self._same_device(node, device):
+                devices.remove(node)
+                return True
+        return False
+
+    def enable_disk_discard(self):
+        '''
+        所有硬盘的driver节点设置discard='unmap'，没有driver节点的添加
+
+        :return:
+            True    # 有修改
+            False   # 都已开启
+        '''
+        changed = False
+        for disk in self._root.iter('disk'):
+            if disk.get('device') not in (None, '', 'disk'):
+                continue
+
+            driver = disk.find('driver')
+            if driver is None:
+                driver = ElementTree.Element('driver', {'name': 'qemu'})
+                disk.insert(0, driver)
+            if driver.get('discard') != 'unmap':
+                driver.set('discard', 'unmap')
+                changed = True
+
+        return changed
+
+
+# 虚拟机xml模板中可以使用的变量
+XML_TEMPLATE_FIELDS = ('name', 'uuid', 'mem', 'vcpu', 'max_mem', 'max_vcpu', 'ceph_uuid', 'ceph_pool', 'diskname',
+                       'ceph_username', 'ceph_hosts_xml', 'mac', 'bridge')
+_TEMPLATE_SAMPLE_VALUES = {
+    'name': 'c7a5fdbdcdaf9455926ad65c16db1809', 'uuid': 'c7a5fdbdcdaf9455926ad65c16db1809', 'mem': 1024, 'vcpu': 1,
+    'max_mem': 4096, 'max_vcpu': 4,
+    'ceph_uuid': '6d8fc28d-6b5f-4e3a-8c39-0d1f5a4b0c11', 'ceph_pool': 'vm', 'diskname': 'disk',
+    'ceph_username': 'admin', 'ceph_hosts_xml': '<host name="127.0.0.1" port="6789"/>', 'mac': 'c8:00:0a:00:00:01',
+    'bridge': 'br0'
+}
+
+_compiled_templates = {}    # {(模板id, has_auth): (模板xml, render)}
+
+
+def compile_xml_template(xml_tpl: str, has_auth: bool = True):
+    '''
+    编译虚拟机xml模板为渲染函数，检查模板变量和填充后的xml；不需要认证的ceph在编译时去除系统盘的auth节点，
+    渲染时只做一次变量替换
+
+    :param xml_tpl: xml模板文本，变量格式同str.format，如{uuid}
+    :param has_auth: ceph是否需要认证
+    :return:
+        render(**values) -> str
+    :raises: XMLError
+    '''
+    try:
+        fields = {f for _, f, _, _ in Formatter().parse(xml_tpl) if f is not None}
+    except ValueError as e:
+        raise XMLError(f'xml模板格式无效，{str(e)}')
+    unknown = fields.difference(XML_TEMPLATE_FIELDS)
+    if unknown:
+        raise XMLError(f'xml模板中有无效的变量{"、".join(sorted(unknown))}，可用的变量：{"、".join(XML_TEMPLATE_FIELDS)}')
+
+    xml = XMLEditor()
+    if not xml.set_xml(xml_tpl.format_map(_TEMPLATE_SAMPLE_VALUES)):
+        raise XMLError('填充变量后的xml文本无效')
+    if xml.get_root().tag != 'domain':
+        raise XMLError('xml模板根节点不是domain')
+    xml.list_disks()    # 检查devices节点
+
+    if not has_auth:
+        # 变量在xml的属性值或文本中，模板本身可以直接作为xml编辑
+        xml = XMLEditor()
+        if not xml.set_xml(xml_tpl):
+            raise XMLError('xml模板不是有效的xml文本，不能去除系统盘的auth节点')
+        if xml.remove_sys_disk_auth():
+            xml_tpl = xml.to_xml()
+
+    return xml_tpl.format_map
+
+
+def render_xml_template(tpl, has_auth: bool = True, **values):
+    '''
+    渲染虚拟机xml模板，每个进程中模板按id和xml内容只编译一次，只修改了xml字段（修改时间未更新）也会重新编译；
+    max_vcpu、max_mem没有指定时取模板配置的最大值，且不小于vcpu、mem
+
+    :param tpl: 虚拟机xml模板VmXmlTemplate()
+    :param has_auth: ceph是否需要认证
+    :param values: 模板变量的值
+    :return:
+        str
+    :raises: XMLError
+    '''
+    if 'vcpu' in values:
+        values.setdefault('max_vcpu', max(tpl.max_vcpu, values['vcpu']))
+    if 'mem' in values:
+        values.setdefault('max_mem', max(tpl.max_mem, values['mem']))
+
+    key = (tpl.id, has_auth)
+    compiled = _compiled_templates.get(key)
+    if compiled is None or compiled[0] != tpl.xml:
+        compiled = (tpl.xml, compile_xml_template(tpl.xml, has_auth=has_auth))
+        _compiled_templates[key] = compiled
 
-        return node_list
+    try:
+        return compiled[1](values)
+    except KeyError as e:
+        raise XMLError(f'xml模板变量{str(e)}没有值')